@@ -1,22 +1,37 @@
 import datetime
 from glob import glob
-import itertools
 import multiprocessing
 import re
-from typing import List, Text, Tuple
-import pathlib
+import shutil
+import time
+from typing import Any, Dict, List, Optional, Text, Tuple
 import os
 import pandas as pd
 import numpy as np
-import tqdm
 
-from fin_traffic_data.utils import (daterange, compute_daterange_overlap,
-                                    datetimerange)
+from fin_traffic_data.metrics import get_metrics
+from fin_traffic_data.profiling import init_worker_profiling
+from fin_traffic_data.utils import daterange
 
 # Info on TMS data
 _vehicle_categories = [1, 2, 3, 4, 5, 6, 7]
 _directions = [1, 2]
 
+# Edges of the bins of the speed histogram (km/h) and of the length classes
+# (m) of the vehicle statistics, see _aggregate_core. The last bins are open.
+_speed_bins = list(range(0, 160, 10))
+_length_bins = [0.0, 5.6, 12.5, 18.75]
+_speed_histogram_columns = [f'speed_{lo}' for lo in _speed_bins]
+_length_class_columns = [f'length_{lo:g}' for lo in _length_bins]
+_statistics_columns = ['speed_count', 'speed_sum', 'speed_sum_sq'] + _speed_histogram_columns + _length_class_columns
+
+# Version of the counts of the aggregated data. Version 1 counted one extra
+# vehicle in every cell with vehicles and one in every cell of the stations
+# without data, and aligned the time buckets to midnight of the first day
+# with data of a station instead of the beginning of the time range (see
+# _bucket_cells). Results of it are rebuilt instead of extended.
+_counts_version = 2
+
 
 def list_rawdata_files(path: Text):
     """
@@ -34,6 +49,12 @@ def list_rawdata_files(path: Text):
         - begin date of the data in the file
         - end date of the data in the file
     """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.compaction import finish_interrupted_compaction
+
+    # A compaction of the directory that was interrupted is completed first,
+    # so that its files are listed either before or after it
+    finish_interrupted_compaction(path)
     filenames = glob(f"{path}/fin_traffic_raw*.h5")
     files = []
     for f in filenames:
@@ -60,11 +81,16 @@ def check_no_daterange_overlap_in_raw_files(raw_files):
 
     Raises a RuntimeError if there are common dates.
     """
-    for i, f in enumerate(raw_files):
-        for f2 in raw_files[i + 1:]:
-            overlap_dates = compute_daterange_overlap(f[1], f[2], f2[1], f2[2])
-            if len(overlap_dates) != 0:
-                raise RuntimeError(f"Files {f[0]} and {f2[0]} have overlapping dates.")
+    # Sweep over the files in the order of their begin dates: a file overlaps
+    # an earlier one iff it begins before the latest end so far
+    latest = None
+    for f in sorted(raw_files, key=lambda f: (f[1], f[2])):
+        if f[1] >= f[2]:
+            continue
+        if latest is not None and f[1] < latest[2]:
+            raise RuntimeError(f"Files {latest[0]} and {f[0]} have overlapping dates.")
+        if latest is None or f[2] > latest[2]:
+            latest = f
 
 
 def check_all_dates_covered_by_raw_files(raw_files):
@@ -80,9 +106,15 @@ def check_all_dates_covered_by_raw_files(raw_files):
     first_date = min(raw_files, key=lambda f: f[1])[1]
     last_date = max(raw_files, key=lambda f: f[2])[2]
 
-    dates_not_in_files = [
-        date for date in daterange(first_date, last_date) if not any([f[1] <= date < f[2] for f in raw_files])
-    ]
+    # Sweep over the files in the order of their begin dates, collecting the
+    # gaps before the files
+    dates_not_in_files = []
+    covered_until = first_date
+    for f in sorted(raw_files, key=lambda f: (f[1], f[2])):
+        if f[1] > covered_until:
+            dates_not_in_files.extend(daterange(covered_until, f[1]))
+        covered_until = max(covered_until, f[2])
+    dates_not_in_files.extend(daterange(covered_until, last_date))
 
     if len(dates_not_in_files) > 0:
         err_msg = f"Error:\n  Dates\n"
@@ -92,6 +124,12 @@ def check_all_dates_covered_by_raw_files(raw_files):
         raise RuntimeError(err_msg)
 
 
+def get_aggregated_file_path(results_dir, mintime, maxtime, delta_t):
+    """Path to the datafile of the data aggregated between two datetimes with the time resolution"""
+    file_name = f'fi_traffic_aggregated-{mintime}-{maxtime}-{delta_t}.h5'
+    return os.path.join(results_dir, file_name)
+
+
 def _tms_rawdata_dataframe_iterator(tms_num, raw_data_files):
     """Iterator over the dataframe and dates of datafiles for raw data of the corresponding TMS"""
     for fileinfo in raw_data_files:
@@ -104,8 +142,150 @@ def _tms_rawdata_dataframe_iterator(tms_num, raw_data_files):
             ...
 
 
+def _bucket_cells(df, mintime, delta_t, num_times) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Maps the rows of raw data to the cells of the aggregated data, numbered
+    by time bucket, direction and vehicle category in the order of the rows
+    of _aggregate_frame.
+
+    The time buckets [mintime + i * delta_t, mintime + (i + 1) * delta_t)
+    are aligned to the beginning of the time range, whatever the first time
+    with data of the station.
+
+    Returns
+    -------
+    Tuple of the cell of every row and whether the row is in the time range
+    and has a known direction and vehicle category
+    """
+    buckets = ((df['time'] - pd.Timestamp(mintime)) // pd.Timedelta(delta_t)).to_numpy()
+    directions = df['direction'].to_numpy().astype(np.int64) - 1
+    categories = df['vehicle category'].to_numpy().astype(np.int64) - 1
+    valid = ((buckets >= 0) & (buckets < num_times) &
+             (directions >= 0) & (directions < len(_directions)) &
+             (categories >= 0) & (categories < len(_vehicle_categories)))
+    cells = ((buckets * len(_directions) + directions) * len(_vehicle_categories) + categories)
+    return cells, valid
+
+
+def _aggregate_frame(df, mintime, maxtime, delta_t, statistics=False) -> pd.DataFrame:
+    """
+    Aggregates raw data of a TMS station into the time buckets between two
+    datetimes in a single vectorized pass over the rows.
+
+    Rows outside of the time range, or with an unknown direction or vehicle
+    category, are ignored.
+
+    Input
+    -----
+    df: Optional[pandas.DataFrame]
+        The raw data, or None if there is none
+    mintime, maxtime: datetime.datetime
+        Time range
+    delta_t: datetime.timedelta
+        Time resolution
+    statistics: bool
+        Whether to compute the speed and length statistics as well
+
+    Returns
+    -------
+    pandas.DataFrame with one row for each time bucket, direction and vehicle
+    category, and the columns
+        - time
+        - direction
+        - vehicle category
+        - counts
+    and with statistics
+        - speed_count: number of vehicles with a speed
+        - speed_sum, speed_sum_sq: sum of the speeds and of their squares
+        - speed_<lo>: number of vehicles with a speed in [lo, next lo) km/h
+        - length_<lo>: number of vehicles with a length in [lo, next lo) m
+    """
+    num_times = -(-(maxtime - mintime) // delta_t)
+    num_cells = num_times * len(_directions) * len(_vehicle_categories)
+    times = np.array([mintime + i * delta_t for i in range(num_times)], dtype='datetime64[ns]')
+    result = pd.DataFrame({
+        'time': np.repeat(times, len(_directions) * len(_vehicle_categories)),
+        'direction': np.tile(np.repeat(_directions, len(_vehicle_categories)), num_times).astype(np.int64),
+        'vehicle category': np.tile(_vehicle_categories, num_times * len(_directions)).astype(np.int64),
+    })
+    if df is None:
+        # As the counts of stations without data have always been stored
+        result['counts'] = np.zeros(num_cells, dtype=np.int64)
+        if statistics:
+            for column in _statistics_columns:
+                result[column] = np.zeros(num_cells, dtype=np.float64 if column in ['speed_sum', 'speed_sum_sq']
+                                          else np.int64)
+        return result
+
+    cells, valid = _bucket_cells(df, mintime, delta_t, num_times)
+    # Every vehicle is counted once
+    result['counts'] = np.bincount(cells[valid], minlength=num_cells).astype(np.float64)
+    if not statistics:
+        return result
+
+    def histogram(values, bins, columns):
+        has_value = valid & np.isfinite(values) & (values >= bins[0])
+        bin_index = np.searchsorted(bins, values[has_value], side='right') - 1
+        counts = np.bincount(cells[has_value] * len(bins) + bin_index, minlength=num_cells * len(bins))
+        for column, column_counts in zip(columns, counts.reshape(num_cells, len(bins)).T):
+            result[column] = column_counts
+
+    # Raw data fetched before the speeds and lengths were stored has neither
+    speeds = (df['speed'].to_numpy(dtype=np.float64) if 'speed' in df.columns
+              else np.full(df.shape[0], np.nan))
+    lengths = (df['length'].to_numpy(dtype=np.float64) if 'length' in df.columns
+               else np.full(df.shape[0], np.nan))
+    # Missing speeds are stored as negative, see raw_data._missing_speed
+    has_speed = valid & np.isfinite(speeds) & (speeds >= 0)
+    result['speed_count'] = np.bincount(cells[has_speed], minlength=num_cells)
+    result['speed_sum'] = np.bincount(cells[has_speed], weights=speeds[has_speed], minlength=num_cells)
+    result['speed_sum_sq'] = np.bincount(cells[has_speed], weights=speeds[has_speed] ** 2, minlength=num_cells)
+    histogram(speeds, _speed_bins, _speed_histogram_columns)
+    histogram(lengths, _length_bins, _length_class_columns)
+    return result
+
+
+def speed_statistics(df: pd.DataFrame, percentiles=(50, 85)) -> pd.DataFrame:
+    """
+    Mean, standard deviation and percentiles of the speeds of time
+    aggregated data with statistics (see aggregate_datafiles). The data can
+    be summed over rows first, e.g. over the directions or vehicle
+    categories. The percentiles are interpolated linearly within the bins of
+    the speed histogram, and the open last bin is taken to be as wide as the
+    one before it.
+
+    Returns
+    -------
+    pandas.DataFrame with the index of df and the columns mean_speed,
+    std_speed and p<percentile> for each percentile. Rows without speeds
+    are NaN.
+    """
+    count = df['speed_count'].to_numpy(dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = df['speed_sum'].to_numpy() / count
+        variance = df['speed_sum_sq'].to_numpy() / count - mean ** 2
+    result = pd.DataFrame({'mean_speed': mean, 'std_speed': np.sqrt(np.maximum(variance, 0))}, index=df.index)
+
+    edges = np.array(_speed_bins + [2 * _speed_bins[-1] - _speed_bins[-2]], dtype=np.float64)
+    cumulative = np.cumsum(df[_speed_histogram_columns].to_numpy(dtype=np.float64), axis=1)
+    total = cumulative[:, -1]
+    for q in percentiles:
+        target = total * q / 100
+        # First bin whose cumulative count reaches the target
+        i = np.minimum((cumulative < target[:, None]).sum(axis=1), len(_speed_bins) - 1)
+        rows = np.arange(len(i))
+        below = np.where(i > 0, cumulative[rows, np.maximum(i - 1, 0)], 0.0)
+        in_bin = cumulative[rows, i] - below
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(in_bin > 0, (target - below) / in_bin, 0.0)
+        value = edges[i] + fraction * (edges[i + 1] - edges[i])
+        result[f'p{q:g}'] = np.where(total > 0, value, np.nan)
+    return result
+
+
 def _aggregate_core(tms_num, mintime, maxtime, delta_t, raw_data_files,
-                    append_to_file, results_dir) -> pd.DataFrame:
+                    append_to_file, results_dir, extra_frames=None, statistics=False,
+                    result_path=None) -> pd.DataFrame:
     """
     Aggregates all data on the TMS between two datetimes
 
@@ -118,42 +298,36 @@ def _aggregate_core(tms_num, mintime, maxtime, delta_t, raw_data_files,
     raw_data_files: Iterator
         Iterator over the raw datafiles
     append_to_file: Optional[Text]
+    extra_frames: Optional[List[pandas.DataFrame]]
+        Raw data of the TMS that is not (yet) read from the raw datafiles,
+        e.g. just fetched
+    statistics: bool
+        Whether to store the speed and length statistics of the vehicles as
+        well, see _aggregate_frame
+    result_path: Optional[Text]
+        Path to store the aggregated data to instead of the time aggregated
+        datafile in results_dir, e.g. a partial file renamed when all the
+        stations are done
+
+    Returns
+    -------
+    The aggregated data as stored in the results
     """
     # Iterator for the dataframes containing raw data for this particular
     # measuring station
     rawdata_iterator = _tms_rawdata_dataframe_iterator(tms_num, raw_data_files)
 
-    frames = [df for df in rawdata_iterator]
-    nodata = False
-    try:
-        df = pd.concat(frames, ignore_index=True).drop('tms_id', axis=1)
-    except:
-        nodata = True
-    if not nodata:
-        df['counts'] = np.ones(df.shape[0], dtype=int)
-
-        df = df.groupby(
-            [
-                pd.Grouper(key='time', freq=delta_t, closed='left', label='left'),
-                pd.Grouper('direction'),
-                pd.Grouper('vehicle category')
-            ]
-        ).count()
-
-    times = [i[0] for i in datetimerange(mintime, maxtime, delta_t)]
-    empty = pd.DataFrame(
-        np.array(list(itertools.product(times, _directions, _vehicle_categories, [0]))),
-        columns=['time', 'direction', 'vehicle category', 'counts']
-    ).groupby([pd.Grouper('time'), pd.Grouper('direction'),
-               pd.Grouper('vehicle category')]).count()
-    if not nodata:
-        df = empty.add(df).fillna(0).reset_index()
-    else:
-        df = empty.reset_index()
+    frames = [df for df in rawdata_iterator] + list(extra_frames or [])
+    frames = [df for df in frames if df is not None and not df.empty]
+    df = pd.concat(frames, ignore_index=True) if frames else None
+    df = _aggregate_frame(df, mintime, maxtime, delta_t, statistics)
     with lock:
-        file_name = f'fi_traffic_aggregated-{mintime}-{maxtime}-{delta_t}.h5'
-        result_path = os.path.join(results_dir, file_name)
-        df.to_hdf(result_path, key=f'tms_{tms_num}', mode='a')
+        if result_path is None:
+            result_path = get_aggregated_file_path(results_dir, mintime, maxtime, delta_t)
+        # Stored as a table with a queryable time column so that later stages
+        # can read only the rows they need
+        df.to_hdf(result_path, key=f'tms_{tms_num}', mode='a', format='table', data_columns=['time'])
+    return df
 
 
 class AggregationEngine:
@@ -161,7 +335,7 @@ class AggregationEngine:
     """Class for aggregating the raw data in a multiprocessing environment."""
 
     def __init__(self, time0, time_end, delta_t, raw_data_files,
-                 append_to_file, results_dir):
+                 append_to_file, results_dir, statistics=False):
         """
         Input
         -----
@@ -173,6 +347,8 @@ class AggregationEngine:
             Time resolution
         raw_data_files: List
             List of the names of the datafiles for raw traffic data
+        statistics: bool
+            Whether to store the speed and length statistics as well
         """
         self.time0 = time0
         self.time_end = time_end
@@ -180,6 +356,7 @@ class AggregationEngine:
         self.raw_data_files = raw_data_files
         self.append_to_file = append_to_file
         self.results_dir = results_dir
+        self.statistics = statistics
 
     def __call__(self, tms_num):
         """
@@ -189,14 +366,25 @@ class AggregationEngine:
         -----
         tms_num: int
             Number of the TMS station
+
+        Returns
+        -------
+        Tuple of the TMS number and the seconds spent on it
         """
+        time0 = time.perf_counter()
         _aggregate_core(tms_num=tms_num,
                         mintime=self.time0,
                         maxtime=self.time_end,
                         delta_t=self.delta_t,
                         raw_data_files=self.raw_data_files,
                         append_to_file=self.append_to_file,
-                        results_dir=self.results_dir)
+                        results_dir=self.results_dir,
+                        statistics=self.statistics)
+        return tms_num, time.perf_counter() - time0
+
+
+# Lock of the worker processes for writing the datafiles, set by init
+lock: Any
 
 
 def init(arg_lock):
@@ -204,60 +392,46 @@ def init(arg_lock):
     filesaving operations."""
     global lock
     lock = arg_lock
+    init_worker_profiling()
 
 
 def aggregate_datafiles(
         raw_data_files: List[Tuple[Text, datetime.date, datetime.date]],
         all_tms_numbers: List[int],
         delta_t: datetime.timedelta,
-        results_dir: str) -> pd.DataFrame:
+        results_dir: str,
+        statistics: bool = False) -> Text:
+    """
+    Aggregates the raw data of all the TMS stations over the whole date range
+    covered by the raw datafiles.
 
-    # Check if there is an existing aggregated datafile with the same resolution
+    Input
+    -----
+    raw_data_files: List[Tuple[Text, datetime.date, datetime.date]]
+        The raw datafiles with their date ranges
+    all_tms_numbers: List[int]
+        Numbers of the TMS stations to aggregate
+    delta_t: datetime.timedelta
+        Time resolution
+    results_dir: str
+        Directory where the aggregated datafile is stored
+    statistics: bool
+        Whether to store the speed statistics (count, sum, sum of squares
+        and histogram) and the length class counts of the vehicles next to
+        the counts, all computed in the same pass over the raw data. See
+        speed_statistics.
+
+    Returns
+    -------
+    Path to the aggregated datafile
+    """
+    first_date = min(raw_data_files, key=lambda f: f[1])[1]
+    last_date = max(raw_data_files, key=lambda f: f[2])[2]
+    time0 = datetime.datetime(year=first_date.year, month=first_date.month, day=first_date.day, hour=0, minute=0)
+    time_end = datetime.datetime(year=last_date.year, month=last_date.month, day=last_date.day, hour=0, minute=0)
+
+    import tqdm
 
-    try:
-        file_name_glob = 'fin-traffic-%s-*.h5' % (delta_t, )
-        result_path_glob = os.path.join(results_dir, file_name_glob)
-        aggregate_files = glob(result_path_glob)
-
-        def get_daterange(afilename):
-            m = re.match(
-                f"{results_dir}" + r"\/fin-traffic-" + f"{delta_t}" +
-                r"-(?P<begindate>\d{4}-\d{2}-\d{2})(\s00:00:00)?-(?P<enddate>\d{4}-\d{2}-\d{2})(\s00:00:00)?\.h5",
-                afilename
-            )
-            d1 = [int(i) for i in m.group("begindate").split('-')]
-            d2 = [int(i) for i in m.group('enddate').split('-')]
-            return datetime.date(year=d1[0], month=d1[1], day=d1[2]), datetime.date(year=d2[0], month=d2[1], day=d2[2])
-
-        afile_dateranges = [(afile, get_daterange(afile)) for afile in aggregate_files]
-
-        # Filter out those files that do not have even partially overlapping data
-        first_date = min(raw_data_files, key=lambda f: f[1])[1]
-        afile_dateranges = list(filter(lambda s: s[1][0] <= first_date, afile_dateranges))
-
-        last_date = max(raw_data_files, key=lambda f: f[2])[2]
-
-        afile_dateranges = list(filter(lambda s: s[1][0] < last_date, afile_dateranges))
-        afile_to_append = max(afile_dateranges, key=lambda f: f[1][1])
-        afile_firstday = afile_to_append[1][0]
-        afile_lastday = afile_to_append[1][1]
-
-        if last_date <= afile_lastday:
-            print("Data already in a aggregate time")
-            exit(0)
-
-        afile_to_append = afile_to_append[0]
-        time0 = datetime.datetime(
-            year=afile_lastday.year, month=afile_lastday.month, day=afile_lastday.day, hour=0, minute=0
-        )
-        time_end = datetime.datetime(year=last_date.year, month=last_date.month, day=last_date.day, hour=0, minute=0)
-        date_end = datetime.date(year=last_date.year, month=last_date.month, day=last_date.day)
-        new_filename = 'fin-traffic-{delta_t}-{afile_firstday}-{date_end}.h5'
-        result_path = os.path.join(results_dir, new_filename)
-    except Exception:
-        afile_to_append = None
-        time0 = datetime.datetime(year=first_date.year, month=first_date.month, day=first_date.day, hour=0, minute=0)
-        time_end = datetime.datetime(year=last_date.year, month=last_date.month, day=last_date.day, hour=0, minute=0)
     # Iterate over TMSs
     lock = multiprocessing.Lock()  # For locking data saving operations
     pool = multiprocessing.Pool(6, initializer=init, initargs=(lock, ))
@@ -265,10 +439,284 @@ def aggregate_datafiles(
                                time_end=time_end,
                                delta_t=delta_t,
                                raw_data_files=raw_data_files,
-                               append_to_file=afile_to_append,
-                               results_dir=results_dir)
-    for _ in tqdm.tqdm(pool.imap(engine, all_tms_numbers)):
-        pass
-    if afile_to_append:
-        path = pathlib.Path(afile_to_append)
-        path.replace(result_path)
+                               append_to_file=None,
+                               results_dir=results_dir,
+                               statistics=statistics)
+    metrics = get_metrics()
+    for tms_num, seconds in tqdm.tqdm(pool.imap(engine, all_tms_numbers)):
+        metrics.observe_station(tms_num, seconds)
+    pool.close()
+    pool.join()
+
+    result_path = get_aggregated_file_path(results_dir, time0, time_end, delta_t)
+    with pd.HDFStore(result_path, mode='a') as store:
+        _set_counts_version(store)
+    return result_path
+
+
+def get_counts_version(path) -> int:
+    """
+    The version of the counts (see _counts_version) of a time aggregated
+    datafile, the earliest of its stations. Datafiles written before the
+    version was recorded have version 1.
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        return int(min((getattr(store.get_storer(key).attrs, 'counts_version', 1) for key in store.keys()), default=1))
+
+
+def _set_counts_version(store):
+    """Records the version of the counts (see _counts_version) of every station of a time aggregated datafile."""
+    for key in store.keys():
+        store.get_storer(key).attrs.counts_version = _counts_version
+
+
+def _copy_for_extension(path, partial_path, tms_nums, with_data, statistics,
+                        time_end) -> Optional[Tuple[pd.Timestamp, Dict[int, int]]]:
+    """
+    Copies a time aggregated datafile to partial_path to be extended, without
+    the rows of its last time bucket, which may have been partial.
+
+    The datafile is not extended if its counts are of an earlier version, it
+    has other stations or statistics columns than the aggregation, it ends
+    at or after time_end, or the counts of a station have another type than
+    if all the raw data was aggregated at once (a station with its first
+    raw data).
+
+    Returns
+    -------
+    Tuple of the time of the last time bucket and the number of rows left of
+    each station, or None if the datafile cannot be extended
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        if sorted(store.keys()) != sorted(f'/tms_{num}' for num in tms_nums):
+            return None
+        for num in tms_nums:
+            storer = store.get_storer(f'tms_{num}')
+            if getattr(storer.attrs, 'counts_version', 1) != _counts_version or not storer.nrows:
+                return None
+            first_row = store.select(f'tms_{num}', start=0, stop=1)
+            if ('speed_count' in first_row.columns) != statistics or \
+                    first_row['counts'].dtype != (np.float64 if num in with_data else np.int64):
+                return None
+        key = f'tms_{tms_nums[0]}'
+        last_time = store.select(key, start=store.get_storer(key).nrows - 1, columns=['time'])['time'].iloc[-1]
+    if last_time >= time_end:
+        return None
+
+    shutil.copyfile(path, partial_path)
+    rows_left = {}
+    with pd.HDFStore(partial_path, mode='a') as store:
+        for num in tms_nums:
+            store.remove(f'tms_{num}', where='time >= last_time')
+            rows_left[num] = store.get_storer(f'tms_{num}').nrows
+    return last_time, rows_left
+
+
+# Estimated bytes of memory per raw data row while a chunk is aggregated (the
+# row itself and the index arrays of _aggregate_frame), and per cell of the
+# aggregated grid (the output columns and their copies while written)
+_chunk_bytes_per_raw_row = 128
+_chunk_bytes_per_cell = 96
+_chunk_bytes_per_statistics_cell = 96 + 16 * len(_statistics_columns)
+
+
+def _raw_rows_per_day(raw_data_files) -> int:
+    """The largest number of raw data rows of a station per day in the raw datafiles."""
+    rows_per_day = 0
+    for filename, begin_date, end_date in raw_data_files:
+        with pd.HDFStore(filename, mode='r') as store:
+            for key in store.keys():
+                nrows = store.get_storer(key).shape[0]
+                rows_per_day = max(rows_per_day, -(-nrows // max((end_date - begin_date).days, 1)))
+    return rows_per_day
+
+
+def get_chunk_length(raw_data_files, delta_t: datetime.timedelta, memory_limit: int, workers: int = 1,
+                     statistics: bool = False) -> datetime.timedelta:
+    """
+    The longest time chunk (a multiple of the time resolution) whose
+    aggregation by the workers is estimated to fit in memory_limit bytes,
+    from the busiest station of the raw datafiles.
+
+    Raises a RuntimeError if not even a single time bucket fits.
+    """
+    rows_per_second = _raw_rows_per_day(raw_data_files) / 86400
+    cells = len(_directions) * len(_vehicle_categories)
+    cell_bytes = _chunk_bytes_per_statistics_cell if statistics else _chunk_bytes_per_cell
+    bucket_bytes = (rows_per_second * delta_t.total_seconds() * _chunk_bytes_per_raw_row + cells * cell_bytes)
+    buckets = int(memory_limit / workers // bucket_bytes)
+    if buckets < 1:
+        raise RuntimeError(f"A time bucket of {delta_t} is estimated to need {int(bucket_bytes * workers)} bytes "
+                           f"with {workers} workers, more than the memory limit of {memory_limit} bytes.")
+    return buckets * delta_t
+
+
+def _read_raw_data_chunk(tms_num, raw_data_files, t0, t1):
+    """
+    Raw data of a TMS station from the datafiles overlapping [t0, t1), or
+    None if there is none. Only the rows of the days of the range are read
+    from the files with a time index (see fin_traffic_data.compaction).
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.compaction import read_raw_data_range
+
+    frames = []
+    for filename, begin_date, end_date in raw_data_files:
+        if datetime.datetime.combine(end_date, datetime.time()) <= t0 or \
+                datetime.datetime.combine(begin_date, datetime.time()) >= t1:
+            continue
+        df = read_raw_data_range(filename, tms_num, t0, t1)
+        if df is None:
+            with pd.HDFStore(filename, mode='r') as store:
+                key = f'tms_{tms_num}'
+                if key not in store:
+                    continue
+                df = store.select(key)
+            df = df.loc[(df['time'] >= t0) & (df['time'] < t1)]
+        if not df.empty:
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def _station_has_raw_data(raw_data_files) -> set:
+    """Numbers of the TMS stations with rows in any of the raw datafiles."""
+    tms_nums = set()
+    for filename, _, _ in raw_data_files:
+        with pd.HDFStore(filename, mode='r') as store:
+            for key in store.keys():
+                if store.get_storer(key).shape[0] > 0:
+                    tms_nums.add(int(key.rsplit('_', 1)[1]))
+    return tms_nums
+
+
+class ChunkAggregationEngine:
+
+    """Aggregates the raw data of a single TMS station in a time chunk in a worker process."""
+
+    def __init__(self, raw_data_files, delta_t, t0, t1, statistics):
+        self.raw_data_files = raw_data_files
+        self.delta_t = delta_t
+        self.t0 = t0
+        self.t1 = t1
+        self.statistics = statistics
+
+    def __call__(self, tms_num):
+        """
+        Returns
+        -------
+        Tuple of the TMS number, the aggregated data of the chunk (None if
+        the station has no raw data in any of the files) and the seconds spent
+        """
+        time0 = time.perf_counter()
+        df = _read_raw_data_chunk(tms_num, self.raw_data_files, self.t0, self.t1)
+        df = _aggregate_frame(df, self.t0, self.t1, self.delta_t, self.statistics)
+        return tms_num, df, time.perf_counter() - time0
+
+
+def aggregate_datafiles_chunked(
+        raw_data_files: List[Tuple[Text, datetime.date, datetime.date]],
+        all_tms_numbers: List[int],
+        delta_t: datetime.timedelta,
+        results_dir: str,
+        chunk_length: Optional[datetime.timedelta] = None,
+        memory_limit: Optional[int] = None,
+        statistics: bool = False,
+        workers: int = 6,
+        extend_from: Optional[Text] = None) -> Text:
+    """
+    Aggregates the raw data of all the TMS stations like aggregate_datafiles,
+    but one time chunk at a time: the raw data of every station in a chunk is
+    read and aggregated, and the counts are appended to the aggregated
+    datafile before the next chunk. Only the raw data of a chunk is in memory
+    at a time, so ranges of years can be aggregated at fine time
+    resolutions. The result is the same as that of aggregate_datafiles.
+
+    The aggregated datafile is written under a temporary name and renamed
+    when complete.
+
+    Input
+    -----
+    raw_data_files: List[Tuple[Text, datetime.date, datetime.date]]
+        The raw datafiles with their date ranges
+    all_tms_numbers: List[int]
+        Numbers of the TMS stations to aggregate
+    delta_t: datetime.timedelta
+        Time resolution
+    results_dir: str
+        Directory where the aggregated datafile is stored
+    chunk_length: Optional[datetime.timedelta]
+        Length of the time chunks, rounded down to a multiple of the time
+        resolution. 30 days by default.
+    memory_limit: Optional[int]
+        Bytes of memory the workers may use for the raw data and the counts
+        of a chunk. The chunks are shortened to fit in it, see
+        get_chunk_length.
+    statistics: bool
+        Whether to store the speed and length statistics as well
+    workers: int
+        Number of the worker processes
+    extend_from: Optional[Text]
+        Time aggregated datafile with the same begin date and time resolution
+        and an earlier end date, e.g. of the previous run. Its rows are
+        copied and only the time buckets from its last one on are
+        aggregated, the last one again as it may have been partial. If it
+        cannot be extended (see _copy_for_extension), all the data is
+        aggregated.
+
+    Returns
+    -------
+    Path to the aggregated datafile
+    """
+    first_date = min(raw_data_files, key=lambda f: f[1])[1]
+    last_date = max(raw_data_files, key=lambda f: f[2])[2]
+    time0 = datetime.datetime(year=first_date.year, month=first_date.month, day=first_date.day, hour=0, minute=0)
+    time_end = datetime.datetime(year=last_date.year, month=last_date.month, day=last_date.day, hour=0, minute=0)
+
+    chunk_length = chunk_length or datetime.timedelta(days=30)
+    if memory_limit is not None:
+        chunk_length = min(chunk_length, get_chunk_length(raw_data_files, delta_t, memory_limit, workers,
+                                                          statistics))
+    # Chunks of whole time buckets, so that no bucket is split between chunks
+    chunk_length = max(chunk_length // delta_t, 1) * delta_t
+    tms_nums = [int(num) for num in all_tms_numbers]
+    with_data = _station_has_raw_data(raw_data_files)
+
+    import tqdm
+
+    result_path = get_aggregated_file_path(results_dir, time0, time_end, delta_t)
+    partial_path = result_path + '.partial'
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    t0 = time0
+    rows_written = dict((num, 0) for num in tms_nums)
+    if extend_from is not None and os.path.abspath(extend_from) != os.path.abspath(result_path):
+        extension = _copy_for_extension(extend_from, partial_path, tms_nums, with_data, statistics, time_end)
+        if extension is not None:
+            t0, rows_written = extension
+            t0 = t0.to_pydatetime()
+    metrics = get_metrics()
+    pool = multiprocessing.Pool(workers, initializer=init, initargs=(multiprocessing.Lock(), ))
+    try:
+        with pd.HDFStore(partial_path, mode='a') as store:
+            num_chunks = -(-(time_end - t0) // chunk_length)
+            for _ in tqdm.tqdm(range(num_chunks)):
+                t1 = min(t0 + chunk_length, time_end)
+                engine = ChunkAggregationEngine(raw_data_files, delta_t, t0, t1, statistics)
+                for tms_num, df, seconds in pool.imap(engine, tms_nums):
+                    # As stored by _aggregate_core, also for the chunks
+                    # without data of the stations with data
+                    df['counts'] = df['counts'].astype(np.float64 if tms_num in with_data else np.int64)
+                    # The rows are numbered over the whole time range, as if
+                    # stored at once
+                    df.index = pd.RangeIndex(rows_written[tms_num], rows_written[tms_num] + df.shape[0])
+                    rows_written[tms_num] += df.shape[0]
+                    store.append(f'tms_{tms_num}', df, format='table', data_columns=['time'])
+                    metrics.observe_station(tms_num, seconds)
+                t0 = t1
+            _set_counts_version(store)
+    finally:
+        pool.close()
+        pool.join()
+
+    os.replace(partial_path, result_path)
+    return result_path
@@ -0,0 +1,151 @@
+import os
+import json
+import datetime
+from typing import List, Optional, Text, Tuple
+
+import pandas as pd
+
+from fin_traffic_data.utils import daterange
+
+# Version of the format of the statistics file
+_statistics_version = 1
+
+# Number of days in a batch when there is no memory budget or no statistics
+_default_batch_days = 30
+
+# Peak memory of fetching the raw data of a station relative to the size of
+# the returned dataframe: the daily frames, their concatenation and the
+# buffers of writing it to the HDF5 file are alive at the same time.
+_peak_memory_factor = 3
+
+
+class FetchStatistics:
+
+    """
+    Observed number of raw data rows per TMS station and day, used to plan
+    the date spans of the fetch batches.
+
+    For every day the largest number of rows of a single station is
+    recorded, as the stations are fetched one at a time, together with the
+    largest observed in-memory size of a row. The statistics are persisted
+    as 'fetch_statistics.json' in the directory of the raw datafiles.
+    """
+
+    filename = 'fetch_statistics.json'
+
+    def __init__(self, path: Text):
+        """
+        Input
+        -----
+        path: Text
+            Path to the persisted statistics. Loaded if it exists.
+        """
+        self.path = path
+        self.max_station_rows = {}
+        self.bytes_per_row = 0.0
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if data is not None and data.get('version') == _statistics_version:
+            self.bytes_per_row = float(data['bytes_per_row'])
+            self.max_station_rows = dict(
+                (datetime.datetime.strptime(date, '%Y-%m-%d').date(), int(rows))
+                for date, rows in data['max_station_rows'].items()
+            )
+
+    @classmethod
+    def open(cls, raw_data_dir: Text) -> 'FetchStatistics':
+        """Opens the statistics of a directory of raw datafiles."""
+        return cls(os.path.join(raw_data_dir, cls.filename))
+
+    def is_empty(self) -> bool:
+        return not self.max_station_rows
+
+    def record(self, df: Optional[pd.DataFrame]):
+        """Records the rows of the raw data of a single station."""
+        if df is None or df.shape[0] == 0:
+            return
+        rows_per_day = df['time'].dt.date.value_counts()
+        for date, rows in rows_per_day.items():
+            self.max_station_rows[date] = max(self.max_station_rows.get(date, 0), int(rows))
+        self.bytes_per_row = max(self.bytes_per_row, df.memory_usage(index=True, deep=True).sum() / df.shape[0])
+
+    def estimate_rows(self, date: datetime.date) -> int:
+        """
+        Estimates the largest number of rows of a single station on the date.
+        Days without observations are estimated by the largest observation.
+        """
+        rows = self.max_station_rows.get(date)
+        if rows is None:
+            rows = max(self.max_station_rows.values(), default=0)
+        return rows
+
+    def estimate_bytes(self, begin_date: datetime.date, end_date: datetime.date) -> float:
+        """Estimates the peak memory of fetching a station between the dates (end date exclusive)."""
+        rows = sum(self.estimate_rows(date) for date in daterange(begin_date, end_date))
+        return _peak_memory_factor * self.bytes_per_row * rows
+
+    def save(self):
+        """Writes the statistics to disk, replacing the earlier version atomically."""
+        partial_path = self.path + '.partial'
+        with open(partial_path, 'w') as f:
+            json.dump({
+                'version': _statistics_version,
+                'bytes_per_row': self.bytes_per_row,
+                'max_station_rows': dict(
+                    (date.isoformat(), rows) for date, rows in sorted(self.max_station_rows.items())
+                ),
+            }, f)
+        os.replace(partial_path, self.path)
+
+
+def plan_batches(date_intervals: List[Tuple[datetime.date, datetime.date]],
+                 statistics: Optional[FetchStatistics] = None,
+                 max_memory: Optional[int] = None) -> List[Tuple[datetime.date, datetime.date]]:
+    """
+    Splits the date intervals into batches, each fetched into its own raw
+    datafile.
+
+    With a memory budget and recorded statistics, every batch is extended
+    day by day as long as the estimated peak memory of fetching a station
+    stays within the budget. As the estimates are additive over the days,
+    this gives the smallest number of batches (files) under the budget. A
+    day that exceeds the budget alone gets a batch of its own. Otherwise the
+    intervals are split into batches of 30 days.
+
+    Input
+    -----
+    date_intervals: List[Tuple[datetime.date, datetime.date]]
+        Date intervals (end date exclusive)
+    statistics: Optional[FetchStatistics]
+        Observed rows per station and day
+    max_memory: Optional[int]
+        Memory budget in bytes
+
+    Returns
+    -------
+    List of (begin date, end date) of the batches
+    """
+    batches = []
+    for begin_interval, end_interval in date_intervals:
+        if max_memory is None or statistics is None or statistics.is_empty():
+            begin_batch = begin_interval
+            while begin_batch < end_interval:
+                end_batch = min(begin_batch + datetime.timedelta(days=_default_batch_days), end_interval)
+                batches.append((begin_batch, end_batch))
+                begin_batch = end_batch
+            continue
+
+        begin_batch = begin_interval
+        batch_bytes = 0.0
+        for date in daterange(begin_interval, end_interval):
+            day_bytes = statistics.estimate_bytes(date, date + datetime.timedelta(days=1))
+            if date > begin_batch and batch_bytes + day_bytes > max_memory:
+                batches.append((begin_batch, date))
+                begin_batch = date
+                batch_bytes = 0.0
+            batch_bytes += day_bytes
+        batches.append((begin_batch, end_interval))
+    return batches
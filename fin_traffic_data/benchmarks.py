@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import pkgutil
+import datetime
+import subprocess
+import multiprocessing
+from typing import Callable, Dict, List, Optional, Text
+
+from fin_traffic_data.metrics import Metrics
+from fin_traffic_data.synthetic import (
+    generate_lamraw_text, write_raw_data_file, synthetic_tms_nums, _default_seed
+)
+
+# Benchmarks in the order they are run. The later ones read the outputs of
+# the earlier ones.
+_benchmarks = ['import', 'parse', 'aggregate_core', 'aggregate_datafiles', 'area', 'export']
+_prerequisites = {
+    'area': ['aggregate_datafiles'],
+    'export': ['aggregate_datafiles', 'area'],
+}
+
+
+# Dependencies that the console scripts import only when they are used, so
+# that the scripts start fast
+_lazy_dependencies = ['networkx', 'matplotlib', 'requests', 'h5py', 'progressbar', 'tqdm']
+
+
+def get_script_modules() -> List[Text]:
+    """Modules of the console scripts."""
+    # Imported here to keep the startup of the console scripts fast
+    import fin_traffic_data.scripts
+
+    return sorted(f'fin_traffic_data.scripts.{module.name}'
+                  for module in pkgutil.iter_modules(fin_traffic_data.scripts.__path__))
+
+
+def measure_import_time(module: Text) -> Dict:
+    """
+    Imports a module in a new interpreter with -X importtime.
+
+    Returns
+    -------
+    Dict with
+        - 'seconds': cumulative import time of the module
+        - 'lazy_dependencies': the dependencies of _lazy_dependencies that
+          were imported with it
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             capture_output=True, text=True, check=True)
+    cumulative = {}
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        cumulative[fields[2].strip()] = int(fields[1])
+    return {
+        'seconds': cumulative[module] / 1e6,
+        'lazy_dependencies': sorted(name for name in cumulative if name in _lazy_dependencies),
+    }
+
+
+def _git_commit() -> Optional[Text]:
+    """Commit of the working tree of the package, or None outside of a git repository."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkWorkspace:
+
+    """
+    Synthetic inputs of the benchmarks in a working directory: the lamraw
+    payloads and the raw datafile of the stations, and the outputs of the
+    stages run so far.
+    """
+
+    def __init__(self, workdir: Text, num_stations: int = 20, days: int = 7,
+                 vehicles_per_day: float = 10000, time_resolution: datetime.timedelta = datetime.timedelta(hours=1),
+                 area: Text = 'hcd', seed: int = _default_seed,
+                 begin_date: datetime.date = datetime.date(2020, 3, 2)):
+        self.workdir = workdir
+        self.num_stations = num_stations
+        self.days = days
+        self.vehicles_per_day = vehicles_per_day
+        self.time_resolution = time_resolution
+        self.area = area
+        self.seed = seed
+        self.begin_date = begin_date
+        self.end_date = begin_date + datetime.timedelta(days=days)
+        # Raw data is generated for num_stations of the stations over the
+        # borders, and the others are aggregated as stations without data
+        self.all_tms_nums = synthetic_tms_nums(area=area)
+        self.tms_nums = self.all_tms_nums[:num_stations]
+        self.raw_dir = os.path.join(workdir, 'raw_data')
+        self.time_dir = os.path.join(workdir, 'aggregated_data_time')
+        self.area_dir = os.path.join(workdir, 'aggregated_data_area')
+        self.lamraw_texts: List[Text] = []
+        self.raw_data_file: Optional[Text] = None
+        self.time_aggregated_file: Optional[Text] = None
+        self.area_aggregated_file: Optional[Text] = None
+
+    def parameters(self) -> Dict:
+        return {
+            'stations': len(self.tms_nums),
+            'days': self.days,
+            'vehicles_per_day': self.vehicles_per_day,
+            'time_resolution': str(self.time_resolution),
+            'area': self.area,
+            'seed': self.seed,
+        }
+
+    def generate(self):
+        """Generates the lamraw payloads of the first station and the raw datafile of all the stations."""
+        self.lamraw_texts = [
+            generate_lamraw_text(self.tms_nums[0], self.begin_date + datetime.timedelta(days=i),
+                                 self.vehicles_per_day, self.seed)
+            for i in range(self.days)
+        ]
+        self.raw_data_file = write_raw_data_file(self.raw_dir, self.tms_nums, self.begin_date, self.end_date,
+                                                 self.vehicles_per_day, self.seed)
+
+    @property
+    def raw_data_files(self):
+        return [(self.raw_data_file, self.begin_date, self.end_date)]
+
+    @property
+    def time0(self) -> datetime.datetime:
+        return datetime.datetime.combine(self.begin_date, datetime.time())
+
+    @property
+    def time_end(self) -> datetime.datetime:
+        return datetime.datetime.combine(self.end_date, datetime.time())
+
+
+def _bench_import(workspace: BenchmarkWorkspace):
+    modules = get_script_modules()
+    imports = dict((module, measure_import_time(module)) for module in modules)
+    return len(modules), 'imports', {
+        'import_times': dict((module, result['seconds']) for module, result in imports.items()),
+        'lazy_dependencies_imported': dict((module, result['lazy_dependencies'])
+                                           for module, result in imports.items() if result['lazy_dependencies']),
+    }
+
+
+def _bench_parse(workspace: BenchmarkWorkspace):
+    from fin_traffic_data.raw_data import parse_tms_raw_data
+
+    rows = 0
+    for text in workspace.lamraw_texts:
+        df = parse_tms_raw_data(text)
+        if df is not None:
+            rows += len(df)
+    return rows, 'rows'
+
+
+def _bench_aggregate_core(workspace: BenchmarkWorkspace):
+    from fin_traffic_data import aggregation
+    from fin_traffic_data.aggregation import _aggregate_core, get_aggregated_file_path
+
+    aggregation.init(multiprocessing.Lock())
+    result_path = get_aggregated_file_path(workspace.workdir, workspace.time0, workspace.time_end,
+                                           workspace.time_resolution)
+    if os.path.exists(result_path):
+        os.remove(result_path)
+    df = _aggregate_core(tms_num=workspace.tms_nums[0],
+                         mintime=workspace.time0,
+                         maxtime=workspace.time_end,
+                         delta_t=workspace.time_resolution,
+                         raw_data_files=workspace.raw_data_files,
+                         append_to_file=None,
+                         results_dir=workspace.workdir)
+    return int(df['counts'].sum()), 'vehicles'
+
+
+def _bench_aggregate_datafiles(workspace: BenchmarkWorkspace):
+    from fin_traffic_data.aggregation import aggregate_datafiles, get_aggregated_file_path
+
+    result_path = get_aggregated_file_path(workspace.time_dir, workspace.time0, workspace.time_end,
+                                           workspace.time_resolution)
+    if os.path.exists(result_path):
+        os.remove(result_path)
+    os.makedirs(workspace.time_dir, exist_ok=True)
+    workspace.time_aggregated_file = aggregate_datafiles(raw_data_files=workspace.raw_data_files,
+                                                         all_tms_numbers=workspace.all_tms_nums,
+                                                         delta_t=workspace.time_resolution,
+                                                         results_dir=workspace.time_dir)
+    return len(workspace.all_tms_nums), 'stations'
+
+
+def _bench_area(workspace: BenchmarkWorkspace):
+    from fin_traffic_data.scripts.get_aggregated_traffic_between_areas import (
+        get_aggregated_traffic_between_areas, get_area_aggregated_file_path, get_tms_over_area_borders
+    )
+
+    result_path = get_area_aggregated_file_path(workspace.area_dir, workspace.area, workspace.time_aggregated_file)
+    if os.path.exists(result_path):
+        os.remove(result_path)
+    workspace.area_aggregated_file = get_aggregated_traffic_between_areas(
+        inputfile=workspace.time_aggregated_file,
+        area=workspace.area,
+        visualization_enabled=False,
+        results_dir=workspace.area_dir)
+    return len(get_tms_over_area_borders(workspace.area)), 'edges'
+
+
+def _bench_export(workspace: BenchmarkWorkspace):
+    from fin_traffic_data.scripts.export_area_data_as_csv import export_area_data_as_csv, get_csv_archive_path
+
+    archive_path = get_csv_archive_path(workspace.area_aggregated_file, 'bz2')
+    for path in [archive_path, archive_path + '.index.json']:
+        if os.path.exists(path):
+            os.remove(path)
+    export_area_data_as_csv(workspace.area_aggregated_file, codec='bz2')
+    return os.path.getsize(archive_path), 'written bytes'
+
+
+_benchmark_functions: Dict[Text, Callable] = {
+    'import': _bench_import,
+    'parse': _bench_parse,
+    'aggregate_core': _bench_aggregate_core,
+    'aggregate_datafiles': _bench_aggregate_datafiles,
+    'area': _bench_area,
+    'export': _bench_export,
+}
+
+
+def run_benchmarks(workspace: BenchmarkWorkspace, names: Optional[List[Text]] = None,
+                   repeat: int = 3) -> List[Dict]:
+    """
+    Runs the benchmarks on the synthetic data of the workspace.
+
+    Every benchmark is run repeat times. Its throughput is computed from the
+    fastest run, and the peak resident set size is the largest of the runs
+    (including the worker processes). The import benchmark imports every
+    console script in a new interpreter and also reports the import time of
+    each (of the last run) and the lazily imported dependencies it imported.
+
+    Input
+    -----
+    workspace: BenchmarkWorkspace
+    names: Optional[List[Text]]
+        Benchmarks to run, by default all. The benchmarks whose inputs are
+        the outputs of the selected ones are run once untimed first.
+    repeat: int
+        Number of timed runs of every benchmark
+
+    Returns
+    -------
+    List of the results as dicts
+    """
+    names = list(names or _benchmarks)
+    unknown = set(names) - set(_benchmarks)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {sorted(unknown)}")
+    workspace.generate()
+    commit = _git_commit()
+    results = []
+    untimed = set(prerequisite for name in names for prerequisite in _prerequisites.get(name, [])) - set(names)
+    for name in _benchmarks:
+        if name in untimed:
+            _benchmark_functions[name](workspace)
+        if name not in names:
+            continue
+        metrics = Metrics()
+        wall_times = []
+        cpu_times = []
+        peak_rss = 0
+        for _ in range(repeat):
+            with metrics.stage(name) as stage:
+                items, unit, *details = _benchmark_functions[name](workspace)
+            wall_times.append(stage.wall_time)
+            cpu_times.append(stage.cpu_time)
+            peak_rss = max(peak_rss, stage.peak_rss)
+        # Over the lifetime of the process, so it includes the earlier benchmarks
+        children_peak_rss = stage.children_peak_rss
+        results.append({
+            'type': 'benchmark',
+            'benchmark': name,
+            'commit': commit,
+            'started': datetime.datetime.now().isoformat(),
+            'parameters': workspace.parameters(),
+            'wall_time': min(wall_times),
+            'wall_times': wall_times,
+            'cpu_time': min(cpu_times),
+            'peak_rss': peak_rss,
+            'children_peak_rss': children_peak_rss,
+            'items': items,
+            'throughput': items / max(min(wall_times), 1e-9),
+            'unit': f'{unit}/s',
+        })
+        for detail in details:
+            results[-1].update(detail)
+    return results
+
+
+def read_benchmark_results(path: Text) -> List[Dict]:
+    """Reads the results appended to a JSON lines file, or an empty list if there is none."""
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_benchmark_results(results: List[Dict], path: Text):
+    """Appends results to a JSON lines file, keeping the results of earlier commits."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+
+
+def compare_benchmark_results(results: List[Dict], earlier: List[Dict]) -> List[Text]:
+    """
+    Lines comparing the results with the latest earlier result of the same
+    benchmark, parameters and unit from another commit.
+    """
+    lines = []
+    for result in results:
+        previous = [r for r in earlier
+                    if r['benchmark'] == result['benchmark'] and r['parameters'] == result['parameters']
+                    and r['unit'] == result['unit']
+                    and (r['commit'] != result['commit'] or result['commit'] is None)]
+        line = (f"{result['benchmark']:<20} {result['throughput']:>14.1f} {result['unit']:<12} "
+                f"wall {result['wall_time']:8.3f} s  peak RSS {result['peak_rss'] // 2**20:6d} MB")
+        if previous:
+            base = previous[-1]
+            line += (f"  throughput {100 * (result['throughput'] / base['throughput'] - 1):+.1f}%"
+                     f", peak RSS {100 * (result['peak_rss'] / max(base['peak_rss'], 1) - 1):+.1f}%"
+                     f" vs {base['commit']}")
+        lines.append(line)
+    return lines
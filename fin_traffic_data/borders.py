@@ -0,0 +1,200 @@
+import os
+import pathlib
+from typing import Dict, Optional, Text
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.metadata import get_tms_stations, get_province_info, _read_packaged_csv
+from fin_traffic_data.registry import UNKNOWN, DenseLookup, get_station_registry
+
+# Mean radius of the Earth in kilometres
+_earth_radius_km = 6371.0088
+
+_areas = ['province', 'erva', 'hcd']
+
+
+def get_border_table_file_name(area: Text) -> Text:
+    """Name of the file of the TMS stations over the borders of the areas of the aggregation level"""
+    return f'tms_over_{area}_borders.csv'
+
+
+class StationIndex:
+
+    """
+    KD-tree of the coordinates of the TMS stations for nearest station and
+    within-radius queries in O(log n).
+
+    The stations are indexed as points on the unit sphere. The straight-line
+    (chord) distance between two points grows with the great-circle distance
+    between them, so the tree finds the same stations as a search by
+    great-circle distance. The distances are great-circle distances on a
+    sphere of the mean radius of the Earth, within 0.5 % of the distances on
+    the ellipsoid.
+    """
+
+    def __init__(self, tms_stations: Optional[pd.DataFrame] = None):
+        """
+        Input
+        -----
+        tms_stations: Optional[pandas.DataFrame]
+            Station metadata, by default get_tms_stations()
+        """
+        # Imported here to keep the startup of the console scripts fast
+        from scipy.spatial import cKDTree
+
+        if tms_stations is None:
+            tms_stations = get_tms_stations()
+        self.tms_nums = np.asarray(tms_stations['num'], dtype=int)
+        # The station metadata stores the x-coordinate (longitude) in the
+        # column 'latitude' and the y-coordinate in 'longitude'
+        lon = np.asarray(tms_stations['latitude'], dtype=float)
+        lat = np.asarray(tms_stations['longitude'], dtype=float)
+        self.tree = cKDTree(self._project(lon, lat))
+
+    @staticmethod
+    def _project(lon, lat) -> np.ndarray:
+        """Earth-centered coordinates of the points on the unit sphere."""
+        lon = np.radians(np.asarray(lon, dtype=float))
+        lat = np.radians(np.asarray(lat, dtype=float))
+        return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+    @staticmethod
+    def _great_circle_km(chord) -> np.ndarray:
+        return 2 * _earth_radius_km * np.arcsin(np.minimum(np.asarray(chord) / 2, 1.0))
+
+    def nearest(self, lon, lat, k: int = 1):
+        """
+        The k nearest TMS stations of the points.
+
+        Returns
+        -------
+        Tuple of the numbers of the stations and their distances in
+        kilometres, with the shape of the points (and an extra last axis of
+        length k if k > 1)
+        """
+        chords, index = self.tree.query(self._project(lon, lat), k=k)
+        return self.tms_nums[index], self._great_circle_km(chords)
+
+    def within_radius(self, lon: float, lat: float, radius_km: float) -> np.ndarray:
+        """Numbers of the TMS stations within the radius in kilometres of the point."""
+        chord = 2 * np.sin(min(radius_km / (2 * _earth_radius_km), np.pi / 2))
+        index = self.tree.query_ball_point(self._project(lon, lat), r=chord)
+        return np.sort(self.tms_nums[np.asarray(index, dtype=int)])
+
+
+def border_station_directions(tms_stations: pd.DataFrame, area_of_municipality) -> pd.DataFrame:
+    """
+    The directions of the TMS stations over the borders of areas.
+
+    Traffic in direction 1 of a station heads to its dir1 municipality and
+    traffic in direction 2 to its dir2 municipality. A station measures
+    traffic between two areas when the municipalities are in different
+    areas. Stations with a municipality without an area are left out.
+
+    Input
+    -----
+    tms_stations: pandas.DataFrame
+        Station metadata as returned by get_tms_stations
+    area_of_municipality: Callable
+        Maps an array of municipality codes to an array of area names, None
+        for municipalities without an area
+
+    Returns
+    -------
+    pandas.DataFrame with the columns source, destination, tms (the TMS
+    number) and direction
+    """
+    tms_nums = np.asarray(tms_stations['num'], dtype=int)
+    dir1 = pd.to_numeric(tms_stations['dir1'], errors='coerce').fillna(UNKNOWN).to_numpy(dtype=int)
+    dir2 = pd.to_numeric(tms_stations['dir2'], errors='coerce').fillna(UNKNOWN).to_numpy(dtype=int)
+    # Both directions of every station at once: direction 1 from dir2 to
+    # dir1 and direction 2 from dir1 to dir2
+    df = pd.DataFrame({
+        'source': area_of_municipality(np.concatenate([dir2, dir1])),
+        'destination': area_of_municipality(np.concatenate([dir1, dir2])),
+        'tms': np.concatenate([tms_nums, tms_nums]),
+        'direction': np.repeat([1, 2], tms_nums.size),
+    })
+    df = df.loc[df['source'].notna() & df['destination'].notna() & (df['source'] != df['destination'])]
+    return df.reset_index(drop=True)
+
+
+def _packaged_foreign_border_directions(area: Text, foreign_areas, tms_nums) -> pd.DataFrame:
+    """
+    The directions of the TMS stations over the borders to the foreign areas
+    in the packaged border table of the aggregation level, for the stations
+    in tms_nums. The municipalities abroad have no codes in
+    municipality_info.csv, so these borders cannot be derived from the
+    station metadata.
+
+    Returns
+    -------
+    pandas.DataFrame with the columns of border_station_directions
+    """
+    packaged = _read_packaged_csv(get_border_table_file_name(area))
+    packaged = packaged.loc[packaged['source'].isin(foreign_areas) | packaged['destination'].isin(foreign_areas)]
+    rows = [(row['source'], row['destination'], int(tms), int(direction))
+            for _, row in packaged.iterrows()
+            for tms, direction in (v.split(',') for v in row['tms'].split(';'))]
+    df = pd.DataFrame(rows, columns=['source', 'destination', 'tms', 'direction'])
+    return df.loc[df['tms'].isin(tms_nums)].reset_index(drop=True)
+
+
+def build_border_tables(tms_stations: Optional[pd.DataFrame] = None) -> Dict[Text, pd.DataFrame]:
+    """
+    Builds the tables of the TMS stations over the borders of the provinces,
+    ERVAs and HCDs from the municipalities in the two directions of the
+    stations (see border_station_directions). The borders to Norway, Sweden
+    and Russia are kept from the packaged tables for the stations in the
+    metadata.
+
+    Input
+    -----
+    tms_stations: Optional[pandas.DataFrame]
+        Station metadata, by default get_tms_stations()
+
+    Returns
+    -------
+    Dictionary from the aggregation level to a table with the columns
+    source, destination and tms as in the packaged tms_over_*_borders.csv
+    """
+    if tms_stations is None:
+        tms_stations = get_tms_stations()
+    registry = get_station_registry(tms_stations)
+    province_info = get_province_info()
+    province_name = DenseLookup(province_info.index, province_info['province'], fill=None)
+    # The countries have negative province numbers
+    foreign = province_info.loc[province_info.index < 0]
+    foreign_areas = {'province': set(foreign['province']), 'erva': set(foreign['erva']), 'hcd': set()}
+    tms_nums = np.asarray(tms_stations['num'], dtype=int)
+
+    area_of_municipality = {
+        'province': lambda m: province_name[registry.municipality_province[m]],
+        'erva': registry.municipality_erva,
+        'hcd': registry.municipality_hcd,
+    }
+    tables = {}
+    for area in _areas:
+        df = pd.concat([border_station_directions(tms_stations, area_of_municipality[area]),
+                        _packaged_foreign_border_directions(area, foreign_areas[area], tms_nums)],
+                       ignore_index=True).drop_duplicates()
+        df['tms'] = df['tms'].astype(str) + ',' + df['direction'].astype(str)
+        tables[area] = df.groupby(['source', 'destination'], sort=True)['tms'].agg(';'.join).reset_index()
+    return tables
+
+
+def write_border_tables(results_dir: Text, tms_stations: Optional[pd.DataFrame] = None) -> Dict[Text, Text]:
+    """
+    Builds the border tables and writes them into the directory.
+
+    Returns
+    -------
+    Dictionary from the aggregation level to the path of its table
+    """
+    pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+    paths = {}
+    for area, df in build_border_tables(tms_stations).items():
+        paths[area] = os.path.join(results_dir, get_border_table_file_name(area))
+        df.to_csv(paths[area], index=False)
+    return paths
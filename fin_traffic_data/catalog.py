@@ -0,0 +1,336 @@
+import datetime
+import hashlib
+import os
+import re
+import sqlite3
+import urllib.parse
+from glob import glob
+from typing import Iterable, List, Optional, Text, Tuple
+
+# Kinds of datafiles produced by the pipeline
+_kinds = ['raw', 'time', 'area', 'export']
+
+_timestamp_pattern = r"(?P<{}>\d{{4}}-\d{{2}}-\d{{2}}) \d{{2}}:\d{{2}}:\d{{2}}"
+_time_aggregated_pattern = (
+    r"fi_traffic_aggregated-" + _timestamp_pattern.format('begin_date') + "-" +
+    _timestamp_pattern.format('end_date') + r"-(?P<resolution>[0-9a-z ,:]+)"
+)
+_filename_patterns = {
+    'raw': re.compile(
+        r"fin_traffic_raw_(?P<begin_date>\d{4}-\d{1,2}-\d{1,2})_(?P<end_date>\d{4}-\d{1,2}-\d{1,2})\.h5$"
+    ),
+    'time': re.compile(_time_aggregated_pattern + r"\.h5$"),
+    'area': re.compile(r"tms_between_(?P<level>[a-z]+)s_input_" + _time_aggregated_pattern + r"\.h5$"),
+    'export': re.compile(
+        r"tms_between_(?P<level>[a-z]+)s_input_" + _time_aggregated_pattern +
+        r"\.(tar\.(bz2|gz|xz|zst)|parquet|arrow)$"
+    ),
+}
+
+
+def _parse_timedelta(x: Text) -> datetime.timedelta:
+    """Parses the output of str(datetime.timedelta), e.g. '1 day, 0:00:00'."""
+    m = re.match(r"((?P<days>-?\d+) days?, )?(?P<hours>\d+):(?P<minutes>\d{2}):(?P<seconds>\d{2})$", x)
+    if not m:
+        raise ValueError(f"Invalid time resolution '{x}'")
+    return datetime.timedelta(days=int(m.group('days') or 0),
+                              hours=int(m.group('hours')),
+                              minutes=int(m.group('minutes')),
+                              seconds=int(m.group('seconds')))
+
+
+def _parse_date(x: Text) -> datetime.date:
+    return datetime.datetime.strptime(x, "%Y-%m-%d").date()
+
+
+def compute_checksum(path: Text) -> Text:
+    """SHA-256 checksum of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(2**20)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class DatasetCatalog:
+
+    """
+    Persistent catalog of the raw, time aggregated, area aggregated and
+    exported datafiles of the pipeline.
+
+    Every datafile is recorded with its date range, time resolution,
+    aggregation level and checksum in an SQLite database, and the lookups
+    are answered from its index instead of listing directories and parsing
+    filenames. The lookups return only the datafiles that exist, and the
+    records of the others are removed unless the catalog is opened read-only.
+    """
+
+    def __init__(self, path: Text, read_only: bool = False):
+        """
+        Input
+        -----
+        path: Text
+            Path to the SQLite database. It is created if it does not exist.
+        read_only: bool
+            Whether to open an existing catalog for lookups only. The
+            catalog is then never written, so the readers do not contend
+            for the write lock with the pipeline.
+        """
+        self.path = path
+        self.read_only = read_only
+        if read_only:
+            self.connection = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro', uri=True)
+            return
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS datasets ("
+                " path TEXT PRIMARY KEY,"
+                " kind TEXT NOT NULL,"
+                " begin_date TEXT NOT NULL,"
+                " end_date TEXT NOT NULL,"
+                " resolution INTEGER,"
+                " level TEXT,"
+                " checksum TEXT,"
+                " registered TEXT NOT NULL,"
+                " size INTEGER,"
+                " mtime REAL)"
+            )
+            # Catalogs created before the size and modification time of the
+            # files were recorded
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(datasets)")]
+            for column, column_type in [('size', 'INTEGER'), ('mtime', 'REAL')]:
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE datasets ADD COLUMN {column} {column_type}")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS datasets_lookup"
+                " ON datasets (kind, level, resolution, begin_date, end_date)"
+            )
+            # For the date range of a kind and the records ending after a date
+            self.connection.execute("CREATE INDEX IF NOT EXISTS datasets_begin ON datasets (kind, begin_date)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS datasets_end ON datasets (kind, end_date)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _resolution_seconds(resolution: Optional[datetime.timedelta]) -> Optional[int]:
+        return None if resolution is None else int(resolution.total_seconds())
+
+    def _forget(self, paths: List[Text]):
+        """
+        Removes the records of datafiles that no longer exist, e.g. raw
+        datafiles merged by a compaction without the catalog, from a
+        writable catalog.
+        """
+        if paths and not self.read_only:
+            with self.connection:
+                self.connection.executemany("DELETE FROM datasets WHERE path = ?", [(path, ) for path in paths])
+
+    def _existing(self, paths: List[Text]) -> List[Text]:
+        """The paths whose datafiles exist, in the same order."""
+        missing = set(path for path in paths if not os.path.exists(path))
+        self._forget(list(missing))
+        return [path for path in paths if path not in missing]
+
+    def _first_existing(self, rows: Iterable[Tuple[Text]]) -> Optional[Text]:
+        """
+        The path of the first row whose datafile exists. The rows are read
+        and checked only up to it.
+        """
+        missing = []
+        found = None
+        for path, in rows:
+            if os.path.exists(path):
+                found = path
+                break
+            missing.append(path)
+        self._forget(missing)
+        return found
+
+    def is_empty(self) -> bool:
+        return self.connection.execute("SELECT 1 FROM datasets LIMIT 1").fetchone() is None
+
+    def register(self,
+                 kind: Text,
+                 path: Text,
+                 begin_date: datetime.date,
+                 end_date: datetime.date,
+                 resolution: Optional[datetime.timedelta] = None,
+                 level: Optional[Text] = None,
+                 checksum: Optional[Text] = None):
+        """
+        Records a datafile in the catalog, replacing an earlier record of the same path.
+
+        Input
+        -----
+        kind: Text
+            One of 'raw', 'time', 'area' or 'export'
+        path: Text
+            Path to the datafile
+        begin_date: datetime.date
+            First date of the data
+        end_date: datetime.date
+            Last date of the data (exclusive)
+        resolution: Optional[datetime.timedelta]
+            Time resolution of aggregated data
+        level: Optional[Text]
+            Area aggregation level ('province', 'erva' or 'hcd')
+        checksum: Optional[Text]
+            SHA-256 checksum of the file. If not given, the checksum of an
+            earlier record of the file is kept if the size and modification
+            time of the file are the same, and otherwise it is computed.
+        """
+        if kind not in _kinds:
+            raise ValueError(f"Unknown kind of datafile '{kind}'")
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if checksum is None:
+            row = self.connection.execute(
+                "SELECT checksum FROM datasets WHERE path = ? AND size = ? AND mtime = ?",
+                (path, stat.st_size, stat.st_mtime)
+            ).fetchone()
+            checksum = compute_checksum(path) if row is None or row[0] is None else row[0]
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO datasets"
+                " (path, kind, begin_date, end_date, resolution, level, checksum, registered, size, mtime)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, kind, begin_date.isoformat(), end_date.isoformat(), self._resolution_seconds(resolution),
+                 level, checksum, datetime.datetime.now().isoformat(), stat.st_size, stat.st_mtime)
+            )
+
+    def remove(self, path: Text):
+        """Removes the record of a datafile from the catalog."""
+        with self.connection:
+            self.connection.execute("DELETE FROM datasets WHERE path = ?", (os.path.abspath(path), ))
+
+    def remove_ending_after(self, kind: Text, date: datetime.date) -> List[Text]:
+        """
+        Removes the records of the datafiles of a kind with data on or after
+        the date. Returns the paths of the removed records.
+        """
+        with self.connection:
+            paths = [row[0] for row in self.connection.execute(
+                "SELECT path FROM datasets WHERE kind = ? AND end_date > ?", (kind, date.isoformat())
+            )]
+            self.connection.execute(
+                "DELETE FROM datasets WHERE kind = ? AND end_date > ?", (kind, date.isoformat())
+            )
+        return paths
+
+    def list(self,
+             kind: Text,
+             resolution: Optional[datetime.timedelta] = None,
+             level: Optional[Text] = None,
+             begin_date: Optional[datetime.date] = None,
+             end_date: Optional[datetime.date] = None) -> List[Tuple[Text, datetime.date, datetime.date]]:
+        """
+        Lists the datafiles of a kind, or only those with data between
+        begin_date and end_date (exclusive) if they are given.
+
+        Returns
+        -------
+        List of tuples (filename, begin date, end date) sorted by the begin date
+        """
+        query = "SELECT path, begin_date, end_date FROM datasets WHERE kind = ? AND level IS ? AND resolution IS ?"
+        parameters: List = [kind, level, self._resolution_seconds(resolution)]
+        if end_date is not None:
+            query += " AND begin_date < ?"
+            parameters.append(end_date.isoformat())
+        if begin_date is not None:
+            query += " AND end_date > ?"
+            parameters.append(begin_date.isoformat())
+        rows = self.connection.execute(query + " ORDER BY begin_date, end_date", parameters).fetchall()
+        existing = set(self._existing([path for path, _, _ in rows]))
+        return [(path, _parse_date(begin), _parse_date(end)) for path, begin, end in rows if path in existing]
+
+    def find(self,
+             kind: Text,
+             begin_date: datetime.date,
+             end_date: datetime.date,
+             resolution: Optional[datetime.timedelta] = None,
+             level: Optional[Text] = None,
+             suffix: Text = '') -> Optional[Text]:
+        """Returns the datafile of a kind with exactly the given date range (and filename suffix), or None."""
+        rows = self.connection.execute(
+            "SELECT path FROM datasets WHERE kind = ? AND level IS ? AND resolution IS ?"
+            " AND begin_date = ? AND end_date = ? AND path LIKE ? ORDER BY path",
+            (kind, level, self._resolution_seconds(resolution), begin_date.isoformat(), end_date.isoformat(),
+             '%' + suffix)
+        )
+        return self._first_existing(rows)
+
+    def find_latest(self,
+                    kind: Text,
+                    begin_date: datetime.date,
+                    before: datetime.date,
+                    resolution: Optional[datetime.timedelta] = None,
+                    level: Optional[Text] = None) -> Optional[Text]:
+        """Returns the datafile of a kind with the given begin date and the latest end date before `before`."""
+        rows = self.connection.execute(
+            "SELECT path FROM datasets WHERE kind = ? AND level IS ? AND resolution IS ?"
+            " AND begin_date = ? AND end_date < ? ORDER BY end_date DESC, path",
+            (kind, level, self._resolution_seconds(resolution), begin_date.isoformat(), before.isoformat())
+        )
+        return self._first_existing(rows)
+
+    def date_range(self, kind: Text) -> Optional[Tuple[datetime.date, datetime.date]]:
+        """Returns the earliest begin date and the latest end date of the datafiles of a kind, or None."""
+        # Only the datafiles at the ends of the range are checked to exist.
+        # The missing ones are excluded in a read-only catalog, whose records
+        # are not removed.
+        missing: List[Text] = []
+        while True:
+            excluded = " AND path NOT IN (%s)" % (', '.join('?' * len(missing)), ) if missing else ""
+            begin, end = self.connection.execute(
+                "SELECT MIN(begin_date), MAX(end_date) FROM datasets WHERE kind = ?" + excluded, [kind] + missing
+            ).fetchone()
+            if begin is None:
+                return None
+            rows = self.connection.execute(
+                "SELECT path FROM datasets WHERE kind = ? AND begin_date = ?" + excluded +
+                " UNION SELECT path FROM datasets WHERE kind = ? AND end_date = ?" + excluded,
+                [kind, begin] + missing + [kind, end] + missing
+            ).fetchall()
+            ends_missing = [path for path, in rows if not os.path.exists(path)]
+            if not ends_missing:
+                return _parse_date(begin), _parse_date(end)
+            self._forget(ends_missing)
+            missing += ends_missing
+
+    def scan(self, directory: Text, kind: Text):
+        """
+        Registers the datafiles of a kind in a directory that are not yet in
+        the catalog, based on their filenames, and removes the records of
+        the datafiles of the kind that no longer exist. Used to build the
+        catalog for results of earlier runs and, on request, to pick up the
+        datafiles written without the catalog, e.g. by
+        fin-traffic-fetch-raw-data. Every file in the directory and every
+        record of the kind is checked, so the lookups do not scan.
+        """
+        known = set(self._existing(
+            [row[0] for row in self.connection.execute("SELECT path FROM datasets WHERE kind = ?", (kind, ))]
+        ))
+        for path in sorted(glob(os.path.join(directory, '*'))):
+            if os.path.abspath(path) in known:
+                continue
+            m = _filename_patterns[kind].match(os.path.basename(path))
+            if not m:
+                continue
+            groups = m.groupdict()
+            self.register(kind=kind,
+                          path=path,
+                          begin_date=_parse_date(groups['begin_date']),
+                          end_date=_parse_date(groups['end_date']),
+                          resolution=_parse_timedelta(groups['resolution']) if 'resolution' in groups else None,
+                          level=groups.get('level'))
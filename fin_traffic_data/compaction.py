@@ -0,0 +1,257 @@
+"""
+Compaction of the raw datafiles of a directory into yearly partitions.
+
+Daily runs of the pipeline leave a raw datafile for every fetched date range.
+Compaction merges them into one raw datafile per year (per contiguous date
+range within a year, so that no dates without data are claimed), with the
+rows of every station sorted by time and a sidecar index of the first row of
+every day. The partitions are ordinary raw datafiles, so everything reading
+the raw data reads them as before.
+"""
+import os
+import json
+import datetime
+from typing import Dict, List, Optional, Text, Tuple
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.utils import daterange
+
+# Journal of a compaction being applied, see _apply_journal
+_journal_filename = 'compaction.journal.json'
+
+RawDataFile = Tuple[Text, datetime.date, datetime.date]
+# Begin date, end date (exclusive) and raw datafiles of a partition
+Partition = Tuple[datetime.date, datetime.date, List[Text]]
+
+
+def get_time_index_path(raw_data_file: Text) -> Text:
+    """Path to the sidecar time index of a raw datafile."""
+    return raw_data_file + '.index.npz'
+
+
+def plan_compaction(raw_data_files: List[RawDataFile]) -> List[Partition]:
+    """
+    The partitions the raw datafiles are compacted into: the date ranges of
+    the files are split at the year boundaries, and the contiguous ranges of
+    each year are merged. A partition that would only be one whole existing
+    file with a time index is left out.
+
+    Returns
+    -------
+    List of tuples of the begin date, the end date (exclusive) and the raw
+    datafiles of a partition
+    """
+    pieces: Dict[int, List[RawDataFile]] = {}
+    for filename, begin_date, end_date in raw_data_files:
+        for year in range(begin_date.year, end_date.year + 1):
+            begin = max(begin_date, datetime.date(year, 1, 1))
+            end = min(end_date, datetime.date(year + 1, 1, 1))
+            if begin < end:
+                pieces.setdefault(year, []).append((filename, begin, end))
+
+    partitions: List[Partition] = []
+    for year in sorted(pieces):
+        # Contiguous date ranges of the year
+        runs: List[Partition] = []
+        for filename, begin, end in sorted(pieces[year], key=lambda p: (p[1], p[2])):
+            if runs and begin <= runs[-1][1]:
+                run_begin, run_end, filenames = runs[-1]
+                runs[-1] = (run_begin, max(run_end, end), filenames + [filename])
+            else:
+                runs.append((begin, end, [filename]))
+        for begin, end, filenames in runs:
+            if (len(filenames) == 1 and (filenames[0], begin, end) in raw_data_files
+                    and os.path.isfile(get_time_index_path(filenames[0]))):
+                continue
+            partitions.append((begin, end, filenames))
+    return partitions
+
+
+def _write_time_index(path: Text, begin_date: datetime.date, end_date: datetime.date,
+                      offsets: Dict[int, np.ndarray]):
+    """Writes the sidecar time index of a partition."""
+    arrays = dict((f'tms_{num}', day_offsets) for num, day_offsets in offsets.items())
+    with open(path, 'wb') as f:
+        np.savez(f, first_day=begin_date.toordinal(), days=(end_date - begin_date).days, **arrays)
+
+
+def _write_partition(result_path: Text, filenames: List[Text], begin_date: datetime.date,
+                     end_date: datetime.date) -> int:
+    """
+    Merges the raw data of the files between the dates into a partition,
+    sorted by time for every station, and writes its time index.
+
+    Returns
+    -------
+    Number of the rows written
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.scripts.fetch_raw_data import _write_raw_data
+
+    keys = set()
+    for filename in filenames:
+        with pd.HDFStore(filename, mode='r') as store:
+            keys.update(store.keys())
+
+    t0 = pd.Timestamp(begin_date)
+    t1 = pd.Timestamp(end_date)
+    day_boundaries = np.array([pd.Timestamp(d) for d in daterange(begin_date, end_date)] + [t1],
+                              dtype='datetime64[ns]')
+    offsets = {}
+    rows = 0
+    for key in sorted(keys, key=lambda k: int(k.rsplit('_', 1)[1])):
+        frames = []
+        for filename in filenames:
+            with pd.HDFStore(filename, mode='r') as store:
+                if key not in store:
+                    continue
+                df = store.select(key)
+            frames.append(df.loc[(df['time'] >= t0) & (df['time'] < t1)])
+        df = pd.concat(frames).sort_values('time', kind='mergesort').reset_index(drop=True)
+        if df.empty:
+            continue
+        tms_num = int(key.rsplit('_', 1)[1])
+        _write_raw_data(df, result_path, tms_num)
+        offsets[tms_num] = np.searchsorted(df['time'].to_numpy(), day_boundaries)
+        rows += df.shape[0]
+    _write_time_index(get_time_index_path(result_path), begin_date, end_date, offsets)
+    return rows
+
+
+def _apply_journal(raw_data_dir: Text):
+    """
+    Completes a compaction recorded in the journal of the directory: the
+    partitions are renamed into place and the compacted files are removed.
+    Every step can be repeated, so an interrupted compaction is completed
+    by applying the journal again. Readers listing the directory at the same
+    time may apply the same journal concurrently, so the files another one
+    already renamed or removed are skipped.
+    """
+    journal_path = os.path.join(raw_data_dir, _journal_filename)
+    try:
+        with open(journal_path, 'r') as f:
+            journal = json.load(f)
+    except FileNotFoundError:
+        # Applied by another reader in the meantime
+        return
+    for partial_path, path in journal['replace']:
+        for source, target in [(partial_path, path),
+                               (get_time_index_path(partial_path), get_time_index_path(path))]:
+            try:
+                os.replace(source, target)
+            except FileNotFoundError:
+                pass
+    kept = set(path for _, path in journal['replace'])
+    for path in journal['remove']:
+        if path in kept:
+            continue
+        for p in [path, get_time_index_path(path)]:
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+    try:
+        os.remove(journal_path)
+    except FileNotFoundError:
+        pass
+
+
+def finish_interrupted_compaction(raw_data_dir: Text) -> bool:
+    """Completes an interrupted compaction of the directory, if any. Returns whether there was one."""
+    if not os.path.isfile(os.path.join(raw_data_dir, _journal_filename)):
+        return False
+    _apply_journal(raw_data_dir)
+    return True
+
+
+def compact_raw_data(raw_data_dir: Text, catalog=None, dry_run: bool = False) -> List[RawDataFile]:
+    """
+    Compacts the raw datafiles of a directory into yearly partitions (see
+    plan_compaction) and retires the compacted files.
+
+    The partitions are first written under temporary names. The renames and
+    removals are then recorded in a journal and applied, so that an
+    interrupted compaction is completed the next time the directory is
+    listed and the raw data is never seen twice or not at all.
+
+    Input
+    -----
+    raw_data_dir: Text
+        Directory of the raw datafiles
+    catalog: Optional[fin_traffic_data.catalog.DatasetCatalog]
+        Catalog whose records of the raw datafiles are updated
+    dry_run: bool
+        Only plan the partitions
+
+    Returns
+    -------
+    List of the partitions written (or planned) as tuples of the filename,
+    the begin date and the end date
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.aggregation import list_rawdata_files, check_no_daterange_overlap_in_raw_files
+    from fin_traffic_data.scripts.fetch_raw_data import get_raw_data_file_path
+
+    raw_data_files = list_rawdata_files(raw_data_dir)
+    check_no_daterange_overlap_in_raw_files(raw_data_files)
+    plan = plan_compaction(raw_data_files)
+    partitions = [(get_raw_data_file_path(raw_data_dir, begin, end), begin, end) for begin, end, _ in plan]
+    if dry_run or not plan:
+        return partitions
+
+    replace = []
+    remove = set()
+    for (path, begin, end), (_, _, filenames) in zip(partitions, plan):
+        partial_path = path + '.partial'
+        for p in [partial_path, get_time_index_path(partial_path)]:
+            if os.path.exists(p):
+                os.remove(p)
+        _write_partition(partial_path, filenames, begin, end)
+        replace.append((partial_path, path))
+        remove.update(filenames)
+
+    journal_path = os.path.join(raw_data_dir, _journal_filename)
+    with open(journal_path + '.partial', 'w') as f:
+        json.dump({'replace': replace, 'remove': sorted(remove)}, f)
+    os.replace(journal_path + '.partial', journal_path)
+    _apply_journal(raw_data_dir)
+
+    if catalog is not None:
+        for path in sorted(remove):
+            catalog.remove(path)
+        for path, begin, end in partitions:
+            catalog.register('raw', path, begin, end)
+    return partitions
+
+
+def read_raw_data_range(raw_data_file: Text, tms_num: int, t0: datetime.datetime,
+                        t1: datetime.datetime) -> Optional[pd.DataFrame]:
+    """
+    Raw data of a TMS station in [t0, t1) read with the time index of the
+    raw datafile, so that only the rows of the days of the range are read.
+
+    Returns
+    -------
+    The rows, or None if the file has no valid time index for the station
+    (e.g. it is not a partition, or the station was rewritten after the
+    compaction)
+    """
+    key = f'tms_{int(tms_num)}'
+    try:
+        with np.load(get_time_index_path(raw_data_file)) as index:
+            if key not in index.files:
+                return None
+            offsets = index[key]
+            first_day = int(index['first_day'])
+    except (OSError, ValueError):
+        return None
+    with pd.HDFStore(raw_data_file, mode='r') as store:
+        if key not in store or store.get_storer(key).shape[0] != offsets[-1]:
+            return None
+        first = min(max(t0.toordinal() - first_day, 0), len(offsets) - 1)
+        last = min(max(-(-(t1 - datetime.datetime.combine(datetime.date.fromordinal(first_day), datetime.time()))
+                         // datetime.timedelta(days=1)), 0), len(offsets) - 1)
+        df = store.select(key, start=int(offsets[first]), stop=int(offsets[last]))
+    return df.loc[(df['time'] >= t0) & (df['time'] < t1)]
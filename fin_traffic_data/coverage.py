@@ -0,0 +1,182 @@
+import datetime
+import os
+from typing import Dict, Iterable, List, Optional, Text
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.utils import daterange
+
+# Days after which a raw datafile that the server reports missing is taken
+# to be absent for good. The file of a day is normally published on the next
+# day, but the files of some stations arrive later.
+_absent_grace_days = 7
+
+
+class CoverageIndex:
+
+    """
+    Bitmap of the (TMS station, day) pairs whose raw data has been fetched.
+
+    A day of a station is covered when its raw data file was downloaded, or
+    when the server reported that the file does not exist and the day is
+    more than _absent_grace_days days old. Files of the later days may still
+    be published, and days that failed for any other reason stay uncovered
+    as well, so they are fetched again.
+
+    The index is persisted as 'coverage.npz' in the directory of the raw
+    datafiles.
+    """
+
+    filename = 'coverage.npz'
+
+    def __init__(self, path: Text):
+        """
+        Input
+        -----
+        path: Text
+            Path to the persisted index. Loaded if it exists.
+        """
+        self.path = path
+        self.stations: List[int]
+        self.first_day: Optional[int]
+        if os.path.isfile(path):
+            with np.load(path) as data:
+                self.stations = [int(s) for s in data['stations']]
+                self.first_day = int(data['first_day'])
+                self.bits = np.unpackbits(data['bits'], axis=1, count=int(data['days'])).astype(bool)
+        else:
+            self.stations = []
+            self.first_day = None
+            self.bits = np.zeros((0, 0), dtype=bool)
+        self._station_rows = dict((s, i) for i, s in enumerate(self.stations))
+
+    @classmethod
+    def open(cls, raw_data_dir: Text, tms_nums: Iterable[int]) -> 'CoverageIndex':
+        """
+        Opens the index of a directory of raw datafiles. If there is no index
+        yet, it is built from all the raw datafiles of the directory.
+
+        Input
+        -----
+        raw_data_dir: Text
+            Directory of the raw datafiles
+        tms_nums: Iterable[int]
+            Numbers of the TMS stations that were fetched into the raw datafiles
+        """
+        path = os.path.join(raw_data_dir, cls.filename)
+        index = cls(path)
+        if not os.path.isfile(path) and os.path.isdir(raw_data_dir):
+            from fin_traffic_data.aggregation import list_rawdata_files
+            tms_nums = [int(n) for n in tms_nums]
+            for filename, begin_date, end_date in list_rawdata_files(raw_data_dir):
+                index.mark_from_raw_file(filename, begin_date, end_date, tms_nums)
+        return index
+
+    def _ensure_days(self, first_day: int, last_day: int):
+        """Grows the bitmap to hold the days first_day..last_day (ordinals, inclusive)."""
+        if self.first_day is None:
+            self.first_day = first_day
+        ndays = self.bits.shape[1]
+        new_first_day = min(self.first_day, first_day)
+        new_ndays = max(self.first_day + ndays, last_day + 1) - new_first_day
+        if new_first_day != self.first_day or new_ndays != ndays:
+            bits = np.zeros((self.bits.shape[0], new_ndays), dtype=bool)
+            offset = self.first_day - new_first_day
+            bits[:, offset:offset + ndays] = self.bits
+            self.bits = bits
+            self.first_day = new_first_day
+
+    def _station_row(self, tms_num: int) -> int:
+        tms_num = int(tms_num)
+        if tms_num not in self._station_rows:
+            self._station_rows[tms_num] = len(self.stations)
+            self.stations.append(tms_num)
+            self.bits = np.vstack([self.bits, np.zeros((1, self.bits.shape[1]), dtype=bool)])
+        return self._station_rows[tms_num]
+
+    def mark(self, tms_num: int, dates: Iterable[datetime.date]):
+        """Marks days of a station as covered."""
+        days = np.array([d.toordinal() for d in dates], dtype=int)
+        if days.size == 0:
+            return
+        self._ensure_days(int(days.min()), int(days.max()))
+        row = self._station_row(tms_num)
+        self.bits[row, days - self.first_day] = True
+
+    def mark_absent(self, tms_num: int, dates: Iterable[datetime.date], today: Optional[datetime.date] = None):
+        """
+        Marks days of a station without a raw datafile on the server as
+        covered, if they are more than _absent_grace_days days before today.
+        The later days are left uncovered.
+        """
+        today = today if today is not None else datetime.date.today()
+        self.mark(tms_num, [date for date in dates if (today - date).days > _absent_grace_days])
+
+    def mark_from_raw_file(self, filename: Text, begin_date: datetime.date, end_date: datetime.date,
+                           tms_nums: Iterable[int]):
+        """
+        Marks the coverage of a raw datafile written before the index existed.
+
+        A station with data in the file is covered on the days it has rows.
+        A station of tms_nums without any data in the file was not available
+        on any of the days, so they are marked as absent (see mark_absent).
+        """
+        dates = list(daterange(begin_date, end_date))
+        with pd.HDFStore(filename, mode='r') as store:
+            stored_stations = set(int(key.lstrip('/').split('_')[1]) for key in store.keys())
+            for tms_num in stored_stations:
+                key = f'tms_{tms_num}'
+                # The raw datafiles are stored in the fixed format, which is read as a whole
+                columns = ['time'] if store.get_storer(key).is_table else None
+                times = store.select(key, columns=columns)['time']
+                self.mark(tms_num, [d.date() for d in pd.DatetimeIndex(times).normalize().unique()])
+        for tms_num in set(tms_nums) - stored_stations:
+            self.mark_absent(tms_num, dates)
+
+    def is_covered(self, tms_num: int, date: datetime.date) -> bool:
+        row = self._station_rows.get(int(tms_num))
+        if row is None or self.first_day is None:
+            return False
+        day = date.toordinal() - self.first_day
+        return 0 <= day < self.bits.shape[1] and bool(self.bits[row, day])
+
+    def missing(self, tms_nums: Iterable[int], begin_date: datetime.date,
+                end_date: datetime.date) -> Dict[int, List[datetime.date]]:
+        """
+        Finds the days between begin_date and end_date (exclusive) that are
+        not covered for each of the stations.
+
+        Returns
+        -------
+        Dict from the station number to the list of its missing days. Stations
+        without missing days are left out.
+        """
+        tms_nums = [int(n) for n in tms_nums]
+        ndays = (end_date - begin_date).days
+        if ndays <= 0:
+            return {}
+        covered = np.zeros((len(tms_nums), ndays), dtype=bool)
+        if self.first_day is not None:
+            lo = max(begin_date.toordinal(), self.first_day)
+            hi = min(end_date.toordinal(), self.first_day + self.bits.shape[1])
+            if lo < hi:
+                for i, tms_num in enumerate(tms_nums):
+                    row = self._station_rows.get(tms_num)
+                    if row is not None:
+                        covered[i, lo - begin_date.toordinal():hi - begin_date.toordinal()] = \
+                            self.bits[row, lo - self.first_day:hi - self.first_day]
+        missing: Dict[int, List[datetime.date]] = {}
+        for i, day in zip(*np.nonzero(~covered)):
+            missing.setdefault(tms_nums[i], []).append(begin_date + datetime.timedelta(days=int(day)))
+        return missing
+
+    def save(self):
+        """Writes the index to disk, replacing the earlier version atomically."""
+        partial_path = self.path + '.partial.npz'
+        np.savez_compressed(partial_path,
+                            stations=np.array(self.stations, dtype=int),
+                            first_day=np.array(self.first_day if self.first_day is not None else 0),
+                            days=np.array(self.bits.shape[1]),
+                            bits=np.packbits(self.bits, axis=1))
+        os.replace(partial_path, self.path)
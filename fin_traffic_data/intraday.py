@@ -0,0 +1,263 @@
+import os
+import re
+import datetime
+from time import perf_counter
+from typing import Dict, Iterable, Optional, Text
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.aggregation import _directions, _vehicle_categories
+from fin_traffic_data.metrics import get_metrics
+from fin_traffic_data.raw_data import (ResponseMock, _missing_file_status_codes,
+                                       get_tms_raw_data_url, parse_tms_raw_data)
+
+
+def _content_range_total(resp) -> Optional[int]:
+    """Total size of the file from the Content-Range header of a response, if known."""
+    m = re.match(r"bytes\s+(?:\d+-\d+|\*)/(?P<total>\d+)", resp.headers.get('Content-Range', ''))
+    return int(m.group('total')) if m else None
+
+
+def _content_range_begin(resp) -> Optional[int]:
+    """Offset of the first byte of a partial response from its Content-Range header."""
+    m = re.match(r"bytes\s+(?P<begin>\d+)-\d+/", resp.headers.get('Content-Range', ''))
+    return int(m.group('begin')) if m else None
+
+
+class RawDataTail:
+
+    """
+    Follows the raw datafile of a TMS station on a day while the file grows.
+
+    Every poll requests only the bytes past those already read, with an HTTP
+    Range request made conditional on the ETag (or Last-Modified time) of the
+    previous response, so that an unchanged file costs a 304 response without
+    a body. A server ignoring the Range header is handled by skipping the
+    bytes already read. Rows are returned only when complete; the bytes of a
+    row still being written are kept until the next poll.
+    """
+
+    def __init__(self, ely_id: int, tms_id: int, date: datetime.date, base_url: Optional[Text] = None):
+        """
+        Input
+        -----
+        ely_id: int
+            ID of the ELY center of the TMS station
+        tms_id: int
+            ID of the TMS station
+        date: datetime.date
+            Day of the datafile
+        base_url: Optional[Text]
+            Location of the raw datafiles, by default get_raw_data_base_url()
+        """
+        self.tms_id = int(tms_id)
+        self.date = date
+        self.url = get_tms_raw_data_url(ely_id, tms_id, date, base_url)
+        # Number of bytes of the file read so far
+        self.offset = 0
+        self.etag = None
+        self.last_modified = None
+        # Bytes after the last complete row
+        self._incomplete_row = b''
+        # Set by poll when the file was replaced and read again from the
+        # beginning, i.e. the rows read before must be discarded
+        self.restarted = False
+
+    def _restart(self):
+        self.offset = 0
+        self.etag = None
+        self.last_modified = None
+        self._incomplete_row = b''
+        self.restarted = True
+
+    def _request(self, session):
+        headers = {}
+        if self.offset > 0:
+            headers['Range'] = f'bytes={self.offset}-'
+            if self.etag is not None:
+                headers['If-None-Match'] = self.etag
+            elif self.last_modified is not None:
+                headers['If-Modified-Since'] = self.last_modified
+        request_time0 = perf_counter()
+        try:
+            resp = session.get(self.url, headers=headers)
+            get_metrics().observe_http_request(perf_counter() - request_time0, resp.status_code, len(resp.content))
+        except Exception:
+            print(f"Timeouterror: {self.date} {self.tms_id}")
+            resp = ResponseMock(499)
+            get_metrics().observe_http_request(perf_counter() - request_time0, resp.status_code)
+        return resp
+
+    def poll(self, session) -> Optional[pd.DataFrame]:
+        """
+        Reads the rows appended to the datafile since the previous poll.
+
+        Input
+        -----
+        session: requests.Session
+            HTTP session reused over the polls
+
+        Returns
+        -------
+        pandas.DataFrame with the new rows as returned by
+        fin_traffic_data.raw_data.parse_tms_raw_data, or None if there are
+        no new complete rows.
+        """
+        self.restarted = False
+        resp = self._request(session)
+
+        if resp.status_code == 416:
+            # Nothing past the offset; a file shorter than what was read has
+            # been replaced
+            total = _content_range_total(resp)
+            if total is None or total >= self.offset:
+                return None
+            self._restart()
+            resp = self._request(session)
+
+        if resp.status_code == 304 or resp.status_code in _missing_file_status_codes:
+            return None
+        if resp.status_code == 200:
+            # The whole file: skip what was already read unless it shrank
+            content = resp.content
+            if len(content) < self.offset:
+                self._restart()
+            else:
+                content = content[self.offset:]
+        elif resp.status_code == 206:
+            content = resp.content
+            begin = _content_range_begin(resp)
+            if begin is not None and begin != self.offset:
+                content = content[self.offset - begin:] if begin < self.offset else b''
+        else:
+            print(f"Failed to poll {self.date}: {self.tms_id}, {resp.status_code}")
+            return None
+
+        self.offset += len(content)
+        self.etag = resp.headers.get('ETag', self.etag)
+        self.last_modified = resp.headers.get('Last-Modified', self.last_modified)
+
+        data = self._incomplete_row + content
+        end_of_rows = data.rfind(b'\n') + 1
+        self._incomplete_row = data[end_of_rows:]
+        if end_of_rows == 0:
+            return None
+        return parse_tms_raw_data(data[:end_of_rows].decode('latin-1'))
+
+
+class IntradayAggregate:
+
+    """
+    Counts of vehicles of the TMS stations on a single day, kept in memory
+    in buckets of the time resolution and updated as new rows arrive.
+    """
+
+    def __init__(self, date: datetime.date, delta_t: datetime.timedelta):
+        """
+        Input
+        -----
+        date: datetime.date
+            The day
+        delta_t: datetime.timedelta
+            Time resolution
+        """
+        self.date = date
+        self.delta_t = delta_t
+        self.time0 = datetime.datetime(year=date.year, month=date.month, day=date.day)
+        self.num_buckets = -(-datetime.timedelta(days=1) // delta_t)
+        self.counts: Dict[int, np.ndarray] = {}
+
+    def _station_counts(self, tms_num: int) -> np.ndarray:
+        tms_num = int(tms_num)
+        if tms_num not in self.counts:
+            self.counts[tms_num] = np.zeros(
+                (self.num_buckets, len(_directions), len(_vehicle_categories)), dtype=int)
+        return self.counts[tms_num]
+
+    def reset(self, tms_num: int):
+        """Discards the counts of a TMS station."""
+        self._station_counts(tms_num)[:] = 0
+
+    def add(self, tms_num: int, df: pd.DataFrame):
+        """
+        Adds the raw data rows of a TMS station to the counts.
+
+        Rows outside of the day, or with an unknown direction or vehicle
+        category, are ignored.
+        """
+        counts = self._station_counts(tms_num)
+        buckets = ((df['time'] - self.time0) // self.delta_t).to_numpy()
+        directions = df['direction'].to_numpy().astype(int) - 1
+        categories = df['vehicle category'].to_numpy().astype(int) - 1
+        valid = ((buckets >= 0) & (buckets < self.num_buckets) &
+                 (directions >= 0) & (directions < len(_directions)) &
+                 (categories >= 0) & (categories < len(_vehicle_categories)))
+        np.add.at(counts, (buckets[valid], directions[valid], categories[valid]), 1)
+
+    def as_dataframe(self, tms_num: int) -> pd.DataFrame:
+        """
+        The counts of a TMS station with the same columns as the time
+        aggregated data: time, direction, vehicle category and counts.
+        """
+        counts = self._station_counts(tms_num)
+        times = [self.time0 + i * self.delta_t for i in range(self.num_buckets)]
+        index = pd.MultiIndex.from_product([times, _directions, _vehicle_categories],
+                                           names=['time', 'direction', 'vehicle category'])
+        return pd.DataFrame({'counts': counts.reshape(-1)}, index=index).reset_index()
+
+    def write(self, results_dir: Text, tms_nums: Iterable[int]) -> Text:
+        """
+        Stores the counts of the TMS stations into the intraday datafile of
+        the day, together with the counts of the stations stored earlier.
+
+        The datafile is written under a temporary name and renamed into
+        place. Replacing the stations in the datafile itself would leave the
+        space of their earlier rows unused, so the file would grow with every
+        poll. Nothing is written if no station changed and the datafile
+        exists.
+
+        Returns
+        -------
+        Path to the datafile
+        """
+        result_path = get_intraday_file_path(results_dir, self.date, self.delta_t)
+        tms_nums = [int(tms_num) for tms_num in tms_nums]
+        if not tms_nums and os.path.isfile(result_path):
+            return result_path
+        for tms_num in tms_nums:
+            self._station_counts(tms_num)
+        partial_path = result_path + '.partial'
+        with pd.HDFStore(partial_path, mode='w') as store:
+            for tms_num in self.counts:
+                store.put(f'tms_{tms_num}', self.as_dataframe(tms_num), format='table', data_columns=['time'])
+        os.replace(partial_path, result_path)
+        return result_path
+
+
+def get_intraday_file_path(results_dir, date, delta_t):
+    """Path to the datafile of the data of a day aggregated while the day is still going on"""
+    file_name = f'fi_traffic_intraday-{date}-{delta_t}.h5'
+    return os.path.join(results_dir, file_name)
+
+
+def poll_intraday_data(tails: Iterable[RawDataTail], aggregate: IntradayAggregate, session) -> Dict[int, int]:
+    """
+    Polls the raw datafiles of the TMS stations once and adds the new rows to
+    the open buckets of the day.
+
+    Returns
+    -------
+    Dictionary from the numbers of the TMS stations whose counts changed to
+    the number of new rows
+    """
+    changed = {}
+    for tail in tails:
+        df = tail.poll(session)
+        if tail.restarted:
+            aggregate.reset(tail.tms_id)
+            changed[tail.tms_id] = 0
+        if df is not None:
+            aggregate.add(tail.tms_id, df)
+            changed[tail.tms_id] = changed.get(tail.tms_id, 0) + df.shape[0]
+    return changed
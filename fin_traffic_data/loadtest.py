@@ -0,0 +1,190 @@
+"""
+End-to-end load test of fetching raw data from the local mock server (see
+fin_traffic_data.mock_server): the throughput of the fetch, and the retries
+caused by the injected latency, errors and throttling.
+"""
+import io
+import os
+import queue
+import datetime
+import tempfile
+import threading
+import contextlib
+from typing import Dict, List, Text, Tuple
+
+from fin_traffic_data.metrics import reset_metrics
+from fin_traffic_data.mock_server import MockServerConfig, start_mock_server
+from fin_traffic_data.metadata import _metadata_dir_env, _tms_stations_url_env, clear_tms_stations_memo
+from fin_traffic_data.raw_data import _raw_data_url_env, _retry_delay_env
+
+
+@contextlib.contextmanager
+def _environment(variables: Dict[Text, Text]):
+    """Sets environment variables for the duration of the context."""
+    previous = dict((name, os.environ.get(name)) for name in variables)
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _fetch_concurrently(begin_date: datetime.date, end_date: datetime.date, tms_stations,
+                        threads: int) -> int:
+    """
+    Fetches the raw data of the stations with the given number of threads,
+    as the fetch threads of the pipelined mode of
+    fin-traffic-complete_pipeline do. The data is not written.
+
+    Returns
+    -------
+    Number of the station-days fetched, or without a datafile on the server
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.raw_data import get_tms_raw_data
+    from fin_traffic_data.registry import get_station_registry
+
+    stations: 'queue.Queue[Tuple[int, int]]' = queue.Queue()
+    for num, ely_id in get_station_registry(tms_stations).station_ely_ids().items():
+        stations.put((num, ely_id))
+    completed: List[datetime.date] = []
+    errors: List[Exception] = []
+
+    def fetch():
+        while True:
+            try:
+                num, ely_id = stations.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                get_tms_raw_data(ely_id, num, begin_date, end_date, False, completed_dates=completed,
+                                 absent_dates=completed)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    workers = [threading.Thread(target=fetch, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return len(completed)
+
+
+def _fetched_station_days(results_dir: Text, tms_nums, begin_date: datetime.date,
+                          end_date: datetime.date) -> int:
+    """Number of the station-days fetched into a raw data directory, or without a datafile on the server."""
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.coverage import CoverageIndex
+
+    missing = CoverageIndex.open(results_dir, tms_nums).missing(tms_nums, begin_date, end_date)
+    return len(tms_nums) * (end_date - begin_date).days - sum(len(dates) for dates in missing.values())
+
+
+def run_load_test(config: MockServerConfig, begin_date: datetime.date, end_date: datetime.date,
+                  threads: int = 1, retry_delay: float = 0.1, verbose: bool = False) -> Dict:
+    """
+    Fetches the raw data of all the stations of the mock server between the
+    dates and measures the fetch.
+
+    With one thread the data is fetched with fin-traffic-fetch-raw-data into
+    a temporary directory, otherwise with the given number of fetch threads
+    without writing it.
+
+    Input
+    -----
+    config: MockServerConfig
+        Content and faults of the mock server
+    begin_date, end_date: datetime.date
+        Dates to fetch, end date exclusive
+    threads: int
+        Number of the fetch threads
+    retry_delay: float
+        Seconds to wait before retrying a failed request
+    verbose: bool
+        Whether to show the output of the fetch
+
+    Returns
+    -------
+    Dictionary of the results
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.metadata import get_tms_stations
+    from fin_traffic_data.scripts.fetch_raw_data import fetch_raw_data
+
+    server = start_mock_server(config)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            variables = {
+                _raw_data_url_env: server.raw_data_url,
+                _tms_stations_url_env: server.stations_url,
+                _metadata_dir_env: os.path.join(tmpdir, 'metadata'),
+                _retry_delay_env: str(retry_delay),
+            }
+            output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+            with _environment(variables), output:
+                clear_tms_stations_memo()
+                metrics = reset_metrics()
+                try:
+                    with metrics.stage('fetch') as stage:
+                        tms_stations = get_tms_stations()
+                        if threads == 1:
+                            results_dir = fetch_raw_data(begin_date, end_date, False, os.path.join(tmpdir, 'raw'))
+                            station_days = _fetched_station_days(results_dir, tms_stations['num'].tolist(),
+                                                                 begin_date, end_date)
+                        else:
+                            station_days = _fetch_concurrently(begin_date, end_date, tms_stations, threads)
+                finally:
+                    clear_tms_stations_memo()
+        server_statistics = server.statistics_json()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    num_requests = stage.counters['http_requests']
+    parameters = dict(vars(config))
+    parameters.pop('stations')
+    parameters['not_found_patterns'] = [p.pattern for p in config.not_found_patterns]
+    return {
+        'type': 'load_test',
+        'started': stage.started.isoformat(),
+        'parameters': parameters,
+        'begin_date': begin_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'threads': threads,
+        'retry_delay': retry_delay,
+        'stations': len(tms_stations),
+        'station_days': station_days,
+        'wall_time': stage.wall_time,
+        'cpu_time': stage.cpu_time,
+        'peak_rss': stage.peak_rss,
+        'throughput': station_days / max(stage.wall_time, 1e-9),
+        'bytes_per_second': stage.counters['bytes_downloaded'] / max(stage.wall_time, 1e-9),
+        'requests': num_requests,
+        'retries': stage.counters['http_retries'],
+        'bytes_downloaded': stage.counters['bytes_downloaded'],
+        'http_status_codes': dict((str(code), n) for code, n in sorted(stage.http_status_codes.items())),
+        'mean_latency': stage.latency_sum / max(num_requests, 1),
+        'server': server_statistics,
+    }
+
+
+def format_load_test_result(result: Dict) -> List[Text]:
+    """Lines summarizing the result of a load test."""
+    server = result['server']
+    return [
+        f"{result['station_days']} station-days in {result['wall_time']:.2f} s "
+        f"({result['throughput']:.1f} station-days/s, {result['bytes_per_second'] / 2**20:.2f} MB/s, "
+        f"{result['threads']} threads)",
+        f"{result['requests']} requests, {result['retries']} retries, "
+        f"mean latency {1000 * result['mean_latency']:.1f} ms, status codes {result['http_status_codes']}",
+        f"Server: {server['requests']} requests, {server['bytes_sent']} bytes, "
+        f"injected {server['injected']['not_found']} not found, {server['injected']['throttled']} throttled, "
+        f"{server['injected']['errors']} errors",
+    ]
@@ -1,26 +1,152 @@
+import os
 import json
-import requests
+import time
+import datetime
+import contextlib
+import functools
 import pandas as pd
-from typing import Dict
-import os.path
+from typing import Dict, Optional, Text
 
+# Location of the TMS station metadata, and the environment variable
+# replacing it, e.g. with a local test server (see fin_traffic_data.mock_server)
+_tms_stations_url = 'https://tie.digitraffic.fi/api/v3/metadata/tms-stations'
+_tms_stations_url_env = 'FIN_TRAFFIC_STATIONS_URL'
 
-def get_tms_stations() -> pd.DataFrame:
+# Version of the format of the station metadata snapshot. Snapshots of other
+# versions are ignored and downloaded again.
+_snapshot_version = 1
+
+# Environment variables setting the snapshot of the station metadata: its
+# directory, its maximum age in seconds before it is downloaded again, and
+# whether to use it without trying to download at all
+_metadata_dir_env = 'FIN_TRAFFIC_METADATA_DIR'
+_metadata_ttl_env = 'FIN_TRAFFIC_METADATA_TTL'
+_offline_env = 'FIN_TRAFFIC_OFFLINE'
+
+# Environment variable of a directory of regenerated border tables (see
+# fin_traffic_data.borders) used instead of the packaged ones
+_borders_dir_env = 'FIN_TRAFFIC_BORDERS_DIR'
+
+_default_metadata_dir = os.path.join(os.path.expanduser('~'), '.cache', 'fin_traffic_data')
+_default_metadata_ttl = 24 * 3600
+
+# Seconds to wait for the metadata server before falling back to the snapshot
+_download_timeout = 30
+
+# Station metadata pinned by a long-running process, see pinned_tms_stations
+_pinned_tms_stations = None
+
+# Station metadata read in this process, the time (seconds since the
+# epoch) it was downloaded and its location
+_memo_tms_stations = None
+_memo_fetched = None
+_memo_source = None
+
+
+@contextlib.contextmanager
+def pinned_tms_stations(tms_stations: pd.DataFrame):
     """
-    Obtain a list of TMS stations and their properties.
+    Makes get_tms_stations return the given station metadata instead of
+    downloading it, e.g. to keep one snapshot in memory for a whole run.
+    """
+    global _pinned_tms_stations
+    previous = _pinned_tms_stations
+    _pinned_tms_stations = tms_stations
+    try:
+        yield
+    finally:
+        _pinned_tms_stations = previous
+
+
+def get_metadata_dir() -> Text:
+    """Directory of the snapshot of the TMS station metadata and of the files derived from it."""
+    return os.environ.get(_metadata_dir_env, _default_metadata_dir)
+
+
+def get_tms_stations_url() -> Text:
+    """Location of the TMS station metadata, FIN_TRAFFIC_STATIONS_URL if set."""
+    return os.environ.get(_tms_stations_url_env) or _tms_stations_url
+
+
+def get_tms_stations_snapshot_path() -> Text:
+    """Path to the on-disk snapshot of the TMS station metadata."""
+    return os.path.join(get_metadata_dir(), f'tms_stations.v{_snapshot_version}.json')
+
+
+def _metadata_ttl() -> float:
+    return float(os.environ.get(_metadata_ttl_env, _default_metadata_ttl))
+
+
+def _is_offline() -> bool:
+    return os.environ.get(_offline_env, '') not in ('', '0')
+
+
+def write_tms_stations_snapshot(tms_stations: pd.DataFrame, path: Optional[Text] = None,
+                                fetched: Optional[float] = None) -> Text:
+    """
+    Writes the station metadata into a snapshot file, e.g. to create a
+    fixture for tests. The file is replaced atomically.
+
+    Input
+    -----
+    tms_stations: pandas.DataFrame
+        Station metadata as returned by get_tms_stations
+    path: Optional[Text]
+        Path to the snapshot, by default get_tms_stations_snapshot_path()
+    fetched: Optional[float]
+        Time (seconds since the epoch) the metadata was downloaded, by
+        default now
 
     Returns
     -------
-    pandas.DataFrame with columns
-        - id : TMS station id
-        - latitude : x-coordinate of the station
-        - longitude : y-coordinate of the station
-        - municipality : integer code of the municipality
-        - province : integer code of the province
-        - dir1 : integer code of the direction 1 municipality
-        - dir2 : integer code of the direction 2 municipality
+    Path to the snapshot
+    """
+    path = path or get_tms_stations_snapshot_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    snapshot = {
+        'version': _snapshot_version,
+        'fetched': time.time() if fetched is None else fetched,
+        'source': get_tms_stations_url(),
+        'stations': tms_stations.to_dict(orient='records'),
+    }
+    partial_path = path + '.partial'
+    with open(partial_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(partial_path, path)
+    return path
+
+
+def read_tms_stations_snapshot(path: Optional[Text] = None):
+    """
+    Reads a snapshot of the station metadata.
+
+    Returns
+    -------
+    Tuple of the station metadata (as returned by get_tms_stations) and the
+    time (seconds since the epoch) it was downloaded, or None if there is no
+    readable snapshot of the current version downloaded from the current
+    location (see get_tms_stations_url).
     """
-    resp = requests.get('https://tie.digitraffic.fi/api/v3/metadata/tms-stations')
+    path = path or get_tms_stations_snapshot_path()
+    try:
+        with open(path, 'r') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get('version') != _snapshot_version or snapshot.get('source') != get_tms_stations_url():
+        return None
+    df = pd.DataFrame(snapshot['stations'])
+    df.index = df['num'].values
+    return df, float(snapshot['fetched'])
+
+
+def _download_tms_stations() -> pd.DataFrame:
+    """Downloads the station metadata from digitraffic."""
+    # Imported here to keep the startup of the console scripts fast
+    import requests
+
+    resp = requests.get(get_tms_stations_url(), timeout=_download_timeout)
+    resp.raise_for_status()
     data = resp.json()['features']
 
     tms_ids = [int(tms['id']) for tms in data]
@@ -47,6 +173,83 @@ def get_tms_stations() -> pd.DataFrame:
     return df
 
 
+def get_tms_stations() -> pd.DataFrame:
+    """
+    Obtain a list of TMS stations and their properties.
+
+    The metadata is downloaded from digitraffic (or from
+    FIN_TRAFFIC_STATIONS_URL if set) at most once in the time to
+    live of the snapshot (FIN_TRAFFIC_METADATA_TTL seconds, one day by
+    default). It is kept in memory for the process and in a snapshot file in
+    the directory FIN_TRAFFIC_METADATA_DIR (~/.cache/fin_traffic_data by
+    default). If the download fails, or FIN_TRAFFIC_OFFLINE is set, the
+    snapshot is used however old it is.
+
+    Returns
+    -------
+    pandas.DataFrame with columns
+        - id : TMS station id
+        - latitude : x-coordinate of the station
+        - longitude : y-coordinate of the station
+        - municipality : integer code of the municipality
+        - province : integer code of the province
+        - dir1 : integer code of the direction 1 municipality
+        - dir2 : integer code of the direction 2 municipality
+    """
+    global _memo_tms_stations, _memo_fetched, _memo_source
+
+    if _pinned_tms_stations is not None:
+        return _pinned_tms_stations.copy()
+
+    now = time.time()
+    ttl = _metadata_ttl()
+    offline = _is_offline()
+    source = get_tms_stations_url()
+    if _memo_tms_stations is not None and _memo_source == source and (offline or now - _memo_fetched < ttl):
+        return _memo_tms_stations.copy()
+
+    snapshot = read_tms_stations_snapshot()
+    if snapshot is not None and (offline or now - snapshot[1] < ttl):
+        _memo_tms_stations, _memo_fetched = snapshot
+        _memo_source = source
+        return _memo_tms_stations.copy()
+    if offline:
+        raise RuntimeError(f"No snapshot of the TMS station metadata in {get_tms_stations_snapshot_path()}")
+
+    try:
+        df = _download_tms_stations()
+    except Exception as e:
+        if snapshot is None:
+            raise
+        fetched = datetime.datetime.fromtimestamp(snapshot[1])
+        print(f"Failed to download the TMS station metadata ({e}), using the snapshot of {fetched}")
+        _memo_tms_stations, _memo_fetched = snapshot
+        _memo_source = source
+        return _memo_tms_stations.copy()
+
+    try:
+        write_tms_stations_snapshot(df, fetched=now)
+    except OSError as e:
+        print(f"Failed to write the snapshot of the TMS station metadata: {e}")
+    _memo_tms_stations, _memo_fetched, _memo_source = df, now, source
+    return df.copy()
+
+
+def clear_tms_stations_memo():
+    """Forgets the station metadata read in this process, e.g. between tests."""
+    global _memo_tms_stations, _memo_fetched, _memo_source
+    _memo_tms_stations = None
+    _memo_fetched = None
+    _memo_source = None
+
+
+@functools.lru_cache(maxsize=None)
+def _read_packaged_csv(file_name: Text, index_col: Optional[int] = None) -> pd.DataFrame:
+    """Parses a CSV file packaged in the data directory, once per process."""
+    return pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', file_name),
+                       index_col=None if index_col is None else [index_col])
+
+
 def get_municipality_info() -> pd.DataFrame:
     """
     Returns the following information on every municipality:
@@ -56,12 +259,20 @@ def get_municipality_info() -> pd.DataFrame:
         - provinceNumber
         - latitude
         - longitude
+        - hcdCode: code of the hospital care district it belongs to
+
+    The hospital care districts are the member municipalities of the
+    districts in 2020, as in the classification key from municipalities to
+    hospital districts of Statistics Finland (kunta_1_20200101 ->
+    sairaanhoitopiiri_1_20200101, https://www.stat.fi/fi/luokitukset/).
+    They differ from the regions e.g. for the Itä-Savo and Länsi-Pohja
+    districts and for Reisjärvi, which belongs to Central Ostrobothnia.
 
     Returns
     -------
     pandas.DataFrame
     """
-    df = pd.read_csv(os.path.dirname(__file__) + '/data/municipality_info.csv', index_col=[0])
+    df = _read_packaged_csv('municipality_info.csv', index_col=0).copy()
     return df
 
 
@@ -79,7 +290,7 @@ def get_province_info() -> pd.DataFrame:
     -------
     pandas.DataFrame
     """
-    df = pd.read_csv(os.path.dirname(__file__) + '/data/province_info.csv', index_col=[0])
+    df = _read_packaged_csv('province_info.csv', index_col=0).copy()
     return df
 
 
@@ -91,7 +302,7 @@ def get_erva_info() -> pd.DataFrame:
     -------
     pandas.DataFrame
     """
-    df = pd.read_csv(os.path.dirname(__file__) + '/data/erva_coordinates.csv', index_col=[0])
+    df = _read_packaged_csv('erva_coordinates.csv', index_col=0).copy()
     return df
 
 
@@ -103,10 +314,17 @@ def get_hcd_info() -> pd.DataFrame:
     -------
     pandas.DataFrame
     """
-    df = pd.read_csv(os.path.dirname(__file__) + '/data/hcd_info.csv', index_col=[0])
+    df = _read_packaged_csv('hcd_info.csv', index_col=0).copy()
     return df
 
 
+@functools.lru_cache(maxsize=None)
+def _read_neighbouring_municipalities() -> Dict:
+    path = os.path.join(os.path.dirname(__file__), 'data', 'municipality_neighbours.json')
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
 def get_neighbouring_municipalities_map() -> Dict:
     """
     Returns a map from municipality name to a list of its neighbours.
@@ -115,8 +333,19 @@ def get_neighbouring_municipalities_map() -> Dict:
     -------
     Dict
     """
-    neighbour_map = json.load(open(os.path.dirname(__file__) + '/data/province_info.csv', 'r'))
-    return neighbour_map
+    return dict((name, list(neighbours)) for name, neighbours in _read_neighbouring_municipalities().items())
+
+
+def _read_border_table(area: Text) -> pd.DataFrame:
+    """
+    Reads the table of the TMS stations over the borders of the areas of the
+    aggregation level, from FIN_TRAFFIC_BORDERS_DIR if it has one.
+    """
+    file_name = f'tms_over_{area}_borders.csv'
+    borders_dir = os.environ.get(_borders_dir_env)
+    if borders_dir and os.path.exists(os.path.join(borders_dir, file_name)):
+        return pd.read_csv(os.path.join(borders_dir, file_name))
+    return _read_packaged_csv(file_name).copy()
 
 
 def get_tms_over_province_borders() -> pd.DataFrame:
@@ -124,8 +353,7 @@ def get_tms_over_province_borders() -> pd.DataFrame:
     Returns a dataframe of TMS stations and the measurement directions
     between provinces.
     """
-    df = pd.read_csv(os.path.dirname(__file__) + '/data/tms_over_province_borders.csv')
-    return df
+    return _read_border_table('province')
 
 
 def get_tms_over_erva_borders() -> pd.DataFrame:
@@ -133,8 +361,7 @@ def get_tms_over_erva_borders() -> pd.DataFrame:
     Returns a dataframe of TMS stations and the measurement directions
     between ERVAs.
     """
-    df = pd.read_csv(os.path.dirname(__file__) + '/data/tms_over_erva_borders.csv')
-    return df
+    return _read_border_table('erva')
 
 
 def get_tms_over_hcd_borders() -> pd.DataFrame:
@@ -142,5 +369,4 @@ def get_tms_over_hcd_borders() -> pd.DataFrame:
     Returns a dataframe of TMS stations and the measurement directions
     between HCDs.
     """
-    df = pd.read_csv(os.path.dirname(__file__) + '/data/tms_over_hcd_borders.csv')
-    return df
+    return _read_border_table('hcd')
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import contextlib
+from typing import Any, Dict, List, Optional, Text, Tuple
+
+resource: Any
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Upper bounds (seconds) of the buckets of the HTTP request latency histogram
+_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf')]
+
+# Counters recorded for every stage
+_counters = ['bytes_downloaded', 'http_requests', 'http_retries', 'rows_parsed', 'rows_dropped', 'bytes_written']
+
+
+def _reset_peak_rss():
+    """Resets the peak resident set size of the process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss(peak_was_reset: bool) -> int:
+    """
+    Peak resident set size in bytes of the process since the last reset, or
+    over the lifetime of the process if it could not be reset.
+    """
+    peak = 0
+    if peak_was_reset:
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    if resource is not None:
+        # ru_maxrss is in kilobytes except on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        if not peak:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return peak
+
+
+def _children_peak_rss() -> int:
+    """
+    Largest peak resident set size in bytes of the finished child processes
+    (e.g. the aggregation workers) over the lifetime of the process. It
+    cannot be reset, so it is not per stage.
+    """
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+
+def _cpu_time():
+    """CPU time in seconds of the process and its finished child processes."""
+    cpu_time = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time += children.ru_utime + children.ru_stime
+    return cpu_time
+
+
+class StageMetrics:
+
+    """Metrics of a single stage of the pipeline."""
+
+    def __init__(self, name: Text):
+        self.name = name
+        self.started = datetime.datetime.now()
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        # Over the lifetime of the process when the stage ended, see _children_peak_rss
+        self.children_peak_rss = 0
+        self.counters = dict((counter, 0) for counter in _counters)
+        self.http_status_codes: Dict[int, int] = {}
+        self.latency_bucket_counts = [0] * len(_latency_buckets)
+        self.latency_sum = 0.0
+        # Tuples of (TMS number, step, seconds)
+        self.station_timings: List[Tuple[int, Text, float]] = []
+
+    def as_dict(self) -> Dict:
+        return {
+            'type': 'stage',
+            'stage': self.name,
+            'started': self.started.isoformat(),
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_rss': self.peak_rss,
+            'children_peak_rss': self.children_peak_rss,
+            'counters': self.counters,
+            'http_status_codes': dict((str(code), n) for code, n in sorted(self.http_status_codes.items())),
+            'http_latency': {
+                'buckets': [str(b) for b in _latency_buckets],
+                'counts': self.latency_bucket_counts,
+                'sum': self.latency_sum,
+            },
+        }
+
+
+class Metrics:
+
+    """
+    Collects the metrics of the stages of a run of the pipeline: wall time,
+    CPU time (including the worker processes), peak resident set size of the
+    process and the largest one of its worker processes so far, downloaded
+    bytes, HTTP requests and their latency, parsed and dropped raw data rows,
+    written bytes, and the time spent on each TMS station.
+
+    The counters are recorded into the innermost active stage. Recording is
+    thread-safe, so the fetch threads can record concurrently.
+    """
+
+    def __init__(self):
+        self.stages: List[StageMetrics] = []
+        self._active: List[StageMetrics] = []
+        self._lock = threading.Lock()
+
+    def _current(self) -> StageMetrics:
+        if self._active:
+            return self._active[-1]
+        if not self.stages or self.stages[-1].name != 'other':
+            self.stages.append(StageMetrics('other'))
+        return self.stages[-1]
+
+    @contextlib.contextmanager
+    def stage(self, name: Text):
+        """Context manager measuring a stage."""
+        stage = StageMetrics(name)
+        with self._lock:
+            self.stages.append(stage)
+            self._active.append(stage)
+        peak_was_reset = _reset_peak_rss()
+        wall_time0 = time.perf_counter()
+        cpu_time0 = _cpu_time()
+        try:
+            yield stage
+        finally:
+            stage.wall_time = time.perf_counter() - wall_time0
+            stage.cpu_time = _cpu_time() - cpu_time0
+            stage.peak_rss = _peak_rss(peak_was_reset)
+            stage.children_peak_rss = _children_peak_rss()
+            with self._lock:
+                self._active.remove(stage)
+
+    def count(self, counter: Text, value: int = 1):
+        """Increments a counter of the current stage."""
+        with self._lock:
+            self._current().counters[counter] += int(value)
+
+    def observe_http_request(self, latency: float, status_code: int, nbytes: int = 0):
+        """Records an HTTP request."""
+        with self._lock:
+            stage = self._current()
+            stage.counters['http_requests'] += 1
+            stage.counters['bytes_downloaded'] += int(nbytes)
+            stage.http_status_codes[status_code] = stage.http_status_codes.get(status_code, 0) + 1
+            stage.latency_sum += latency
+            for i, upper_bound in enumerate(_latency_buckets):
+                if latency <= upper_bound:
+                    stage.latency_bucket_counts[i] += 1
+                    break
+
+    def observe_station(self, tms_num: int, seconds: float, step: Optional[Text] = None):
+        """
+        Records the time spent on a TMS station in the current stage, and in
+        a step of it (e.g. 'fetch' or 'aggregate' in the pipelined mode).
+        """
+        with self._lock:
+            stage = self._current()
+            stage.station_timings.append((int(tms_num), step or stage.name, float(seconds)))
+
+    def write_json_lines(self, path: Text):
+        """
+        Appends the metrics to a file as JSON lines: one line for each stage
+        and one line for each station timing.
+        """
+        run = datetime.datetime.now().isoformat()
+        with open(path, 'a') as f:
+            for stage in self.stages:
+                f.write(json.dumps(dict(run=run, **stage.as_dict())) + '\n')
+                for tms_num, step, seconds in stage.station_timings:
+                    f.write(json.dumps({'run': run, 'type': 'station', 'stage': stage.name, 'step': step,
+                                        'tms': tms_num, 'seconds': seconds}) + '\n')
+
+    def write_prometheus(self, path: Text):
+        """
+        Writes the metrics in the Prometheus text exposition format, e.g. for
+        the textfile collector of the node exporter. The file is replaced
+        atomically.
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP fin_traffic_{name} {help_text}')
+            lines.append(f'# TYPE fin_traffic_{name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'fin_traffic_{name}{suffix}{{{label_text}}} {value}')
+
+        metric('stage_wall_seconds', 'gauge', 'Wall time of the stage.',
+               [('', {'stage': s.name}, s.wall_time) for s in self.stages])
+        metric('stage_cpu_seconds', 'gauge', 'CPU time of the stage including worker processes.',
+               [('', {'stage': s.name}, s.cpu_time) for s in self.stages])
+        metric('stage_peak_rss_bytes', 'gauge', 'Peak resident set size during the stage.',
+               [('', {'stage': s.name}, s.peak_rss) for s in self.stages])
+        metric('children_peak_rss_bytes', 'gauge', 'Largest peak resident set size of the finished worker processes.',
+               [('', {}, max([s.children_peak_rss for s in self.stages], default=0))])
+        for counter in _counters:
+            metric(f'stage_{counter}', 'gauge', f'{counter.replace("_", " ").capitalize()} in the stage.',
+                   [('', {'stage': s.name}, s.counters[counter]) for s in self.stages])
+        metric('stage_http_responses', 'gauge', 'HTTP responses in the stage by status code.',
+               [('', {'stage': s.name, 'code': code}, n)
+                for s in self.stages for code, n in sorted(s.http_status_codes.items())])
+
+        samples: List[Tuple[Text, Dict[Text, Text], float]] = []
+        for s in self.stages:
+            cumulative = 0
+            for upper_bound, n in zip(_latency_buckets, s.latency_bucket_counts):
+                cumulative += n
+                le = '+Inf' if upper_bound == float('inf') else str(upper_bound)
+                samples.append(('_bucket', {'stage': s.name, 'le': le}, cumulative))
+            samples.append(('_sum', {'stage': s.name}, s.latency_sum))
+            samples.append(('_count', {'stage': s.name}, cumulative))
+        metric('http_request_duration_seconds', 'histogram', 'Latency of the HTTP requests.', samples)
+
+        # A station is timed once for every date interval, and a series may
+        # only have one sample
+        station_seconds: Dict[Tuple[Text, Text, int], float] = {}
+        for s in self.stages:
+            for tms_num, step, seconds in s.station_timings:
+                station_seconds[(s.name, step, tms_num)] = station_seconds.get((s.name, step, tms_num), 0.0) + seconds
+        metric('station_seconds', 'gauge', 'Time spent on a TMS station.',
+               [('', {'stage': stage, 'step': step, 'tms': tms_num}, seconds)
+                for (stage, step, tms_num), seconds in station_seconds.items()])
+
+        partial_path = path + '.partial'
+        with open(partial_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(partial_path, path)
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """The metrics of the current run."""
+    return _metrics
+
+
+def reset_metrics() -> Metrics:
+    """Starts collecting the metrics of a new run."""
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def write_metrics(metrics: Metrics, json_path: Optional[Text] = None, prometheus_path: Optional[Text] = None):
+    """Writes the metrics into the files that are given."""
+    if json_path is not None:
+        metrics.write_json_lines(json_path)
+    if prometheus_path is not None:
+        metrics.write_prometheus(prometheus_path)
@@ -0,0 +1,410 @@
+"""
+Local HTTP server simulating the Väylä raw data server and the digitraffic
+station metadata, e.g. for trying out the scripts and for load tests without
+touching the real servers.
+
+By default every lamraw_<tms>_<yy>_<day>.csv file is a full day of synthetic
+vehicles (see fin_traffic_data.synthetic). With --rows-per-second the
+datafiles grow while the server runs instead, e.g. for trying out
+fin-traffic-tail-raw-data:
+
+    fin-traffic-mock-server --port 8000 --rows-per-second 5
+    fin-traffic-tail-raw-data --time-resolution 15m --poll-interval 5 \
+        --tms 101 --ely-id 1 --base-url http://localhost:8000/
+
+The station metadata is served at any path ending in tms-stations, and the
+statistics of the served requests and injected faults at /_stats.
+"""
+import re
+import json
+import time
+import zlib
+import random
+import datetime
+import threading
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Text
+
+_lamraw_path = re.compile(r".*/lamraw_(?P<tms_id>\d+)_(?P<year>\d{2})_(?P<day_number>\d+)\.csv$")
+_stations_path = re.compile(r".*/tms-stations/?$")
+_stats_path = '/_stats'
+
+# Status codes of the injected server errors
+_error_status_codes = [500, 503]
+
+
+def _raw_data_row(tms_id: int, year: int, day_number: int, i: int, seconds_of_day: float) -> bytes:
+    """Row i of a synthetic raw datafile recorded at the given second of the day."""
+    seconds_of_day = min(seconds_of_day, 86399.999)
+    hour, rest = divmod(seconds_of_day, 3600)
+    minute, second = divmod(rest, 60)
+    millisecond = int((second % 1) * 1000)
+    direction = 1 + i % 2
+    category = 1 + (i * 7919) % 7
+    speed = 60 + (i * 31) % 60
+    return (f"{tms_id};{year};{day_number};{int(hour)};{int(minute)};{int(second)};{millisecond};"
+            f"4.5;{direction};{direction};{category};{speed};0;300;0;0\n").encode('ascii')
+
+
+@functools.lru_cache(maxsize=256)
+def _synthetic_raw_data(tms_id: int, year: int, day_number: int, vehicles_per_day: float, seed: int) -> bytes:
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.synthetic import generate_lamraw_text
+
+    date = datetime.date(2000 + year, 1, 1) + datetime.timedelta(days=day_number - 1)
+    return generate_lamraw_text(tms_id, date, vehicles_per_day, seed).encode('ascii')
+
+
+def synthetic_tms_stations(num_stations: Optional[int] = None, seed: int = 2020) -> Dict:
+    """
+    Station metadata in the GeoJSON format of digitraffic for the stations
+    of fin_traffic_data.synthetic.synthetic_tms_nums, in randomly chosen
+    municipalities. More stations than there are stations over the borders
+    get numbers after the largest of them.
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.metadata import get_municipality_info
+    from fin_traffic_data.synthetic import synthetic_tms_nums
+
+    tms_nums = synthetic_tms_nums()
+    if num_stations is not None:
+        tms_nums = tms_nums[:num_stations]
+        tms_nums += list(range(tms_nums[-1] + 1, tms_nums[-1] + 1 + num_stations - len(tms_nums)))
+    municipalities = get_municipality_info()
+    rng = random.Random(seed)
+    features = []
+    for tms_num in tms_nums:
+        municipality, dir1, dir2 = (rng.choice(municipalities.index) for _ in range(3))
+        features.append({
+            'type': 'Feature',
+            'id': 20000 + tms_num,
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [round(rng.uniform(21.0, 30.0), 6), round(rng.uniform(60.0, 69.0), 6), 0.0],
+            },
+            'properties': {
+                'id': 20000 + tms_num,
+                'tmsNumber': tms_num,
+                'municipalityCode': int(municipality),
+                'provinceCode': int(municipalities.loc[municipality, 'provinceNumber']),
+                'direction1MunicipalityCode': int(dir1),
+                'direction2MunicipalityCode': int(dir2),
+            },
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+class MockServerConfig:
+
+    """
+    Content and fault injection of the mock server.
+
+    Faults are decided per request in this order: a path matching one of
+    not_found_patterns, or a datafile among the missing_rate share of them
+    (always the same ones), gets 404; a request of a datafile over the
+    request rate gets 429; error_rate of the other requests of datafiles get
+    a random one of 500 and 503. Every response is delayed by latency plus
+    a uniform jitter, and the body is sent at most at bandwidth bytes per
+    second.
+    """
+
+    def __init__(self, rows_per_second: Optional[float] = None, vehicles_per_day: float = 10000,
+                 seed: int = 2020, num_stations: Optional[int] = None, stations: Optional[Dict] = None,
+                 latency: float = 0.0, latency_jitter: float = 0.0, error_rate: float = 0.0,
+                 not_found_patterns: Optional[List[Text]] = None, missing_rate: float = 0.0,
+                 max_requests_per_second: Optional[float] = None, bandwidth: Optional[float] = None):
+        """
+        Input
+        -----
+        rows_per_second: Optional[float]
+            If given, the datafiles grow by this many rows per second since
+            the server started instead of being full days of synthetic data
+        vehicles_per_day: float
+            Mean number of vehicles in a full day of synthetic data
+        seed: int
+            Seed of the synthetic data and of the injected faults
+        num_stations: Optional[int]
+            Number of the stations in the station metadata
+        stations: Optional[Dict]
+            Station metadata (GeoJSON) to serve instead of synthetic stations
+        latency, latency_jitter: float
+            Delay of every response in seconds, and the maximum of a random
+            delay added to it
+        error_rate: float
+            Share of the requests of datafiles answered with a server error
+        not_found_patterns: Optional[List[Text]]
+            Regular expressions of the paths answered with 404
+        missing_rate: float
+            Share of the datafiles answered with 404
+        max_requests_per_second: Optional[float]
+            Requests of datafiles over this rate (a token bucket with a
+            burst of one second) are answered with 429
+        bandwidth: Optional[float]
+            Bytes per second at most sent in a response body
+        """
+        self.rows_per_second = rows_per_second
+        self.vehicles_per_day = vehicles_per_day
+        self.seed = seed
+        self.num_stations = num_stations
+        self.stations = stations
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.not_found_patterns = [re.compile(p) for p in not_found_patterns or []]
+        self.missing_rate = missing_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.bandwidth = bandwidth
+
+
+class MockServer(ThreadingHTTPServer):
+
+    """HTTP server of MockDataHandler, keeping the state shared by the requests."""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, config: MockServerConfig):
+        super().__init__(server_address, MockDataHandler)
+        self.config = config
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._rng = random.Random(config.seed)
+        # Tokens of the request rate limit, if any
+        self._tokens = config.max_requests_per_second or 0.0
+        self._tokens_updated = time.monotonic()
+        self._stations: Optional[bytes] = None
+        # Statistics of the served requests, see statistics_json
+        self.requests = 0
+        self.bytes_sent = 0
+        self.status_codes: Dict[int, int] = {}
+        self.injected: Dict[Text, int] = {'not_found': 0, 'throttled': 0, 'errors': 0}
+
+    @property
+    def base_url(self) -> Text:
+        host, port = self.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode('ascii')
+        return f'http://{host}:{port}/'
+
+    @property
+    def raw_data_url(self) -> Text:
+        return self.base_url + 'lam/rawdata/'
+
+    @property
+    def stations_url(self) -> Text:
+        return self.base_url + 'api/v3/metadata/tms-stations'
+
+    def stations_json(self) -> bytes:
+        with self._lock:
+            if self._stations is None:
+                stations = self.config.stations or synthetic_tms_stations(self.config.num_stations,
+                                                                          self.config.seed)
+                self._stations = json.dumps(stations).encode('utf-8')
+            return self._stations
+
+    def injected_fault(self, path: Text) -> Optional[int]:
+        """Status code of the fault injected into a request, or None."""
+        config = self.config
+        is_datafile = _lamraw_path.match(path) is not None
+        with self._lock:
+            if (any(p.search(path) for p in config.not_found_patterns)
+                    or (is_datafile and zlib.crc32(path.encode('utf-8')) / 2**32 < config.missing_rate)):
+                self.injected['not_found'] += 1
+                return 404
+            if not is_datafile:
+                return None
+            if config.max_requests_per_second is not None:
+                now = time.monotonic()
+                self._tokens = min(config.max_requests_per_second,
+                                   self._tokens + (now - self._tokens_updated) * config.max_requests_per_second)
+                self._tokens_updated = now
+                if self._tokens < 1:
+                    self.injected['throttled'] += 1
+                    return 429
+                self._tokens -= 1
+            if self._rng.random() < config.error_rate:
+                self.injected['errors'] += 1
+                return self._rng.choice(_error_status_codes)
+        return None
+
+    def delay(self) -> float:
+        with self._lock:
+            return self.config.latency + self._rng.uniform(0, self.config.latency_jitter)
+
+    def record(self, status_code: int, nbytes: int):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += nbytes
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+
+    def statistics_json(self) -> Dict:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'bytes_sent': self.bytes_sent,
+                'status_codes': dict((str(code), n) for code, n in sorted(self.status_codes.items())),
+                'injected': dict(self.injected),
+            }
+
+
+class GrowingRawDataHandler(BaseHTTPRequestHandler):
+
+    """
+    Serves every lamraw_<tms>_<yy>_<day>.csv file with rows_per_second rows
+    appended per second since the server started. The responses support
+    Range requests and ETags like a static file server.
+    """
+
+    rows_per_second: float = 1.0
+    started: float = time.time()
+
+    def _content(self, tms_id: int, year: int, day_number: int) -> bytes:
+        elapsed = time.time() - self.started
+        start = datetime.datetime.fromtimestamp(self.started)
+        start_seconds = start.hour * 3600 + start.minute * 60 + start.second
+        num_rows = int(elapsed * self.rows_per_second)
+        return b''.join(
+            _raw_data_row(tms_id, year, day_number, i, start_seconds + i / self.rows_per_second)
+            for i in range(num_rows))
+
+    def _send_content(self, content: bytes, content_type: Text):
+        """Sends content as a static file server would, returning the status code."""
+        etag = f'"{len(content)}-{zlib.crc32(content)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return 304, 0
+
+        range_match = re.match(r"bytes=(?P<begin>\d+)-$", self.headers.get('Range', ''))
+        if range_match:
+            begin = int(range_match.group('begin'))
+            if begin >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(content)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return 416, 0
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {begin}-{len(content) - 1}/{len(content)}')
+            content = content[begin:]
+            status_code = 206
+        else:
+            self.send_response(200)
+            status_code = 200
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self._write_body(content)
+        return status_code, len(content)
+
+    def _write_body(self, content: bytes):
+        self.wfile.write(content)
+
+    def do_GET(self):
+        m = _lamraw_path.match(self.path)
+        if not m:
+            self.send_error(404)
+            return
+        content = self._content(int(m.group('tms_id')), int(m.group('year')), int(m.group('day_number')))
+        self._send_content(content, 'text/csv')
+
+
+class MockDataHandler(GrowingRawDataHandler):
+
+    """
+    Serves the raw datafiles and the station metadata configured by the
+    MockServerConfig of the server, injecting its faults.
+    """
+
+    server: MockServer
+
+    def setup(self):
+        super().setup()
+        # Datafiles grow only if the server is configured so
+        self.rows_per_second = self.server.config.rows_per_second or 0.0
+        self.started = self.server.started
+
+    def log_message(self, format, *args):
+        pass
+
+    def _write_body(self, content: bytes):
+        bandwidth = self.server.config.bandwidth
+        if not bandwidth:
+            self.wfile.write(content)
+            return
+        # Chunks of a tenth of a second
+        chunk_size = max(int(bandwidth / 10), 1)
+        for begin in range(0, len(content), chunk_size):
+            self.wfile.write(content[begin:begin + chunk_size])
+            time.sleep(len(content[begin:begin + chunk_size]) / bandwidth)
+
+    def _send_status(self, status_code: int):
+        self.send_response(status_code)
+        if status_code == 429:
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        if self.path == _stats_path:
+            content = json.dumps(server.statistics_json()).encode('utf-8')
+            self._send_content(content, 'application/json')
+            return
+
+        time.sleep(server.delay())
+        status_code, nbytes = server.injected_fault(self.path), 0
+        if status_code is not None:
+            self._send_status(status_code)
+        elif _stations_path.match(self.path):
+            status_code, nbytes = self._send_content(server.stations_json(), 'application/json')
+        elif _lamraw_path.match(self.path):
+            m = _lamraw_path.match(self.path)
+            tms_id, year, day_number = int(m.group('tms_id')), int(m.group('year')), int(m.group('day_number'))
+            if self.rows_per_second:
+                content = self._content(tms_id, year, day_number)
+            else:
+                content = _synthetic_raw_data(tms_id, year, day_number, server.config.vehicles_per_day,
+                                              server.config.seed)
+            status_code, nbytes = self._send_content(content, 'text/csv')
+        else:
+            status_code = 404
+            self._send_status(status_code)
+        server.record(status_code, nbytes)
+
+
+def start_mock_server(config: MockServerConfig, host: Text = 'localhost', port: int = 0) -> MockServer:
+    """
+    Starts the mock server in a background thread. Port 0 picks a free port,
+    see MockServer.base_url. Stop the server with shutdown() and
+    server_close().
+    """
+    server = MockServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_growing_raw_data(port: int = 8000, rows_per_second: float = 1.0):
+    """Serves growing raw datafiles on localhost until interrupted."""
+    GrowingRawDataHandler.rows_per_second = rows_per_second
+    GrowingRawDataHandler.started = time.time()
+    server = ThreadingHTTPServer(('localhost', port), GrowingRawDataHandler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def serve_mock_data(config: MockServerConfig, host: Text = 'localhost', port: int = 8000):
+    """Serves the mock data until interrupted."""
+    server = MockServer((host, port), config)
+    print(f"Raw datafiles at {server.raw_data_url}", flush=True)
+    print(f"Station metadata at {server.stations_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
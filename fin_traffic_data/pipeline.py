@@ -0,0 +1,399 @@
+import os
+import time
+import uuid
+import queue
+import pathlib
+import datetime
+import functools
+import tempfile
+import threading
+import multiprocessing
+from typing import Any, Dict, List, Optional, Text, Tuple
+
+import pandas as pd
+
+from fin_traffic_data import aggregation
+from fin_traffic_data.aggregation import (
+    _aggregate_core, _aggregate_frame, _copy_for_extension, _read_raw_data_chunk, _set_counts_version,
+    _station_has_raw_data, init, get_aggregated_file_path, check_no_daterange_overlap_in_raw_files,
+    check_all_dates_covered_by_raw_files
+)
+from fin_traffic_data.batching import FetchStatistics
+from fin_traffic_data.coverage import CoverageIndex
+from fin_traffic_data.metadata import get_tms_stations
+from fin_traffic_data.metrics import get_metrics
+from fin_traffic_data.raw_data import get_tms_raw_data
+from fin_traffic_data.registry import get_station_registry
+from fin_traffic_data.scripts.fetch_raw_data import get_raw_data_file_path, _write_raw_data
+from fin_traffic_data.scripts.get_aggregated_traffic_between_areas import (
+    get_tms_over_area_borders, get_area_aggregated_file_path, parse_border_tms,
+    compute_edge_traffic, visualize_area_graph, set_counts_version, set_edge_generations
+)
+from fin_traffic_data.scripts.export_area_data_as_csv import (
+    export_dataframe_member, write_archive, get_csv_archive_path
+)
+
+
+def _fetch_stations(stations, date_intervals, slots, events, stop):
+    """
+    Fetch thread. Takes stations (TMS number, ELY center ID) from the queue
+    until it is empty and puts their raw data of all the date intervals into
+    the event queue. A slot is taken for each station before fetching, so the
+    fetch threads wait while too many fetched stations are waiting to be
+    processed.
+    """
+    while True:
+        slots.acquire()
+        if stop.is_set():
+            return
+        try:
+            num, ely_id = stations.get_nowait()
+        except queue.Empty:
+            slots.release()
+            return
+        try:
+            time0 = time.perf_counter()
+            fetched = []
+            for begin_date, end_date in date_intervals:
+                completed_dates = []
+                absent_dates = []
+                df = get_tms_raw_data(ely_id, num, begin_date, end_date, False, completed_dates=completed_dates,
+                                      absent_dates=absent_dates)
+                fetched.append((begin_date, end_date, df, completed_dates, absent_dates))
+        except Exception as e:
+            events.put(('error', num, e))
+            return
+        events.put(('fetched', num, (fetched, time.perf_counter() - time0)))
+
+
+def _put_event(events, event, key, payload):
+    """Puts an event of a worker task into the event queue, e.g. as the callback of the task."""
+    events.put((event, key, payload))
+
+
+def _extend_station(tms_num, mintime, maxtime, delta_t, raw_data_files, extra_frames, result_path,
+                    extended_from, rows) -> pd.DataFrame:
+    """
+    Aggregates the raw data of a TMS station from extended_from on and
+    appends it to the rows copied to result_path from the previous time
+    aggregated datafile (see _copy_for_extension).
+
+    Returns
+    -------
+    The aggregated data of the whole time range as stored in the results
+    """
+    frames = [_read_raw_data_chunk(tms_num, raw_data_files, extended_from, maxtime)]
+    frames += [df.loc[df['time'] >= extended_from] for df in extra_frames]
+    frames = [df for df in frames if df is not None and not df.empty]
+    df = _aggregate_frame(pd.concat(frames, ignore_index=True) if frames else None, extended_from, maxtime, delta_t)
+    with aggregation.lock:
+        with pd.HDFStore(result_path, mode='a') as store:
+            key = f'tms_{tms_num}'
+            # As stored by _aggregate_core for the whole time range
+            df['counts'] = df['counts'].astype(store.select(key, start=0, stop=1)['counts'].dtype)
+            df.index = pd.RangeIndex(rows, rows + df.shape[0])
+            store.append(key, df, format='table', data_columns=['time'])
+            return store.select(key)
+
+
+def _aggregate_station(kwds, extension=None):
+    """
+    Aggregation task of a station. Returns the aggregated counts and the
+    seconds spent.
+
+    With extension, a tuple (time of the first time bucket to aggregate,
+    rows of the station copied from the previous time aggregated datafile,
+    whether the station had raw data before), only the raw data from that
+    time on is aggregated. A station with its first raw data is aggregated
+    over the whole time range, as its counts change type.
+    """
+    time0 = time.perf_counter()
+    if extension is not None:
+        extended_from, rows, had_data = extension
+        if had_data or all(df.empty for df in kwds['extra_frames']):
+            df = _extend_station(kwds['tms_num'], kwds['mintime'], kwds['maxtime'], kwds['delta_t'],
+                                 kwds['raw_data_files'], kwds['extra_frames'], kwds['result_path'],
+                                 extended_from, rows)
+            return df, time.perf_counter() - time0
+    df = _aggregate_core(**kwds)
+    return df, time.perf_counter() - time0
+
+
+def run_pipelined(logger,
+                  date_intervals: List[Tuple[datetime.date, datetime.date]],
+                  raw_data_files: List[Tuple[Text, datetime.date, datetime.date]],
+                  time_resolution: datetime.timedelta,
+                  aggregation_levels: List[Text],
+                  results_dir_fetch: Text,
+                  results_dir_aggregate: Text,
+                  results_dir_traffic: Text,
+                  visualize_bool: bool = False,
+                  fetch_threads: int = 4,
+                  workers: int = 6,
+                  max_pending: int = 32,
+                  codec: Text = 'bz2',
+                  extend_from: Optional[Text] = None) -> Dict:
+    """
+    Fetches the raw data of new date intervals, aggregates it by time and by
+    area and exports the areas as CSV archives with the stages running
+    concurrently instead of one after another.
+
+    - Fetch threads download the raw data station by station.
+    - As soon as a station is downloaded, its raw data is stored and sent
+      directly to the aggregation workers, together with its older raw
+      datafiles. If the time aggregated datafile of an earlier run can be
+      extended, only the new time buckets are aggregated.
+    - As soon as all the stations of an edge between two areas are
+      aggregated, the traffic of the edge is computed and stored, and the
+      edge is formatted and compressed as a member of the CSV archive by the
+      same workers.
+    - The archives are assembled from the members when all edges are done.
+
+    The time and area aggregated datafiles are written to partial files that
+    replace the datafiles only when all the stations and edges are done, so
+    an interrupted run leaves no half-written aggregated datafiles behind.
+    The raw data is written directly to the raw datafiles station by
+    station, as by fin-traffic-fetch-raw-data. The coverage index records
+    the stored station-days, and the raw datafiles are registered in the
+    catalog only after a complete run.
+
+    At most max_pending stations are between being fetched and being
+    aggregated at a time; the fetch threads wait for free slots, which keeps
+    the memory use bounded when aggregation is slower than the network. The
+    aggregated counts of a station are kept in memory only until all the
+    edges using it are computed.
+
+    Input
+    -----
+    logger: logging.Logger
+    date_intervals: List[Tuple[datetime.date, datetime.date]]
+        Date intervals to fetch, each stored in its own raw datafile
+    raw_data_files: List[Tuple[Text, datetime.date, datetime.date]]
+        Earlier raw datafiles to include in the aggregation
+    time_resolution: datetime.timedelta
+        Time resolution of the aggregation
+    aggregation_levels: List[Text]
+        Area aggregation levels ('province', 'erva' or 'hcd')
+    results_dir_fetch, results_dir_aggregate, results_dir_traffic: Text
+        Directories of the raw, time aggregated and area aggregated datafiles
+    visualize_bool: bool
+        Whether to draw the graphs of the areas
+    fetch_threads: int
+        Number of concurrent downloads
+    workers: int
+        Number of aggregation and export worker processes
+    max_pending: int
+        Maximum number of stations fetched but not yet aggregated
+    codec: Text
+        Compression of the CSV archives
+    extend_from: Optional[Text]
+        Time aggregated datafile of an earlier run with the same begin date
+        and time resolution, to be extended as by aggregate_datafiles_chunked
+
+    Returns
+    -------
+    Dict with
+        - 'raw': list of the new raw datafiles (filename, begin date, end date)
+        - 'time': path to the time aggregated datafile
+        - 'area': dict from aggregation level to the area aggregated datafile
+        - 'export': dict from aggregation level to the CSV archive
+    """
+    new_raw_data_files = [(get_raw_data_file_path(results_dir_fetch, begin_date, end_date), begin_date, end_date)
+                          for begin_date, end_date in date_intervals]
+    all_raw_data_files = sorted(raw_data_files + new_raw_data_files, key=lambda f: f[1])
+    check_no_daterange_overlap_in_raw_files(all_raw_data_files)
+    check_all_dates_covered_by_raw_files(all_raw_data_files)
+    first_date = all_raw_data_files[0][1]
+    last_date = max(f[2] for f in all_raw_data_files)
+    time0 = datetime.datetime(year=first_date.year, month=first_date.month, day=first_date.day)
+    time_end = datetime.datetime(year=last_date.year, month=last_date.month, day=last_date.day)
+    time_aggregated_file = get_aggregated_file_path(results_dir_aggregate, time0, time_end, time_resolution)
+
+    tms_stations = get_tms_stations()
+    registry = get_station_registry(tms_stations)
+    tms_nums = registry.tms_nums.tolist()
+
+    # Edges of all the aggregation levels and the stations they wait for
+    edges = {}
+    edges_of_station = dict((num, []) for num in tms_nums)
+    tms_over_area_borders = {}
+    for area in aggregation_levels:
+        tms_over_area_borders[area] = get_tms_over_area_borders(area)
+        for _, row in tms_over_area_borders[area].iterrows():
+            edge = (area, f"{row['source']}:{row['destination']}")
+            tms_infos = parse_border_tms(row['tms'])
+            waiting = set(int(tms_num) for tms_num, _ in tms_infos)
+            unknown = waiting - set(tms_nums)
+            if unknown:
+                raise RuntimeError(f"TMS stations {sorted(unknown)} of the edge {edge[1]} are not known.")
+            edges[edge] = (tms_infos, waiting)
+            for num in waiting:
+                edges_of_station[num].append(edge)
+
+    for results_dir in [results_dir_fetch, results_dir_aggregate, results_dir_traffic]:
+        pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+    area_files = dict((area, get_area_aggregated_file_path(results_dir_traffic, area, time_aggregated_file))
+                      for area in aggregation_levels)
+    time_partial_path = time_aggregated_file + '.partial'
+    area_partial_paths = dict((area, path + '.partial') for area, path in area_files.items())
+    for partial_path in [time_partial_path] + list(area_partial_paths.values()):
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    extension = None
+    if extend_from is not None and os.path.abspath(extend_from) != os.path.abspath(time_aggregated_file):
+        with_data = _station_has_raw_data(raw_data_files)
+        extension = _copy_for_extension(extend_from, time_partial_path, tms_nums, with_data, False, time_end)
+    if extension is not None:
+        extended_from, rows_left = extension
+        extended_from = extended_from.to_pydatetime()
+        logger.info('Extending the time aggregated datafile %s from %s' % (extend_from, extended_from))
+
+    coverage = CoverageIndex.open(results_dir_fetch, tms_nums)
+    statistics = FetchStatistics.open(results_dir_fetch)
+    metrics = get_metrics()
+    # Events (kind, TMS number or edge, payload) of the fetch threads and workers
+    events: queue.Queue[Tuple[Text, Any, Any]] = queue.Queue()
+    slots = threading.Semaphore(max_pending)
+    stop = threading.Event()
+    stations: queue.Queue[Tuple[int, int]] = queue.Queue()
+    for num, ely_id in registry.station_ely_ids().items():
+        stations.put((num, ely_id))
+
+    aggregated = {}
+    # Whether each computed edge has rows to export
+    computed = {}
+    members: Dict[Text, Dict[Text, Any]] = dict((area, {}) for area in aggregation_levels)
+    generations: Dict[Text, Dict[Text, Text]] = dict((area, {}) for area in aggregation_levels)
+    remaining_stations = len(tms_nums)
+    remaining_exports = 0
+
+    with tempfile.TemporaryDirectory(dir=results_dir_traffic) as tmpdir:
+        # The worker processes are started before the fetch threads
+        lock = multiprocessing.Lock()
+        pool = multiprocessing.Pool(workers, initializer=init, initargs=(lock, ))
+        threads = [
+            threading.Thread(target=_fetch_stations,
+                             args=(stations, date_intervals, slots, events, stop),
+                             daemon=True)
+            for _ in range(fetch_threads)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while remaining_stations > 0 or remaining_exports > 0:
+                event, key, payload = events.get()
+                if event == 'error':
+                    raise payload
+
+                elif event == 'fetched':
+                    num = key
+                    fetched, seconds = payload
+                    metrics.observe_station(num, seconds, step='fetch')
+                    frames = []
+                    for begin_date, end_date, df, completed_dates, absent_dates in fetched:
+                        if df is not None:
+                            _write_raw_data(df, get_raw_data_file_path(results_dir_fetch, begin_date, end_date), num)
+                            frames.append(df)
+                        coverage.mark(num, completed_dates)
+                        coverage.mark_absent(num, absent_dates)
+                        statistics.record(df)
+                    logger.debug('Fetched TMS %s' % (num, ))
+                    pool.apply_async(_aggregate_station,
+                                     (dict(tms_num=num,
+                                           mintime=time0,
+                                           maxtime=time_end,
+                                           delta_t=time_resolution,
+                                           raw_data_files=raw_data_files,
+                                           append_to_file=None,
+                                           results_dir=results_dir_aggregate,
+                                           extra_frames=frames,
+                                           result_path=time_partial_path),
+                                      None if extension is None else
+                                      (extended_from, rows_left[num], num in with_data)),
+                                     callback=functools.partial(_put_event, events, 'aggregated', num),
+                                     error_callback=functools.partial(_put_event, events, 'error', num))
+
+                elif event == 'aggregated':
+                    num = key
+                    remaining_stations -= 1
+                    slots.release()
+                    logger.debug('Aggregated TMS %s, %d stations left' % (num, remaining_stations))
+                    aggregated[num], seconds = payload
+                    metrics.observe_station(num, seconds, step='aggregate')
+                    # The edges are removed from the lists while iterating
+                    for edge in list(edges_of_station[num]):
+                        tms_infos, waiting = edges[edge]
+                        waiting.discard(num)
+                        if waiting:
+                            continue
+                        area, edge_key = edge
+                        df = compute_edge_traffic(tms_infos, lambda tms_num: aggregated[int(tms_num)])
+                        for tms_num, _ in tms_infos:
+                            edges_of_station[int(tms_num)].remove(edge)
+                        computed[edge] = df is not None
+                        if df is None:
+                            continue
+                        df.to_hdf(area_partial_paths[area], key=edge_key, complevel=9, format='table')
+                        generations[area][edge_key] = uuid.uuid4().hex
+                        logger.debug('Computed %s edge %s' % (area, edge_key))
+                        remaining_exports += 1
+                        pool.apply_async(export_dataframe_member,
+                                         (df, codec, tmpdir, generations[area][edge_key]),
+                                         callback=functools.partial(_put_event, events, 'exported', edge),
+                                         error_callback=functools.partial(_put_event, events, 'error', edge))
+                    # Keep the aggregated counts only while edges still need them
+                    for tms_num in list(aggregated.keys()):
+                        if not edges_of_station[tms_num]:
+                            del aggregated[tms_num]
+
+                elif event == 'exported':
+                    area, edge_key = key
+                    remaining_exports -= 1
+                    members[area]['/' + edge_key] = payload
+            pool.close()
+        except BaseException:
+            stop.set()
+            pool.terminate()
+            raise
+        finally:
+            # Release the fetch threads waiting for a slot
+            for _ in threads:
+                slots.release()
+            pool.join()
+            coverage.save()
+            statistics.save()
+
+        missing = sorted(f'{area} {edge_key}' for area, edge_key in edges if (area, edge_key) not in computed)
+        if missing:
+            raise RuntimeError(f"Edges {missing} were not computed.")
+        missing = sorted(f'{area} {edge_key}' for (area, edge_key), has_rows in computed.items()
+                         if has_rows and '/' + edge_key not in members[area])
+        if missing:
+            raise RuntimeError(f"Edges {missing} were not exported.")
+
+        if os.path.isfile(time_partial_path):
+            with pd.HDFStore(time_partial_path, mode='a') as store:
+                _set_counts_version(store)
+            os.replace(time_partial_path, time_aggregated_file)
+        export_paths = {}
+        for area in aggregation_levels:
+            if os.path.isfile(area_partial_paths[area]):
+                set_edge_generations(area_partial_paths[area], generations[area])
+                set_counts_version(area_partial_paths[area])
+                os.replace(area_partial_paths[area], area_files[area])
+            export_paths[area] = get_csv_archive_path(area_files[area], codec)
+            keys = sorted(members[area].keys())
+            write_archive(outputpath=export_paths[area],
+                          codec=codec,
+                          tmpdir=tmpdir,
+                          members=[(key, members[area][key]) for key in keys])
+            if visualize_bool:
+                visualize_area_graph(area, tms_over_area_borders[area])
+
+    return {
+        'raw': [f for f in new_raw_data_files if os.path.isfile(f[0])],
+        'time': time_aggregated_file,
+        'area': area_files,
+        'export': export_paths,
+    }
@@ -0,0 +1,238 @@
+import os
+import json
+import datetime
+from typing import Iterable, Optional, Text, Tuple
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.aggregation import _counts_version, _directions, _vehicle_categories, get_counts_version
+
+
+def get_prefix_sum_index_paths(aggregated_file: Text) -> Tuple[Text, Text]:
+    """Paths to the array and to the description of the prefix-sum index of a time aggregated datafile"""
+    return aggregated_file + '.cumsum.npy', aggregated_file + '.cumsum.json'
+
+
+def _read_station_counts(store, key, time0, delta_t, num_times, since=0) -> np.ndarray:
+    """
+    Counts of a station in the buckets since the given one, as an array of
+    shape (buckets, directions, vehicle categories).
+    """
+    start = time0 + since * delta_t
+    if store.get_storer(key).is_table:
+        df = store.select(key, where='time >= start', columns=['time', 'direction', 'vehicle category', 'counts'])
+    else:
+        df = store.select(key)
+        df = df.loc[df['time'] >= start]
+    counts = np.zeros((num_times - since, len(_directions), len(_vehicle_categories)), dtype=np.int64)
+    buckets = ((df['time'] - start) // delta_t).to_numpy()
+    directions = df['direction'].to_numpy().astype(int) - 1
+    categories = df['vehicle category'].to_numpy().astype(int) - 1
+    valid = ((buckets >= 0) & (buckets < counts.shape[0]) &
+             (directions >= 0) & (directions < len(_directions)) &
+             (categories >= 0) & (categories < len(_vehicle_categories)))
+    np.add.at(counts, (buckets[valid], directions[valid], categories[valid]),
+              df['counts'].to_numpy()[valid].astype(np.int64))
+    return counts
+
+
+class PrefixSumIndex:
+
+    """
+    Cumulative sums over time of the time aggregated counts of every TMS
+    station, direction and vehicle category, stored next to the time
+    aggregated datafile.
+
+    cumsum[s, i] is the total of station s in the first i buckets, so the
+    total over any range of buckets is the difference of two rows, and the
+    counts at any multiple of the time resolution are differences of every
+    m-th row. The array is memory mapped, so a query reads only the rows it
+    needs.
+    """
+
+    def __init__(self, cumsum: np.ndarray, time0: datetime.datetime, delta_t: datetime.timedelta,
+                 tms_nums: Iterable[int], counts_version: int = _counts_version):
+        """
+        Input
+        -----
+        cumsum: numpy.ndarray
+            Array of shape (stations, buckets + 1, directions, vehicle categories)
+        time0: datetime.datetime
+            Beginning of the first bucket
+        delta_t: datetime.timedelta
+            Time resolution
+        tms_nums: Iterable[int]
+            Numbers of the TMS stations of the rows of cumsum
+        counts_version: int
+            Version of the counts the index was built from, see
+            fin_traffic_data.aggregation._counts_version
+        """
+        self.cumsum = cumsum
+        self.time0 = time0
+        self.delta_t = delta_t
+        self.tms_nums = [int(num) for num in tms_nums]
+        self.counts_version = counts_version
+        self._station_row = dict((num, i) for i, num in enumerate(self.tms_nums))
+
+    @property
+    def num_times(self) -> int:
+        return self.cumsum.shape[1] - 1
+
+    @property
+    def time_end(self) -> datetime.datetime:
+        return self.time0 + self.num_times * self.delta_t
+
+    @classmethod
+    def open(cls, aggregated_file: Text) -> Optional['PrefixSumIndex']:
+        """Opens the index of a time aggregated datafile, or returns None if it has none."""
+        array_path, info_path = get_prefix_sum_index_paths(aggregated_file)
+        try:
+            with open(info_path, 'r') as f:
+                info = json.load(f)
+            cumsum = np.load(array_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        return cls(cumsum,
+                   time0=datetime.datetime.fromisoformat(info['time0']),
+                   delta_t=datetime.timedelta(seconds=info['delta_t']),
+                   tms_nums=info['tms_nums'],
+                   counts_version=info.get('counts_version', 1))
+
+    def _rows(self, tms_nums) -> np.ndarray:
+        try:
+            return np.array([self._station_row[int(num)] for num in tms_nums], dtype=int)
+        except KeyError as e:
+            raise KeyError(f"TMS station {e.args[0]} is not in the index") from None
+
+    def _bucket(self, t) -> int:
+        """Number of the buckets beginning before t."""
+        t = pd.Timestamp(t).to_pydatetime()
+        i = -(-(t - self.time0) // self.delta_t)
+        return int(min(max(i, 0), self.num_times))
+
+    def totals(self, tms_nums, t0, t1) -> np.ndarray:
+        """
+        Totals of the TMS stations over the buckets beginning in [t0, t1).
+
+        Returns
+        -------
+        numpy.ndarray of shape (stations, directions, vehicle categories)
+        """
+        rows = self._rows(tms_nums)
+        i0, i1 = self._bucket(t0), self._bucket(t1)
+        if i1 <= i0:
+            return np.zeros((rows.size, len(_directions), len(_vehicle_categories)), dtype=np.int64)
+        return np.asarray(self.cumsum[rows, i1]) - np.asarray(self.cumsum[rows, i0])
+
+    def total(self, tms_num: int, t0, t1, direction: Optional[int] = None,
+              vehicle_category: Optional[int] = None):
+        """
+        Total of a TMS station over the buckets beginning in [t0, t1), in
+        one direction and vehicle category if given, otherwise summed over
+        them.
+        """
+        totals = self.totals([tms_num], t0, t1)[0]
+        if direction is not None:
+            totals = totals[direction - 1:direction]
+        if vehicle_category is not None:
+            totals = totals[:, vehicle_category - 1:vehicle_category]
+        return int(totals.sum())
+
+    def resample(self, tms_nums, resolution: datetime.timedelta, t0=None, t1=None):
+        """
+        Counts of the TMS stations at a coarser time resolution, which must be
+        a multiple of the resolution of the index.
+
+        Returns
+        -------
+        Tuple of the beginnings of the new buckets and an array of shape
+        (stations, buckets, directions, vehicle categories). A last partial
+        bucket is left out.
+        """
+        if resolution % self.delta_t:
+            raise ValueError(f"Resolution {resolution} is not a multiple of {self.delta_t}")
+        step = resolution // self.delta_t
+        rows = self._rows(tms_nums)
+        i0 = self._bucket(self.time0 if t0 is None else t0)
+        i1 = self._bucket(self.time_end if t1 is None else t1)
+        edges = np.arange(i0, i1 + 1, step)
+        times = [self.time0 + int(i) * self.delta_t for i in edges[:-1]]
+        cumsum = np.asarray(self.cumsum[rows[:, None], edges[None, :]])
+        return times, np.diff(cumsum, axis=1)
+
+
+def build_prefix_sum_index(aggregated_file: Text, time0: datetime.datetime, time_end: datetime.datetime,
+                           delta_t: datetime.timedelta, extend_from: Optional[Text] = None) -> PrefixSumIndex:
+    """
+    Builds the prefix-sum index of a time aggregated datafile.
+
+    If extend_from is a time aggregated datafile with an index, the same
+    beginning and time resolution, and data that is a prefix of the data of
+    aggregated_file (e.g. the file of an earlier end date), the rows of its
+    index are copied and only the newer rows of aggregated_file are read.
+    An index built from counts of an earlier version is not extended, and
+    the index is built from all the rows.
+
+    Input
+    -----
+    aggregated_file: Text
+        Path to the time aggregated datafile
+    time0, time_end: datetime.datetime
+        Time range of the datafile
+    delta_t: datetime.timedelta
+        Time resolution
+    extend_from: Optional[Text]
+        Path to an earlier time aggregated datafile
+
+    Returns
+    -------
+    The index
+    """
+    num_times = (time_end - time0) // delta_t
+    previous = None
+    if extend_from is not None and os.path.isfile(extend_from):
+        previous = PrefixSumIndex.open(extend_from)
+        if previous is not None and (previous.time0 != time0 or previous.delta_t != delta_t
+                                     or previous.num_times > num_times
+                                     or previous.counts_version != _counts_version
+                                     or get_counts_version(extend_from) != _counts_version):
+            previous = None
+
+    array_path, info_path = get_prefix_sum_index_paths(aggregated_file)
+    partial_path = array_path + '.partial.npy'
+    with pd.HDFStore(aggregated_file, mode='r') as store:
+        keys = sorted(store.keys(), key=lambda k: int(k.rsplit('_', 1)[1]))
+        tms_nums = [int(key.rsplit('_', 1)[1]) for key in keys]
+        cumsum = np.lib.format.open_memmap(
+            partial_path, mode='w+', dtype=np.int64,
+            shape=(len(keys), num_times + 1, len(_directions), len(_vehicle_categories)))
+        for row, (key, tms_num) in enumerate(zip(keys, tms_nums)):
+            since = 0
+            cumsum[row, 0] = 0
+            if previous is not None and tms_num in previous._station_row:
+                since = previous.num_times
+                cumsum[row, :since + 1] = previous.cumsum[previous._station_row[tms_num]]
+            counts = _read_station_counts(store, key, time0, delta_t, num_times, since)
+            cumsum[row, since + 1:] = cumsum[row, since] + np.cumsum(counts, axis=0)
+        cumsum.flush()
+        del cumsum
+
+    # The description is written last, so the index is opened only when complete
+    if os.path.exists(info_path):
+        os.remove(info_path)
+    os.replace(partial_path, array_path)
+    info = {
+        'time0': time0.isoformat(),
+        'delta_t': delta_t.total_seconds(),
+        'tms_nums': tms_nums,
+        # The index of a datafile counted before the count fix has its version
+        'counts_version': get_counts_version(aggregated_file),
+    }
+    with open(info_path + '.partial', 'w') as f:
+        json.dump(info, f)
+    os.replace(info_path + '.partial', info_path)
+    index = PrefixSumIndex.open(aggregated_file)
+    if index is None:
+        raise OSError(f"Cannot open the prefix-sum index of {aggregated_file}")
+    return index
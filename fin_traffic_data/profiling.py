@@ -0,0 +1,192 @@
+import os
+import sys
+import pathlib
+import contextlib
+from collections import defaultdict
+from typing import Optional, Text
+
+# Environment variables passing the profiling options to the worker processes
+_profile_env = 'FIN_TRAFFIC_PROFILE'
+_profile_dir_env = 'FIN_TRAFFIC_PROFILE_DIR'
+_profile_name_env = 'FIN_TRAFFIC_PROFILE_NAME'
+
+_profilers = ['cpu', 'mem']
+
+# Number of the largest allocation sites in the memory profiles
+_top_allocations = 50
+
+# Number of frames stored for each memory allocation
+_traceback_frames = 25
+
+# Paths of the CPU profile carrying less than this fraction of the total time
+# are left out of the collapsed stacks
+_min_stack_fraction = 1e-5
+
+
+def add_profile_arguments(parser):
+    """Adds the --profile and --profile-dir options to the parser of a console script."""
+    parser.add_argument("--profile",
+                        type=str,
+                        default=None,
+                        choices=_profilers,
+                        help=("Profile the run, including the worker processes: 'cpu' with cProfile "
+                              "(pstats and collapsed stacks for flame graphs) or 'mem' with tracemalloc "
+                              "(largest allocation sites)."))
+    parser.add_argument("--profile-dir",
+                        type=str,
+                        default='profiles',
+                        help="Directory of the profiles.")
+
+
+def _function_label(func):
+    filename, lineno, name = func
+    if filename == '~':
+        # Built-in function
+        return name
+    return f"{os.path.basename(filename)}:{name}:{lineno}"
+
+
+def _collapsed_stacks(stats):
+    """
+    Approximates the call stacks of a cProfile profile in the collapsed
+    format of flamegraph.pl ('caller;callee microseconds' per line).
+
+    cProfile records only caller-callee pairs, so the time of a function is
+    divided among the paths leading to it in proportion to the time spent in
+    it from each caller.
+    """
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+    total_time = sum(tt for (_, _, tt, _, _) in stats.values()) or 1.0
+    roots = [func for func, (_, _, _, _, callers) in stats.items() if not callers]
+
+    lines = defaultdict(float)
+
+    def visit(func, path, fraction):
+        _, _, tt, ct, _ = stats[func]
+        lines[path] += tt * fraction
+        for callee, (_, _, _, edge_ct) in callees[func].items():
+            callee_ct = stats[callee][3]
+            if not callee_ct or callee in path_funcs:
+                continue
+            callee_fraction = fraction * edge_ct / callee_ct
+            if callee_fraction * callee_ct < _min_stack_fraction * total_time:
+                continue
+            path_funcs.add(callee)
+            visit(callee, path + ';' + _function_label(callee), callee_fraction)
+            path_funcs.remove(callee)
+
+    for root in roots:
+        path_funcs = set([root])
+        visit(root, _function_label(root), 1.0)
+
+    return [f"{path} {int(round(seconds * 1e6))}" for path, seconds in sorted(lines.items())
+            if seconds * 1e6 >= 0.5]
+
+
+class _Profiler:
+
+    """cProfile or tracemalloc profiler of a process, dumped into the profile directory."""
+
+    def __init__(self, kind: Text, profile_dir: Text, name: Text):
+        self.kind = kind
+        self.profile_dir = profile_dir
+        self.name = name
+        if kind == 'cpu':
+            import cProfile
+            self.profile = cProfile.Profile()
+        elif kind == 'mem':
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+        else:
+            raise ValueError(f"Unknown profiler '{kind}'")
+
+    def start(self):
+        if self.kind == 'cpu':
+            self.profile.enable()
+        else:
+            if self.tracemalloc.is_tracing():
+                self.tracemalloc.clear_traces()
+            else:
+                self.tracemalloc.start(_traceback_frames)
+
+    def stop(self):
+        """Stops profiling and writes the profile. Returns the paths of the written files."""
+        pathlib.Path(self.profile_dir).mkdir(parents=True, exist_ok=True)
+        basepath = os.path.join(self.profile_dir, f"{self.name}-{os.getpid()}")
+        if self.kind == 'cpu':
+            import pstats
+            self.profile.disable()
+            self.profile.dump_stats(basepath + '.pstats')
+            stats = pstats.Stats(self.profile).stats
+            with open(basepath + '.collapsed', 'w') as f:
+                f.write('\n'.join(_collapsed_stacks(stats)) + '\n')
+            return [basepath + '.pstats', basepath + '.collapsed']
+
+        snapshot = self.tracemalloc.take_snapshot()
+        current, peak = self.tracemalloc.get_traced_memory()
+        self.tracemalloc.stop()
+        snapshot = snapshot.filter_traces([
+            self.tracemalloc.Filter(False, self.tracemalloc.__file__),
+            self.tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            self.tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ])
+        with open(basepath + '.mem.txt', 'w') as f:
+            f.write(f"Traced memory: current {current} bytes, peak {peak} bytes\n\n")
+            f.write(f"Top {_top_allocations} allocation sites of the memory still allocated:\n")
+            for stat in snapshot.statistics('lineno')[:_top_allocations]:
+                f.write(f"{stat}\n")
+            f.write(f"\nTop {_top_allocations // 5} allocation tracebacks:\n")
+            for stat in snapshot.statistics('traceback')[:_top_allocations // 5]:
+                f.write(f"\n{stat}\n")
+                for line in stat.traceback.format():
+                    f.write(f"{line}\n")
+        return [basepath + '.mem.txt']
+
+
+@contextlib.contextmanager
+def profiled(kind: Optional[Text], profile_dir: Text = 'profiles', name: Text = 'fin_traffic'):
+    """
+    Profiles the enclosed code if kind ('cpu' or 'mem') is given.
+
+    The options are also passed to the worker processes through environment
+    variables, and the pools that call init_worker_profiling() in their
+    initializer write a profile for each worker.
+    """
+    if kind is None:
+        yield
+        return
+    profile_dir = os.path.abspath(profile_dir)
+    os.environ[_profile_env] = kind
+    os.environ[_profile_dir_env] = profile_dir
+    os.environ[_profile_name_env] = name
+    profiler = _Profiler(kind, profile_dir, name)
+    profiler.start()
+    try:
+        yield
+    finally:
+        paths = profiler.stop()
+        for env in [_profile_env, _profile_dir_env, _profile_name_env]:
+            os.environ.pop(env, None)
+        print(f"Profiles written: {', '.join(paths)} (and the workers' in {profile_dir})", file=sys.stderr)
+
+
+def init_worker_profiling():
+    """
+    Starts profiling a worker process of a multiprocessing Pool if the
+    parent is being profiled. Called from the initializers of the pools.
+    The profile is written when the worker exits, i.e. when the pool is
+    closed and joined (not terminated).
+    """
+    kind = os.environ.get(_profile_env)
+    if not kind:
+        return
+    from multiprocessing import util
+    # A forked worker inherits the profiler of the parent
+    sys.setprofile(None)
+    name = os.environ.get(_profile_name_env, 'fin_traffic') + '-worker'
+    profiler = _Profiler(kind, os.environ[_profile_dir_env], name)
+    profiler.start()
+    util.Finalize(None, profiler.stop, exitpriority=100)
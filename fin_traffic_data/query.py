@@ -0,0 +1,422 @@
+import os
+import threading
+import collections
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Text, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.aggregation import _directions, _vehicle_categories
+
+# Environment variable of the byte budget of the default chunk cache
+_cache_bytes_env = 'FIN_TRAFFIC_QUERY_CACHE_BYTES'
+_default_cache_bytes = 256 * 2**20
+
+# Rows of a key read at a time. The rows of the aggregated datafiles are
+# ordered by time, so a chunk covers a contiguous time range (with 14 rows
+# per time of a station, about 24 days at the resolution of an hour).
+_chunk_rows = 8192
+
+# Bytes accounted for the entries of the cache other than chunks
+_small_entry_bytes = 256
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+# HDF5 is not safe to use from several threads at a time, so the datafiles
+# are read by one thread at a time. Queries answered from the cache do not
+# take the lock.
+_hdf5_lock = threading.RLock()
+
+
+class ChunkCache:
+
+    """
+    Least recently used cache of the chunks read from the aggregated
+    datafiles, limited to a number of bytes. Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes: int = _default_cache_bytes):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Values and their sizes in bytes, the least recently used first
+        self._entries: 'collections.OrderedDict[Hashable, Tuple[Any, int]]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """The cached value of the key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes: int):
+        """Caches a value, evicting the least recently used values over the byte budget."""
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def statistics(self) -> Dict[Text, int]:
+        """Numbers of entries, bytes, hits and misses of the cache."""
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+def get_chunk_cache() -> ChunkCache:
+    """
+    The chunk cache shared by the queries of this process. Its byte budget
+    is read from the environment variable FIN_TRAFFIC_QUERY_CACHE_BYTES
+    (256 MiB by default).
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ChunkCache(int(os.environ.get(_cache_bytes_env, _default_cache_bytes)))
+        return _default_cache
+
+
+class _Datafile:
+
+    """
+    A datafile opened only when something has to be read from it, so that
+    queries answered from the cache do not touch the file at all. The
+    cache keys include the modification time and the size of the file, so
+    the chunks of a replaced file are not used.
+    """
+
+    def __init__(self, path: Text, cache: ChunkCache):
+        stat = os.stat(path)
+        self.path = path
+        self.cache = cache
+        self.file_id = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        self._store = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self._store is not None:
+            try:
+                self._store.close()
+            finally:
+                self._store = None
+                _hdf5_lock.release()
+
+    @property
+    def store(self) -> pd.HDFStore:
+        if self._store is None:
+            _hdf5_lock.acquire()
+            try:
+                self._store = pd.HDFStore(self.path, mode='r')
+            except BaseException:
+                _hdf5_lock.release()
+                raise
+        return self._store
+
+    def keys(self) -> List[Text]:
+        cache_key = ('keys', self.file_id)
+        keys = self.cache.get(cache_key)
+        if keys is None:
+            keys = [key.lstrip('/') for key in self.store.keys()]
+            self.cache.put(cache_key, keys, _small_entry_bytes * (1 + len(keys)))
+        return keys
+
+    def num_rows(self, key: Text) -> Tuple[int, int]:
+        """Numbers of rows and of chunks of a key, zero if there is no such key."""
+        cache_key = ('rows', self.file_id, key)
+        info = self.cache.get(cache_key)
+        if info is None:
+            if key not in self.keys():
+                info = (0, 0)
+            else:
+                storer = self.store.get_storer(key)
+                if storer.is_table:
+                    info = (int(storer.nrows), -(-int(storer.nrows) // _chunk_rows))
+                else:
+                    # The fixed format is read as a whole
+                    info = (int(storer.shape[0]) if storer.shape else 0, 1)
+            self.cache.put(cache_key, info, _small_entry_bytes)
+        return info
+
+    def chunk(self, key: Text, index: int) -> Dict[Text, np.ndarray]:
+        """The columns of a chunk of rows of a key, with the times as int64 nanoseconds."""
+        cache_key = ('chunk', self.file_id, key, index)
+        chunk = self.cache.get(cache_key)
+        if chunk is None:
+            num_rows, num_chunks = self.num_rows(key)
+            if num_chunks == 1 and not self.store.get_storer(key).is_table:
+                df = self.store.select(key)
+            else:
+                df = self.store.select(key, start=index * _chunk_rows, stop=(index + 1) * _chunk_rows)
+            chunk = _frame_to_columns(df)
+            self.cache.put(cache_key, chunk, sum(column.nbytes for column in chunk.values()))
+        return chunk
+
+    def first_time(self, key: Text, index: int) -> int:
+        """Time of the first row of a chunk, read alone if the chunk is not cached."""
+        cache_key = ('first', self.file_id, key, index)
+        first = self.cache.get(cache_key)
+        if first is None:
+            chunk = self.cache.get(('chunk', self.file_id, key, index))
+            if chunk is not None:
+                return int(chunk['time'][0])
+            row = self.store.select(key, start=index * _chunk_rows, stop=index * _chunk_rows + 1)
+            first = int(_to_nanoseconds(row['time'])[0])
+            self.cache.put(cache_key, first, _small_entry_bytes)
+        return first
+
+    def read(self, key: Text, t0: Optional[int], t1: Optional[int]) -> Optional[Dict[Text, np.ndarray]]:
+        """
+        The columns of the rows of a key with t0 <= time < t1 (times in
+        nanoseconds, None for no limit), reading only the chunks that
+        overlap the range. None if there is no such key.
+        """
+        num_rows, num_chunks = self.num_rows(key)
+        if num_rows == 0:
+            return None
+        # The rows are ordered by time, so the chunks overlapping the range
+        # are found by bisecting the times of their first rows
+        first_chunk = 0 if t0 is None else max(self._bisect(key, num_chunks, t0) - 1, 0)
+        end_chunk = num_chunks if t1 is None else self._bisect(key, num_chunks, t1)
+        chunks = [self.chunk(key, index) for index in range(first_chunk, max(end_chunk, first_chunk + 1))]
+        columns = dict((name, np.concatenate([chunk[name] for chunk in chunks])) for name in chunks[0])
+        times = columns['time']
+        mask = np.ones(times.size, dtype=bool)
+        if t0 is not None:
+            mask &= times >= t0
+        if t1 is not None:
+            mask &= times < t1
+        return dict((name, column[mask]) for name, column in columns.items())
+
+    def _bisect(self, key, num_chunks, t) -> int:
+        """Number of the chunks whose first row is before t."""
+        lo, hi = 0, num_chunks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.first_time(key, mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def _to_nanoseconds(times) -> np.ndarray:
+    return pd.to_datetime(np.asarray(times)).values.astype('datetime64[ns]').view(np.int64)
+
+
+def _frame_to_columns(df: pd.DataFrame) -> Dict[Text, np.ndarray]:
+    columns = {}
+    for name in df.columns:
+        if name == 'time':
+            columns[name] = _to_nanoseconds(df[name])
+        else:
+            columns[name] = df[name].to_numpy()
+    return columns
+
+
+def _time_limit(t) -> Optional[int]:
+    if t is None:
+        return None
+    return int(pd.Timestamp(t).value)
+
+
+def _edge_key(edge: Union[Text, Tuple[Text, Text]]) -> Text:
+    if isinstance(edge, tuple):
+        return f'{edge[0]}:{edge[1]}'
+    return str(edge)
+
+
+def _select(columns: Dict[Text, np.ndarray], name: Text, values) -> Dict[Text, np.ndarray]:
+    if values is None:
+        return columns
+    mask = np.isin(columns[name].astype(int), np.asarray(list(values), dtype=int))
+    return dict((column, array[mask]) for column, array in columns.items())
+
+
+def _read_keys(path: Text, keys: List[Text], t0, t1, filters: Dict[Text, Optional[Iterable[int]]],
+               cache: Optional[ChunkCache]) -> List[Optional[Dict[Text, np.ndarray]]]:
+    cache = cache if cache is not None else get_chunk_cache()
+    t0, t1 = _time_limit(t0), _time_limit(t1)
+    results = []
+    with _Datafile(path, cache) as datafile:
+        for key in keys:
+            columns = datafile.read(key, t0, t1)
+            if columns is not None:
+                for name, values in filters.items():
+                    columns = _select(columns, name, values)
+            results.append(columns)
+    return results
+
+
+def _to_frame(label: Text, labels: List, results: List[Optional[Dict[Text, np.ndarray]]],
+              names: List[Text]) -> pd.DataFrame:
+    frames = []
+    for value, columns in zip(labels, results):
+        if columns is None or columns['time'].size == 0:
+            continue
+        data = {label: np.full(columns['time'].size, value)}
+        for name in names:
+            data[name] = columns[name].view('datetime64[ns]') if name == 'time' else columns[name]
+        frames.append(pd.DataFrame(data))
+    if not frames:
+        return pd.DataFrame(columns=[label] + names)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _to_array(results: List[Optional[Dict[Text, np.ndarray]]],
+              axes: List[Tuple[Text, List[int]]]) -> Tuple[np.ndarray, np.ndarray]:
+    present = [columns for columns in results if columns is not None]
+    times = np.unique(np.concatenate([columns['time'] for columns in present])) if present \
+        else np.zeros(0, dtype=np.int64)
+    counts = np.zeros((len(results), times.size) + tuple(len(values) for _, values in axes))
+    for i, columns in enumerate(results):
+        if columns is None or columns['time'].size == 0:
+            continue
+        index = [np.full(columns['time'].size, i), np.searchsorted(times, columns['time'])]
+        valid = np.ones(columns['time'].size, dtype=bool)
+        for name, values in axes:
+            position = np.searchsorted(values, columns[name].astype(int))
+            position = np.minimum(position, len(values) - 1)
+            valid &= np.asarray(values)[position] == columns[name].astype(int)
+            index.append(position)
+        np.add.at(counts, tuple(axis[valid] for axis in index), columns['counts'][valid])
+    return times.view('datetime64[ns]'), counts
+
+
+def list_stations(aggregated_file: Text, cache: Optional[ChunkCache] = None) -> List[int]:
+    """Numbers of the TMS stations in a time aggregated datafile."""
+    with _Datafile(aggregated_file, cache if cache is not None else get_chunk_cache()) as datafile:
+        return sorted(int(key.rsplit('_', 1)[1]) for key in datafile.keys() if key.startswith('tms_'))
+
+
+def list_edges(area_file: Text, cache: Optional[ChunkCache] = None) -> List[Text]:
+    """Keys (source:destination) of the edges in an area aggregated datafile."""
+    with _Datafile(area_file, cache if cache is not None else get_chunk_cache()) as datafile:
+        return sorted(datafile.keys())
+
+
+def query_stations(aggregated_file: Text, tms_nums: Iterable[int], t0=None, t1=None,
+                   directions: Optional[Iterable[int]] = None,
+                   vehicle_categories: Optional[Iterable[int]] = None,
+                   cache: Optional[ChunkCache] = None) -> pd.DataFrame:
+    """
+    Counts of TMS stations in a time aggregated datafile.
+
+    Only the chunks of rows overlapping the time range are read, and they
+    are kept in the chunk cache for later queries.
+
+    Input
+    -----
+    aggregated_file: Text
+        Path to the time aggregated datafile
+    tms_nums: Iterable[int]
+        Numbers of the TMS stations. Stations without data are left out.
+    t0, t1: Optional[datetime.datetime]
+        Time range [t0, t1), by default all the data
+    directions, vehicle_categories: Optional[Iterable[int]]
+        Directions and vehicle categories to include, by default all
+    cache: Optional[ChunkCache]
+        Chunk cache, by default get_chunk_cache()
+
+    Returns
+    -------
+    pandas.DataFrame with the columns tms, time, direction, vehicle category
+    and counts
+    """
+    tms_nums = [int(num) for num in tms_nums]
+    results = _read_keys(aggregated_file, [f'tms_{num}' for num in tms_nums], t0, t1,
+                         {'direction': directions, 'vehicle category': vehicle_categories}, cache)
+    return _to_frame('tms', tms_nums, results, ['time', 'direction', 'vehicle category', 'counts'])
+
+
+def query_station_array(aggregated_file: Text, tms_nums: Iterable[int], t0=None, t1=None,
+                        directions: Optional[Iterable[int]] = None,
+                        vehicle_categories: Optional[Iterable[int]] = None,
+                        cache: Optional[ChunkCache] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Counts of TMS stations in a time aggregated datafile as a dense array.
+    The arguments are those of query_stations.
+
+    Returns
+    -------
+    Tuple of the times (numpy.datetime64) present in the data of any of the
+    stations, and an array of shape (stations, times, directions, vehicle
+    categories) with zeros where there is no data
+    """
+    tms_nums = [int(num) for num in tms_nums]
+    directions = sorted(directions) if directions is not None else _directions
+    vehicle_categories = sorted(vehicle_categories) if vehicle_categories is not None else _vehicle_categories
+    results = _read_keys(aggregated_file, [f'tms_{num}' for num in tms_nums], t0, t1,
+                         {'direction': directions, 'vehicle category': vehicle_categories}, cache)
+    return _to_array(results, [('direction', directions), ('vehicle category', vehicle_categories)])
+
+
+def query_edges(area_file: Text, edges: Iterable[Union[Text, Tuple[Text, Text]]], t0=None, t1=None,
+                vehicle_categories: Optional[Iterable[int]] = None,
+                cache: Optional[ChunkCache] = None) -> pd.DataFrame:
+    """
+    Counts of edges between areas in an area (or region) aggregated
+    datafile.
+
+    Input
+    -----
+    area_file: Text
+        Path to the area aggregated datafile
+    edges: Iterable
+        Edges as keys 'source:destination' or tuples (source, destination).
+        Edges without data are left out.
+    t0, t1: Optional[datetime.datetime]
+        Time range [t0, t1), by default all the data
+    vehicle_categories: Optional[Iterable[int]]
+        Vehicle categories to include, by default all
+    cache: Optional[ChunkCache]
+        Chunk cache, by default get_chunk_cache()
+
+    Returns
+    -------
+    pandas.DataFrame with the columns edge, time, vehicle category and counts
+    """
+    edge_keys = [_edge_key(edge) for edge in edges]
+    results = _read_keys(area_file, edge_keys, t0, t1, {'vehicle category': vehicle_categories}, cache)
+    return _to_frame('edge', edge_keys, results, ['time', 'vehicle category', 'counts'])
+
+
+def query_edge_array(area_file: Text, edges: Iterable[Union[Text, Tuple[Text, Text]]], t0=None, t1=None,
+                     vehicle_categories: Optional[Iterable[int]] = None,
+                     cache: Optional[ChunkCache] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Counts of edges between areas as a dense array. The arguments are those
+    of query_edges.
+
+    Returns
+    -------
+    Tuple of the times (numpy.datetime64) present in the data of any of the
+    edges, and an array of shape (edges, times, vehicle categories) with
+    zeros where there is no data
+    """
+    edge_keys = [_edge_key(edge) for edge in edges]
+    vehicle_categories = sorted(vehicle_categories) if vehicle_categories is not None else _vehicle_categories
+    results = _read_keys(area_file, edge_keys, t0, t1, {'vehicle category': vehicle_categories}, cache)
+    return _to_array(results, [('vehicle category', vehicle_categories)])
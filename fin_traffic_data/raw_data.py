@@ -1,12 +1,13 @@
+import os
 import datetime
 from io import StringIO
-from time import sleep
+from time import sleep, perf_counter
+from typing import Optional, Text
 
-import requests
 import pandas as pd
 import numpy as np
-import progressbar
 
+from fin_traffic_data.metrics import get_metrics
 from fin_traffic_data.utils import daterange
 
 _tms_raw_column_names = [
@@ -15,6 +16,32 @@ _tms_raw_column_names = [
     'total time', 'timespan', 'queue_begin'
 ]
 
+# Location of the raw datafiles, and the environment variable replacing it,
+# e.g. with a local test server (see fin_traffic_data.mock_server)
+_raw_data_url = 'https://aineistot.vayla.fi/lam/rawdata/'
+_raw_data_url_env = 'FIN_TRAFFIC_RAW_DATA_URL'
+
+# Seconds to wait before retrying a failed request, and the environment
+# variable replacing it
+_retry_delay = 5
+_retry_delay_env = 'FIN_TRAFFIC_RETRY_DELAY'
+
+# Columns of the parsed raw data, and the compact types of those that are
+# stored as other than int64 or datetime64
+_tms_raw_data_columns = ['tms_id', 'time', 'direction', 'vehicle category', 'speed', 'length']
+_tms_raw_data_dtypes = {
+    'direction': np.int8,
+    'vehicle category': np.int8,
+    'speed': np.int16,
+    'length': np.float32,
+}
+
+# Speed stored for the vehicles without one, as the speeds are integers
+_missing_speed = -1
+
+# HTTP status codes meaning that there is no data file for the date
+_missing_file_status_codes = [404, 410]
+
 
 class ResponseMock:
 
@@ -42,11 +69,66 @@ def _tms_raw_date_parser(*args) -> np.ndarray:
     ])
 
 
+def get_raw_data_base_url() -> Text:
+    """Location of the raw datafiles, FIN_TRAFFIC_RAW_DATA_URL if set."""
+    base_url = os.environ.get(_raw_data_url_env) or _raw_data_url
+    return base_url if base_url.endswith('/') else base_url + '/'
+
+
+def _get_retry_delay() -> float:
+    return float(os.environ.get(_retry_delay_env, _retry_delay))
+
+
+def get_tms_raw_data_url(ely_id: int, tms_id: int, date: datetime.date, base_url: Optional[Text] = None) -> Text:
+    """URL of the raw datafile of a TMS station on the date, by default at get_raw_data_base_url()."""
+    if base_url is None:
+        base_url = get_raw_data_base_url()
+    day_number = (date - datetime.date(date.year, 1, 1)).days + 1
+    return base_url + f'{date.year}/{int(ely_id):02d}/lamraw_{int(tms_id)}_{date:%y}_{day_number}.csv'
+
+
+def parse_tms_raw_data(text: Text) -> Optional[pd.DataFrame]:
+    """
+    Parses rows of a raw datafile and removes the faulty readings.
+
+    Returns
+    -------
+    pandas.DataFrame with the columns tms_id, time, direction, vehicle
+    category, speed (km/h) and length (m), or None if there are no rows.
+    """
+    stream = StringIO(text)
+    stream.seek(0)
+    df = pd.read_csv(stream,
+                     names=_tms_raw_column_names,
+                     delimiter=';',
+                     usecols=_tms_raw_column_names[:-3],
+                     parse_dates={
+                         'time': [
+                             'year', 'day_number', 'hour', 'minute',
+                             'second', 'millisecond'
+                         ]
+                     },
+                     date_parser=_tms_raw_date_parser)
+    # Remove faulty readings and empty datasets
+    if 'time' not in df.columns:
+        return None
+    metrics = get_metrics()
+    metrics.count('rows_parsed', df.shape[0])
+    # Rows without a direction or vehicle category cannot be counted
+    valid = (df['faulty'] == 0) & df['direction'].notna() & df['vehicle category'].notna()
+    metrics.count('rows_dropped', (~valid).sum())
+    df = df.loc[valid][_tms_raw_data_columns]
+    df['speed'] = df['speed'].fillna(_missing_speed)
+    return df.astype(_tms_raw_data_dtypes)
+
+
 def get_tms_raw_data(ely_id: int,
                      tms_id: int,
                      date_begin: datetime.date,
                      date_end: datetime.date,
-                     show_progress=True) -> pd.DataFrame:
+                     show_progress=True,
+                     completed_dates=None,
+                     absent_dates=None) -> pd.DataFrame:
     """
     Fetches raw TMS data from a single TMS location between
     dates date_begin and date_end.
@@ -63,6 +145,11 @@ def get_tms_raw_data(ely_id: int,
         Last date of the range (exclusive)
     show_progress: bool (optional)
         Whether to show progressbar
+    completed_dates: Optional[List[datetime.date]]
+        If given, the dates whose data was fetched are appended to this list.
+    absent_dates: Optional[List[datetime.date]]
+        If given, the dates that have no data file on the server are
+        appended to this list.
 
     Returns
     -------
@@ -71,13 +158,19 @@ def get_tms_raw_data(ely_id: int,
         - time
         - direction
         - vehicle category
+        - speed
+        - length
 
     or None if the TMS cannot be found in any ELY center's dataset (likely an old TMS id).
     """
-    ely_id = "%02d" % ely_id
+    # Imported here to keep the startup of the console scripts fast
+    import requests
+    import progressbar
 
     tms_id = int(tms_id)
 
+    metrics = get_metrics()
+    retry_delay = _get_retry_delay()
     dfs = []
     if show_progress:
         bar = progressbar.ProgressBar(
@@ -85,48 +178,34 @@ def get_tms_raw_data(ely_id: int,
             wrap_stdout=True)
     for i, date in enumerate(daterange(date_begin, date_end)):
         print("TMS ID: %s - %s" % (tms_id, date), flush=True)
-        year_date0 = datetime.date(date.year, 1, 1)
-        day_number = (date - year_date0).days + 1
-        year_short = f"{date:%y}"
         it = 0
         while it < 3:
+            request_time0 = perf_counter()
             try:
-                resp = requests.get(
-                    'https://aineistot.vayla.fi/lam/rawdata/' +
-                    f'{date.year}/{ely_id}/lamraw_{tms_id}_{year_short}' +
-                    f'_{day_number}.csv')
+                resp = requests.get(get_tms_raw_data_url(ely_id, tms_id, date))
+                metrics.observe_http_request(perf_counter() - request_time0, resp.status_code, len(resp.content))
             except Exception:
                 print(f"Timeouterror: {date} {tms_id}")
                 resp = ResponseMock(499)
+                metrics.observe_http_request(perf_counter() - request_time0, resp.status_code)
             if resp.status_code in [400, 401, 402, 403, 404, 405, 406, 408, 409, 410, 411, 412, 413, 414,415, 416, 417, 418, 421, 422, 423, 424, 425, 426, 428]:
                 break
             elif resp.status_code != 200:
                 print(f"Waiting: {resp.status_code}")
-                sleep(5)
+                metrics.count('http_retries')
+                sleep(retry_delay)
                 it += 1
             else:
                 break
+        if completed_dates is not None and resp.status_code == 200:
+            completed_dates.append(date)
+        if absent_dates is not None and resp.status_code in _missing_file_status_codes:
+            absent_dates.append(date)
         if resp.status_code != 200:
             print(f"Failed to fetch {date}: {tms_id}, {resp.status_code}")
         else:
-            stream = StringIO(resp.text)
-            stream.seek(0)
-            df = pd.read_csv(stream,
-                             names=_tms_raw_column_names,
-                             delimiter=';',
-                             usecols=_tms_raw_column_names[:-3],
-                             parse_dates={
-                                 'time': [
-                                     'year', 'day_number', 'hour', 'minute',
-                                     'second', 'millisecond'
-                                 ]
-                             },
-                             date_parser=_tms_raw_date_parser)
-            # Remove faulty readings and empty datasets
-            if 'time' in df.columns:
-                df = df.loc[df['faulty'] == 0][[
-                    'tms_id', 'time', 'direction', 'vehicle category'
-                ]]
+            df = parse_tms_raw_data(resp.text)
+            if df is not None:
                 dfs.append(df)
         if show_progress:
             bar.update(i)
@@ -0,0 +1,268 @@
+import os
+import json
+import hashlib
+import pathlib
+from typing import Dict, List, Optional, Text, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.aggregation import _vehicle_categories
+from fin_traffic_data.borders import border_station_directions
+from fin_traffic_data.metadata import get_tms_stations, get_municipality_info, get_metadata_dir
+from fin_traffic_data.registry import DenseLookup
+
+# Version of the format of the compiled operators. Operators of other
+# versions are compiled again.
+_operator_version = 1
+
+
+
+def get_operator_dir() -> Text:
+    """Directory of the compiled region flow operators."""
+    return os.path.join(get_metadata_dir(), 'region_operators')
+
+
+def station_metadata_version(tms_stations: pd.DataFrame) -> Text:
+    """Hash of the station metadata that the border stations of regions depend on."""
+    columns = tms_stations[['num', 'dir1', 'dir2']].astype(str)
+    return hashlib.sha256(pd.util.hash_pandas_object(columns, index=False).values.tobytes()).hexdigest()
+
+
+def normalize_region_mapping(regions: Dict[Union[int, Text], Text]) -> Dict[int, Text]:
+    """
+    Maps the municipalities of a municipality-to-region mapping to their
+    codes. The municipalities may be given by code or by name.
+
+    Raises a ValueError for unknown municipalities.
+    """
+    municipality_info = get_municipality_info()
+    codes_by_name = dict(zip(municipality_info['municipality'], municipality_info.index))
+    known_codes = set(int(code) for code in municipality_info.index)
+    mapping = {}
+    for municipality, region in regions.items():
+        if isinstance(municipality, str) and not municipality.strip().isdigit():
+            if municipality not in codes_by_name:
+                raise ValueError(f"Unknown municipality '{municipality}'")
+            code = int(codes_by_name[municipality])
+        else:
+            code = int(municipality)
+            if code not in known_codes:
+                raise ValueError(f"Unknown municipality code {code}")
+        mapping[code] = str(region)
+    return mapping
+
+
+def read_region_mapping(path: Text) -> Dict[int, Text]:
+    """
+    Reads a municipality-to-region mapping from a CSV file with the columns
+    municipality (code or name) and region.
+    """
+    df = pd.read_csv(path, dtype=str)
+    return normalize_region_mapping(dict(zip(df['municipality'].str.strip(), df['region'].str.strip())))
+
+
+def region_mapping_key(mapping: Dict[int, Text], tms_stations: pd.DataFrame) -> Text:
+    """Key of the operator of the mapping: hash of the mapping and of the station metadata version."""
+    content = json.dumps({
+        'version': _operator_version,
+        'regions': sorted(mapping.items()),
+        'stations': station_metadata_version(tms_stations),
+    })
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class RegionFlowOperator:
+
+    """
+    Linear operator from the time aggregated counts of the station
+    directions over the borders of a set of regions to the counts of the
+    edges between the regions.
+
+    The operator is a sparse matrix with a row for every edge (source
+    region, destination region) and a column for every station direction,
+    with ones where the station direction measures the traffic of the edge.
+    """
+
+    def __init__(self, key: Text, edges: List[Tuple[Text, Text]], tms_nums: np.ndarray,
+                 directions: np.ndarray, edge_index: np.ndarray):
+        """
+        Input
+        -----
+        key: Text
+            Key of the operator, see region_mapping_key
+        edges: List[Tuple[Text, Text]]
+            Source and destination regions of the edges
+        tms_nums, directions: numpy.ndarray
+            TMS numbers and directions of the station directions
+        edge_index: numpy.ndarray
+            Index of the edge of every station direction
+        """
+        # Imported here to keep the startup of the console scripts fast
+        import scipy.sparse
+
+        self.key = key
+        self.edges = list(edges)
+        self.tms_nums = np.asarray(tms_nums, dtype=int)
+        self.directions = np.asarray(directions, dtype=int)
+        self.edge_index = np.asarray(edge_index, dtype=int)
+        self.matrix = scipy.sparse.csc_matrix(
+            (np.ones(self.edge_index.size), (self.edge_index, np.arange(self.edge_index.size))),
+            shape=(len(self.edges), self.edge_index.size))
+
+    @classmethod
+    def compile(cls, mapping: Dict[int, Text], tms_stations: pd.DataFrame) -> 'RegionFlowOperator':
+        """Derives the border station directions of the regions of the mapping."""
+        region = DenseLookup(list(mapping.keys()), list(mapping.values()), fill=None)
+        df = border_station_directions(tms_stations, lambda municipalities: region[municipalities])
+        df = df.sort_values(['source', 'destination', 'tms', 'direction'], kind='mergesort')
+        edges = list(df[['source', 'destination']].drop_duplicates().itertuples(index=False, name=None))
+        edge_of_pair = dict((edge, i) for i, edge in enumerate(edges))
+        edge_index = np.array([edge_of_pair[edge] for edge in zip(df['source'], df['destination'])], dtype=int)
+        return cls(region_mapping_key(mapping, tms_stations), edges, df['tms'].to_numpy(),
+                   df['direction'].to_numpy(), edge_index)
+
+    def save(self, path: Text):
+        """Stores the operator. The file is replaced atomically."""
+        pathlib.Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+        partial_path = path + '.partial.npz'
+        np.savez(partial_path,
+                 version=_operator_version,
+                 key=self.key,
+                 sources=np.array([edge[0] for edge in self.edges], dtype=str),
+                 destinations=np.array([edge[1] for edge in self.edges], dtype=str),
+                 tms_nums=self.tms_nums,
+                 directions=self.directions,
+                 edge_index=self.edge_index)
+        os.replace(partial_path, path)
+
+    @classmethod
+    def load(cls, path: Text) -> Optional['RegionFlowOperator']:
+        """Reads a stored operator, or returns None if there is none of the current version."""
+        try:
+            with np.load(path) as f:
+                if int(f['version']) != _operator_version:
+                    return None
+                return cls(str(f['key']), list(zip(f['sources'].tolist(), f['destinations'].tolist())),
+                           f['tms_nums'], f['directions'], f['edge_index'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def edge_keys(self) -> List[Text]:
+        """Keys of the edges as in the area aggregated datafiles."""
+        return [f'{source}:{destination}' for source, destination in self.edges]
+
+    def apply(self, counts: np.ndarray) -> np.ndarray:
+        """
+        Applies the operator to counts of the station directions.
+
+        Input
+        -----
+        counts: numpy.ndarray
+            Array with a row for every station direction of the operator
+
+        Returns
+        -------
+        numpy.ndarray with a row for every edge
+        """
+        return np.asarray(self.matrix @ counts)
+
+    def apply_to_file(self, inputfile: Text) -> Dict[Text, pd.DataFrame]:
+        """
+        Computes the traffic of the edges from a time aggregated datafile.
+        Only the stations of the operator are read, one at a time.
+
+        Returns
+        -------
+        Dictionary from the edge keys to pandas.DataFrame with the columns
+        time, vehicle category and counts
+        """
+        result: Optional[np.ndarray] = None
+        times: Optional[np.ndarray] = None
+        with pd.HDFStore(inputfile, mode='r') as store:
+            for tms_num in np.unique(self.tms_nums):
+                key = f'tms_{tms_num}'
+                if key not in store:
+                    continue
+                df = store.select(key)
+                columns = np.flatnonzero(self.tms_nums == tms_num)
+                station_counts = []
+                for direction in self.directions[columns]:
+                    rows = df.loc[df['direction'] == direction]
+                    station_counts.append(rows['counts'].to_numpy(dtype=float))
+                    if times is None:
+                        times = rows['time'].to_numpy()
+                        result = np.zeros((len(self.edges), times.size))
+                result += np.asarray(self.matrix[:, columns] @ np.stack(station_counts))
+
+        frames: Dict[Text, pd.DataFrame] = {}
+        if result is None or times is None:
+            return frames
+        categories = np.resize(_vehicle_categories, times.size)
+        for edge_key, counts in zip(self.edge_keys(), result):
+            frames[edge_key] = pd.DataFrame({'time': times, 'vehicle category': categories, 'counts': counts})
+        return frames
+
+
+def get_region_flow_operator(regions: Dict[Union[int, Text], Text],
+                             tms_stations: Optional[pd.DataFrame] = None,
+                             operator_dir: Optional[Text] = None) -> RegionFlowOperator:
+    """
+    The operator of the edges between the regions of a municipality-to-region
+    mapping. It is compiled once and stored in operator_dir (by default
+    get_operator_dir()) by the hash of the mapping and of the station
+    metadata, so later calls with the same regions read it from there.
+
+    Input
+    -----
+    regions: Dict
+        Region of every municipality, given by code or name. Municipalities
+        that are not in the mapping are outside of all the regions.
+    tms_stations: Optional[pandas.DataFrame]
+        Station metadata, by default get_tms_stations()
+    operator_dir: Optional[Text]
+        Directory of the compiled operators
+    """
+    if tms_stations is None:
+        tms_stations = get_tms_stations()
+    mapping = normalize_region_mapping(regions)
+    key = region_mapping_key(mapping, tms_stations)
+    path = os.path.join(operator_dir or get_operator_dir(), f'{key}.npz')
+    operator = RegionFlowOperator.load(path)
+    if operator is None or operator.key != key:
+        operator = RegionFlowOperator.compile(mapping, tms_stations)
+        operator.save(path)
+    return operator
+
+
+def get_region_aggregated_file_path(results_dir, operator, inputfile):
+    """Path to the datafile of the traffic between the regions computed from the time aggregated datafile"""
+    input_filename = os.path.basename(inputfile)
+    file_name = 'tms_between_regions_%s_input_%s.h5' % (operator.key[:12], input_filename.split('.')[0])
+    return os.path.join(results_dir, file_name)
+
+
+def get_aggregated_traffic_between_regions(inputfile: Text, regions: Dict[Union[int, Text], Text],
+                                           results_dir: Text) -> Text:
+    """
+    Computes the traffic between custom regions from the time aggregated data.
+
+    Input
+    -----
+    inputfile: Text
+        Path to the time aggregated datafile
+    regions: Dict
+        Region of every municipality, see get_region_flow_operator
+    results_dir: Text
+        Directory where the results are stored
+
+    Returns
+    -------
+    Path to the region aggregated datafile
+    """
+    operator = get_region_flow_operator(regions)
+    pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+    result_path = get_region_aggregated_file_path(results_dir, operator, inputfile)
+    for edge_key, df in operator.apply_to_file(inputfile).items():
+        df.to_hdf(result_path, key=edge_key, complevel=9, format='table')
+    return result_path
@@ -0,0 +1,120 @@
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.metadata import (get_tms_stations, get_province_info,
+                                       get_municipality_info, get_hcd_info)
+
+# Value of the integer lookups for unknown keys. Not -1, which is a province
+# code (Norway).
+UNKNOWN = -2**31
+
+# Registries built in this process, by the hash of the station metadata
+_registries: Dict[int, 'StationRegistry'] = {}
+
+
+class DenseLookup:
+
+    """
+    Mapping from integer codes to values stored in a dense array indexed by
+    the code, so that an array of codes is mapped with a single indexing
+    operation. Codes without a value are mapped to the fill value.
+    """
+
+    def __init__(self, keys: Iterable[int], values: Iterable, fill=UNKNOWN):
+        keys = np.asarray(list(keys), dtype=int)
+        values = np.asarray(list(values))
+        self.fill = fill
+        self.offset = int(keys.min()) if keys.size else 0
+        size = int(keys.max()) - self.offset + 1 if keys.size else 0
+        dtype = values.dtype if values.dtype.kind in 'iu' else object
+        self.values = np.full(size, fill, dtype=dtype)
+        self.values[keys - self.offset] = values
+
+    def __getitem__(self, keys) -> np.ndarray:
+        keys = np.asarray(keys, dtype=int)
+        index = keys - self.offset
+        valid = (index >= 0) & (index < self.values.size)
+        result = np.full(keys.shape, self.fill, dtype=self.values.dtype)
+        result[valid] = self.values[index[valid]]
+        return result
+
+
+class StationRegistry:
+
+    """
+    Lookup arrays from the TMS stations to their ELY centers and areas.
+
+    The arrays are aligned with tms_nums, the numbers of the stations in the
+    order of the station metadata. The areas of other municipalities (e.g.
+    the dir1 and dir2 municipalities of the stations) are mapped with the
+    municipality lookups.
+    """
+
+    def __init__(self, tms_stations: pd.DataFrame):
+        """
+        Input
+        -----
+        tms_stations: pandas.DataFrame
+            Station metadata as returned by get_tms_stations
+        """
+        province_info = get_province_info()
+        municipality_info = get_municipality_info()
+        hcd_info = get_hcd_info().reset_index()
+
+        self.province_ely = DenseLookup(province_info.index, province_info['ely-center (traffic)'])
+        self.province_erva = DenseLookup(province_info.index, province_info['erva'], fill=None)
+        self.municipality_province = DenseLookup(municipality_info.index, municipality_info['provinceNumber'])
+        self.municipality_hcd_code = DenseLookup(municipality_info.index, municipality_info['hcdCode'])
+        # hcd_info lists Central Ostrobothnia also under the code of South
+        # Ostrobothnia, so the last code of every district is used
+        hcd_info = hcd_info.drop_duplicates('hcd_name', keep='last')
+        self.hcd_name = DenseLookup(hcd_info['hcd_code'], hcd_info['hcd_name'], fill=None)
+
+        self.tms_nums = np.asarray(tms_stations['num'], dtype=int)
+        self.station_index = DenseLookup(self.tms_nums, np.arange(self.tms_nums.size))
+        self.station_municipality = np.asarray(tms_stations['municipality'], dtype=int)
+        self.station_province = np.asarray(tms_stations['province'], dtype=int)
+        self.station_ely = self.province_ely[self.station_province]
+        self.station_erva = self.province_erva[self.station_province]
+        self.station_hcd = self.hcd_name[self.municipality_hcd_code[self.station_municipality]]
+
+    def municipality_erva(self, municipalities) -> np.ndarray:
+        """ERVAs of the municipalities."""
+        return self.province_erva[self.municipality_province[municipalities]]
+
+    def municipality_hcd(self, municipalities) -> np.ndarray:
+        """Names of the hospital care districts of the municipalities."""
+        return self.hcd_name[self.municipality_hcd_code[municipalities]]
+
+    def ely_ids(self, tms_nums) -> np.ndarray:
+        """IDs of the ELY centers of the TMS stations, UNKNOWN for unknown stations."""
+        index = self.station_index[tms_nums]
+        known = index != UNKNOWN
+        ely_ids = np.full(index.shape, UNKNOWN, dtype=self.station_ely.dtype)
+        ely_ids[known] = self.station_ely[index[known]]
+        return ely_ids
+
+    def station_ely_ids(self) -> Dict[int, int]:
+        """Dictionary from the numbers of all the TMS stations to the IDs of their ELY centers."""
+        return dict(zip(self.tms_nums.tolist(), self.station_ely.tolist()))
+
+
+def get_station_registry(tms_stations: Optional[pd.DataFrame] = None) -> StationRegistry:
+    """
+    The lookup arrays of the TMS stations, built once per process for the
+    same station metadata.
+
+    Input
+    -----
+    tms_stations: Optional[pandas.DataFrame]
+        Station metadata, by default get_tms_stations()
+    """
+    if tms_stations is None:
+        tms_stations = get_tms_stations()
+    key = int(pd.util.hash_pandas_object(tms_stations[['num', 'municipality', 'province']],
+                                         index=False).sum())
+    if key not in _registries:
+        _registries[key] = StationRegistry(tms_stations)
+    return _registries[key]
@@ -1,41 +1,43 @@
 import sys
-import re
 import pathlib
-from datetime import timedelta
 import argparse
+import datetime
 from fin_traffic_data.metadata import get_tms_stations
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.utils import parse_memory_size, parse_time_resolution
 from fin_traffic_data.aggregation import (
     list_rawdata_files, check_no_daterange_overlap_in_raw_files,
-    check_all_dates_covered_by_raw_files, aggregate_datafiles
+    check_all_dates_covered_by_raw_files, aggregate_datafiles, aggregate_datafiles_chunked
 )
 
 
-def _parse_time_resolution(x):
-    """Parse human-readable input of time resolution"""
-    m = re.findall(r"(?P<num>\d+)(?P<qualif>w|d|h|m|s)", x)
-    dt = timedelta()
-    for obj in m:
-        if obj[1] == 'w':
-            dt += timedelta(days=int(obj[0])*7)
-        elif obj[1] == 'd':
-            dt += timedelta(days=int(obj[0]))
-        elif obj[1] == 'h':
-            dt += timedelta(hours=int(obj[0]))
-        elif obj[1] == 'm':
-            dt += timedelta(minutes=int(obj[0]))
-        elif obj[1] == 's':
-            dt += timedelta(seconds=int(obj[0]))
-        else:
-            raise ValueError(f"Unknown literal '{obj[1]}'")
-    return dt
-
-
-def aggregate_raw_data(basepath, delta_t, results_dir):
+def aggregate_raw_data(basepath, delta_t, results_dir, raw_data_files=None, prefix_sums=False, statistics=False,
+                       chunk_length=None, memory_limit=None, extend_from=None):
+    """
+    Aggregates the raw datafiles in basepath with the time resolution delta_t.
+
+    If raw_data_files (a list of tuples of filename, begin date and end date,
+    e.g. from the dataset catalog) is given, the directory is not listed.
+    If prefix_sums is set, the prefix-sum index of the aggregated datafile is
+    built (see fin_traffic_data.prefix_sums). If statistics is set, the
+    speed and length statistics of the vehicles are stored as well (see
+    fin_traffic_data.aggregation.aggregate_datafiles). If chunk_length or
+    memory_limit is given, the data is aggregated one time chunk at a time
+    (see fin_traffic_data.aggregation.aggregate_datafiles_chunked). If
+    extend_from (an aggregated datafile of the same begin date and time
+    resolution with an earlier end date) is given, the data is aggregated in
+    time chunks from the end of it on, if it can be extended.
+
+    Returns
+    -------
+    Path to the aggregated datafile
+    """
     # Create the output directory
     pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
 
     # Get the raw datafiles
-    raw_data_files = list_rawdata_files(basepath)
+    if raw_data_files is None:
+        raw_data_files = list_rawdata_files(basepath)
     if not raw_data_files:
         raise RuntimeError(f"No datafiles in {basepath}/")
 
@@ -47,14 +49,39 @@ def aggregate_raw_data(basepath, delta_t, results_dir):
     all_tms_stations = get_tms_stations()
 
     # Aggregate all the datafiles
-    aggregate_datafiles(
-        raw_data_files=raw_data_files,
-        all_tms_numbers=all_tms_stations['num'],
-        delta_t=delta_t,
-        results_dir=results_dir
-    )
-
-    return results_dir
+    if chunk_length is not None or memory_limit is not None or extend_from is not None:
+        aggregated_file = aggregate_datafiles_chunked(
+            raw_data_files=raw_data_files,
+            all_tms_numbers=all_tms_stations['num'],
+            delta_t=delta_t,
+            results_dir=results_dir,
+            chunk_length=chunk_length,
+            memory_limit=memory_limit,
+            statistics=statistics,
+            extend_from=extend_from
+        )
+    else:
+        aggregated_file = aggregate_datafiles(
+            raw_data_files=raw_data_files,
+            all_tms_numbers=all_tms_stations['num'],
+            delta_t=delta_t,
+            results_dir=results_dir,
+            statistics=statistics
+        )
+
+    if prefix_sums:
+        # Imported here to keep the startup of the console scripts fast
+        from fin_traffic_data.prefix_sums import build_prefix_sum_index
+
+        build_prefix_sum_index(aggregated_file,
+                               time0=_date_to_datetime(min(f[1] for f in raw_data_files)),
+                               time_end=_date_to_datetime(max(f[2] for f in raw_data_files)),
+                               delta_t=delta_t)
+    return aggregated_file
+
+
+def _date_to_datetime(date):
+    return datetime.datetime(year=date.year, month=date.month, day=date.day)
 
 
 # Parse script arguments
@@ -65,7 +92,7 @@ def parse_args(args=sys.argv[1:]):
                         help="Directory containing the raw traffic data",
                         default="raw_data")
 
-    parser.add_argument("--time-resolution", type=_parse_time_resolution,
+    parser.add_argument("--time-resolution", type=parse_time_resolution,
                         required=True,
                         help="Time resolution of the aggregation")
 
@@ -74,14 +101,45 @@ def parse_args(args=sys.argv[1:]):
                         default='aggregated_data_time',
                         help="Name of the directory to store the results.")
 
+    parser.add_argument("--prefix-sums",
+                        action='store_true',
+                        default=False,
+                        help=("Store a prefix-sum index next to the aggregated datafile for fast totals over "
+                              "time windows and coarser time resolutions."))
+
+    parser.add_argument("--statistics",
+                        action='store_true',
+                        default=False,
+                        help=("Store the speed statistics (sum, sum of squares and histogram) and the length "
+                              "class counts of the vehicles next to the counts."))
+
+    parser.add_argument("--chunk",
+                        type=parse_time_resolution,
+                        default=None,
+                        help=("Aggregate the data one time chunk of this length at a time (e.g. 30d), keeping only "
+                              "the raw data of a chunk in memory."))
+
+    parser.add_argument("--memory-limit",
+                        type=parse_memory_size,
+                        default=None,
+                        help=("Memory the aggregation of a chunk may use (e.g. 2G). The chunks are shortened to "
+                              "fit in it. Implies aggregating one chunk at a time."))
+
+    add_profile_arguments(parser)
+
     return parser.parse_args(args)
 
 
 def main():
     args = parse_args()
-    aggregate_raw_data(basepath=args.dir,
-                       delta_t=args.time_resolution,
-                       results_dir=args.results_dir)
+    with profiled(args.profile, args.profile_dir, 'aggregate_raw_data'):
+        aggregate_raw_data(basepath=args.dir,
+                           delta_t=args.time_resolution,
+                           results_dir=args.results_dir,
+                           prefix_sums=args.prefix_sums,
+                           statistics=args.statistics,
+                           chunk_length=args.chunk,
+                           memory_limit=args.memory_limit)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,30 @@
+import sys
+import argparse
+from fin_traffic_data.borders import write_border_tables
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description=("Builds the tables of the TMS stations over the borders of the provinces, ERVAs and HCDs "
+                     "from the current station metadata."))
+    parser.add_argument("--results_dir", "-rd",
+                        type=str,
+                        default='border_tables',
+                        help="Name of the directory to store the results.")
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with profiled(args.profile, args.profile_dir, 'build_border_tables'):
+        for area, path in write_border_tables(args.results_dir).items():
+            print(f"{area}: {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import argparse
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+
+# Catalog of the pipeline, see fin_traffic_data.scripts.complete_pipeline
+_default_catalog_path = 'fin_traffic_catalog.sqlite'
+
+
+def compact(raw_data_dir, catalog_path=None, dry_run=False):
+    """
+    Compacts the raw datafiles of a directory into yearly partitions and
+    prints the partitions (see fin_traffic_data.compaction.compact_raw_data).
+    The records of the raw datafiles in the catalog are updated if given.
+
+    Returns
+    -------
+    List of the partitions as tuples of the filename, the begin date and the
+    end date
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.catalog import DatasetCatalog
+    from fin_traffic_data.compaction import compact_raw_data
+
+    if catalog_path is not None:
+        with DatasetCatalog(catalog_path) as catalog:
+            partitions = compact_raw_data(raw_data_dir, catalog=catalog, dry_run=dry_run)
+    else:
+        partitions = compact_raw_data(raw_data_dir, dry_run=dry_run)
+    for path, begin_date, end_date in partitions:
+        print(f"{'Would write' if dry_run else 'Wrote'} {path} ({begin_date} - {end_date})")
+    if not partitions:
+        print(f"Nothing to compact in {raw_data_dir}/")
+    return partitions
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Merges the raw traffic datafiles into time-sorted yearly partitions.")
+
+    parser.add_argument("--dir",
+                        type=str,
+                        default="raw_data",
+                        help="Directory containing the raw traffic data")
+
+    parser.add_argument("--catalog",
+                        type=str,
+                        default=_default_catalog_path if os.path.isfile(_default_catalog_path) else None,
+                        help=("Path to the catalog of the datafiles whose records of the raw datafiles are updated, "
+                              f"by default {_default_catalog_path} if it exists."))
+
+    parser.add_argument("--dry-run",
+                        action='store_true',
+                        default=False,
+                        help="Only show the partitions that would be written.")
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with profiled(args.profile, args.profile_dir, 'compact_raw_data'):
+        compact(raw_data_dir=args.dir, catalog_path=args.catalog, dry_run=args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
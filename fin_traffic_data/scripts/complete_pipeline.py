@@ -1,51 +1,38 @@
 import os
 import sys
+import glob
 import time
 import argparse
-import glob
-import re
+import contextlib
 from logging import handlers
 import logging
 import datetime
-from fin_traffic_data.scripts.fetch_raw_data import fetch_raw_data
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.batching import FetchStatistics, plan_batches
+from fin_traffic_data.catalog import DatasetCatalog
+from fin_traffic_data.metrics import get_metrics, reset_metrics, write_metrics
+from fin_traffic_data.prefix_sums import get_prefix_sum_index_paths
+from fin_traffic_data.utils import parse_memory_size, parse_time_resolution
+from fin_traffic_data.scripts.fetch_raw_data import (
+    fetch_raw_data, fetch_missing_raw_data, get_raw_data_file_path
+)
 from fin_traffic_data.scripts.aggregate_raw_data import aggregate_raw_data
 from fin_traffic_data.scripts.get_aggregated_traffic_between_areas import get_aggregated_traffic_between_areas
-from fin_traffic_data.scripts.export_area_data_as_csv import export_area_data_as_csv
-
-
-def _parse_time_resolution(x):
-    """Parse human-readable input of time resolution"""
-    m = re.findall(r"(?P<num>\d+)(?P<qualif>w|d|h|m|s)", x)
-    dt = datetime.timedelta()
-    for obj in m:
-        if obj[1] == 'w':
-            dt += datetime.timedelta(days=int(obj[0])*7)
-        elif obj[1] == 'd':
-            dt += datetime.timedelta(days=int(obj[0]))
-        elif obj[1] == 'h':
-            dt += datetime.timedelta(hours=int(obj[0]))
-        elif obj[1] == 'm':
-            dt += datetime.timedelta(minutes=int(obj[0]))
-        elif obj[1] == 's':
-            dt += datetime.timedelta(seconds=int(obj[0]))
-        else:
-            raise ValueError(f"Unknown literal '{obj[1]}'")
-    return dt
-
-
-def determine_dates_to_fetch(logger, results_dir_fetch,
-                             begin_date, end_date):
+from fin_traffic_data.scripts.export_area_data_as_csv import export_area_data_as_csv, get_csv_archive_path
+
+
+def determine_dates_to_fetch(logger, catalog,
+                             begin_date, end_date,
+                             statistics=None, max_memory=None):
     logger.info('Determining dates to fetch TMS information')
     logger.debug(('Desired initial dates\n'
                   'Being date: %s.\n'
                   'End date: %s.') % (begin_date,
                                       end_date))
-    match_pattern = '%s/fin_traffic_raw_*' % (results_dir_fetch, )
-    aggregation_files = glob.glob(match_pattern)
-    logger.debug('Looking for dates in files with pattern: %s' % (match_pattern))
+    raw_date_range = catalog.date_range('raw')
 
     date_intervals = []
-    if len(aggregation_files) == 0:
+    if raw_date_range is None:
         logger.debug('No previous files were found. Going to use begin and end date')
         begin_first_interval = begin_date
         end_first_interval = end_date
@@ -55,26 +42,7 @@ def determine_dates_to_fetch(logger, results_dir_fetch,
                      'End date: %s') % (begin_first_interval,
                                         end_first_interval))
     else:
-        earliest_date = datetime.datetime(year=2050, month=1, day=1).date()
-        latest_date = datetime.datetime(year=1970, month=1, day=1).date()
-        for file in aggregation_files:
-            logger.debug('Looking for dates in file: %s' % (file, ))
-            regex_match = re.match((r".*fin_traffic_raw_.*(?P<begin_date>\d{4}-\d{2}-\d{2}).*"
-                                    r"(?P<end_date>\d{4}-\d{2}-\d{2}).*"), file)
-            if not regex_match:
-                logger.debug('File did not have a begin or end date: %s' % (file, ))
-                continue
-
-            begin_date_file = datetime.datetime.strptime(regex_match.group('begin_date'),
-                                                         "%Y-%m-%d").date()
-            end_date_file = datetime.datetime.strptime(regex_match.group('end_date'),
-                                                       "%Y-%m-%d").date()
-            logger.debug('Begin date: %s. End date: %s.' % (begin_date_file, end_date_file))
-            if begin_date_file < earliest_date:
-                earliest_date = begin_date_file
-
-            if end_date_file > latest_date:
-                latest_date = end_date_file
+        earliest_date, latest_date = raw_date_range
         logger.debug(('Earliest date found: %s.\n'
                       'Latest date found: %s.') % (earliest_date,
                                                    latest_date))
@@ -101,24 +69,21 @@ def determine_dates_to_fetch(logger, results_dir_fetch,
             end_second_interval = end_date
             date_intervals.append((begin_second_interval, end_second_interval))
 
+        # Holes between the raw datafiles. The datafiles before begin_date
+        # do not cover any of the dates.
+        covered_until = earliest_date
+        for _, begin_date_file, end_date_file in catalog.list('raw', begin_date=begin_date, end_date=end_date):
+            if begin_date_file > covered_until:
+                begin_hole = max(covered_until, begin_date)
+                end_hole = min(begin_date_file, end_date)
+                if begin_hole < end_hole:
+                    logger.debug('No raw datafile between %s and %s' % (begin_hole, end_hole))
+                    date_intervals.append((begin_hole, end_hole))
+            covered_until = max(covered_until, end_date_file)
+        date_intervals.sort()
+
     logger.debug('Checking for large dates to do a batch of them')
-    batched_intervals = []
-    for begin_interval, end_interval in date_intervals:
-        time_difference = end_interval - begin_interval
-        if time_difference.days > 30:
-            begin_batch_interval = begin_interval
-            end_batch_interval = begin_interval + datetime.timedelta(days=30)
-            while True:
-                batched_intervals.append((begin_batch_interval, end_batch_interval))
-                if end_batch_interval == end_interval:
-                    break
-                else:
-                    begin_batch_interval = end_batch_interval
-                    end_batch_interval = end_batch_interval + datetime.timedelta(days=30)
-                    if end_batch_interval >= end_interval:
-                        end_batch_interval = end_interval
-        else:
-            batched_intervals.append((begin_interval, end_interval))
+    batched_intervals = plan_batches(date_intervals, statistics=statistics, max_memory=max_memory)
 
     logger.info(('Determined intervals\n'
                  '%s') % (batched_intervals, ))
@@ -126,110 +91,369 @@ def determine_dates_to_fetch(logger, results_dir_fetch,
     return batched_intervals
 
 
-def get_time_aggregation_file(logger, results_dir_aggregate, begin_date, end_date):
-    logger.info('Checking for existent time aggregated files.')
-    match_pattern = '%s/fi_traffic_aggregated-*' % (results_dir_aggregate, )
-    aggregation_files = glob.glob(match_pattern)
-    logger.debug('Looking for dates in files with pattern: %s' % (match_pattern))
+def remove_datafile(path):
+    """
+    Removes a datafile of the results together with the files named after
+    it, e.g. its prefix-sum index or the index of an exported archive.
+    """
+    for sidecar in [path] + glob.glob(glob.escape(path) + '.*'):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
 
-    if len(aggregation_files) == 0:
-        logger.info('No files with the pattern were found.')
-        return None
-    else:
-        for file in aggregation_files:
-            logger.debug('Looking for dates in file: %s' % (file, ))
-            regex_match = re.match((r".*fi_traffic_aggregated-.*(?P<begin_date>\d{4}-\d{2}-\d{2}).*"
-                                    r"(?P<end_date>\d{4}-\d{2}-\d{2}).*"), file)
-            if not regex_match:
-                logger.debug('Invalid aggregation file: %s' % (file, ))
-                continue
-
-            begin_date_file = datetime.datetime.strptime(regex_match.group('begin_date'),
-                                                         "%Y-%m-%d").date()
-            end_date_file = datetime.datetime.strptime(regex_match.group('end_date'),
-                                                       "%Y-%m-%d").date()
-            logger.debug('Begin date: %s. End date: %s.' % (begin_date_file, end_date_file))
-            if begin_date_file == begin_date and end_date_file == end_date:
-                logger.info('File found! Had the same begin and end date!')
-                return file
+
+def get_time_aggregation_file(logger, catalog, begin_date, end_date, time_resolution):
+    logger.info('Checking for existent time aggregated files.')
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.aggregation import _counts_version, get_counts_version
+
+    file = catalog.find('time', begin_date, end_date, resolution=time_resolution)
+    if file is not None and get_counts_version(file) != _counts_version:
+        # Counted before the count fix, so the raw data is aggregated again
+        logger.info('Removing %s with counts of an earlier version.' % (file, ))
+        catalog.remove(file)
+        remove_datafile(file)
+        file = None
+    if file is not None:
+        logger.info('File found! Had the same begin and end date!')
+        return file
 
     logger.info('No time aggregated files were found.')
     return None
 
 
-def get_area_aggregation_file(logger, results_dir_traffic, begin_date, end_date,
+def build_time_aggregation_index(logger, catalog, time_aggregated_file, begin_date, end_date, time_resolution):
+    """
+    Builds the prefix-sum index of a time aggregated datafile registered in
+    the catalog. The index of the time aggregated datafile with the same
+    begin date and the latest earlier end date is extended if it has one, so
+    only the newly appended days are read.
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.prefix_sums import build_prefix_sum_index
+
+    previous_file = catalog.find_latest('time', begin_date, end_date, resolution=time_resolution)
+    logger.info('Building the prefix-sum index of %s (extending the index of %s)'
+                % (time_aggregated_file, previous_file))
+    with get_metrics().stage('prefix_sums'):
+        build_prefix_sum_index(time_aggregated_file,
+                               time0=datetime.datetime.combine(begin_date, datetime.time()),
+                               time_end=datetime.datetime.combine(end_date, datetime.time()),
+                               delta_t=time_resolution,
+                               extend_from=previous_file)
+
+
+def get_area_aggregation_file(logger, catalog, begin_date, end_date, time_resolution,
                               aggregation_level):
     logger.info('Checking for existent area aggregated files. Level: %s' % (aggregation_level))
-    match_pattern = '%s/tms_between_*' % (results_dir_traffic, )
-    aggregation_files = glob.glob(match_pattern)
-    logger.debug('Looking for dates in files with pattern: %s' % (match_pattern))
-    comp_aggregation_level = aggregation_level + "s"
+    file = catalog.find('area', begin_date, end_date, resolution=time_resolution, level=aggregation_level)
+    if file is not None:
+        logger.info('Found file! Had the same begin, end date and area!')
+        return file
+
+    logger.info('No area aggregated files were found.')
+    return None
+
 
-    if len(aggregation_files) == 0:
-        logger.info('No files with the pattern were found.')
+def get_area_aggregation_file_to_extend(logger, catalog, begin_date, end_date, time_resolution,
+                                        aggregation_level):
+    """
+    Finds the area aggregated file with the same begin date and area that has
+    the latest end date before end_date. Its contents are a prefix of the
+    results for the whole date range, so it can be extended incrementally.
+    """
+    logger.info('Checking for area aggregated files to extend. Level: %s' % (aggregation_level))
+    file = catalog.find_latest('area', begin_date, end_date, resolution=time_resolution, level=aggregation_level)
+    if file is None:
+        logger.info('No area aggregated file to extend was found.')
         return None
-    else:
-        for file in aggregation_files:
-            logger.debug('Looking for dates and area in file: %s' % (file, ))
-            regex_match = re.match((r".*tms_between_(?P<area>[a-zA-Z]*)"
-                                    r".*fi_traffic_aggregated-.*"
-                                    r"(?P<begin_date>\d{4}-\d{2}-\d{2}).*"
-                                    r"(?P<end_date>\d{4}-\d{2}-\d{2}).*"), file)
-            if not regex_match:
-                logger.debug('Invalid aggregation file: %s' % (file, ))
-                continue
-
-            begin_date_file = datetime.datetime.strptime(regex_match.group('begin_date'),
-                                                         "%Y-%m-%d").date()
-            end_date_file = datetime.datetime.strptime(regex_match.group('end_date'),
-                                                       "%Y-%m-%d").date()
-            area = regex_match.group('area')
-            logger.debug('Begin date: %s. End date: %s. Area: %s' % (begin_date_file,
-                                                                     end_date_file,
-                                                                     area))
-            if (begin_date_file == begin_date and end_date_file == end_date
-               and area == comp_aggregation_level):
-                logger.info('Found file! Had the same begin, end date and area!')
-                return file
 
-    logger.info('No time aggregated files were found.')
-    return None
+    logger.info('Found file to extend: %s' % (file, ))
+    return file
+
+
+def reconcile_catalog(logger, catalog, results_dir_fetch, results_dir_aggregate, results_dir_traffic):
+    """
+    Reconciles the dataset catalog with the results directories: the
+    datafiles not yet in the catalog, e.g. those of earlier runs or of
+    fin-traffic-fetch-raw-data, are registered, and the records of removed
+    datafiles are dropped. Only the new datafiles are hashed.
+    """
+    logger.info('Reconciling the dataset catalog with the results directories')
+    catalog.scan(results_dir_fetch, 'raw')
+    catalog.scan(results_dir_aggregate, 'time')
+    catalog.scan(results_dir_traffic, 'area')
+    catalog.scan(results_dir_traffic, 'export')
+
+
+def open_catalog(logger, catalog_path, results_dir_fetch, results_dir_aggregate, results_dir_traffic,
+                 rescan=False):
+    """
+    Opens the dataset catalog. A new catalog is filled with the datafiles
+    already in the results directories, and an existing one is reconciled
+    with them (see reconcile_catalog) only if rescan is set.
+    """
+    catalog = DatasetCatalog(catalog_path)
+    if catalog.is_empty():
+        logger.info('Building the dataset catalog %s from the results directories' % (catalog_path, ))
+        reconcile_catalog(logger, catalog, results_dir_fetch, results_dir_aggregate, results_dir_traffic)
+    elif rescan:
+        reconcile_catalog(logger, catalog, results_dir_fetch, results_dir_aggregate, results_dir_traffic)
+    return catalog
+
+
+def fill_missing_raw_data(logger, catalog, begin_date, end_date, results_dir_fetch):
+    """
+    Fetches the station-days that are missing inside the existing raw
+    datafiles of the date range, and removes the results that are out of
+    date because of them from the catalog and from the disk.
+    """
+    raw_data_files = catalog.list('raw', begin_date=begin_date, end_date=end_date)
+    logger.info('Fetching missing station-days of the raw data')
+    with get_metrics().stage('fill_gaps'):
+        filled_dates = fetch_missing_raw_data(raw_data_files=raw_data_files, results_dir=results_dir_fetch)
+    if filled_dates:
+        logger.info('Stored missing raw data of the dates: %s' % (filled_dates, ))
+        for raw_data_file, begin_date_file, end_date_file in raw_data_files:
+            if any(begin_date_file <= d < end_date_file for d in filled_dates):
+                catalog.register('raw', raw_data_file, begin_date_file, end_date_file)
+        # The results including these dates are out of date. Their files are
+        # removed as well, so that they are not registered again by a scan
+        # or extended by the next run.
+        for kind in ['time', 'area', 'export']:
+            for path in catalog.remove_ending_after(kind, filled_dates[0]):
+                logger.info('Removing the out of date %s' % (path, ))
+                remove_datafile(path)
+
+
+# Maximum number of stations fetched but not yet aggregated in the pipelined mode
+_max_pending_stations = 32
+
+
+def get_aggregation_levels(aggregation_level):
+    """List of the area aggregation levels of the --aggregation_level option"""
+    if aggregation_level == "all":
+        return ["province", "erva", "hcd"]
+    return [aggregation_level]
+
+
+def _fetch_tms_data_aggregate_pipelined(logger, catalog, begin_date, end_date, date_intervals,
+                                        results_dir_fetch, time_resolution, results_dir_aggregate,
+                                        aggregation_level, visualize_bool, results_dir_traffic,
+                                        statistics=None, max_memory=None, prefix_sums=False):
+    """
+    Runs the fetch, time aggregation, area aggregation and export of new
+    date intervals concurrently (see fin_traffic_data.pipeline.run_pipelined)
+    and records the results in the catalog.
+    """
+    from fin_traffic_data.pipeline import run_pipelined
+
+    # The existing raw datafiles are read by the aggregation workers while
+    # the new ones are fetched, so their gaps are filled first
+    fill_missing_raw_data(logger=logger,
+                          catalog=catalog,
+                          begin_date=begin_date,
+                          end_date=end_date,
+                          results_dir_fetch=results_dir_fetch)
+
+    aggregation_list = get_aggregation_levels(aggregation_level)
+    logger.info('Fetching and aggregating in a pipeline\n'
+                'Date intervals: %s\n'
+                'Time resolution: %s\n'
+                'Aggregation levels: %s' % (date_intervals, time_resolution, aggregation_list))
+    # A fetched station is held in memory for all the date intervals
+    max_pending = _max_pending_stations
+    if max_memory is not None and statistics is not None and not statistics.is_empty():
+        station_bytes = sum(statistics.estimate_bytes(b, e) for b, e in date_intervals)
+        max_pending = int(max(1, min(max_pending, max_memory // max(station_bytes, 1))))
+        logger.info('Estimated memory of a fetched station: %d bytes. Stations pending at a time: %d'
+                    % (station_bytes, max_pending))
+    raw_data_files = catalog.list('raw')
+    # The time aggregated datafile of an earlier run is extended with the
+    # new days instead of aggregating all the raw data again
+    previous_file = catalog.find_latest('time',
+                                        min(f[0] for f in date_intervals + [f[1:] for f in raw_data_files]),
+                                        max(f[1] for f in date_intervals + [f[1:] for f in raw_data_files]),
+                                        resolution=time_resolution)
+    with get_metrics().stage('pipelined'):
+        results = run_pipelined(logger=logger,
+                                date_intervals=date_intervals,
+                                raw_data_files=raw_data_files,
+                                time_resolution=time_resolution,
+                                aggregation_levels=aggregation_list,
+                                results_dir_fetch=results_dir_fetch,
+                                results_dir_aggregate=results_dir_aggregate,
+                                results_dir_traffic=results_dir_traffic,
+                                visualize_bool=visualize_bool,
+                                max_pending=max_pending,
+                                extend_from=previous_file)
+        _count_bytes_written([f[0] for f in results['raw']] + [results['time']] +
+                             list(results['area'].values()) + list(results['export'].values()))
+
+    for raw_data_file, begin_date_interval, end_date_interval in results['raw']:
+        catalog.register('raw', raw_data_file, begin_date_interval, end_date_interval)
+    all_raw_data_files = raw_data_files + results['raw']
+    catalog.register('time', results['time'],
+                     begin_date=min(f[1] for f in all_raw_data_files),
+                     end_date=max(f[2] for f in all_raw_data_files),
+                     resolution=time_resolution)
+    if prefix_sums:
+        build_time_aggregation_index(logger=logger,
+                                     catalog=catalog,
+                                     time_aggregated_file=results['time'],
+                                     begin_date=min(f[1] for f in all_raw_data_files),
+                                     end_date=max(f[2] for f in all_raw_data_files),
+                                     time_resolution=time_resolution)
+    result_tar_path = None
+    for aggregation_area in aggregation_list:
+        catalog.register('area', results['area'][aggregation_area], begin_date, end_date,
+                         resolution=time_resolution, level=aggregation_area)
+        result_tar_path = results['export'][aggregation_area]
+        catalog.register('export', result_tar_path, begin_date, end_date,
+                         resolution=time_resolution, level=aggregation_area)
+    logger.info('Finished to execute complete process of fetching TMS data')
+    return result_tar_path
+
+
+def _count_bytes_written(paths):
+    """Records the sizes of output files in the metrics of the current stage."""
+    for path in paths:
+        if path is not None and os.path.isfile(path):
+            get_metrics().count('bytes_written', os.path.getsize(path))
 
 
 def fetch_tms_data_aggregate(logger, begin_date, end_date,
                              progressbar_bool, results_dir_fetch,
                              time_resolution, results_dir_aggregate,
                              aggregation_level, visualize_bool,
-                             results_dir_traffic):
+                             results_dir_traffic, catalog_path='fin_traffic_catalog.sqlite',
+                             pipelined=False, max_memory=None,
+                             metrics_file=None, prometheus_file=None, catalog=None,
+                             prefix_sums=False, rescan=False, fetch_from=None):
+    """
+    Fetches the raw data between the dates, aggregates it by time and by
+    area and exports the results as CSV, reusing the earlier results
+    recorded in the catalog.
+
+    An already opened catalog can be given instead of catalog_path, e.g. by
+    a long-running process. The catalog is reconciled with the results
+    directories only when it is created or if rescan is set, e.g. after
+    fin-traffic-fetch-raw-data wrote raw datafiles without it. If
+    prefix_sums is set, the prefix-sum index of the time aggregated datafile
+    is built (see fin_traffic_data.prefix_sums).
+
+    Only the raw data from fetch_from on is fetched and checked for missing
+    station-days if it is given, e.g. by a long-running process that has
+    completed the earlier days. The results still span begin_date to
+    end_date.
+
+    Returns
+    -------
+    Path to the CSV archive (of the last aggregation level)
+    """
     logger.info('Starting to fetch all data and aggregate.')
+    metrics = reset_metrics()
+    try:
+        with contextlib.ExitStack() as stack:
+            if catalog is None:
+                catalog = stack.enter_context(open_catalog(logger=logger,
+                                                           catalog_path=catalog_path,
+                                                           results_dir_fetch=results_dir_fetch,
+                                                           results_dir_aggregate=results_dir_aggregate,
+                                                           results_dir_traffic=results_dir_traffic,
+                                                           rescan=rescan))
+            elif rescan:
+                reconcile_catalog(logger, catalog, results_dir_fetch, results_dir_aggregate, results_dir_traffic)
+            return _fetch_tms_data_aggregate(logger=logger,
+                                             catalog=catalog,
+                                             begin_date=begin_date,
+                                             end_date=end_date,
+                                             progressbar_bool=progressbar_bool,
+                                             results_dir_fetch=results_dir_fetch,
+                                             time_resolution=time_resolution,
+                                             results_dir_aggregate=results_dir_aggregate,
+                                             aggregation_level=aggregation_level,
+                                             visualize_bool=visualize_bool,
+                                             results_dir_traffic=results_dir_traffic,
+                                             pipelined=pipelined,
+                                             max_memory=max_memory,
+                                             prefix_sums=prefix_sums,
+                                             fetch_from=fetch_from)
+    finally:
+        for stage in metrics.stages:
+            logger.info('Stage %s: wall time %.1f s, CPU time %.1f s, peak RSS %d MB (workers so far %d MB), %s'
+                        % (stage.name, stage.wall_time, stage.cpu_time, stage.peak_rss // 2**20,
+                           stage.children_peak_rss // 2**20, stage.counters))
+        write_metrics(metrics, json_path=metrics_file, prometheus_path=prometheus_file)
+
+
+def _fetch_tms_data_aggregate(logger, catalog, begin_date, end_date,
+                              progressbar_bool, results_dir_fetch,
+                              time_resolution, results_dir_aggregate,
+                              aggregation_level, visualize_bool,
+                              results_dir_traffic, pipelined=False, max_memory=None,
+                              prefix_sums=False, fetch_from=None):
+    fetch_begin_date = begin_date if fetch_from is None else max(begin_date, fetch_from)
+    # Observed rows per station and day for planning the batches
+    statistics = FetchStatistics.open(results_dir_fetch)
     date_intervals = determine_dates_to_fetch(logger=logger,
-                                              results_dir_fetch=results_dir_fetch,
-                                              begin_date=begin_date,
-                                              end_date=end_date)
+                                              catalog=catalog,
+                                              begin_date=fetch_begin_date,
+                                              end_date=end_date,
+                                              statistics=statistics,
+                                              max_memory=max_memory)
     logger.info('Date intervals determined.')
 
+    if pipelined and len(date_intervals) > 0:
+        return _fetch_tms_data_aggregate_pipelined(logger=logger,
+                                                   catalog=catalog,
+                                                   begin_date=begin_date,
+                                                   end_date=end_date,
+                                                   date_intervals=date_intervals,
+                                                   results_dir_fetch=results_dir_fetch,
+                                                   time_resolution=time_resolution,
+                                                   results_dir_aggregate=results_dir_aggregate,
+                                                   aggregation_level=aggregation_level,
+                                                   visualize_bool=visualize_bool,
+                                                   results_dir_traffic=results_dir_traffic,
+                                                   statistics=statistics,
+                                                   max_memory=max_memory,
+                                                   prefix_sums=prefix_sums)
+
+    metrics = get_metrics()
     if len(date_intervals) == 0:
         logger.info('No new date interval determined. Not downloading anything.')
     else:
-        for begin_date_interval, end_date_interval in date_intervals:
-            logger.info('Fetching raw data\n'
-                        'Begin date: %s\n'
-                        'End date: %s\n'
-                        'Progressbar bool: %s\n'
-                        'Results dir fetch: %s' % (begin_date_interval,
-                                                   end_date_interval,
-                                                   progressbar_bool,
-                                                   results_dir_fetch))
-            results_dir_fetch = fetch_raw_data(begin_date=begin_date_interval,
-                                               end_date=end_date_interval,
-                                               progressbar_bool=progressbar_bool,
-                                               results_dir=results_dir_fetch)
+        with metrics.stage('fetch'):
+            for begin_date_interval, end_date_interval in date_intervals:
+                logger.info('Fetching raw data\n'
+                            'Begin date: %s\n'
+                            'End date: %s\n'
+                            'Progressbar bool: %s\n'
+                            'Results dir fetch: %s' % (begin_date_interval,
+                                                       end_date_interval,
+                                                       progressbar_bool,
+                                                       results_dir_fetch))
+                results_dir_fetch = fetch_raw_data(begin_date=begin_date_interval,
+                                                   end_date=end_date_interval,
+                                                   progressbar_bool=progressbar_bool,
+                                                   results_dir=results_dir_fetch)
+                raw_data_file = get_raw_data_file_path(results_dir_fetch, begin_date_interval, end_date_interval)
+                if os.path.isfile(raw_data_file):
+                    catalog.register('raw', raw_data_file, begin_date_interval, end_date_interval)
+                    _count_bytes_written([raw_data_file])
         logger.info('Raw data fetched!')
 
+    fill_missing_raw_data(logger=logger,
+                          catalog=catalog,
+                          begin_date=fetch_begin_date,
+                          end_date=end_date,
+                          results_dir_fetch=results_dir_fetch)
+
     time_aggregated_file = get_time_aggregation_file(logger=logger,
-                                                     results_dir_aggregate=results_dir_aggregate,
+                                                     catalog=catalog,
                                                      begin_date=begin_date,
-                                                     end_date=end_date)
+                                                     end_date=end_date,
+                                                     time_resolution=time_resolution)
     if time_aggregated_file is None:
         logger.info('Aggregating data by time\n'
                     'Aggregating raw data files in: %s\n'
@@ -237,54 +461,116 @@ def fetch_tms_data_aggregate(logger, begin_date, end_date,
                     'Results dir time aggregated: %s' % (results_dir_fetch,
                                                          time_resolution,
                                                          results_dir_aggregate))
-        results_dir_aggregate = aggregate_raw_data(basepath=results_dir_fetch,
-                                                   delta_t=time_resolution,
-                                                   results_dir=results_dir_aggregate)
+        raw_data_files = catalog.list('raw')
+        # The time aggregated datafile of an earlier run is extended with
+        # the new days instead of aggregating all the raw data again
+        previous_file = None
+        if raw_data_files:
+            previous_file = catalog.find_latest('time',
+                                                min(f[1] for f in raw_data_files),
+                                                max(f[2] for f in raw_data_files),
+                                                resolution=time_resolution)
+        if previous_file is not None:
+            logger.info('Extending the time aggregated datafile %s' % (previous_file, ))
+        with metrics.stage('aggregate_time'):
+            aggregated_file = aggregate_raw_data(basepath=results_dir_fetch,
+                                                 delta_t=time_resolution,
+                                                 results_dir=results_dir_aggregate,
+                                                 raw_data_files=raw_data_files,
+                                                 extend_from=previous_file)
+            _count_bytes_written([aggregated_file])
+        catalog.register('time', aggregated_file,
+                         begin_date=min(f[1] for f in raw_data_files),
+                         end_date=max(f[2] for f in raw_data_files),
+                         resolution=time_resolution)
         logger.info('Data aggregated by time!')
+        if prefix_sums:
+            build_time_aggregation_index(logger=logger,
+                                         catalog=catalog,
+                                         time_aggregated_file=aggregated_file,
+                                         begin_date=min(f[1] for f in raw_data_files),
+                                         end_date=max(f[2] for f in raw_data_files),
+                                         time_resolution=time_resolution)
     else:
         logger.info('Found file with already aggregated data: %s' % (time_aggregated_file, ))
+        if prefix_sums and not os.path.isfile(get_prefix_sum_index_paths(time_aggregated_file)[1]):
+            build_time_aggregation_index(logger=logger,
+                                         catalog=catalog,
+                                         time_aggregated_file=time_aggregated_file,
+                                         begin_date=begin_date,
+                                         end_date=end_date,
+                                         time_resolution=time_resolution)
 
     time_aggregated_file = get_time_aggregation_file(logger=logger,
-                                                     results_dir_aggregate=results_dir_aggregate,
+                                                     catalog=catalog,
                                                      begin_date=begin_date,
-                                                     end_date=end_date)
+                                                     end_date=end_date,
+                                                     time_resolution=time_resolution)
     if time_aggregated_file is not None:
         # If all constructing a list with all levels
-        if aggregation_level == "all":
-            aggregation_list = ["province", "erva", "hcd"]
-        else:
-            aggregation_list = [aggregation_level]
+        aggregation_list = get_aggregation_levels(aggregation_level)
 
         for aggregation_area in aggregation_list:
             result_path_traffic = get_area_aggregation_file(logger=logger,
-                                                            results_dir_traffic=results_dir_traffic,
+                                                            catalog=catalog,
                                                             begin_date=begin_date,
                                                             end_date=end_date,
+                                                            time_resolution=time_resolution,
                                                             aggregation_level=aggregation_area)
+            area_file_to_extend = None
             if result_path_traffic is None:
+                area_file_to_extend = get_area_aggregation_file_to_extend(logger=logger,
+                                                                          catalog=catalog,
+                                                                          begin_date=begin_date,
+                                                                          end_date=end_date,
+                                                                          time_resolution=time_resolution,
+                                                                          aggregation_level=aggregation_area)
                 logger.info('Aggregating data by area\n'
                             'Time aggregated input file: %s\n'
                             'Aggregation level: %s\n'
                             'Visaluzation enabled?: %s\n'
+                            'Extending file: %s\n'
                             'Results dir area aggregated: %s' % (time_aggregated_file,
                                                                  aggregation_area,
                                                                  visualize_bool,
+                                                                 area_file_to_extend,
                                                                  results_dir_traffic))
-                result_path_traffic = get_aggregated_traffic_between_areas(inputfile=time_aggregated_file,
-                                                                           area=aggregation_area,
-                                                                           visualization_enabled=visualize_bool,
-                                                                           results_dir=results_dir_traffic)
+                with metrics.stage('aggregate_area_' + aggregation_area):
+                    result_path_traffic = get_aggregated_traffic_between_areas(
+                        inputfile=time_aggregated_file,
+                        area=aggregation_area,
+                        visualization_enabled=visualize_bool,
+                        results_dir=results_dir_traffic,
+                        append_to=area_file_to_extend
+                    )
+                    _count_bytes_written([result_path_traffic])
+                if area_file_to_extend is not None:
+                    # The extended file was renamed
+                    catalog.remove(area_file_to_extend)
+                catalog.register('area', result_path_traffic, begin_date, end_date,
+                                 resolution=time_resolution, level=aggregation_area)
                 logger.info('Data aggregated by area!')
             else:
                 logger.info('Data aggregated by area file found: %s' % (result_path_traffic, ))
 
-            result_tar_path = result_path_traffic.split('.')[0] + ".tar.bz2"
-            if os.path.isfile(result_tar_path):
+            result_tar_path = catalog.find('export', begin_date, end_date,
+                                           resolution=time_resolution, level=aggregation_area,
+                                           suffix='.tar.bz2')
+            if result_tar_path is not None:
                 logger.info('Compressed file already found: %s' % (result_tar_path))
             else:
                 logger.info('Exporting results as CSV'
                             'Exporting results in file: %s' % (result_path_traffic, ))
-                result_tar_path = export_area_data_as_csv(inputpath=result_path_traffic)
+                # The archive of the extended file has the members of the edges that did not change
+                previous_tar_path = None
+                if area_file_to_extend is not None:
+                    previous_tar_path = get_csv_archive_path(area_file_to_extend)
+                with metrics.stage('export_' + aggregation_area):
+                    result_tar_path = export_area_data_as_csv(inputpath=result_path_traffic,
+                                                              reuse_from=previous_tar_path)
+                    _count_bytes_written([result_tar_path])
+                catalog.register('export', result_tar_path, begin_date, end_date,
+                                 resolution=time_resolution, level=aggregation_area)
                 logger.info('Exported results in CSV!')
 
                 logger.info('Finished to execute complete process of fetching TMS data')
@@ -319,7 +605,7 @@ def parse_args(args=sys.argv[1:]):
                         help="Set the area aggregation level.")
 
     parser.add_argument("--time-resolution",
-                        type=_parse_time_resolution,
+                        type=parse_time_resolution,
                         required=True,
                         help="Time resolution of the aggregation")
 
@@ -338,6 +624,52 @@ def parse_args(args=sys.argv[1:]):
                         default='aggregated_data_area',
                         help="Name of the directory to store the aggregated data by area.")
 
+    parser.add_argument("--catalog",
+                        type=str,
+                        default='fin_traffic_catalog.sqlite',
+                        help=("Path to the catalog of the datafiles. It is built from the results directories "
+                              "if it does not exist."))
+
+    parser.add_argument("--rescan",
+                        action='store_true',
+                        default=False,
+                        help=("Reconcile the existing catalog with the results directories: register the "
+                              "datafiles written without it, e.g. by fin-traffic-fetch-raw-data, and drop the "
+                              "records of removed datafiles."))
+
+    parser.add_argument("--pipelined",
+                        action='store_true',
+                        default=False,
+                        help=("Aggregate and export the stations and edges as soon as their data is fetched "
+                              "instead of running the stages one after another."))
+
+    parser.add_argument("--prefix-sums",
+                        action='store_true',
+                        default=False,
+                        help=("Store a prefix-sum index next to the time aggregated datafile for fast totals "
+                              "over time windows and coarser time resolutions. The index of the previous "
+                              "run is extended with the new days."))
+
+    parser.add_argument("--max-memory",
+                        type=parse_memory_size,
+                        default=None,
+                        help=("Memory budget for fetching, e.g. '4G'. The raw data is fetched in batches "
+                              "of dates planned from the rows per station and day observed in earlier runs. "
+                              "Without it, or without observations, the batches are 30 days."))
+
+    parser.add_argument("--metrics-file",
+                        type=str,
+                        default=None,
+                        help="Append the performance metrics of the stages to this file as JSON lines.")
+
+    parser.add_argument("--prometheus-file",
+                        type=str,
+                        default=None,
+                        help=("Write the performance metrics of the stages to this file in the Prometheus "
+                              "text format, e.g. for the textfile collector of the node exporter."))
+
+    add_profile_arguments(parser)
+
     # Arguments for logging
     parser.add_argument("--logfile", "-lf", type=str,
                         default="logs_complete_pipeline.log",
@@ -376,16 +708,24 @@ def main():
     logger = logging.getLogger()
     logger.info('Logger ready. Logging to file: %s' % (logfile))
     try:
-        fetch_tms_data_aggregate(logger=logger,
-                                 begin_date=args.begin_date,
-                                 end_date=args.end_date,
-                                 progressbar_bool=False,
-                                 results_dir_fetch=args.results_dir_fetch,
-                                 time_resolution=args.time_resolution,
-                                 results_dir_aggregate=args.results_dir_aggregate,
-                                 aggregation_level=args.aggregation_level,
-                                 visualize_bool=False,
-                                 results_dir_traffic=args.results_dir_traffic)
+        with profiled(args.profile, args.profile_dir, 'complete_pipeline'):
+            fetch_tms_data_aggregate(logger=logger,
+                                     begin_date=args.begin_date,
+                                     end_date=args.end_date,
+                                     progressbar_bool=False,
+                                     results_dir_fetch=args.results_dir_fetch,
+                                     time_resolution=args.time_resolution,
+                                     results_dir_aggregate=args.results_dir_aggregate,
+                                     aggregation_level=args.aggregation_level,
+                                     visualize_bool=False,
+                                     results_dir_traffic=args.results_dir_traffic,
+                                     catalog_path=args.catalog,
+                                     pipelined=args.pipelined,
+                                     max_memory=args.max_memory,
+                                     prefix_sums=args.prefix_sums,
+                                     metrics_file=args.metrics_file,
+                                     prometheus_file=args.prometheus_file,
+                                     rescan=args.rescan)
     except Exception:
         logger.exception("Fatal error in main loop")
     finally:
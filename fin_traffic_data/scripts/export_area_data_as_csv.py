@@ -1,34 +1,568 @@
 import os
 import sys
-from io import BytesIO
+import bz2
+import lzma
+import zlib
+import json
+import shutil
+import hashlib
+import contextlib
 import tarfile
+import tempfile
 import argparse
 import codecs
-import h5py
+import multiprocessing
+import numpy as np
 import pandas as pd
+from fin_traffic_data.profiling import add_profile_arguments, init_worker_profiling, profiled
 
+# Output codecs. Each member of the archive is compressed as an independent
+# stream; all of these formats decompress concatenated streams as one.
+_codecs = ['bz2', 'gz', 'xz', 'zst']
 
-def export_area_data_as_csv(inputpath):
-    # Get only the filename
-    input_file = os.path.basename(inputpath)
-    # Remove the extension
-    input_file = input_file.split('.')[0]
-    outputpath = inputpath.split('.')[0] + ".tar.bz2"
-
-    with h5py.File(inputpath, 'r') as hf:
-        tms_keys = list(hf.keys())
-        with tarfile.open(outputpath, 'w:bz2') as tfile:
-            for key in tms_keys:
-                print(f"Exporting {key}")
-                fileobj = BytesIO()
-                writer_wrapper = codecs.getwriter('utf-8')(fileobj)
-                df = pd.read_hdf(inputpath, key=key)
-                df.to_csv(writer_wrapper)
-                filename = input_file + "/" + key + '.csv'
-                tinfo = tarfile.TarInfo(filename)
-                tinfo.size = fileobj.tell()
-                fileobj.seek(0)
-                tfile.addfile(tinfo, fileobj=fileobj)
+# Single file columnar output formats and their file extensions
+_columnar_formats = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Version of the format of the index written next to the CSV archives
+_export_index_version = 2
+
+# Number of rows formatted to CSV at a time
+_chunksize = 50000
+
+# Size of a formatted member kept in memory before it is spilled to disk
+_spool_size = 8 * 2**20
+
+# Number of the last rows of an edge hashed into its fingerprint, covering
+# the rows of the last timestamp that are computed again when the edge is
+# extended
+_fingerprint_rows = 64
+
+# Layout of a member in the archive: its tar header, its CSV data and the
+# padding to the tar block size are separate compressed streams, so that
+# rows appended to an edge can be written as another data stream after the
+# compressed data of the earlier archive.
+
+
+def _get_compressor(codec):
+    """Returns a new compressor object with compress() and flush() methods for the codec."""
+    if codec == 'bz2':
+        return bz2.BZ2Compressor(9)
+    elif codec == 'gz':
+        return zlib.compressobj(9, zlib.DEFLATED, 31)
+    elif codec == 'xz':
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+    elif codec == 'zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("The codec 'zst' requires the zstandard package.")
+        return zstandard.ZstdCompressor(level=10).compressobj()
+    else:
+        raise ValueError(f"Unknown codec '{codec}'")
+
+
+def _iterate_chunks(store, key):
+    """Iterator over the dataframe stored under the key in chunks of rows."""
+    storer = store.get_storer(key)
+    if storer.is_table and storer.nrows:
+        yield from store.select(key, chunksize=_chunksize)
+    else:
+        yield store.select(key)
+
+
+def _fingerprint_frames(frames):
+    """Content hash of the rows of consecutive dataframes, including their index and column names."""
+    sha = hashlib.sha1()
+    for i, df in enumerate(frames):
+        if i == 0:
+            sha.update(','.join(str(col) for col in df.columns).encode('utf-8'))
+        # The row hashes do not depend on how the rows are chunked
+        sha.update(pd.util.hash_pandas_object(df).values.tobytes())
+    return sha.hexdigest()
+
+
+def _hash_tail(tail):
+    """Content hash of the last rows of an edge, including their index and column names."""
+    sha = hashlib.sha1()
+    sha.update(','.join(str(col) for col in tail.columns).encode('utf-8'))
+    sha.update(pd.util.hash_pandas_object(tail).values.tobytes())
+    return sha.hexdigest()
+
+
+def _fingerprint_tail(generation, nrows, tail_hash):
+    """
+    Fingerprint of an edge from its generation (see
+    get_aggregated_traffic_between_areas.set_edge_generations), its number of
+    rows and the hash of its last rows. An edge of the same generation has
+    only been extended, so these identify its content without reading all of
+    it.
+    """
+    sha = hashlib.sha1()
+    sha.update(f'{generation}:{nrows}:{tail_hash}'.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _read_tail_hash(store, key, nrows):
+    """Hash of the last rows of the first nrows rows stored under the key."""
+    return _hash_tail(store.select(key, start=max(nrows - _fingerprint_rows, 0), stop=nrows))
+
+
+def _member_info(fingerprint, nrows, tail_hash, generation):
+    """
+    Description of the data of a member, recorded in the index of the
+    archive: its fingerprint, and for an edge with a generation also its
+    number of rows and the hash of its last rows, from which a later export
+    recognizes the rows appended to it.
+    """
+    return {'fingerprint': fingerprint, 'nrows': nrows, 'tail': tail_hash, 'generation': generation}
+
+
+def _write_member(frames, codec, tmpdir, header=True):
+    """
+    Formats consecutive dataframes as a single CSV file and writes it as a
+    single compressed stream into a temporary file. Without header, the rows
+    are formatted as a continuation of an earlier CSV file.
+
+    Returns
+    -------
+    Tuple of the path to the compressed data and the size of the CSV file
+    """
+    with tempfile.SpooledTemporaryFile(max_size=_spool_size, dir=tmpdir) as csvfile:
+        writer_wrapper = codecs.getwriter('utf-8')(csvfile)
+        for i, df in enumerate(frames):
+            df.to_csv(writer_wrapper, header=(header and i == 0))
+        size = csvfile.tell()
+        csvfile.seek(0)
+
+        fd, member_path = tempfile.mkstemp(dir=tmpdir, suffix='.part')
+        with os.fdopen(fd, 'wb') as member_file:
+            compressor = _get_compressor(codec)
+            while True:
+                block = csvfile.read(2**20)
+                if not block:
+                    break
+                member_file.write(compressor.compress(block))
+            member_file.write(compressor.flush())
+
+    return member_path, size
+
+
+def _export_member(store, key, codec, tmpdir, cached_member=None):
+    """
+    Formats the dataframe stored under the key as CSV and writes it as a
+    single compressed stream into a temporary file.
+
+    Input
+    -----
+    store: pandas.HDFStore
+        Opened area aggregated datafile
+    key: Text
+        Key of the dataframe in the store
+    codec: Text
+        One of 'bz2', 'gz', 'xz' or 'zst'
+    tmpdir: Text
+        Directory for the temporary files
+    cached_member: Optional[Dict]
+        Index entry of the member in an earlier export. If the data has not
+        changed, nothing is formatted. If the edge has the same generation
+        and its first rows are those of the earlier export, only the rows
+        appended since are formatted.
+
+    Returns
+    -------
+    Dict with
+        - path: the path to the compressed data, None if unchanged
+        - size: the size of the CSV data in path
+        - appended: whether the data in path follows the data of the member
+          in the earlier archive
+    and the description of the data (see _member_info)
+    """
+    storer = store.get_storer(key)
+    generation = getattr(storer.attrs, 'generation', None) if storer.is_table else None
+    if generation is None:
+        fingerprint = _fingerprint_frames(_iterate_chunks(store, key))
+        info = _member_info(fingerprint, None, None, None)
+    else:
+        nrows = int(storer.nrows)
+        tail_hash = _read_tail_hash(store, key, nrows)
+        info = _member_info(_fingerprint_tail(generation, nrows, tail_hash), nrows, tail_hash, generation)
+    cached_member = cached_member or {}
+    if info['fingerprint'] == cached_member.get('fingerprint'):
+        return dict(path=None, size=0, appended=True, **info)
+
+    previous_nrows = cached_member.get('nrows')
+    if (generation is not None and cached_member.get('generation') == generation and previous_nrows
+            and previous_nrows <= info['nrows']
+            and _read_tail_hash(store, key, previous_nrows) == cached_member.get('tail')):
+        # Extended since the earlier export: only the new rows are formatted
+        frames = store.select(key, start=previous_nrows, chunksize=_chunksize)
+        member_path, size = _write_member(frames, codec, tmpdir, header=False)
+        return dict(path=member_path, size=size, appended=True, **info)
+
+    member_path, size = _write_member(_iterate_chunks(store, key), codec, tmpdir)
+    return dict(path=member_path, size=size, appended=False, **info)
+
+
+def export_dataframe_member(df, codec, tmpdir, generation=None):
+    """
+    Formats an edge held in memory as a member of a CSV archive, exactly as
+    _export_member does for the same data stored in an area aggregated
+    datafile with the given generation. Used to export the edges while they
+    are being computed.
+
+    Returns
+    -------
+    The member as returned by _export_member
+    """
+    member_path, size = _write_member([df], codec, tmpdir)
+    if generation is None:
+        info = _member_info(_fingerprint_frames([df]), None, None, None)
+    else:
+        tail_hash = _hash_tail(df.iloc[-_fingerprint_rows:])
+        info = _member_info(_fingerprint_tail(generation, df.shape[0], tail_hash), df.shape[0], tail_hash,
+                            generation)
+    return dict(path=member_path, size=size, appended=False, **info)
+
+
+def _tar_padding(size):
+    """Number of bytes padding a member of the given size to the tar block size."""
+    return (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+
+
+def _write_member_header(fileobj, codec, arcname, size):
+    """Writes the tar header of a member as its own compressed stream and returns its uncompressed size."""
+    tinfo = tarfile.TarInfo(arcname)
+    tinfo.size = size
+    header = tinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+    compressor = _get_compressor(codec)
+    fileobj.write(compressor.compress(header))
+    fileobj.write(compressor.flush())
+    return len(header)
+
+
+def _write_member_padding(fileobj, codec, size):
+    """Writes the padding of a member of the given size to the tar block size as its own compressed stream."""
+    padding = _tar_padding(size)
+    if padding:
+        compressor = _get_compressor(codec)
+        fileobj.write(compressor.compress(tarfile.NUL * padding))
+        fileobj.write(compressor.flush())
+    return padding
+
+
+def _write_end_of_archive(fileobj, codec, archive_size):
+    """Writes the compressed end-of-archive blocks of a tar archive of the given uncompressed size."""
+    archive_size += 2 * tarfile.BLOCKSIZE
+    padding = (tarfile.RECORDSIZE - archive_size % tarfile.RECORDSIZE) % tarfile.RECORDSIZE
+    compressor = _get_compressor(codec)
+    fileobj.write(compressor.compress(tarfile.NUL * (2 * tarfile.BLOCKSIZE + padding)))
+    fileobj.write(compressor.flush())
+
+
+def _copy_range(src, dst, offset, length):
+    """Copies length bytes starting from offset in src to the current position of dst."""
+    src.seek(offset)
+    while length > 0:
+        block = src.read(min(length, 2**20))
+        if not block:
+            raise RuntimeError(f"Unexpected end of file {src.name}")
+        dst.write(block)
+        length -= len(block)
+
+
+def get_csv_archive_path(inputpath, codec='bz2'):
+    """Path to the CSV archive of an area aggregated datafile"""
+    return inputpath.split('.')[0] + ".tar." + codec
+
+
+def _get_export_index_path(archive_path):
+    return archive_path + '.index.json'
+
+
+def _load_export_index(archive_path, codec):
+    """
+    Loads the index of the members of an earlier export.
+
+    Returns
+    -------
+    Dict from key to the member information, or an empty dict if the archive
+    or its index is missing, was written with another codec or does not match.
+    """
+    try:
+        with open(_get_export_index_path(archive_path), 'r') as f:
+            index = json.load(f)
+        archive_size = os.path.getsize(archive_path)
+    except (OSError, ValueError):
+        return {}
+    if (index.get('version') != _export_index_version or index.get('codec') != codec
+            or index.get('archive_size') != archive_size):
+        return {}
+    return dict((member['key'], member) for member in index['members'])
+
+
+def write_archive(outputpath, codec, tmpdir, members, cached_members=None, reuse_from=None):
+    """
+    Writes a CSV archive and its index from the compressed members.
+
+    Input
+    -----
+    outputpath: Text
+        Path to the archive. The directory of the area aggregated datafile in
+        the archive is named after it.
+    codec: Text
+        One of 'bz2', 'gz', 'xz' or 'zst'
+    tmpdir: Text
+        Temporary directory in the output directory
+    members: Iterable[Tuple[Text, Dict]]
+        Keys with the results of _export_member in the order of the archive
+    cached_members: Optional[Dict]
+        Index of the earlier archive, for the members that were not exported
+        again or only had rows appended
+    reuse_from: Optional[Text]
+        Earlier archive
+    """
+    input_file = os.path.basename(outputpath).split('.')[0]
+    # Write into a temporary file so that a partial archive is never left behind
+    partial_outputpath = os.path.join(tmpdir, 'archive')
+    archive_size = 0
+    index_members = []
+    with contextlib.ExitStack() as stack:
+        tfile = stack.enter_context(open(partial_outputpath, 'wb'))
+        if cached_members:
+            old_tfile = stack.enter_context(open(reuse_from, 'rb'))
+
+        for key, member in members:
+            arcname = input_file + "/" + key.lstrip('/') + '.csv'
+            size = member['size']
+            if member['path'] is None:
+                print(f"Reusing {key.lstrip('/')}")
+            elif member['appended']:
+                print(f"Appending to {key.lstrip('/')}")
+            else:
+                print(f"Exporting {key.lstrip('/')}")
+            if member['appended']:
+                size += cached_members[key]['size']
+
+            archive_size += _write_member_header(tfile, codec, arcname, size)
+            offset = tfile.tell()
+            if member['appended']:
+                _copy_range(old_tfile, tfile, cached_members[key]['offset'], cached_members[key]['length'])
+            if member['path'] is not None:
+                with open(member['path'], 'rb') as member_file:
+                    shutil.copyfileobj(member_file, tfile)
+                os.remove(member['path'])
+            length = tfile.tell() - offset
+            archive_size += size + _write_member_padding(tfile, codec, size)
+            index_members.append(dict(
+                key=key,
+                size=size,
+                offset=offset,
+                length=length,
+                **dict((name, member[name]) for name in ['fingerprint', 'nrows', 'tail', 'generation'])
+            ))
+        _write_end_of_archive(tfile, codec, archive_size)
+        index = {
+            'version': _export_index_version,
+            'codec': codec,
+            'archive_size': tfile.tell(),
+            'members': index_members
+        }
+
+    partial_indexpath = os.path.join(tmpdir, 'index')
+    with open(partial_indexpath, 'w') as f:
+        json.dump(index, f)
+    os.replace(partial_outputpath, outputpath)
+    os.replace(partial_indexpath, _get_export_index_path(outputpath))
+
+
+def _init_export_worker(inputpath):
+    """Initialization of the multiprocessing Pool; every worker opens the input once."""
+    global store
+    store = pd.HDFStore(inputpath, mode='r')
+    init_worker_profiling()
+
+
+def _export_member_worker(args):
+    return _export_member(store, *args)
+
+
+def export_area_data_as_csv(inputpath, codec='bz2', workers=None, reuse_from=None):
+    """
+    Exports every edge of an area aggregated datafile as a CSV file inside a
+    compressed tar-archive.
+
+    The members are formatted and compressed in parallel, each in its own
+    compressed stream, and written to the archive in the order of the keys.
+    A member is formatted in chunks of rows and spilled to disk when large,
+    so the memory use of a worker is bounded independently of its size.
+
+    Next to the archive an index '<archive>.index.json' records the content
+    hash and the location of each member. When exporting again, the members
+    whose data has not changed are copied from the earlier archive as
+    compressed bytes instead of being formatted and compressed again. For an
+    edge that was only extended (of the same generation, see
+    get_aggregated_traffic_between_areas.set_edge_generations, with the same
+    rows up to the number of rows of the earlier export), the compressed data
+    of the earlier archive is copied and only the new rows are formatted and
+    compressed, as another stream after it.
+
+    Input
+    -----
+    inputpath: Text
+        Path to the area aggregated datafile
+    codec: Text (optional)
+        Compression of the archive. One of 'bz2', 'gz', 'xz' or 'zst'
+    workers: Optional[int]
+        Number of worker processes. Defaults to the number of CPUs.
+    reuse_from: Optional[Text]
+        Earlier archive (with its index) of the same edges to reuse the
+        unchanged members from. Defaults to the archive being written.
+
+    Returns
+    -------
+    Path to the archive
+    """
+    outputpath = get_csv_archive_path(inputpath, codec)
+    _get_compressor(codec)  # Fail early on unavailable codecs
+
+    if reuse_from is None:
+        reuse_from = outputpath
+    cached_members = _load_export_index(reuse_from, codec)
+
+    with pd.HDFStore(inputpath, mode='r') as hdfstore:
+        tms_keys = hdfstore.keys()
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tms_keys)))
+
+    output_dir = os.path.dirname(os.path.abspath(outputpath))
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmpdir:
+        tasks = [(key, codec, tmpdir, cached_members.get(key)) for key in tms_keys]
+        with multiprocessing.Pool(workers, initializer=_init_export_worker, initargs=(inputpath, )) as pool:
+            write_archive(outputpath=outputpath,
+                          codec=codec,
+                          tmpdir=tmpdir,
+                          members=zip(tms_keys, pool.imap(_export_member_worker, tasks)),
+                          cached_members=cached_members,
+                          reuse_from=reuse_from)
+            # Let the workers exit cleanly instead of being terminated
+            pool.close()
+            pool.join()
+
+    return outputpath
+
+
+def _columnar_fields(pa, columns, dtypes):
+    """
+    Fields of the columnar export of the columns of an area aggregated
+    datafile: the time as a timestamp, the vehicle category as int8, the
+    counts and the vehicle counts of the statistics (see
+    aggregation._statistics_columns) as int32, the speed sums as float64, and
+    any other column with the type it is stored with.
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.aggregation import _statistics_columns
+
+    fields = []
+    for column in columns:
+        if column == 'time':
+            fields.append((column, pa.timestamp('s')))
+        elif column == 'vehicle category':
+            fields.append((column, pa.int8()))
+        elif column in ['speed_sum', 'speed_sum_sq']:
+            fields.append((column, pa.float64()))
+        elif column == 'counts' or column in _statistics_columns:
+            fields.append((column, pa.int32()))
+        else:
+            fields.append((column, pa.from_numpy_dtype(dtypes[column])))
+    return fields
+
+
+def _columnar_array(pa, values, field_type):
+    """Arrow array of the values of a column of an area aggregated datafile with the type of its field."""
+    if field_type == pa.timestamp('s'):
+        return pa.array(values.astype('datetime64[s]'), type=field_type)
+    return pa.array(values.astype(field_type.to_pandas_dtype()), type=field_type)
+
+
+def export_area_data_as_columnar(inputpath, output_format='parquet'):
+    """
+    Exports all edges of an area aggregated datafile into a single Parquet or
+    Arrow IPC file with the columns
+        - source : source area, dictionary encoded
+        - destination : destination area, dictionary encoded
+        - time : timestamp
+        - vehicle category : int8
+        - counts : int32
+    and the columns of the statistics if the datafile has them (see
+    fin_traffic_data.aggregation.aggregate_datafiles)
+        - speed_count, speed_<lo>, length_<lo> : int32
+        - speed_sum, speed_sum_sq : float64
+
+    The rows of each edge are written in chunks as separate row groups (record
+    batches) so that readers can skip the edges and columns they do not need,
+    e.g. pyarrow.parquet.read_table(path, filters=[('source', '=', 'HYKS')]).
+
+    Input
+    -----
+    inputpath: Text
+        Path to the area aggregated datafile
+    output_format: Text (optional)
+        Either 'parquet' or 'arrow'
+
+    Returns
+    -------
+    Path to the exported file
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Exporting as Parquet or Arrow requires the pyarrow package.")
+
+    outputpath = inputpath.split('.')[0] + _columnar_formats[output_format]
+
+    with pd.HDFStore(inputpath, mode='r') as hdfstore:
+        tms_keys = hdfstore.keys()
+        edges = [key.lstrip('/').split(':') for key in tms_keys]
+
+        # The columns of the schema are those of the edges, which all have
+        # the same columns
+        if tms_keys:
+            first_rows = hdfstore.select(tms_keys[0], start=0, stop=1)
+        else:
+            first_rows = pd.DataFrame(columns=['time', 'vehicle category', 'counts'])
+        area_type = pa.dictionary(pa.int16(), pa.string())
+        fields = _columnar_fields(pa, first_rows.columns, first_rows.dtypes)
+        schema = pa.schema([('source', area_type), ('destination', area_type)] + fields)
+
+        # A single dictionary of area names is shared by all the row groups
+        areas = sorted(set(area for edge in edges for area in edge))
+        area_codes = dict((area, code) for code, area in enumerate(areas))
+        area_dictionary = pa.array(areas, type=pa.string())
+
+        partial_outputpath = outputpath + '.partial'
+        if output_format == 'parquet':
+            writer = pq.ParquetWriter(partial_outputpath, schema, compression='zstd')
+        else:
+            writer = pa.ipc.new_file(partial_outputpath, schema)
+        with writer:
+            for key, (source, destination) in zip(tms_keys, edges):
+                print(f"Exporting {key.lstrip('/')}")
+                for df in _iterate_chunks(hdfstore, key):
+                    nrows = df.shape[0]
+                    table = pa.Table.from_arrays([
+                        pa.DictionaryArray.from_arrays(
+                            np.full(nrows, area_codes[source], dtype=np.int16), area_dictionary
+                        ),
+                        pa.DictionaryArray.from_arrays(
+                            np.full(nrows, area_codes[destination], dtype=np.int16), area_dictionary
+                        ),
+                    ] + [_columnar_array(pa, df[column].values, field_type) for column, field_type in fields],
+                        schema=schema)
+                    writer.write_table(table)
+    os.replace(partial_outputpath, outputpath)
 
     return outputpath
 
@@ -38,7 +572,7 @@ def parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(
         description=(
             "Converts the aggregated TMS data for traffic between provinces or ERVAs to CSV form inside"
-            "a bzipped tar-archive. For ERVAs,"
+            "a compressed tar-archive. For ERVAs,"
             "expects the input to be 'tms_between_ervas.h5'; for provinces 'tms_between_provinces.h5'"
         )
     )
@@ -46,13 +580,34 @@ def parse_args(args=sys.argv[1:]):
     parser.add_argument("--input",
                         required=True,
                         help="Path to the aggregated_data by area input-file")
+    parser.add_argument("--format",
+                        type=str,
+                        default='csv',
+                        choices=['csv'] + list(_columnar_formats.keys()),
+                        help=("Output format: a tar-archive of CSV files, or a single Parquet or Arrow IPC file "
+                              "(requires the pyarrow package)."))
+    parser.add_argument("--codec",
+                        type=str,
+                        default='bz2',
+                        choices=_codecs,
+                        help="Compression of the archive ('zst' requires the zstandard package).")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="Number of worker processes. Defaults to the number of CPUs.")
+
+    add_profile_arguments(parser)
 
     return parser.parse_args(args)
 
 
 def main():
     args = parse_args()
-    export_area_data_as_csv(inputpath=args.input)
+    with profiled(args.profile, args.profile_dir, 'export_area_data'):
+        if args.format == 'csv':
+            export_area_data_as_csv(inputpath=args.input, codec=args.codec, workers=args.workers)
+        else:
+            export_area_data_as_columnar(inputpath=args.input, output_format=args.format)
 
 
 if __name__ == '__main__':
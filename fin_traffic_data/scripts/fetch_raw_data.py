@@ -1,53 +1,148 @@
 import os
 import sys
+import time
 import datetime
 import pathlib
 import argparse
-import progressbar
-from fin_traffic_data.metadata import get_tms_stations, get_province_info
+import pandas as pd
+from fin_traffic_data.batching import FetchStatistics
+from fin_traffic_data.coverage import CoverageIndex
+from fin_traffic_data.metadata import get_tms_stations
+from fin_traffic_data.metrics import get_metrics
+from fin_traffic_data.profiling import add_profile_arguments, profiled
 from fin_traffic_data.raw_data import get_tms_raw_data
+from fin_traffic_data.registry import get_station_registry
+
+
+def get_raw_data_file_path(results_dir, begin_date, end_date):
+    """Path to the datafile of the raw data between two dates"""
+    file_name = 'fin_traffic_raw_%s_%s.h5' % (begin_date,
+                                              end_date)
+    return os.path.join(results_dir, file_name)
+
+
+def _write_raw_data(df, result_path, num):
+    df.to_hdf(
+        result_path,
+        mode='a',
+        key=f"tms_{num}",
+        format='fixed',
+        nan_rep='None',
+        complib="blosc:snappy"
+    )
 
 
 def fetch_raw_data(begin_date, end_date, progressbar_bool, results_dir):
-    # Get info on available TMS stations
+    # Get info on available TMS stations and their ELY centers
     tms_stations = get_tms_stations()
-
-    # Get info on provinces
-    province_info = get_province_info()
+    registry = get_station_registry(tms_stations)
 
     if progressbar_bool:
+        import progressbar
         bar = progressbar.ProgressBar(max_value=tms_stations.shape[0], redirect_stdout=True)
 
     # Create the output directory
     pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
 
+    # Station-days fetched into the directory
+    coverage = CoverageIndex.open(results_dir, tms_stations['num'])
+    statistics = FetchStatistics.open(results_dir)
+    metrics = get_metrics()
+
     # Load data for each TMS
     it = 0
-    tms_stations_list = tms_stations.values.tolist()
-    for tms_station in tms_stations_list:
-        province = int(tms_station[5])
-        num = int(tms_station[1])
-        ely_id = province_info.loc[province]['ely-center (traffic)']
-        df = get_tms_raw_data(ely_id, num, begin_date, end_date, False)
-        if df is not None:
-            file_name = 'fin_traffic_raw_%s_%s.h5' % (begin_date,
-                                                      end_date)
-            result_path = os.path.join(results_dir, file_name)
-            df.to_hdf(
-                result_path,
-                mode='a',
-                key=f"tms_{num}",
-                format='fixed',
-                nan_rep='None',
-                complib="blosc:snappy"
-            )
-        if progressbar_bool:
-            it += 1
-            bar.update(it)
+    try:
+        for num, ely_id in registry.station_ely_ids().items():
+            completed_dates = []
+            absent_dates = []
+            time0 = time.perf_counter()
+            df = get_tms_raw_data(ely_id, num, begin_date, end_date, False, completed_dates=completed_dates,
+                                  absent_dates=absent_dates)
+            metrics.observe_station(num, time.perf_counter() - time0)
+            if df is not None:
+                result_path = get_raw_data_file_path(results_dir, begin_date, end_date)
+                _write_raw_data(df, result_path, num)
+            coverage.mark(num, completed_dates)
+            coverage.mark_absent(num, absent_dates)
+            statistics.record(df)
+            if progressbar_bool:
+                it += 1
+                bar.update(it)
+    finally:
+        coverage.save()
+        statistics.save()
 
     return results_dir
 
 
+def _contiguous_date_ranges(dates):
+    """Splits sorted dates into ranges (begin date, end date (exclusive)) of consecutive days."""
+    ranges = []
+    for date in dates:
+        if ranges and ranges[-1][1] == date:
+            ranges[-1][1] = date + datetime.timedelta(days=1)
+        else:
+            ranges.append([date, date + datetime.timedelta(days=1)])
+    return [tuple(r) for r in ranges]
+
+
+def fetch_missing_raw_data(raw_data_files, results_dir):
+    """
+    Fetches the (TMS station, day) pairs that are missing from the coverage
+    index inside the date ranges of existing raw datafiles, and merges them
+    into the datafile of their date. This includes the recent days whose
+    files the server reported missing (see CoverageIndex.mark_absent).
+
+    Input
+    -----
+    raw_data_files: List[Tuple[Text, datetime.date, datetime.date]]
+        The raw datafiles with their date ranges
+    results_dir: Text
+        Directory of the raw datafiles
+
+    Returns
+    -------
+    List of the dates for which new data was stored
+    """
+    if not raw_data_files:
+        return []
+
+    tms_stations = get_tms_stations()
+    registry = get_station_registry(tms_stations)
+    coverage = CoverageIndex.open(results_dir, tms_stations['num'])
+    statistics = FetchStatistics.open(results_dir)
+
+    stored_dates = set()
+    try:
+        for num, ely_id in registry.station_ely_ids().items():
+            for filename, file_begin_date, file_end_date in raw_data_files:
+                missing = coverage.missing([num], file_begin_date, file_end_date).get(num, [])
+                for begin_date, end_date in _contiguous_date_ranges(missing):
+                    completed_dates = []
+                    absent_dates = []
+                    df = get_tms_raw_data(ely_id, num, begin_date, end_date, False,
+                                          completed_dates=completed_dates, absent_dates=absent_dates)
+                    statistics.record(df)
+                    if df is not None:
+                        try:
+                            stored_df = pd.read_hdf(filename, key=f"tms_{num}", mode='r')
+                            # Drop any rows of partially stored days before merging
+                            stored_dates_of_rows = stored_df['time'].dt.date
+                            stored_df = stored_df.loc[~stored_dates_of_rows.isin(set(completed_dates))]
+                            df = pd.concat([stored_df, df]).sort_values('time', kind='mergesort')
+                        except KeyError:
+                            pass
+                        _write_raw_data(df, filename, num)
+                        stored_dates.update(completed_dates)
+                    coverage.mark(num, completed_dates)
+                    coverage.mark_absent(num, absent_dates)
+    finally:
+        coverage.save()
+        statistics.save()
+
+    return sorted(stored_dates)
+
+
 # Parse script arguments
 def parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description="Loads raw traffic data from Väylä")
@@ -75,15 +170,18 @@ def parse_args(args=sys.argv[1:]):
                         default='raw_data',
                         help="Name of the directory to store the results.")
 
+    add_profile_arguments(parser)
+
     return parser.parse_args(args)
 
 
 def main():
     args = parse_args()
-    fetch_raw_data(begin_date=args.begin_date,
-                   end_date=args.end_date,
-                   progressbar_bool=args.progressbar,
-                   results_dir=args.results_dir)
+    with profiled(args.profile, args.profile_dir, 'fetch_raw_data'):
+        fetch_raw_data(begin_date=args.begin_date,
+                       end_date=args.end_date,
+                       progressbar_bool=args.progressbar,
+                       results_dir=args.results_dir)
 
 
 if __name__ == '__main__':
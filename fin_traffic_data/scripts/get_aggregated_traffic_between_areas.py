@@ -1,61 +1,181 @@
 import os
 import sys
+import uuid
+import shutil
 import pathlib
 import argparse
 import pandas as pd
-import networkx as nx
-import matplotlib.pyplot as plt
 
+from fin_traffic_data.aggregation import _statistics_columns, _counts_version
 from fin_traffic_data.metadata import (
     get_tms_over_province_borders, get_tms_over_erva_borders,
     get_tms_over_hcd_borders, get_province_info, get_erva_info,
     get_hcd_info
 )
+from fin_traffic_data.profiling import add_profile_arguments, profiled
 
 
-def get_aggregated_traffic_between_areas(inputfile, area,
-                                         visualization_enabled, results_dir):
-    # Select ERVA / province
+def _read_tms_counts(store, tms_num, since=None):
+    """
+    Reads the time aggregated counts of a single TMS.
+
+    Input
+    -----
+    store: pandas.HDFStore
+        Opened time aggregated datafile
+    tms_num: int
+        Number of the TMS station
+    since: Optional[pandas.Timestamp]
+        If given, only rows with the same or a later time are returned
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    key = f'tms_{tms_num}'
+    if since is not None and store.get_storer(key).is_table:
+        df = store.select(key, where='time >= since')
+    else:
+        df = store.select(key)
+        if since is not None:
+            df = df.loc[df['time'] >= since]
+    return df
+
+
+def _remove_last_timestamp(store, key):
+    """
+    Removes the rows of the last timestamp stored under the key.
+
+    Returns
+    -------
+    The removed timestamp, or None if there is no data
+    """
+    if key not in store:
+        return None
+    nrows = store.get_storer(key).nrows
+    if not nrows:
+        return None
+    # A timestamp has a row for each vehicle category
+    times = store.select(key, start=max(nrows - 64, 0), columns=['time'])['time']
+    last_timestamp = times.iloc[-1]
+    store.remove(key, start=nrows - int((times == last_timestamp).sum()), stop=nrows)
+    return last_timestamp
+
+
+def set_counts_version(path):
+    """Records the version of the counts (see aggregation._counts_version) of every edge of an area aggregated file."""
+    with pd.HDFStore(path, mode='a') as store:
+        for key in store.keys():
+            store.get_storer(key).attrs.counts_version = _counts_version
+
+
+def set_edge_generations(path, generations):
+    """
+    Records the generation of the edges written from scratch into an area
+    aggregated file. An edge keeps its generation while it is only extended,
+    which lets the CSV export recognize its unchanged rows without reading
+    them.
+
+    Input
+    -----
+    path: Text
+        Path to the area aggregated file
+    generations: Dict[Text, Text]
+        Generation of each key, e.g. a random UUID
+    """
+    with pd.HDFStore(path, mode='a') as store:
+        for key, generation in generations.items():
+            store.get_storer(key).attrs.generation = generation
+
+
+def has_current_counts(path):
+    """Whether every edge of an area aggregated file has counts of the current version, so it can be extended."""
+    with pd.HDFStore(path, mode='r') as store:
+        return all(getattr(store.get_storer(key).attrs, 'counts_version', 1) == _counts_version
+                   for key in store.keys())
+
+
+def get_tms_over_area_borders(area):
+    """TMS stations over the borders of the areas of the aggregation level"""
     if area == 'province':
-        tms_over_area_borders = get_tms_over_province_borders()
+        return get_tms_over_province_borders()
     elif area == 'erva':
-        tms_over_area_borders = get_tms_over_erva_borders()
+        return get_tms_over_erva_borders()
     elif area == 'hcd':
-        tms_over_area_borders = get_tms_over_hcd_borders()
+        return get_tms_over_hcd_borders()
+    raise ValueError(f"Unknown area aggregation level '{area}'")
 
-    # Create the output directory
-    pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+
+def get_area_aggregated_file_path(results_dir, area, inputfile):
+    """Path to the datafile of the traffic between the areas computed from the time aggregated datafile"""
+    input_filename = inputfile.split('/')[-1]
+    file_name = 'tms_between_%ss_input_%s.h5' % (area,
+                                                 input_filename.split('.')[0])
+    return os.path.join(results_dir, file_name)
+
+
+def parse_border_tms(tms):
+    """Parses the 'tms' column of the border tables into a list of (TMS number, direction)."""
+    return [tuple(v.split(',')) for v in tms.split(';')]
+
+
+def compute_edge_traffic(tms_infos, read_tms_counts):
+    """
+    Sums the counts of the TMS stations of an edge in their directions over
+    the border, and the speed and length statistics if the time aggregated
+    data has them.
+
+    Input
+    -----
+    tms_infos: List[Tuple[Text, Text]]
+        TMS numbers and directions of the edge
+    read_tms_counts: Callable
+        Returns the time aggregated counts of a TMS number
+
+    Returns
+    -------
+    pandas.DataFrame indexed by the row numbers of the time aggregated data
+    with the columns time, vehicle category, counts and the statistics
+    columns, or None if there are no rows
+    """
+    df = None
+    for tms_num, direction in tms_infos:
+        _df = read_tms_counts(tms_num).reset_index()
+        _df = _df.loc[_df['direction'] == int(direction)]
+
+        if df is not None:
+            for vehicle_category in [1, 2, 3, 4, 5, 6, 7]:
+                for column in columns:
+                    df.loc[df['vehicle category'] == vehicle_category, column] +=\
+                        _df.loc[_df['vehicle category'] == vehicle_category][column].values
+        else:
+            df = _df
+            columns = ['counts'] + [column for column in _statistics_columns if column in df.columns]
+    if df.empty:
+        return None
+    cols = df.columns.values.tolist()
+    cols.remove('index')
+    cols.remove('direction')
+    # Keep the row numbers of the input so that appended rows are
+    # indexed as if the whole input had been processed
+    return df[cols].set_index(df['index'].rename(None))
+
+
+def visualize_area_graph(area, tms_over_area_borders):
+    """
+    Draws the directed graph of the areas with an edge for each pair of
+    areas that has TMS stations on their border.
+
+    networkx and matplotlib are imported here so that they are only loaded
+    when a visualization is actually requested.
+    """
+    import networkx as nx
+    import matplotlib.pyplot as plt
 
     # Instantiate the directed graph
     G = nx.DiGraph()
-
-    # Read
     for _, row in tms_over_area_borders.iterrows():
-        tms_infos = [tuple(v.split(',')) for v in row['tms'].split(';')]
-        G.add_edge(row['source'], row['destination'], tms=tms_infos)
-        df = None
-        for tms_num, direction in tms_infos:
-            _df = pd.read_hdf(inputfile, key=f'tms_{tms_num}').reset_index()
-            _df = _df.loc[_df['direction'] == int(direction)]
-
-            if df is not None:
-                for vehicle_category in [1, 2, 3, 4, 5, 6, 7]:
-                    df.loc[df['vehicle category'] == vehicle_category, 'counts'] +=\
-                        _df.loc[_df['vehicle category'] == vehicle_category]['counts'].values
-            else:
-                df = _df
-        cols = df.columns.values.tolist()
-        cols.remove('index')
-        cols.remove('direction')
-        df = df[cols]
-        input_filename = inputfile.split('/')[-1]
-        file_name = 'tms_between_%ss_input_%s.h5' % (area,
-                                                     input_filename.split('.')[0])
-        result_path = os.path.join(results_dir, file_name)
-        df.to_hdf(result_path,
-                  key=f"{row['source']}:{row['destination']}",
-                  complevel=9,
-                  format='table')
+        G.add_edge(row['source'], row['destination'], tms=parse_border_tms(row['tms']))
 
     # Create map of areaName -> (longitude, latitude)
     if area == 'province':
@@ -68,9 +188,92 @@ def get_aggregated_traffic_between_areas(inputfile, area,
         data = get_hcd_info()
         coordinate_map = dict([(key, row[['longitude', 'latitude']]) for key, row in data.iterrows()])
 
+    nx.draw_networkx(G, pos=coordinate_map)
+    plt.show()
+
+
+def get_aggregated_traffic_between_areas(inputfile, area,
+                                         visualization_enabled, results_dir,
+                                         append_to=None):
+    """
+    Computes the traffic between areas from the time aggregated data.
+
+    Input
+    -----
+    inputfile: Text
+        Path to the time aggregated datafile
+    area: Text
+        One of 'province', 'erva' or 'hcd'
+    visualization_enabled: bool
+        Whether to draw the graph of the areas
+    results_dir: Text
+        Directory where the results are stored
+    append_to: Optional[Text]
+        Existing area aggregated file of the same area. If given, only the rows
+        of the input since the last timestamp of each edge are read, the last
+        timestamp is recomputed as its time bucket may have been partial, and
+        the new rows are appended. The extended file replaces append_to.
+        A file with counts of an earlier version is replaced by one computed
+        from the whole input instead.
+
+    Returns
+    -------
+    Path to the area aggregated datafile
+    """
+    # Select ERVA / province
+    tms_over_area_borders = get_tms_over_area_borders(area)
+
+    # Create the output directory
+    pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+
+    # The results are written under a temporary name and renamed when
+    # complete, so an interrupted run leaves no half-written file behind
+    result_path = get_area_aggregated_file_path(results_dir, area, inputfile)
+    partial_path = result_path + '.partial'
+    replaced = append_to
+    if append_to is not None and not has_current_counts(append_to):
+        print(f"{append_to} has counts of an earlier version, computing all the rows again")
+        append_to = None
+    if append_to is not None:
+        shutil.copyfile(append_to, partial_path)
+    elif os.path.exists(partial_path):
+        os.remove(partial_path)
+
+    # Last timestamp of each edge already in the results, whose rows are
+    # computed again
+    last_timestamps = {}
+    if append_to is not None:
+        with pd.HDFStore(partial_path, mode='a') as result_store:
+            for _, row in tms_over_area_borders.iterrows():
+                key = f"{row['source']}:{row['destination']}"
+                last_timestamps[key] = _remove_last_timestamp(result_store, key)
+
+    # Read
+    generations = {}
+    with pd.HDFStore(inputfile, mode='r') as input_store:
+        for _, row in tms_over_area_borders.iterrows():
+            key = f"{row['source']}:{row['destination']}"
+            since = last_timestamps.get(key)
+            df = compute_edge_traffic(parse_border_tms(row['tms']),
+                                      lambda tms_num: _read_tms_counts(input_store, tms_num, since))
+            if df is None:
+                continue
+            df.to_hdf(partial_path,
+                      key=key,
+                      complevel=9,
+                      format='table',
+                      append=since is not None)
+            if since is None:
+                generations[key] = uuid.uuid4().hex
+
+    set_edge_generations(partial_path, generations)
+    set_counts_version(partial_path)
+    os.replace(partial_path, result_path)
+    if replaced is not None and os.path.abspath(replaced) != os.path.abspath(result_path):
+        os.remove(replaced)
+
     if(visualization_enabled):
-        nx.draw_networkx(G, pos=coordinate_map)
-        plt.show()
+        visualize_area_graph(area, tms_over_area_borders)
 
     return result_path
 
@@ -96,16 +299,25 @@ def parse_args(args=sys.argv[1:]):
                         type=str,
                         default='aggregated_data_area',
                         help="Name of the directory to store the results.")
+    parser.add_argument("--append-to",
+                        type=str,
+                        default=None,
+                        help=("Existing area aggregated file to extend with the input rows newer "
+                              "than its last timestamp instead of recomputing all of them."))
+
+    add_profile_arguments(parser)
 
     return parser.parse_args(args)
 
 
 def main():
     args = parse_args()
-    get_aggregated_traffic_between_areas(inputfile=args.input,
-                                         area=args.area,
-                                         visualization_enabled=args.visualize,
-                                         results_dir=args.results_dir)
+    with profiled(args.profile, args.profile_dir, 'aggregated_traffic_between_areas'):
+        get_aggregated_traffic_between_areas(inputfile=args.input,
+                                             area=args.area,
+                                             visualization_enabled=args.visualize,
+                                             results_dir=args.results_dir,
+                                             append_to=args.append_to)
 
 
 if __name__ == '__main__':
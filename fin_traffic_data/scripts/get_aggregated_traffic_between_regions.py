@@ -0,0 +1,40 @@
+import sys
+import argparse
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.regions import get_aggregated_traffic_between_regions, read_region_mapping
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Computes the aggregated traffic between custom regions made of municipalities."
+    )
+
+    parser.add_argument("--input",
+                        required=True,
+                        help="Path to the aggregated_data input-file")
+    parser.add_argument("--regions",
+                        required=True,
+                        help=("CSV file with the columns 'municipality' (code or name) and 'region'. "
+                              "Municipalities that are not listed are outside of all the regions."))
+    parser.add_argument("--results_dir", "-rd",
+                        type=str,
+                        default='aggregated_data_regions',
+                        help="Name of the directory to store the results.")
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with profiled(args.profile, args.profile_dir, 'aggregated_traffic_between_regions'):
+        result_path = get_aggregated_traffic_between_regions(inputfile=args.input,
+                                                             regions=read_region_mapping(args.regions),
+                                                             results_dir=args.results_dir)
+        print(result_path)
+
+
+if __name__ == '__main__':
+    main()
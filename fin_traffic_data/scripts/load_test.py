@@ -0,0 +1,95 @@
+import sys
+import json
+import datetime
+import argparse
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.scripts.mock_server import add_mock_server_arguments, get_mock_server_config
+
+
+def load_test(config, begin_date, end_date, threads=1, retry_delay=0.1, results_file=None, verbose=False):
+    """
+    Runs a load test of fetching raw data from the local mock server, prints
+    its summary and appends the result to results_file if given.
+
+    The parameters are those of fin_traffic_data.loadtest.run_load_test.
+
+    Returns
+    -------
+    The result as a dict
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.loadtest import run_load_test, format_load_test_result
+    from fin_traffic_data.benchmarks import write_benchmark_results
+
+    result = run_load_test(config, begin_date, end_date, threads=threads, retry_delay=retry_delay,
+                           verbose=verbose)
+    for line in format_load_test_result(result):
+        print(line)
+    if results_file is not None:
+        write_benchmark_results([result], results_file)
+    return result
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Measures fetching raw traffic data from a local mock server with injected faults.")
+
+    parser.add_argument('--begin-date',
+                        type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d').date(),
+                        default=datetime.date(2020, 3, 2),
+                        help='First date to fetch.')
+
+    parser.add_argument('--end-date',
+                        type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d').date(),
+                        default=datetime.date(2020, 3, 3),
+                        help='Day past the last day to fetch.')
+
+    parser.add_argument("--threads",
+                        type=int,
+                        default=1,
+                        help="Number of fetch threads. With one thread the data is fetched as "
+                             "fin-traffic-fetch-raw-data does.")
+
+    parser.add_argument("--retry-delay",
+                        type=float,
+                        default=0.1,
+                        help="Seconds to wait before retrying a failed request.")
+
+    parser.add_argument("--results-file",
+                        type=str,
+                        default=None,
+                        help="File the result is appended to as a JSON line.")
+
+    parser.add_argument("--json",
+                        action='store_true',
+                        default=False,
+                        help="Print the whole result as JSON.")
+
+    parser.add_argument("--verbose",
+                        action='store_true',
+                        default=False,
+                        help="Show the output of the fetch.")
+
+    add_mock_server_arguments(parser)
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with profiled(args.profile, args.profile_dir, 'load_test'):
+        result = load_test(config=get_mock_server_config(args),
+                           begin_date=args.begin_date,
+                           end_date=args.end_date,
+                           threads=args.threads,
+                           retry_delay=args.retry_delay,
+                           results_file=args.results_file,
+                           verbose=args.verbose)
+    if args.json:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import sys
+import json
+import argparse
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.mock_server import MockServerConfig, serve_mock_data
+
+
+def add_mock_server_arguments(parser: argparse.ArgumentParser):
+    """Adds the options of the content and the faults of the mock server to a parser."""
+    parser.add_argument("--rows-per-second", type=float, default=None,
+                        help="Serve datafiles growing by this many rows per second instead of full days of "
+                             "synthetic data.")
+    parser.add_argument("--vehicles-per-day", type=float, default=10000,
+                        help="Mean number of vehicles in a day of synthetic data.")
+    parser.add_argument("--stations", type=int, default=None,
+                        help="Number of the stations in the station metadata, by default all the stations "
+                             "over the area borders.")
+    parser.add_argument("--stations-file", type=str, default=None,
+                        help="Station metadata (GeoJSON as served by digitraffic) to serve instead.")
+    parser.add_argument("--seed", type=int, default=2020, help="Seed of the synthetic data and the faults.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay of every response in seconds.")
+    parser.add_argument("--latency-jitter", type=float, default=0.0,
+                        help="Maximum of a random delay in seconds added to every response.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of the requests of datafiles answered with 500 or 503.")
+    parser.add_argument("--not-found", type=str, nargs='+', default=[],
+                        help="Regular expressions of the paths answered with 404.")
+    parser.add_argument("--missing-rate", type=float, default=0.0,
+                        help="Share of the datafiles answered with 404.")
+    parser.add_argument("--max-requests-per-second", type=float, default=None,
+                        help="Requests of datafiles over this rate are answered with 429.")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="Bytes per second at most sent in a response.")
+
+
+def get_mock_server_config(args: argparse.Namespace) -> MockServerConfig:
+    """The configuration of the options added by add_mock_server_arguments."""
+    stations = None
+    if args.stations_file is not None:
+        with open(args.stations_file, 'r') as f:
+            stations = json.load(f)
+    return MockServerConfig(rows_per_second=args.rows_per_second,
+                            vehicles_per_day=args.vehicles_per_day,
+                            seed=args.seed,
+                            num_stations=args.stations,
+                            stations=stations,
+                            latency=args.latency,
+                            latency_jitter=args.latency_jitter,
+                            error_rate=args.error_rate,
+                            not_found_patterns=args.not_found,
+                            missing_rate=args.missing_rate,
+                            max_requests_per_second=args.max_requests_per_second,
+                            bandwidth=args.bandwidth)
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Serves synthetic raw traffic datafiles and station metadata for testing.")
+    parser.add_argument("--host", type=str, default='localhost', help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    add_mock_server_arguments(parser)
+    add_profile_arguments(parser)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with profiled(args.profile, args.profile_dir, 'mock_server'):
+        serve_mock_data(get_mock_server_config(args), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
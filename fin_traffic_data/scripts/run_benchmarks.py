@@ -0,0 +1,118 @@
+import sys
+import tempfile
+import argparse
+import contextlib
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.utils import parse_time_resolution
+
+
+def benchmark(results_file, workdir=None, names=None, repeat=3, **parameters):
+    """
+    Runs the benchmarks on synthetic data, appends their results to
+    results_file and prints them compared to the results of the previous
+    commit in the file.
+
+    The parameters are those of fin_traffic_data.benchmarks.BenchmarkWorkspace.
+
+    Returns
+    -------
+    List of the results
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.benchmarks import (
+        BenchmarkWorkspace, run_benchmarks, read_benchmark_results,
+        write_benchmark_results, compare_benchmark_results
+    )
+
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix='fin_traffic_benchmark_'))
+        workspace = BenchmarkWorkspace(workdir, **parameters)
+        results = run_benchmarks(workspace, names=names, repeat=repeat)
+    earlier = read_benchmark_results(results_file)
+    for line in compare_benchmark_results(results, earlier):
+        print(line)
+    write_benchmark_results(results, results_file)
+    return results
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Times the parsing, aggregation and export of synthetic raw traffic data.")
+
+    parser.add_argument("--benchmark",
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        choices=['import', 'parse', 'aggregate_core', 'aggregate_datafiles', 'area', 'export'],
+                        help="Benchmarks to run, by default all.")
+
+    parser.add_argument("--stations",
+                        type=int,
+                        default=20,
+                        help="Number of stations with synthetic raw data.")
+
+    parser.add_argument("--days",
+                        type=int,
+                        default=7,
+                        help="Number of days of synthetic raw data.")
+
+    parser.add_argument("--vehicles_per_day",
+                        type=float,
+                        default=10000,
+                        help="Mean number of vehicles per station and day.")
+
+    parser.add_argument("--time-resolution",
+                        type=parse_time_resolution,
+                        default='1h',
+                        help="Time resolution of the aggregation")
+
+    parser.add_argument("--area",
+                        type=str,
+                        default='hcd',
+                        choices=['province', 'erva', 'hcd'],
+                        help="Area aggregation level.")
+
+    parser.add_argument("--seed",
+                        type=int,
+                        default=2020,
+                        help="Seed of the synthetic data.")
+
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=3,
+                        help="Number of timed runs of every benchmark.")
+
+    parser.add_argument("--workdir",
+                        type=str,
+                        default=None,
+                        help="Directory of the synthetic data and the outputs, by default a temporary one.")
+
+    parser.add_argument("--results_file",
+                        type=str,
+                        default='benchmark_results.jsonl',
+                        help="File the results are appended to as JSON lines.")
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with profiled(args.profile, args.profile_dir, 'run_benchmarks'):
+        benchmark(results_file=args.results_file,
+                  workdir=args.workdir,
+                  names=args.benchmark,
+                  repeat=args.repeat,
+                  num_stations=args.stations,
+                  days=args.days,
+                  vehicles_per_day=args.vehicles_per_day,
+                  time_resolution=args.time_resolution,
+                  area=args.area,
+                  seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
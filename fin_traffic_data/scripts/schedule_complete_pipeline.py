@@ -2,36 +2,33 @@ import os
 import sys
 import time
 import argparse
-import re
 from logging import handlers
 import logging
 import datetime
-from fin_traffic_data.scripts.complete_pipeline import fetch_tms_data_aggregate
-
-
-def _parse_time_resolution(x):
-    """Parse human-readable input of time resolution"""
-    m = re.findall(r"(?P<num>\d+)(?P<qualif>w|d|h|m|s)", x)
-    dt = datetime.timedelta()
-    for obj in m:
-        if obj[1] == 'w':
-            dt += datetime.timedelta(days=int(obj[0])*7)
-        elif obj[1] == 'd':
-            dt += datetime.timedelta(days=int(obj[0]))
-        elif obj[1] == 'h':
-            dt += datetime.timedelta(hours=int(obj[0]))
-        elif obj[1] == 'm':
-            dt += datetime.timedelta(minutes=int(obj[0]))
-        elif obj[1] == 's':
-            dt += datetime.timedelta(seconds=int(obj[0]))
-        else:
-            raise ValueError(f"Unknown literal '{obj[1]}'")
-    return dt
+from fin_traffic_data.coverage import _absent_grace_days
+from fin_traffic_data.metadata import get_tms_stations, pinned_tms_stations
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.scripts.complete_pipeline import fetch_tms_data_aggregate, open_catalog
+from fin_traffic_data.utils import parse_memory_size, parse_time_resolution
+
+# Hour of the day when the raw data of the previous day is published
+_publication_hour = 12
+
+# Delays (seconds) of retrying a failed run in the daemon mode: doubling from
+# one minute up to one hour
+_first_retry_delay = 60
+_max_retry_delay = 3600
+
+# Age (seconds) after which the daemon downloads the TMS station metadata again
+_station_metadata_max_age = 7 * 24 * 3600
 
 
 def schedule_complete_pipeline(logger, begin_date, results_dir_fetch,
                                time_resolution, results_dir_aggregate,
-                               aggregation_level, results_dir_traffic):
+                               aggregation_level, results_dir_traffic,
+                               catalog_path='fin_traffic_catalog.sqlite',
+                               metrics_file=None, prometheus_file=None, prefix_sums=False,
+                               max_memory=None, rescan=False):
     while True:
         now_time = datetime.datetime.now()
         logger.info('Current time: %s' % (now_time, ))
@@ -46,8 +43,16 @@ def schedule_complete_pipeline(logger, begin_date, results_dir_fetch,
                                      results_dir_aggregate=results_dir_aggregate,
                                      aggregation_level=aggregation_level,
                                      visualize_bool=False,
-                                     results_dir_traffic=results_dir_traffic)
-            elapsed_execution = start_execution - time.time()
+                                     results_dir_traffic=results_dir_traffic,
+                                     catalog_path=catalog_path,
+                                     max_memory=max_memory,
+                                     metrics_file=metrics_file,
+                                     prometheus_file=prometheus_file,
+                                     prefix_sums=prefix_sums,
+                                     rescan=rescan)
+            # The catalog is kept up to date by the runs
+            rescan = False
+            elapsed_execution = time.time() - start_execution
             elapsed_delta = datetime.timedelta(seconds=elapsed_execution)
             logger.info(('Sleeping for 1 hour.'
                          ' Total elapsed time of execution: %s') % (elapsed_delta, ))
@@ -57,6 +62,118 @@ def schedule_complete_pipeline(logger, begin_date, results_dir_fetch,
             time.sleep(3600)
 
 
+def _latest_available_date(now_time, publication_hour=_publication_hour):
+    """End date (exclusive) of the raw data published by the given time."""
+    if now_time.hour >= publication_hour:
+        return now_time.date()
+    return now_time.date() - datetime.timedelta(days=1)
+
+
+def _retry_delay(failures):
+    """Seconds to wait before the next attempt after consecutive failures."""
+    return min(_first_retry_delay * 2**(failures - 1), _max_retry_delay)
+
+
+def _sleep_until(logger, wake_time):
+    seconds = (wake_time - datetime.datetime.now()).total_seconds()
+    if seconds > 0:
+        logger.info('Sleeping until %s.' % (wake_time.replace(microsecond=0), ))
+        time.sleep(seconds)
+
+
+def run_daemon(logger, begin_date, results_dir_fetch,
+               time_resolution, results_dir_aggregate,
+               aggregation_level, results_dir_traffic,
+               catalog_path='fin_traffic_catalog.sqlite',
+               metrics_file=None, prometheus_file=None, max_memory=None,
+               publication_hour=_publication_hour, prefix_sums=False, rescan=False):
+    """
+    Keeps the results up to date as a long-running process.
+
+    Unlike schedule_complete_pipeline, the state is kept in memory between
+    the runs: the catalog stays open, the TMS station metadata is downloaded
+    again only once it is _station_metadata_max_age old or after a failure,
+    and the last completed date is tracked. A run is started only when the
+    data of a new day has been published, and the daemon sleeps until the
+    next expected publication time in between. A failed run is retried
+    after a delay doubling from one minute up to one hour, and the day is
+    attempted until it succeeds.
+
+    The first run checks the whole date range. The later runs fetch only
+    the days from the completed date on, and fill the missing station-days
+    of the days still within the grace period of the coverage index (see
+    CoverageIndex.mark_absent). Every run extends the time aggregated, area
+    aggregated and prefix-sum files of the previous run with the new days
+    (see fin_traffic_data.scripts.complete_pipeline), so the raw data of the
+    earlier days is not aggregated again. The stages run one after another:
+    the pipelined mode aggregates all the days of every station and is meant
+    for fetching long date ranges.
+
+    Input
+    -----
+    publication_hour: int
+        Hour of the day when the data of the previous day is published
+
+    The other arguments are those of fetch_tms_data_aggregate.
+    """
+    with open_catalog(logger=logger,
+                      catalog_path=catalog_path,
+                      results_dir_fetch=results_dir_fetch,
+                      results_dir_aggregate=results_dir_aggregate,
+                      results_dir_traffic=results_dir_traffic,
+                      rescan=rescan) as catalog:
+        completed_date = None
+        tms_stations = None
+        tms_stations_time = None
+        failures = 0
+        while True:
+            end_date = _latest_available_date(datetime.datetime.now(), publication_hour)
+            if completed_date is None or end_date > completed_date:
+                logger.info('Processing the data until %s.' % (end_date, ))
+                start_execution = time.time()
+                fetch_from = None
+                if completed_date is not None:
+                    fetch_from = completed_date - datetime.timedelta(days=_absent_grace_days)
+                try:
+                    if tms_stations is None or time.time() - tms_stations_time > _station_metadata_max_age:
+                        tms_stations = get_tms_stations()
+                        tms_stations_time = time.time()
+                    with pinned_tms_stations(tms_stations):
+                        fetch_tms_data_aggregate(logger=logger,
+                                                 begin_date=begin_date,
+                                                 end_date=end_date,
+                                                 progressbar_bool=False,
+                                                 results_dir_fetch=results_dir_fetch,
+                                                 time_resolution=time_resolution,
+                                                 results_dir_aggregate=results_dir_aggregate,
+                                                 aggregation_level=aggregation_level,
+                                                 visualize_bool=False,
+                                                 results_dir_traffic=results_dir_traffic,
+                                                 max_memory=max_memory,
+                                                 metrics_file=metrics_file,
+                                                 prometheus_file=prometheus_file,
+                                                 catalog=catalog,
+                                                 prefix_sums=prefix_sums,
+                                                 fetch_from=fetch_from)
+                except Exception:
+                    failures += 1
+                    delay = _retry_delay(failures)
+                    logger.exception('Processing the data until %s failed (attempt %d). Retrying in %d s.'
+                                     % (end_date, failures, delay))
+                    # The station metadata is downloaded again on retry
+                    tms_stations = None
+                    time.sleep(delay)
+                    continue
+                completed_date = end_date
+                failures = 0
+                elapsed_delta = datetime.timedelta(seconds=time.time() - start_execution)
+                logger.info('Completed the data until %s in %s.' % (completed_date, elapsed_delta))
+
+            # The data of the completed end date is published on the next day
+            _sleep_until(logger, datetime.datetime.combine(completed_date + datetime.timedelta(days=1),
+                                                           datetime.time(hour=publication_hour)))
+
+
 # Parse script arguments
 def parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(
@@ -76,7 +193,7 @@ def parse_args(args=sys.argv[1:]):
                         help="Set the area aggregation level.")
 
     parser.add_argument("--time-resolution",
-                        type=_parse_time_resolution,
+                        type=parse_time_resolution,
                         required=True,
                         help="Time resolution of the aggregation")
 
@@ -95,6 +212,55 @@ def parse_args(args=sys.argv[1:]):
                         default='aggregated_data_area',
                         help="Name of the directory to store the aggregated data by area.")
 
+    parser.add_argument("--catalog",
+                        type=str,
+                        default='fin_traffic_catalog.sqlite',
+                        help=("Path to the catalog of the datafiles. It is built from the results directories "
+                              "if it does not exist."))
+
+    parser.add_argument("--rescan",
+                        action='store_true',
+                        default=False,
+                        help=("Reconcile the existing catalog with the results directories before the first run, "
+                              "e.g. after fin-traffic-fetch-raw-data wrote raw datafiles without it."))
+
+    parser.add_argument("--max-memory",
+                        type=parse_memory_size,
+                        default=None,
+                        help=("Memory budget for fetching, e.g. '4G'. The raw data is fetched in batches "
+                              "of dates planned from the rows per station and day observed in earlier runs."))
+
+    parser.add_argument("--metrics-file",
+                        type=str,
+                        default=None,
+                        help="Append the performance metrics of every run to this file as JSON lines.")
+
+    parser.add_argument("--prometheus-file",
+                        type=str,
+                        default=None,
+                        help=("Write the performance metrics of the latest run to this file in the Prometheus "
+                              "text format."))
+
+    parser.add_argument("--prefix-sums",
+                        action='store_true',
+                        default=False,
+                        help=("Keep a prefix-sum index next to the time aggregated datafile, extended with the "
+                              "new days of every run."))
+
+    parser.add_argument("--daemon",
+                        action='store_true',
+                        help=("Run as a long-running daemon keeping its state in memory: process each newly "
+                              "published day once, sleep until the next publication time and retry failures "
+                              "with an exponential backoff. Without it, the pipeline is rerun every hour "
+                              "after noon."))
+
+    parser.add_argument("--publication-hour",
+                        type=int,
+                        default=_publication_hour,
+                        help="Hour of the day when the data of the previous day is published (daemon mode).")
+
+    add_profile_arguments(parser)
+
     # Arguments for logging
     parser.add_argument("--logfile", "-lf", type=str,
                         default="logs_schedule_complete_pipeline.log",
@@ -133,13 +299,36 @@ def main():
     logger = logging.getLogger()
     logger.info('Logger ready. Logging to file: %s' % (logfile))
     try:
-        schedule_complete_pipeline(logger=logger,
-                                   begin_date=args.begin_date,
-                                   results_dir_fetch=args.results_dir_fetch,
-                                   time_resolution=args.time_resolution,
-                                   results_dir_aggregate=args.results_dir_aggregate,
-                                   aggregation_level=args.aggregation_level,
-                                   results_dir_traffic=args.results_dir_traffic)
+        with profiled(args.profile, args.profile_dir, 'schedule_complete_pipeline'):
+            if args.daemon:
+                run_daemon(logger=logger,
+                           begin_date=args.begin_date,
+                           results_dir_fetch=args.results_dir_fetch,
+                           time_resolution=args.time_resolution,
+                           results_dir_aggregate=args.results_dir_aggregate,
+                           aggregation_level=args.aggregation_level,
+                           results_dir_traffic=args.results_dir_traffic,
+                           catalog_path=args.catalog,
+                           metrics_file=args.metrics_file,
+                           prometheus_file=args.prometheus_file,
+                           max_memory=args.max_memory,
+                           publication_hour=args.publication_hour,
+                           prefix_sums=args.prefix_sums,
+                           rescan=args.rescan)
+            else:
+                schedule_complete_pipeline(logger=logger,
+                                           begin_date=args.begin_date,
+                                           results_dir_fetch=args.results_dir_fetch,
+                                           time_resolution=args.time_resolution,
+                                           results_dir_aggregate=args.results_dir_aggregate,
+                                           aggregation_level=args.aggregation_level,
+                                           results_dir_traffic=args.results_dir_traffic,
+                                           catalog_path=args.catalog,
+                                           metrics_file=args.metrics_file,
+                                           prometheus_file=args.prometheus_file,
+                                           prefix_sums=args.prefix_sums,
+                                           max_memory=args.max_memory,
+                                           rescan=args.rescan)
     except Exception:
         logger.exception("Fatal error in main loop")
     finally:
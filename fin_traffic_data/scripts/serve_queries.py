@@ -0,0 +1,104 @@
+import os
+import sys
+import asyncio
+import logging
+import argparse
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.utils import parse_memory_size, parse_time_resolution
+
+
+def serve_queries(logger, catalog_path, time_resolution, host='127.0.0.1', port=8080,
+                  reload_interval=60.0, cache_bytes=None, threads=4):
+    """
+    Serves the station and edge queries of the latest datafiles of the
+    catalog over HTTP until interrupted (see fin_traffic_data.service).
+    """
+    # The datafiles are only read, and the pipeline writing new datafiles
+    # must not be blocked by the locks of the readers
+    os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
+
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.query import ChunkCache
+    from fin_traffic_data.service import QueryService
+
+    service = QueryService(logger=logger,
+                           catalog_path=catalog_path,
+                           time_resolution=time_resolution,
+                           cache=ChunkCache(cache_bytes) if cache_bytes is not None else None,
+                           reload_interval=reload_interval,
+                           threads=threads)
+    try:
+        asyncio.run(service.serve(host=host, port=port))
+    except KeyboardInterrupt:
+        logger.info('Stopped serving queries.')
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Serves time series queries of the aggregated traffic data over HTTP.")
+
+    parser.add_argument("--catalog",
+                        type=str,
+                        default='fin_traffic_catalog.sqlite',
+                        help="Path to the catalog of the datafiles written by the pipeline.")
+
+    parser.add_argument("--time-resolution",
+                        type=parse_time_resolution,
+                        required=True,
+                        help="Time resolution of the datafiles to serve")
+
+    parser.add_argument("--host",
+                        type=str,
+                        default='127.0.0.1',
+                        help="Address to listen on.")
+
+    parser.add_argument("--port",
+                        type=int,
+                        default=8080,
+                        help="Port to listen on.")
+
+    parser.add_argument("--reload-interval",
+                        type=float,
+                        default=60.0,
+                        help="Seconds between the checks of the catalog for newly published datafiles.")
+
+    parser.add_argument("--cache-size",
+                        type=parse_memory_size,
+                        default=None,
+                        help=("Memory budget of the cache of the data read, e.g. '1G'. By default "
+                              "FIN_TRAFFIC_QUERY_CACHE_BYTES or 256 MiB."))
+
+    parser.add_argument("--threads",
+                        type=int,
+                        default=4,
+                        help="Number of threads answering queries.")
+
+    parser.add_argument("--loglevel", "-ll", type=str,
+                        default="INFO",
+                        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"],
+                        help="Set logging level.")
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S %p',
+                        level=getattr(logging, args.loglevel, None))
+    with profiled(args.profile, args.profile_dir, 'serve_queries'):
+        serve_queries(logger=logging.getLogger(),
+                      catalog_path=args.catalog,
+                      time_resolution=args.time_resolution,
+                      host=args.host,
+                      port=args.port,
+                      reload_interval=args.reload_interval,
+                      cache_bytes=args.cache_size,
+                      threads=args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import sys
+import time
+import pathlib
+import argparse
+import datetime
+from fin_traffic_data.intraday import RawDataTail, IntradayAggregate, poll_intraday_data
+from fin_traffic_data.profiling import add_profile_arguments, profiled
+from fin_traffic_data.registry import get_station_registry
+from fin_traffic_data.utils import parse_time_resolution
+
+
+def tail_raw_data(delta_t, results_dir, poll_interval=60.0, tms_nums=None, date=None,
+                  base_url=None, max_polls=None, ely_id=None):
+    """
+    Follows the raw datafiles of the current day and keeps the counts of the
+    day aggregated with the time resolution delta_t up to date. After every
+    poll the counts of the stations with new rows are stored into the
+    intraday datafile of the day. When the day changes, the datafiles of the
+    next day are followed.
+
+    If date is given, the datafiles of that day are followed and the day
+    does not change, e.g. for a test server. If ely_id is given, it is used
+    as the ELY center of all the stations tms_nums instead of looking it up
+    from the station metadata.
+
+    Returns
+    -------
+    Path to the intraday datafile of the last day
+    """
+    # Imported here to keep the startup of the console scripts fast
+    import requests
+
+    pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+    if ely_id is not None and tms_nums:
+        ely_ids = dict((int(num), ely_id) for num in tms_nums)
+    else:
+        ely_ids = get_station_registry().station_ely_ids()
+        if tms_nums:
+            ely_ids = dict((num, ely_ids[num]) for num in tms_nums if num in ely_ids)
+
+    session = requests.Session()
+    polls = 0
+    day = None
+    result_path = None
+    while max_polls is None or polls < max_polls:
+        today = date or datetime.date.today()
+        if today != day:
+            if day is not None:
+                # Read the rest of the rows of the finished day
+                changed = poll_intraday_data(tails, aggregate, session)
+                result_path = aggregate.write(results_dir, changed)
+            day = today
+            tails = [RawDataTail(station_ely_id, num, day, base_url) for num, station_ely_id in ely_ids.items()]
+            aggregate = IntradayAggregate(day, delta_t)
+            # Every station gets a datafile entry, also before its first rows
+            result_path = aggregate.write(results_dir, ely_ids)
+
+        poll_time0 = time.perf_counter()
+        changed = poll_intraday_data(tails, aggregate, session)
+        result_path = aggregate.write(results_dir, changed)
+        polls += 1
+        print(f"{datetime.datetime.now()}: {sum(changed.values())} new rows from {len(changed)} TMS stations",
+              flush=True)
+
+        if max_polls is None or polls < max_polls:
+            time.sleep(max(0.0, poll_interval - (time.perf_counter() - poll_time0)))
+    return result_path
+
+
+# Parse script arguments
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Follows the raw traffic data of the current day and aggregates it as it arrives.")
+    parser.add_argument("--time-resolution", type=parse_time_resolution,
+                        required=True,
+                        help="Time resolution of the aggregation")
+
+    parser.add_argument("--poll-interval",
+                        type=float,
+                        default=60.0,
+                        help="Seconds between the polls of the datafiles.")
+
+    parser.add_argument("--tms",
+                        type=int,
+                        nargs='+',
+                        default=None,
+                        help="Numbers of the TMS stations to follow. Defaults to all the stations.")
+
+    parser.add_argument("--ely-id",
+                        type=int,
+                        default=None,
+                        help=("ID of the ELY center of the stations given with --tms. Skips downloading "
+                              "the station metadata."))
+
+    parser.add_argument("--date",
+                        type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d').date(),
+                        default=None,
+                        help="Follow the datafiles of this day instead of the current day.")
+
+    parser.add_argument("--base-url",
+                        type=str,
+                        default=None,
+                        help=("Location of the raw datafiles, e.g. of a local test server. By default "
+                              "FIN_TRAFFIC_RAW_DATA_URL or the raw data server of Väylä."))
+
+    parser.add_argument("--max-polls",
+                        type=int,
+                        default=None,
+                        help="Stop after this many polls.")
+
+    parser.add_argument("--results_dir", "-rd",
+                        type=str,
+                        default='intraday_data',
+                        help="Name of the directory to store the results.")
+
+    add_profile_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with profiled(args.profile, args.profile_dir, 'tail_raw_data'):
+        tail_raw_data(delta_t=args.time_resolution,
+                      results_dir=args.results_dir,
+                      poll_interval=args.poll_interval,
+                      tms_nums=set(args.tms) if args.tms else None,
+                      date=args.date,
+                      base_url=args.base_url,
+                      max_polls=args.max_polls,
+                      ely_id=args.ely_id)
+
+
+if __name__ == '__main__':
+    main()
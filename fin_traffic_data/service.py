@@ -0,0 +1,354 @@
+"""
+Local HTTP service answering station and edge time series queries from the
+latest datafiles recorded in the dataset catalog, see
+fin-traffic-serve-queries.
+
+Endpoints
+---------
+GET /stations?tms=101,102&begin=2020-03-02&end=2020-03-09&direction=1&category=1,2
+    Counts of TMS stations from the time aggregated datafile
+GET /edges?edge=HUS:Varsinais-Suomi&level=hcd&begin=...&end=...&category=1
+    Counts of edges from the area aggregated datafile of the level
+GET /datasets
+    The datafiles served, and the statistics of the cache and the requests
+GET /health
+
+The responses are JSON (pandas 'split' orientation) or CSV with format=csv.
+"""
+import os
+import json
+import signal
+import asyncio
+import datetime
+import urllib.parse
+import concurrent.futures
+from typing import Dict, Optional, Text, Tuple
+
+from fin_traffic_data.catalog import DatasetCatalog
+from fin_traffic_data.query import ChunkCache, get_chunk_cache, query_stations, query_edges
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# Maximum size of a request line or header line
+_max_line = 65536
+
+
+class QueryError(Exception):
+
+    """Error of a query, answered with its HTTP status code."""
+
+    def __init__(self, status: int, message: Text):
+        super().__init__(message)
+        self.status = status
+
+
+def _latest(catalog: DatasetCatalog, kind: Text, resolution: datetime.timedelta,
+            level: Optional[Text] = None) -> Optional[Tuple[Text, datetime.date, datetime.date]]:
+    """The datafile of a kind with the latest end date, the longest one of those."""
+    datafiles = catalog.list(kind, resolution=resolution, level=level)
+    if not datafiles:
+        return None
+    return max(datafiles, key=lambda f: (f[2], -f[1].toordinal()))
+
+
+def resolve_datasets(catalog_path: Text, time_resolution: datetime.timedelta) -> Dict:
+    """
+    The latest time aggregated datafile and area aggregated datafiles of all
+    the levels with the time resolution in the catalog.
+
+    Returns
+    -------
+    Dict with
+        - 'time': (path, begin date, end date) or None
+        - 'area': dict from the aggregation level to (path, begin date, end date)
+    """
+    # Opened read-only so that the service never holds the write lock of
+    # the catalog while the pipeline publishes
+    with DatasetCatalog(catalog_path, read_only=True) as catalog:
+        areas = {}
+        for level in ['province', 'erva', 'hcd']:
+            latest = _latest(catalog, 'area', time_resolution, level)
+            if latest is not None:
+                areas[level] = latest
+        return {'time': _latest(catalog, 'time', time_resolution), 'area': areas}
+
+
+def _split_values(values) -> list:
+    return [value for item in values for value in item.split(',') if value]
+
+
+def _parse_ints(params, name) -> Optional[list]:
+    if name not in params:
+        return None
+    try:
+        return sorted(set(int(value) for value in _split_values(params[name])))
+    except ValueError:
+        raise QueryError(400, f"Invalid {name}: {params[name]}") from None
+
+
+def _parse_time(params, name) -> Optional[datetime.datetime]:
+    if name not in params:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(params[name][-1])
+    except ValueError:
+        raise QueryError(400, f"Invalid {name}: {params[name][-1]}") from None
+
+
+class QueryService:
+
+    """
+    Answers the queries of the HTTP clients from the datafiles of the
+    catalog.
+
+    - The chunks read from the datafiles are kept in a cache shared by all
+      the clients, so only the first query of a time range reads the files.
+    - Identical queries arriving while one is being answered wait for its
+      result instead of reading the files again.
+    - The catalog is checked for newly published datafiles every
+      reload_interval seconds (and on SIGHUP). The new datafiles are
+      switched to between requests; requests already being answered finish
+      with the datafiles they started with, so the service does not stop
+      while the pipeline publishes.
+
+    The datafiles are read in a pool of threads so that the event loop is
+    never blocked by a read.
+    """
+
+    def __init__(self, logger, catalog_path: Text, time_resolution: datetime.timedelta,
+                 cache: Optional[ChunkCache] = None, reload_interval: float = 60.0, threads: int = 4):
+        """
+        Input
+        -----
+        logger: logging.Logger
+        catalog_path: Text
+            Path to the catalog of the datafiles
+        time_resolution: datetime.timedelta
+            Time resolution of the datafiles to serve
+        cache: Optional[ChunkCache]
+            Chunk cache, by default fin_traffic_data.query.get_chunk_cache()
+        reload_interval: float
+            Seconds between the checks for newly published datafiles
+        threads: int
+            Number of threads answering queries
+        """
+        self.logger = logger
+        self.catalog_path = catalog_path
+        self.time_resolution = time_resolution
+        self.cache = cache if cache is not None else get_chunk_cache()
+        self.reload_interval = reload_interval
+        # As returned by resolve_datasets
+        self.datasets: Dict = {'time': None, 'area': {}}
+        self.counters = {'requests': 0, 'queries': 0, 'coalesced': 0, 'errors': 0, 'reloads': 0}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self._catalog_mtime: Optional[int] = None
+
+    async def reload(self, force: bool = False) -> bool:
+        """
+        Switches to the latest datafiles of the catalog if the catalog has
+        changed. Returns whether the datafiles changed.
+        """
+        try:
+            mtime = os.stat(self.catalog_path).st_mtime_ns
+        except OSError:
+            self.logger.warning('Catalog %s not found.' % (self.catalog_path, ))
+            return False
+        if not force and mtime == self._catalog_mtime:
+            return False
+        loop = asyncio.get_running_loop()
+        datasets = await loop.run_in_executor(self._executor, resolve_datasets,
+                                              self.catalog_path, self.time_resolution)
+        self._catalog_mtime = mtime
+        if datasets == self.datasets:
+            return False
+        # Requests that have already looked up their datafile keep it
+        self.datasets = datasets
+        self.counters['reloads'] += 1
+        self.logger.info('Serving the datafiles %s' % (datasets, ))
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.reload()
+            except Exception:
+                self.logger.exception('Checking the catalog for new datafiles failed.')
+
+    async def _coalesced(self, key: Tuple, compute) -> bytes:
+        """Result of compute, shared by the identical queries running at the same time."""
+        future = self._inflight.get(key)
+        if future is None:
+            self.counters['queries'] += 1
+            future = asyncio.get_running_loop().run_in_executor(self._executor, compute)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.counters['coalesced'] += 1
+        # A client disconnecting does not cancel the query of the others
+        return await asyncio.shield(future)
+
+    def _datafile(self, kind: Text, level: Optional[Text] = None) -> Text:
+        if kind == 'time':
+            datafile = self.datasets['time']
+        else:
+            datafile = self.datasets['area'].get(level)
+        if datafile is None:
+            raise QueryError(503, f"No {kind} aggregated datafile" + (f" of the level {level}" if level else ""))
+        return datafile[0]
+
+    async def query(self, endpoint: Text, params: Dict) -> Tuple[bytes, Text]:
+        """Answers a query. Returns the body and its content type."""
+        output_format = params.get('format', ['json'])[-1]
+        if output_format not in ('json', 'csv'):
+            raise QueryError(400, f"Unknown format {output_format}")
+        t0, t1 = _parse_time(params, 'begin'), _parse_time(params, 'end')
+        categories = _parse_ints(params, 'category')
+        # Identifies the query among the running ones, see _coalesced
+        key: Tuple
+        if endpoint == '/stations':
+            tms_nums = _parse_ints(params, 'tms')
+            if not tms_nums:
+                raise QueryError(400, "No TMS stations given (tms)")
+            directions = _parse_ints(params, 'direction')
+            path = self._datafile('time')
+            key = ('stations', path, tuple(tms_nums), t0, t1, _optional_tuple(directions),
+                   _optional_tuple(categories), output_format)
+
+            def compute():
+                df = query_stations(path, tms_nums, t0, t1, directions=directions,
+                                    vehicle_categories=categories, cache=self.cache)
+                return _encode(df, output_format)
+        elif endpoint == '/edges':
+            edges = _split_values(params.get('edge', []))
+            if not edges:
+                raise QueryError(400, "No edges given (edge)")
+            level = params.get('level', ['hcd'])[-1]
+            path = self._datafile('area', level)
+            key = ('edges', path, tuple(edges), t0, t1, _optional_tuple(categories), output_format)
+
+            def compute():
+                df = query_edges(path, edges, t0, t1, vehicle_categories=categories, cache=self.cache)
+                return _encode(df, output_format)
+        else:
+            raise QueryError(404, f"Unknown endpoint {endpoint}")
+        content_type = 'text/csv' if output_format == 'csv' else 'application/json'
+        return await self._coalesced(key, compute), content_type
+
+    def status(self) -> Dict:
+        return {
+            'datasets': dict(
+                [('time', _describe(self.datasets['time']))] +
+                [(f'area/{level}', _describe(datafile)) for level, datafile in self.datasets['area'].items()]),
+            'cache': self.cache.statistics(),
+            'requests': dict(self.counters),
+        }
+
+    async def _respond(self, method: Text, target: Text) -> Tuple[int, bytes, Text]:
+        if method != 'GET':
+            raise QueryError(405, f"Method {method} not allowed")
+        url = urllib.parse.urlsplit(target)
+        params = urllib.parse.parse_qs(url.query)
+        if url.path == '/health':
+            return 200, b'{"status": "ok"}', 'application/json'
+        if url.path == '/datasets':
+            return 200, json.dumps(self.status()).encode('utf-8'), 'application/json'
+        try:
+            body, content_type = await self.query(url.path, params)
+        except FileNotFoundError as e:
+            # The datafile was removed after a newer one was published
+            raise QueryError(503, f"Datafile not available: {e.filename}") from None
+        return 200, body, content_type
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the HTTP/1.1 requests of a connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._write(writer, 400, json.dumps({'error': 'Malformed request'}).encode('utf-8'),
+                                      'application/json', keep_alive=False)
+                    break
+                keep_alive = (headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1')
+                self.counters['requests'] += 1
+                try:
+                    status, body, content_type = await self._respond(method, target)
+                except QueryError as e:
+                    self.counters['errors'] += 1
+                    status, body, content_type = e.status, json.dumps({'error': str(e)}).encode('utf-8'), \
+                        'application/json'
+                except Exception as e:
+                    self.counters['errors'] += 1
+                    self.logger.exception('Query %s failed.' % (target, ))
+                    status, body, content_type = 500, json.dumps({'error': str(e)}).encode('utf-8'), \
+                        'application/json'
+                await self._write(writer, status, body, content_type, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _write(writer, status, body, content_type, keep_alive):
+        head = (f"HTTP/1.1 {status} {_reasons.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    async def serve(self, host: Text = '127.0.0.1', port: int = 8080, ready=None):
+        """
+        Serves until cancelled. ready is called with the server when it
+        accepts connections, e.g. to find out the port when port is 0.
+        """
+        await self.reload(force=True)
+        server = await asyncio.start_server(self.handle, host, port, limit=_max_line)
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload(force=True)))
+        except (NotImplementedError, AttributeError, RuntimeError):
+            # No signals on Windows, nor outside of the main thread
+            pass
+        watcher = asyncio.ensure_future(self._watch())
+        self.logger.info('Serving queries on %s' % (', '.join(str(s.getsockname()) for s in server.sockets), ))
+        if ready is not None:
+            ready(server)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            self._executor.shutdown(wait=False)
+
+
+def _optional_tuple(values) -> Optional[Tuple]:
+    return None if values is None else tuple(values)
+
+
+def _describe(datafile) -> Optional[Dict]:
+    if datafile is None:
+        return None
+    path, begin_date, end_date = datafile
+    return {'path': path, 'begin_date': begin_date.isoformat(), 'end_date': end_date.isoformat()}
+
+
+def _encode(df, output_format: Text) -> bytes:
+    if output_format == 'csv':
+        return df.to_csv(index=False, date_format='%Y-%m-%dT%H:%M:%S').encode('utf-8')
+    return df.to_json(orient='split', index=False, date_format='iso').encode('utf-8')
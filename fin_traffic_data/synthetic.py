@@ -0,0 +1,165 @@
+"""
+Deterministic synthetic raw traffic data for benchmarks and offline tests:
+lamraw CSV payloads as served by the raw data server, and raw datafiles as
+written by fin-traffic-fetch-raw-data. The same seed, station and date
+always give the same vehicles.
+"""
+import os
+import pathlib
+import datetime
+from typing import Iterable, List, Optional, Set, Text
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.raw_data import _tms_raw_data_dtypes
+from fin_traffic_data.utils import daterange
+
+# Share of the vehicles of the day in each hour, with the peaks of the
+# morning and afternoon commutes
+_hourly_profile = np.array([
+    0.6, 0.4, 0.3, 0.3, 0.5, 1.5, 3.5, 6.5, 6.8, 5.0, 4.6, 4.8,
+    5.1, 5.3, 5.9, 7.2, 8.0, 7.4, 5.6, 4.3, 3.4, 2.6, 1.8, 1.1
+])
+_hourly_profile = _hourly_profile / _hourly_profile.sum()
+
+# Vehicle categories (car, truck, bus, semi-trailer, truck with trailer,
+# car with trailer, car with caravan), their shares and lengths in metres
+_vehicle_categories = np.arange(1, 8)
+_category_shares = np.array([0.85, 0.03, 0.005, 0.04, 0.04, 0.03, 0.005])
+_category_lengths = np.array([4.5, 9.0, 12.0, 16.0, 22.0, 9.0, 11.0])
+
+# Share of the readings marked faulty
+_faulty_share = 0.005
+
+# Default seed of the generator
+_default_seed = 2020
+
+
+def _rng(seed: int, tms_num: int, date: datetime.date) -> np.random.Generator:
+    return np.random.default_rng([int(seed), int(tms_num), date.toordinal()])
+
+
+def _vehicles(tms_num: int, date: datetime.date, vehicles_per_day: float, seed: int) -> pd.DataFrame:
+    """All the columns of the vehicles of a station on a date, ordered by time."""
+    rng = _rng(seed, tms_num, date)
+    n = int(rng.poisson(vehicles_per_day))
+    hours = rng.choice(24, size=n, p=_hourly_profile)
+    # Hundredths of a second since midnight
+    times = np.sort(hours * 360000 + rng.integers(0, 360000, size=n))
+    categories = rng.choice(_vehicle_categories, size=n, p=_category_shares)
+    directions = rng.integers(1, 3, size=n)
+    lengths = np.round(_category_lengths[categories - 1] * rng.normal(1.0, 0.1, size=n), 1)
+    speeds = np.clip(np.round(rng.normal(85 - 10 * (categories > 1), 12, size=n)), 20, 160).astype(int)
+    timespans = np.diff(times, prepend=times[:1])
+    return pd.DataFrame({
+        'tms_id': np.full(n, int(tms_num)),
+        'year': np.full(n, date.year % 100),
+        'day_number': np.full(n, date.timetuple().tm_yday),
+        'hour': times // 360000,
+        'minute': times // 6000 % 60,
+        'second': times // 100 % 60,
+        'millisecond': times % 100,
+        'length': lengths,
+        'lane': directions + 2 * rng.integers(0, 2, size=n),
+        'direction': directions,
+        'vehicle category': categories,
+        'speed': speeds,
+        'faulty': (rng.random(size=n) < _faulty_share).astype(int),
+        'total time': times,
+        'timespan': np.minimum(timespans, 99999),
+        'queue_begin': np.zeros(n, dtype=int),
+    })
+
+
+def generate_lamraw_text(tms_num: int, date: datetime.date, vehicles_per_day: float = 10000,
+                         seed: int = _default_seed) -> Text:
+    """
+    The raw datafile (lamraw_<tms>_<yy>_<day>.csv) of a station on a date.
+
+    Input
+    -----
+    tms_num: int
+        Number of the TMS station
+    date: datetime.date
+    vehicles_per_day: float
+        Mean number of vehicles of the day. The actual number is drawn from
+        a Poisson distribution.
+    seed: int
+        Seed of the generator
+    """
+    return _vehicles(tms_num, date, vehicles_per_day, seed).to_csv(sep=';', header=False, index=False)
+
+
+def generate_raw_data_frame(tms_num: int, begin_date: datetime.date, end_date: datetime.date,
+                            vehicles_per_day: float = 10000, seed: int = _default_seed) -> Optional[pd.DataFrame]:
+    """
+    The raw data of a station between the dates (end date exclusive) as
+    returned by fin_traffic_data.raw_data.get_tms_raw_data for the files of
+    generate_lamraw_text, or None if there are no vehicles.
+    """
+    frames = []
+    for date in daterange(begin_date, end_date):
+        df = _vehicles(tms_num, date, vehicles_per_day, seed)
+        df = df.loc[df['faulty'] == 0]
+        d0 = np.datetime64(datetime.datetime(date.year, 1, 1), 'ms')
+        # As parsed by fin_traffic_data.raw_data._tms_raw_date_parser
+        time = (d0 + (df['day_number'].to_numpy() - 1).astype('timedelta64[D]')
+                + (df['total time'].to_numpy() // 100).astype('timedelta64[s]')
+                + df['millisecond'].to_numpy().astype('timedelta64[ms]'))
+        frames.append(pd.DataFrame({
+            'tms_id': df['tms_id'].to_numpy(),
+            'time': time.astype('datetime64[ns]'),
+            'direction': df['direction'].to_numpy(),
+            'vehicle category': df['vehicle category'].to_numpy(),
+            'speed': df['speed'].to_numpy(),
+            'length': df['length'].to_numpy(),
+        }).astype(_tms_raw_data_dtypes))
+    df = pd.concat(frames, ignore_index=True) if frames else None
+    if df is None or df.empty:
+        return None
+    return df
+
+
+def write_raw_data_file(results_dir: Text, tms_nums: Iterable[int], begin_date: datetime.date,
+                        end_date: datetime.date, vehicles_per_day: float = 10000,
+                        seed: int = _default_seed) -> Text:
+    """
+    Writes the synthetic raw data of the stations between the dates into a
+    raw datafile as written by fin-traffic-fetch-raw-data.
+
+    Returns
+    -------
+    Path to the raw datafile
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.scripts.fetch_raw_data import get_raw_data_file_path, _write_raw_data
+
+    pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+    path = get_raw_data_file_path(results_dir, begin_date, end_date)
+    if os.path.exists(path):
+        os.remove(path)
+    for tms_num in tms_nums:
+        df = generate_raw_data_frame(tms_num, begin_date, end_date, vehicles_per_day, seed)
+        if df is not None:
+            _write_raw_data(df, path, int(tms_num))
+    return path
+
+
+def synthetic_tms_nums(num_stations: Optional[int] = None, area: Optional[Text] = None) -> List[int]:
+    """
+    Numbers of real TMS stations to generate data for: the stations over the
+    borders of the areas of the aggregation level (all levels by default),
+    so that the area aggregation has data. At most num_stations of them.
+    """
+    # Imported here to keep the startup of the console scripts fast
+    from fin_traffic_data.scripts.get_aggregated_traffic_between_areas import (
+        get_tms_over_area_borders, parse_border_tms
+    )
+
+    border_tms_nums: Set[int] = set()
+    for level in [area] if area is not None else ['province', 'erva', 'hcd']:
+        for tms in get_tms_over_area_borders(level)['tms']:
+            border_tms_nums.update(int(tms_num) for tms_num, _ in parse_border_tms(tms))
+    tms_nums = sorted(border_tms_nums)
+    return tms_nums if num_stations is None else tms_nums[:num_stations]
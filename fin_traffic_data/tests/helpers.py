@@ -0,0 +1,45 @@
+import datetime
+
+import pandas as pd
+
+from fin_traffic_data.synthetic import write_raw_data_file, synthetic_tms_nums
+
+# Small synthetic data set: a few stations over the province borders and
+# one station without any raw data
+_num_stations = 6
+_vehicles_per_day = 300
+_station_without_data = 1
+
+
+def get_test_tms_nums():
+    """Numbers of the stations of the synthetic raw datafiles, the last one without raw data."""
+    return synthetic_tms_nums(_num_stations, area='province') + [_station_without_data]
+
+
+def write_test_raw_data(raw_data_dir, begin_date, end_date, days_per_file=1):
+    """
+    Writes synthetic raw datafiles of the test stations covering the dates,
+    days_per_file days in each file.
+
+    Returns
+    -------
+    List of tuples of the filename, the begin date and the end date
+    """
+    tms_nums = get_test_tms_nums()[:-1]
+    files = []
+    date = begin_date
+    while date < end_date:
+        file_end = min(date + datetime.timedelta(days=days_per_file), end_date)
+        files.append((write_raw_data_file(raw_data_dir, tms_nums, date, file_end, _vehicles_per_day),
+                      date, file_end))
+        date = file_end
+    return files
+
+
+def assert_datafiles_equal(test_case, path, expected_path):
+    """Asserts that two HDF5 datafiles have the same keys and frames."""
+    with pd.HDFStore(path, mode='r') as store, pd.HDFStore(expected_path, mode='r') as expected:
+        test_case.assertEqual(sorted(store.keys()), sorted(expected.keys()))
+        for key in expected.keys():
+            with test_case.subTest(key=key):
+                pd.testing.assert_frame_equal(store[key], expected[key])
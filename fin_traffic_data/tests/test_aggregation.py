@@ -0,0 +1,188 @@
+import os
+import datetime
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.aggregation import (aggregate_datafiles, aggregate_datafiles_chunked, get_counts_version,
+                                          _counts_version)
+from fin_traffic_data.scripts.get_aggregated_traffic_between_areas import get_aggregated_traffic_between_areas
+from fin_traffic_data.synthetic import synthetic_tms_nums
+from fin_traffic_data.tests.helpers import get_test_tms_nums, write_test_raw_data, assert_datafiles_equal
+
+
+class TestChunkedAggregation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        cls.raw_data_files = write_test_raw_data(os.path.join(cls.tmpdir.name, 'raw_data'),
+                                                 datetime.date(2020, 3, 2), datetime.date(2020, 3, 5),
+                                                 days_per_file=2)
+        cls.tms_nums = get_test_tms_nums()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def _results_dir(self, name):
+        path = os.path.join(self.tmpdir.name, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _aggregate_in_memory(self, delta_t, statistics):
+        return aggregate_datafiles(self.raw_data_files, self.tms_nums, delta_t,
+                                   self._results_dir(f'in_memory_{delta_t.total_seconds():g}_{statistics}'),
+                                   statistics=statistics)
+
+    def test_chunked_equals_in_memory(self):
+        # Chunks of whole days, chunks not dividing a day and a single chunk
+        for delta_t, chunk_length in [(datetime.timedelta(hours=1), datetime.timedelta(days=1)),
+                                      (datetime.timedelta(hours=7), datetime.timedelta(hours=15)),
+                                      (datetime.timedelta(hours=7), datetime.timedelta(days=30))]:
+            for statistics in [False, True]:
+                with self.subTest(delta_t=delta_t, chunk_length=chunk_length, statistics=statistics):
+                    expected = self._aggregate_in_memory(delta_t, statistics)
+                    path = aggregate_datafiles_chunked(
+                        self.raw_data_files, self.tms_nums, delta_t,
+                        self._results_dir(f'chunked_{chunk_length.total_seconds():g}_{statistics}'),
+                        chunk_length=chunk_length, statistics=statistics, workers=2)
+                    assert_datafiles_equal(self, path, expected)
+
+    def test_memory_limit_equals_in_memory(self):
+        delta_t = datetime.timedelta(hours=1)
+        expected = self._aggregate_in_memory(delta_t, False)
+        path = aggregate_datafiles_chunked(self.raw_data_files, self.tms_nums, delta_t,
+                                           self._results_dir('memory_limit'), memory_limit=2**20, workers=2)
+        assert_datafiles_equal(self, path, expected)
+
+    def test_extension_equals_aggregation_of_all_the_data(self):
+        # The last bucket of the earlier datafile is partial
+        delta_t = datetime.timedelta(hours=7)
+        for statistics in [False, True]:
+            with self.subTest(statistics=statistics):
+                earlier = aggregate_datafiles(self.raw_data_files[:1], self.tms_nums, delta_t,
+                                              self._results_dir(f'earlier_{statistics}'), statistics=statistics)
+                expected = self._aggregate_in_memory(delta_t, statistics)
+                path = aggregate_datafiles_chunked(self.raw_data_files, self.tms_nums, delta_t,
+                                                   self._results_dir(f'extended_{statistics}'),
+                                                   chunk_length=datetime.timedelta(days=1),
+                                                   statistics=statistics, workers=2, extend_from=earlier)
+                assert_datafiles_equal(self, path, expected)
+
+    def test_extension_with_other_columns_aggregates_all_the_data(self):
+        delta_t = datetime.timedelta(hours=7)
+        earlier = aggregate_datafiles(self.raw_data_files[:1], self.tms_nums, delta_t,
+                                      self._results_dir('earlier_without_statistics'))
+        expected = self._aggregate_in_memory(delta_t, True)
+        path = aggregate_datafiles_chunked(self.raw_data_files, self.tms_nums, delta_t,
+                                           self._results_dir('extended_with_statistics'),
+                                           statistics=True, workers=2, extend_from=earlier)
+        assert_datafiles_equal(self, path, expected)
+
+
+class TestAreaExtension(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        raw_data_files = write_test_raw_data(os.path.join(cls.tmpdir.name, 'raw_data'),
+                                             datetime.date(2020, 3, 2), datetime.date(2020, 3, 5),
+                                             days_per_file=2)
+        # The last bucket of the earlier datafile is partial
+        delta_t = datetime.timedelta(hours=7)
+        for name in ['earlier', 'all']:
+            os.makedirs(os.path.join(cls.tmpdir.name, name))
+        # All the stations over the province borders, most of them without raw data
+        tms_nums = synthetic_tms_nums(area='province')
+        cls.earlier = aggregate_datafiles(raw_data_files[:1], tms_nums, delta_t,
+                                          os.path.join(cls.tmpdir.name, 'earlier'))
+        cls.inputfile = aggregate_datafiles(raw_data_files, tms_nums, delta_t,
+                                            os.path.join(cls.tmpdir.name, 'all'))
+        cls.expected = get_aggregated_traffic_between_areas(cls.inputfile, 'province', False,
+                                                            os.path.join(cls.tmpdir.name, 'expected'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def _earlier_area_file(self, results_dir):
+        results_dir = os.path.join(self.tmpdir.name, results_dir)
+        path = get_aggregated_traffic_between_areas(self.earlier, 'province', False, results_dir)
+        return results_dir, path, self._generations(path)
+
+    def _generations(self, path):
+        with pd.HDFStore(path, mode='r') as store:
+            return dict((key, store.get_storer(key).attrs.generation) for key in store.keys())
+
+    def test_extension_equals_computation_over_all_the_input(self):
+        results_dir, earlier, generations = self._earlier_area_file('extended')
+        path = get_aggregated_traffic_between_areas(self.inputfile, 'province', False, results_dir,
+                                                    append_to=earlier)
+        assert_datafiles_equal(self, path, self.expected)
+        self.assertFalse(os.path.exists(earlier))
+        # The extended edges keep their generation
+        self.assertEqual(self._generations(path), generations)
+
+    def test_counts_of_an_earlier_version_are_computed_again(self):
+        results_dir, earlier, generations = self._earlier_area_file('earlier_version')
+        with pd.HDFStore(earlier, mode='a') as store:
+            for key in store.keys():
+                # Extending would keep the rows before the last timestamp
+                df = store[key]
+                df['counts'] += 1
+                store.put(key, df, format='table')
+                store.get_storer(key).attrs.counts_version = 1
+        path = get_aggregated_traffic_between_areas(self.inputfile, 'province', False, results_dir,
+                                                    append_to=earlier)
+        assert_datafiles_equal(self, path, self.expected)
+        self.assertFalse(set(self._generations(path).items()) & set(generations.items()))
+
+
+class TestCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_counts_equal_hand_computed_counts(self):
+        # Two days of raw data of station 101 and none of station 102
+        raw_data_path = os.path.join(self.tmpdir.name, 'fin_traffic_raw_2020-03-02_2020-03-04.h5')
+        pd.DataFrame({
+            'time': pd.to_datetime(['2020-03-02 00:00:00', '2020-03-02 06:59:59', '2020-03-02 07:00:00',
+                                    '2020-03-03 03:30:00', '2020-03-03 23:59:59', '2020-03-03 12:00:00',
+                                    '2020-03-02 08:00:00']),
+            'direction': [1, 1, 2, 1, 2, 1, 3],
+            'vehicle category': [1, 1, 3, 2, 7, 0, 1],
+        }).to_hdf(raw_data_path, key='tms_101')
+        path = aggregate_datafiles([(raw_data_path, datetime.date(2020, 3, 2), datetime.date(2020, 3, 4))],
+                                   [101, 102], datetime.timedelta(hours=7), self.tmpdir.name)
+
+        # Buckets of 7 hours from the beginning of the range, the last one
+        # ending with it. Every vehicle is counted once, and the vehicles
+        # with an unknown direction or vehicle category are not counted.
+        times = pd.date_range('2020-03-02', periods=7, freq='7h')
+        expected = pd.DataFrame({
+            'time': np.repeat(times.to_numpy(), 14),
+            'direction': np.tile(np.repeat([1, 2], 7), 7).astype(np.int64),
+            'vehicle category': np.tile(np.arange(1, 8), 14).astype(np.int64),
+            'counts': np.zeros(98, dtype=np.int64),
+        })
+        self.assertEqual(get_counts_version(path), _counts_version)
+        pd.testing.assert_frame_equal(pd.read_hdf(path, 'tms_102'), expected)
+        expected['counts'] = expected['counts'].astype(np.float64)
+        for time, direction, category, counts in [('2020-03-02 00:00', 1, 1, 2),
+                                                  ('2020-03-02 07:00', 2, 3, 1),
+                                                  ('2020-03-02 21:00', 1, 2, 1),
+                                                  ('2020-03-03 18:00', 2, 7, 1)]:
+            expected.loc[(expected['time'] == pd.Timestamp(time)) & (expected['direction'] == direction) &
+                         (expected['vehicle category'] == category), 'counts'] = counts
+        pd.testing.assert_frame_equal(pd.read_hdf(path, 'tms_101'), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import datetime
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data import batching
+from fin_traffic_data.batching import FetchStatistics, plan_batches
+
+
+def _date(month, day):
+    return datetime.date(2020, month, day)
+
+
+def _statistics(rows_per_day, bytes_per_row=10.0):
+    """Statistics of the rows per day, with bytes_per_row bytes per row."""
+    statistics = FetchStatistics(os.devnull)
+    statistics.max_station_rows = dict(rows_per_day)
+    statistics.bytes_per_row = bytes_per_row
+    return statistics
+
+
+class TestPlanBatches(unittest.TestCase):
+
+    def test_split_by_the_budget(self):
+        # 3000 bytes per day
+        statistics = _statistics(dict((_date(3, day), 100) for day in range(1, 11)))
+        day_bytes = batching._peak_memory_factor * 10.0 * 100
+        self.assertEqual(plan_batches([(_date(3, 1), _date(3, 11))], statistics, 3 * day_bytes),
+                         [(_date(3, 1), _date(3, 4)), (_date(3, 4), _date(3, 7)), (_date(3, 7), _date(3, 10)),
+                          (_date(3, 10), _date(3, 11))])
+        # The batches do not span the intervals
+        self.assertEqual(plan_batches([(_date(3, 1), _date(3, 3)), (_date(3, 5), _date(3, 8))], statistics,
+                                      4 * day_bytes),
+                         [(_date(3, 1), _date(3, 3)), (_date(3, 5), _date(3, 8))])
+        # Days without observations are estimated by the largest observation
+        self.assertEqual(plan_batches([(_date(4, 1), _date(4, 5))], statistics, 2 * day_bytes + 1),
+                         [(_date(4, 1), _date(4, 3)), (_date(4, 3), _date(4, 5))])
+
+    def test_batches_are_within_the_budget(self):
+        rng = np.random.default_rng(2020)
+        dates = [_date(3, 1) + datetime.timedelta(days=n) for n in range(60)]
+        statistics = _statistics(zip(dates, rng.integers(50, 500, len(dates))))
+        max_memory = 20000
+        batches = plan_batches([(dates[0], dates[-1] + datetime.timedelta(days=1))], statistics, max_memory)
+        self.assertEqual(batches[0][0], dates[0])
+        self.assertEqual(batches[-1][1], dates[-1] + datetime.timedelta(days=1))
+        for (_, end), (begin, _) in zip(batches[:-1], batches[1:]):
+            self.assertEqual(end, begin)
+        for begin, end in batches:
+            self.assertLessEqual(statistics.estimate_bytes(begin, end), max_memory)
+        # Each batch is as long as the budget allows
+        for begin, end in batches[:-1]:
+            self.assertGreater(statistics.estimate_bytes(begin, end + datetime.timedelta(days=1)), max_memory)
+
+    def test_day_over_the_budget(self):
+        statistics = _statistics({_date(3, 1): 100, _date(3, 2): 10000, _date(3, 3): 100, _date(3, 4): 100})
+        self.assertEqual(plan_batches([(_date(3, 1), _date(3, 5))], statistics, 10000),
+                         [(_date(3, 1), _date(3, 2)), (_date(3, 2), _date(3, 3)), (_date(3, 3), _date(3, 5))])
+        # Also alone in its interval
+        self.assertEqual(plan_batches([(_date(3, 2), _date(3, 3))], statistics, 10000),
+                         [(_date(3, 2), _date(3, 3))])
+
+    def test_without_statistics_or_budget(self):
+        intervals = [(_date(1, 1), _date(3, 15)), (_date(4, 1), _date(4, 2))]
+        expected = [(_date(1, 1), _date(1, 31)), (_date(1, 31), _date(3, 1)), (_date(3, 1), _date(3, 15)),
+                    (_date(4, 1), _date(4, 2))]
+        statistics = _statistics({_date(1, 1): 100})
+        self.assertEqual(plan_batches(intervals), expected)
+        self.assertEqual(plan_batches(intervals, statistics), expected)
+        self.assertEqual(plan_batches(intervals, None, 1000), expected)
+        self.assertEqual(plan_batches(intervals, _statistics({}), 1000), expected)
+
+
+class TestFetchStatistics(unittest.TestCase):
+
+    def test_record_save_and_load(self):
+        with tempfile.TemporaryDirectory(prefix='fin_traffic_test_') as tmpdir:
+            statistics = FetchStatistics.open(tmpdir)
+            self.assertTrue(statistics.is_empty())
+            times = pd.to_datetime(['2020-03-01 10:00', '2020-03-01 11:00', '2020-03-02 10:00'])
+            statistics.record(pd.DataFrame({'time': times, 'speed': [80.0, 90.0, 100.0]}))
+            statistics.record(pd.DataFrame({'time': times[2:].repeat(3), 'speed': [80.0, 90.0, 100.0]}))
+            statistics.record(None)
+            statistics.save()
+
+            loaded = FetchStatistics.open(tmpdir)
+            self.assertEqual(loaded.max_station_rows, {_date(3, 1): 2, _date(3, 2): 3})
+            self.assertEqual(loaded.bytes_per_row, statistics.bytes_per_row)
+            self.assertGreater(loaded.bytes_per_row, 0.0)
+
+            # Statistics of another version are not used
+            with open(loaded.path, 'w') as f:
+                f.write('{"version": 0, "bytes_per_row": 1.0, "max_station_rows": {}}')
+            self.assertTrue(FetchStatistics.open(tmpdir).is_empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.borders import StationIndex, border_station_directions, build_border_tables, _earth_radius_km
+
+
+def _fixture_tms_stations(tms_nums, dir1, dir2, lon=None, lat=None):
+    """Station metadata as returned by get_tms_stations, all in Helsinki."""
+    tms_nums = list(tms_nums)
+    return pd.DataFrame({
+            'id': [20000 + num for num in tms_nums],
+            'num': tms_nums,
+            # The x-coordinate is stored in the column 'latitude'
+            'latitude': lon if lon is not None else [24.9] * len(tms_nums),
+            'longitude': lat if lat is not None else [60.2] * len(tms_nums),
+            'municipality': [91] * len(tms_nums),
+            'province': [1] * len(tms_nums),
+            'dir1': dir1,
+            'dir2': dir2,
+        },
+        index=tms_nums)
+
+
+def _haversine_km(lon0, lat0, lon, lat):
+    lon0, lat0, lon, lat = (np.radians(x) for x in (lon0, lat0, lon, lat))
+    a = np.sin((lat - lat0) / 2)**2 + np.cos(lat0) * np.cos(lat) * np.sin((lon - lon0) / 2)**2
+    return 2 * _earth_radius_km * np.arcsin(np.sqrt(a))
+
+
+class TestBorderStationDirections(unittest.TestCase):
+
+    def test_directions_over_the_borders(self):
+        areas = {1: 'A', 2: 'B', 3: 'A'}
+        tms_stations = _fixture_tms_stations([101, 102, 103, 104], dir1=[1, 1, 4, None], dir2=[2, 3, 1, 2])
+        df = border_station_directions(
+            tms_stations, lambda municipalities: np.array([areas.get(int(m)) for m in municipalities], dtype=object))
+        # Direction 1 heads to the dir1 municipality. The stations within an
+        # area, or with a municipality without an area, are left out.
+        expected = pd.DataFrame({'source': ['B', 'A'], 'destination': ['A', 'B'], 'tms': [101, 101],
+                                 'direction': [1, 2]})
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+    def test_border_tables_keep_the_foreign_borders(self):
+        # Helsinki-Tampere, Helsinki-Espoo and a station of the Russian
+        # border in Rovaniemi
+        tms_stations = _fixture_tms_stations([101, 102, 1430], dir1=[91, 91, 698], dir2=[837, 49, 698])
+        tables = build_border_tables(tms_stations)
+        province = tables['province'].set_index(['source', 'destination'])['tms'].to_dict()
+        self.assertEqual(province, {('Pirkanmaa', 'Uusimaa'): '101,1', ('Uusimaa', 'Pirkanmaa'): '101,2',
+                                    ('Venäjä', 'Lappi'): '1430,2', ('Lappi', 'Venäjä'): '1430,1'})
+        erva = tables['erva'].set_index(['source', 'destination'])['tms'].to_dict()
+        self.assertEqual(erva, {('TAYS', 'HYKS'): '101,1', ('HYKS', 'TAYS'): '101,2',
+                                ('Venäjä', 'OYS'): '1430,2', ('OYS', 'Venäjä'): '1430,1'})
+        # There are no foreign hospital care districts
+        self.assertEqual(sorted(tables['hcd']['tms']), ['101,1', '101,2'])
+
+
+class TestStationIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2020)
+        self.lon = rng.uniform(20.0, 31.0, 200)
+        self.lat = rng.uniform(59.5, 70.0, 200)
+        tms_nums = np.arange(1, 201)
+        self.index = StationIndex(_fixture_tms_stations(tms_nums, dir1=[91] * 200, dir2=[49] * 200,
+                                                        lon=self.lon, lat=self.lat))
+        self.points = list(zip(rng.uniform(20.0, 31.0, 20), rng.uniform(59.5, 70.0, 20)))
+
+    def test_nearest_equals_haversine(self):
+        for lon, lat in self.points:
+            distances = _haversine_km(lon, lat, self.lon, self.lat)
+            tms_nums, km = self.index.nearest(lon, lat, k=3)
+            np.testing.assert_array_equal(tms_nums, np.argsort(distances)[:3] + 1)
+            np.testing.assert_allclose(km, np.sort(distances)[:3], rtol=1e-9)
+        tms_num, km = self.index.nearest(self.lon[9], self.lat[9])
+        self.assertEqual(int(tms_num), 10)
+        self.assertAlmostEqual(float(km), 0.0, places=6)
+
+    def test_within_radius_equals_haversine(self):
+        for radius_km in [10.0, 80.0, 250.0]:
+            for lon, lat in self.points:
+                distances = _haversine_km(lon, lat, self.lon, self.lat)
+                np.testing.assert_array_equal(self.index.within_radius(lon, lat, radius_km),
+                                              np.flatnonzero(distances <= radius_km) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
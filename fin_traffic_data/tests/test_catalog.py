@@ -0,0 +1,206 @@
+import os
+import logging
+import sqlite3
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+from fin_traffic_data import catalog as catalog_module
+from fin_traffic_data.aggregation import get_aggregated_file_path
+from fin_traffic_data.catalog import DatasetCatalog
+from fin_traffic_data.scripts import complete_pipeline
+
+_resolution = datetime.timedelta(hours=1)
+
+
+def _date(day):
+    return datetime.date(2020, 3, day)
+
+
+def _datetime(day):
+    return datetime.datetime(2020, 3, day)
+
+
+class TestDatasetCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        self.catalog = DatasetCatalog(os.path.join(self.tmpdir.name, 'catalog.sqlite'))
+
+    def tearDown(self):
+        self.catalog.close()
+        self.tmpdir.cleanup()
+
+    def _write(self, filename, content=b'data'):
+        path = os.path.join(self.tmpdir.name, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return os.path.abspath(path)
+
+    def _register_time(self, begin_day, end_day):
+        path = self._write(os.path.basename(get_aggregated_file_path('', _datetime(begin_day), _datetime(end_day),
+                                                                      _resolution)))
+        self.catalog.register('time', path, _date(begin_day), _date(end_day), resolution=_resolution)
+        return path
+
+    def test_find(self):
+        path = self._register_time(2, 4)
+        self.assertEqual(self.catalog.find('time', _date(2), _date(4), resolution=_resolution), path)
+        self.assertIsNone(self.catalog.find('time', _date(2), _date(5), resolution=_resolution))
+        self.assertIsNone(self.catalog.find('time', _date(2), _date(4), resolution=datetime.timedelta(hours=2)))
+        self.assertIsNone(self.catalog.find('time', _date(2), _date(4), resolution=_resolution, suffix='.tar.bz2'))
+
+    def test_find_latest(self):
+        self._register_time(2, 3)
+        path = self._register_time(2, 5)
+        self._register_time(2, 7)
+        self._register_time(3, 4)
+        self.assertEqual(self.catalog.find_latest('time', _date(2), _date(7), resolution=_resolution), path)
+        self.assertIsNone(self.catalog.find_latest('time', _date(2), _date(3), resolution=_resolution))
+
+    def test_list(self):
+        raw_files = [(self._write(f'fin_traffic_raw_2020-03-0{day}_2020-03-0{day + 1}.h5'), _date(day), _date(day + 1))
+                     for day in [4, 2, 3]]
+        for path, begin_date, end_date in raw_files:
+            self.catalog.register('raw', path, begin_date, end_date)
+        self.assertEqual(self.catalog.list('raw'), sorted(raw_files, key=lambda f: f[1]))
+        self.assertEqual(self.catalog.list('time', resolution=_resolution), [])
+        self.assertEqual(self.catalog.date_range('raw'), (_date(2), _date(5)))
+
+    def test_list_between_dates(self):
+        raw_files = [(self._write(f'fin_traffic_raw_2020-03-0{day}_2020-03-0{day + 1}.h5'), _date(day), _date(day + 1))
+                     for day in range(2, 8)]
+        for path, begin_date, end_date in raw_files:
+            self.catalog.register('raw', path, begin_date, end_date)
+        with mock.patch.object(catalog_module.os.path, 'exists', wraps=os.path.exists) as exists:
+            self.assertEqual(self.catalog.list('raw', begin_date=_date(4), end_date=_date(6)), raw_files[2:4])
+            self.assertEqual(exists.call_count, 2)
+        self.assertEqual(self.catalog.list('raw', end_date=_date(3)), raw_files[:1])
+        self.assertEqual(self.catalog.list('raw', begin_date=_date(7)), raw_files[-1:])
+
+    def test_lookups_check_only_the_returned_datafiles(self):
+        for end_day in range(3, 9):
+            self._register_time(2, end_day)
+        raw_paths = [self._write(f'fin_traffic_raw_2020-03-0{day}_2020-03-0{day + 1}.h5') for day in range(2, 8)]
+        for day, path in zip(range(2, 8), raw_paths):
+            self.catalog.register('raw', path, _date(day), _date(day + 1))
+        with mock.patch.object(catalog_module.os.path, 'exists', wraps=os.path.exists) as exists:
+            self.catalog.find_latest('time', _date(2), _date(9), resolution=_resolution)
+            self.assertEqual(exists.call_count, 1)
+            exists.reset_mock()
+            self.assertEqual(self.catalog.date_range('raw'), (_date(2), _date(8)))
+            self.assertEqual(exists.call_count, 2)
+        # The removed datafiles at the ends are excluded, also from a read-only catalog
+        os.remove(raw_paths[0])
+        os.remove(raw_paths[-1])
+        with DatasetCatalog(self.catalog.path, read_only=True) as catalog:
+            self.assertEqual(catalog.date_range('raw'), (_date(3), _date(7)))
+        self.assertEqual(self.catalog.date_range('raw'), (_date(3), _date(7)))
+        self.assertEqual(len(self.catalog.list('raw')), 4)
+
+    def test_stale_records(self):
+        # Datafiles removed without the catalog are neither returned nor kept
+        older = self._register_time(2, 3)
+        newer = self._register_time(2, 5)
+        os.remove(newer)
+        self.assertIsNone(self.catalog.find('time', _date(2), _date(5), resolution=_resolution))
+        self.assertEqual(self.catalog.find_latest('time', _date(2), _date(7), resolution=_resolution), older)
+        raw_path = self._write('fin_traffic_raw_2020-03-02_2020-03-03.h5')
+        self.catalog.register('raw', raw_path, _date(2), _date(3))
+        self.catalog.register('raw', self._write('fin_traffic_raw_2020-03-03_2020-03-05.h5'), _date(3), _date(5))
+        os.remove(raw_path)
+        self.assertEqual(self.catalog.date_range('raw'), (_date(3), _date(5)))
+        os.remove(older)
+        self.assertIsNone(self.catalog.find_latest('time', _date(2), _date(7), resolution=_resolution))
+        self.assertEqual(self.catalog.connection.execute("SELECT COUNT(*) FROM datasets").fetchone()[0], 1)
+
+    def test_read_only(self):
+        older = self._register_time(2, 3)
+        newer = self._register_time(2, 5)
+        os.remove(newer)
+        with DatasetCatalog(self.catalog.path, read_only=True) as catalog:
+            self.assertEqual(catalog.find_latest('time', _date(2), _date(7), resolution=_resolution), older)
+            with self.assertRaises(sqlite3.OperationalError):
+                catalog.register('time', older, _date(2), _date(3), resolution=_resolution)
+        # The records of the removed datafiles are kept for the writers
+        self.assertEqual(self.catalog.connection.execute("SELECT COUNT(*) FROM datasets").fetchone()[0], 2)
+
+    def test_scan(self):
+        time_path = self._register_time(2, 3)
+        raw_path = self._write('fin_traffic_raw_2020-03-02_2020-03-04.h5')
+        self._write('unrelated.h5')
+        self.catalog.scan(self.tmpdir.name, 'raw')
+        self.assertEqual(self.catalog.list('raw'), [(raw_path, _date(2), _date(4))])
+        # The resolution is parsed from the filename of time aggregated datafiles
+        self.catalog.remove(time_path)
+        self.catalog.scan(self.tmpdir.name, 'time')
+        self.assertEqual(self.catalog.find('time', _date(2), _date(3), resolution=_resolution), time_path)
+        # Records of removed datafiles are dropped by the next scan
+        os.remove(raw_path)
+        self.catalog.scan(self.tmpdir.name, 'raw')
+        self.assertIsNone(self.catalog.connection.execute(
+            "SELECT 1 FROM datasets WHERE kind = 'raw'").fetchone())
+
+    def test_remove_ending_after(self):
+        self._register_time(2, 3)
+        newer = self._register_time(2, 5)
+        self.assertEqual(self.catalog.remove_ending_after('time', _date(4)), [newer])
+        self.assertEqual([end for _, _, end in self.catalog.list('time', resolution=_resolution)], [_date(3)])
+
+    def test_filled_raw_data_removes_out_of_date_results(self):
+        raw_path = self._write('fin_traffic_raw_2020-03-02_2020-03-05.h5')
+        self.catalog.register('raw', raw_path, _date(2), _date(5))
+        older = self._register_time(2, 3)
+        newer = self._register_time(2, 5)
+        sidecars = [self._write(os.path.basename(newer) + suffix) for suffix in ['.cumsum.npy', '.cumsum.json']]
+        area_path = self._write('tms_between_provinces_input_' + os.path.basename(newer))
+        self.catalog.register('area', area_path, _date(2), _date(5), resolution=_resolution, level='province')
+        export_path = self._write(os.path.basename(area_path)[:-len('.h5')] + '.tar.bz2')
+        self.catalog.register('export', export_path, _date(2), _date(5), resolution=_resolution, level='province')
+        sidecars.append(self._write(os.path.basename(export_path) + '.index.json'))
+
+        with mock.patch.object(complete_pipeline, 'fetch_missing_raw_data', return_value=[_date(3)]):
+            complete_pipeline.fill_missing_raw_data(logging.getLogger(__name__), self.catalog, _date(2), _date(5),
+                                                    self.tmpdir.name)
+        for path in [newer, area_path, export_path] + sidecars:
+            self.assertFalse(os.path.exists(path), path)
+        self.assertTrue(os.path.exists(older))
+        # Not registered again by a scan, so the next run does not extend them
+        for kind in ['time', 'area', 'export']:
+            self.catalog.scan(self.tmpdir.name, kind)
+        self.assertEqual(self.catalog.find_latest('time', _date(2), _date(6), resolution=_resolution), older)
+        self.assertEqual(self.catalog.list('area', resolution=_resolution, level='province'), [])
+        self.assertEqual(self.catalog.list('export', resolution=_resolution, level='province'), [])
+
+    def test_open_catalog_scans_only_new_catalog_or_on_rescan(self):
+        logger = logging.getLogger(__name__)
+        directories = [self.tmpdir.name] * 3
+        first = self._write('fin_traffic_raw_2020-03-02_2020-03-03.h5')
+        path = os.path.join(self.tmpdir.name, 'other_catalog.sqlite')
+        with complete_pipeline.open_catalog(logger, path, *directories) as catalog:
+            self.assertEqual([f[0] for f in catalog.list('raw')], [first])
+        second = self._write('fin_traffic_raw_2020-03-03_2020-03-04.h5')
+        with complete_pipeline.open_catalog(logger, path, *directories) as catalog:
+            self.assertEqual([f[0] for f in catalog.list('raw')], [first])
+        with complete_pipeline.open_catalog(logger, path, *directories, rescan=True) as catalog:
+            self.assertEqual([f[0] for f in catalog.list('raw')], [first, second])
+
+    def test_checksum_reused_while_unchanged(self):
+        path = self._write('fin_traffic_raw_2020-03-02_2020-03-03.h5')
+        with mock.patch.object(catalog_module, 'compute_checksum',
+                               wraps=catalog_module.compute_checksum) as compute_checksum:
+            self.catalog.register('raw', path, _date(2), _date(3))
+            self.catalog.register('raw', path, _date(2), _date(3))
+            self.assertEqual(compute_checksum.call_count, 1)
+            # Rewritten with other data
+            self._write('fin_traffic_raw_2020-03-02_2020-03-03.h5', b'other data')
+            self.catalog.register('raw', path, _date(2), _date(3))
+            self.assertEqual(compute_checksum.call_count, 2)
+        checksum, = self.catalog.connection.execute("SELECT checksum FROM datasets WHERE path = ?",
+                                                    (path, )).fetchone()
+        self.assertEqual(checksum, catalog_module.compute_checksum(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+from fin_traffic_data import compaction
+from fin_traffic_data.aggregation import aggregate_datafiles, aggregate_datafiles_chunked, list_rawdata_files
+from fin_traffic_data.catalog import DatasetCatalog
+from fin_traffic_data.tests.helpers import get_test_tms_nums, write_test_raw_data, assert_datafiles_equal
+
+_delta_t = datetime.timedelta(hours=7)
+
+
+class TestCompaction(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        self.raw_data_dir = os.path.join(self.tmpdir.name, 'raw_data')
+        # Daily datafiles over a year boundary
+        self.raw_data_files = write_test_raw_data(self.raw_data_dir, datetime.date(2019, 12, 30),
+                                                  datetime.date(2020, 1, 3))
+        self.tms_nums = get_test_tms_nums()
+        self.expected = aggregate_datafiles(self.raw_data_files, self.tms_nums, _delta_t,
+                                            self._results_dir('before'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _results_dir(self, name):
+        path = os.path.join(self.tmpdir.name, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _assert_aggregation_unchanged(self):
+        raw_data_files = list_rawdata_files(self.raw_data_dir)
+        path = aggregate_datafiles(raw_data_files, self.tms_nums, _delta_t, self._results_dir('after'))
+        assert_datafiles_equal(self, path, self.expected)
+        # The chunks are read with the time indices of the partitions
+        path = aggregate_datafiles_chunked(raw_data_files, self.tms_nums, _delta_t,
+                                           self._results_dir('after_chunked'),
+                                           chunk_length=datetime.timedelta(days=1), workers=2)
+        assert_datafiles_equal(self, path, self.expected)
+
+    def test_compaction_does_not_change_the_aggregation(self):
+        partitions = compaction.compact_raw_data(self.raw_data_dir)
+        self.assertEqual([(begin, end) for _, begin, end in partitions],
+                         [(datetime.date(2019, 12, 30), datetime.date(2020, 1, 1)),
+                          (datetime.date(2020, 1, 1), datetime.date(2020, 1, 3))])
+        self.assertEqual(sorted(list_rawdata_files(self.raw_data_dir)), sorted(partitions))
+        self._assert_aggregation_unchanged()
+
+    def test_journal_applied_twice(self):
+        # Interrupted after the journal was written
+        with mock.patch.object(compaction, '_apply_journal'):
+            compaction.compact_raw_data(self.raw_data_dir)
+        journal_path = os.path.join(self.raw_data_dir, compaction._journal_filename)
+        shutil.copyfile(journal_path, journal_path + '.copy')
+        self.assertTrue(compaction.finish_interrupted_compaction(self.raw_data_dir))
+        # Another reader applying the same journal finds its files done
+        os.replace(journal_path + '.copy', journal_path)
+        compaction._apply_journal(self.raw_data_dir)
+        self.assertFalse(os.path.exists(journal_path))
+        self._assert_aggregation_unchanged()
+
+    def test_catalog_records(self):
+        with DatasetCatalog(os.path.join(self.tmpdir.name, 'catalog.sqlite')) as catalog:
+            for path, begin_date, end_date in self.raw_data_files:
+                catalog.register('raw', path, begin_date, end_date)
+            partitions = compaction.compact_raw_data(self.raw_data_dir, catalog=catalog)
+            self.assertEqual(catalog.list('raw'), [(os.path.abspath(path), begin_date, end_date)
+                                                   for path, begin_date, end_date in partitions])
+
+    def test_catalog_drops_records_of_removed_files(self):
+        with DatasetCatalog(os.path.join(self.tmpdir.name, 'catalog.sqlite')) as catalog:
+            for path, begin_date, end_date in self.raw_data_files:
+                catalog.register('raw', path, begin_date, end_date)
+            # Compacted without the catalog
+            compaction.compact_raw_data(self.raw_data_dir)
+            self.assertEqual(catalog.list('raw'), [])
+            self.assertTrue(catalog.is_empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
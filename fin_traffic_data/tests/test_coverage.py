@@ -0,0 +1,165 @@
+import os
+import re
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from fin_traffic_data import metadata
+from fin_traffic_data.aggregation import list_rawdata_files
+from fin_traffic_data.coverage import CoverageIndex
+from fin_traffic_data.mock_server import MockServerConfig, start_mock_server
+from fin_traffic_data.raw_data import _raw_data_url_env
+from fin_traffic_data.scripts import fetch_raw_data as fetch_module
+from fin_traffic_data.tests.helpers import get_test_tms_nums, write_test_raw_data
+
+
+def _date(day):
+    return datetime.date(2020, 3, day)
+
+
+class TestCoverageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_mark_missing_save_round_trip(self):
+        index = CoverageIndex.open(self.tmpdir.name, [101, 102])
+        self.assertEqual(index.missing([101], _date(2), _date(4)), {101: [_date(2), _date(3)]})
+        index.mark(101, [_date(3), _date(5)])
+        # Days before the first day marked so far
+        index.mark(102, [_date(1)])
+        index.save()
+
+        index = CoverageIndex.open(self.tmpdir.name, [101, 102])
+        self.assertTrue(index.is_covered(101, _date(5)))
+        self.assertFalse(index.is_covered(101, _date(4)))
+        self.assertEqual(index.missing([101, 102, 103], _date(1), _date(6)),
+                         {101: [_date(1), _date(2), _date(4)],
+                          102: [_date(2), _date(3), _date(4), _date(5)],
+                          103: [_date(1), _date(2), _date(3), _date(4), _date(5)]})
+        self.assertEqual(index.missing([101], _date(5), _date(5)), {})
+
+    def test_recent_absent_days_stay_uncovered(self):
+        index = CoverageIndex(os.path.join(self.tmpdir.name, CoverageIndex.filename))
+        today = _date(20)
+        index.mark_absent(101, [_date(day) for day in range(10, 16)], today=today)
+        self.assertEqual(index.missing([101], _date(10), _date(16)), {101: [_date(13), _date(14), _date(15)]})
+        # Once older than the grace period
+        index.mark_absent(101, [_date(13), _date(14), _date(15)], today=_date(22))
+        self.assertEqual(index.missing([101], _date(10), _date(16)), {101: [_date(15)]})
+
+    def test_bootstrap_from_the_raw_datafiles(self):
+        raw_data_files = write_test_raw_data(self.tmpdir.name, _date(2), _date(5), days_per_file=2)
+        tms_nums = get_test_tms_nums()
+        index = CoverageIndex.open(self.tmpdir.name, tms_nums)
+        # Also the station without data, which was not available
+        self.assertEqual(index.missing(tms_nums, _date(2), _date(5)), {})
+        self.assertEqual(index.missing(tms_nums[:1], _date(1), _date(2)), {tms_nums[0]: [_date(1)]})
+
+        # A day of a station removed from the first raw datafile
+        path = raw_data_files[0][0]
+        df = pd.read_hdf(path, key=f'tms_{tms_nums[0]}')
+        df.loc[df['time'].dt.date != _date(3)].to_hdf(path, key=f'tms_{tms_nums[0]}', format='fixed')
+        self.assertEqual(CoverageIndex.open(self.tmpdir.name, tms_nums).missing(tms_nums, _date(2), _date(5)),
+                         {tms_nums[0]: [_date(3)]})
+
+
+class TestFetchMissingRawData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        self.server = start_mock_server(MockServerConfig(vehicles_per_day=100, num_stations=4))
+        self.environ = mock.patch.dict(os.environ, {_raw_data_url_env: self.server.raw_data_url,
+                                                    metadata._tms_stations_url_env: self.server.stations_url,
+                                                    metadata._metadata_dir_env: self.tmpdir.name})
+        self.environ.start()
+        metadata.clear_tms_stations_memo()
+        self.raw_data_dir = os.path.join(self.tmpdir.name, 'raw_data')
+        fetch_module.fetch_raw_data(_date(2), _date(4), False, self.raw_data_dir)
+        fetch_module.fetch_raw_data(_date(4), _date(5), False, self.raw_data_dir)
+        self.raw_data_files = list_rawdata_files(self.raw_data_dir)
+        self.tms_nums = metadata.get_tms_stations()['num'].tolist()
+
+    def tearDown(self):
+        metadata.clear_tms_stations_memo()
+        self.environ.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def _fetch_missing(self, raw_data_files):
+        with mock.patch.object(fetch_module, 'get_tms_raw_data', wraps=fetch_module.get_tms_raw_data) as get:
+            stored_dates = fetch_module.fetch_missing_raw_data(raw_data_files, self.raw_data_dir)
+        return stored_dates, [call.args[1:4] for call in get.call_args_list]
+
+    def test_missing_days_are_fetched(self):
+        path = self.raw_data_files[0][0]
+        num = self.tms_nums[0]
+        expected = pd.read_hdf(path, key=f'tms_{num}')
+        expected.loc[expected['time'].dt.date != _date(3)].to_hdf(path, key=f'tms_{num}', format='fixed')
+        index = CoverageIndex.open(self.raw_data_dir, self.tms_nums)
+        index.bits[index.stations.index(num), _date(3).toordinal() - index.first_day] = False
+        index.save()
+
+        stored_dates, fetched = self._fetch_missing(self.raw_data_files)
+        self.assertEqual(stored_dates, [_date(3)])
+        self.assertEqual(fetched, [(num, _date(3), _date(4))])
+        pd.testing.assert_frame_equal(pd.read_hdf(path, key=f'tms_{num}').reset_index(drop=True),
+                                      expected.reset_index(drop=True))
+        self.assertEqual(CoverageIndex.open(self.raw_data_dir, self.tms_nums).missing(self.tms_nums, _date(2),
+                                                                                       _date(5)), {})
+
+    def test_late_datafile_is_fetched(self):
+        # The files of a station are not published yet on the recent days
+        num = self.tms_nums[0]
+        end_date = datetime.date.today()
+        begin_date = end_date - datetime.timedelta(days=3)
+        self.server.config.not_found_patterns = [re.compile(f'lamraw_{num}_')]
+        fetch_module.fetch_raw_data(begin_date, end_date, False, self.raw_data_dir)
+        path = fetch_module.get_raw_data_file_path(self.raw_data_dir, begin_date, end_date)
+        with pd.HDFStore(path, mode='r') as store:
+            self.assertNotIn(f'/tms_{num}', store.keys())
+        recent_dates = [begin_date + datetime.timedelta(days=n) for n in range(3)]
+        self.assertEqual(CoverageIndex.open(self.raw_data_dir, self.tms_nums).missing(self.tms_nums, begin_date,
+                                                                                       end_date),
+                         {num: recent_dates})
+
+        # Still missing
+        raw_data_files = [(path, begin_date, end_date)]
+        stored_dates, fetched = self._fetch_missing(raw_data_files)
+        self.assertEqual((stored_dates, fetched), ([], [(num, begin_date, end_date)]))
+
+        # Published late
+        self.server.config.not_found_patterns = []
+        stored_dates, fetched = self._fetch_missing(raw_data_files)
+        self.assertEqual((stored_dates, fetched), (recent_dates, [(num, begin_date, end_date)]))
+        self.assertEqual(sorted(pd.read_hdf(path, key=f'tms_{num}')['time'].dt.date.unique()), recent_dates)
+        self.assertEqual(CoverageIndex.open(self.raw_data_dir, self.tms_nums).missing(self.tms_nums, begin_date,
+                                                                                       end_date), {})
+
+    def test_old_absent_days_are_not_fetched_again(self):
+        num = self.tms_nums[0]
+        self.server.config.not_found_patterns = [re.compile(f'lamraw_{num}_')]
+        fetch_module.fetch_raw_data(_date(5), _date(7), False, self.raw_data_dir)
+        raw_data_files = [(fetch_module.get_raw_data_file_path(self.raw_data_dir, _date(5), _date(7)), _date(5),
+                           _date(7))]
+        self.server.config.not_found_patterns = []
+        self.assertEqual(self._fetch_missing(raw_data_files), ([], []))
+
+    def test_index_is_built_from_all_the_raw_datafiles(self):
+        # Raw datafiles written before the index existed, filled only in part
+        os.remove(os.path.join(self.raw_data_dir, CoverageIndex.filename))
+        stored_dates, fetched = self._fetch_missing(self.raw_data_files[1:])
+        self.assertEqual((stored_dates, fetched), ([], []))
+        self.assertEqual(CoverageIndex.open(self.raw_data_dir, self.tms_nums).missing(self.tms_nums, _date(2),
+                                                                                       _date(5)), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,295 @@
+import os
+import bz2
+import json
+import contextlib
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.aggregation import _statistics_columns
+from fin_traffic_data.scripts import export_area_data_as_csv as export
+from fin_traffic_data.scripts.get_aggregated_traffic_between_areas import set_edge_generations
+
+_edges = ['Uusimaa:Pirkanmaa', 'Pirkanmaa:Uusimaa', 'Uusimaa:Varsinais-Suomi']
+
+
+def _edge_frame(num_times, seed, first_row=0):
+    """Rows of an edge of an area aggregated file for num_times hours from 2020-03-02."""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2020-03-02', periods=num_times, freq='1h')
+    nrows = num_times * 7
+    return pd.DataFrame({
+        'time': np.repeat(times.to_numpy(), 7),
+        'vehicle category': np.tile(np.arange(1, 8), num_times),
+        'counts': rng.integers(0, 100, nrows).astype(np.float64),
+    }, index=pd.RangeIndex(first_row, first_row + nrows))
+
+
+def _write_area_file(path, num_times, generations=None):
+    for i, key in enumerate(_edges):
+        _edge_frame(num_times, seed=i).to_hdf(path, key=key, complevel=9, format='table')
+    set_edge_generations(path, generations or dict((key, f'generation-{key}') for key in _edges))
+
+
+def _extend_area_file(path, num_times, extra_times):
+    """Extends every edge like --append-to: the last timestamp is computed again and new rows are appended."""
+    with pd.HDFStore(path, mode='a') as store:
+        for i, key in enumerate(_edges):
+            nrows = store.get_storer(key).nrows
+            store.remove(key, start=nrows - 7, stop=nrows)
+            df = _edge_frame(num_times + extra_times, seed=i).iloc[(num_times - 1) * 7:]
+            store.append(key, df, format='table')
+
+
+def _read_members(archive_path):
+    with tarfile.open(archive_path, 'r:bz2') as tfile:
+        return dict((member.name, tfile.extractfile(member).read()) for member in tfile.getmembers())
+
+
+def _read_index(archive_path):
+    with open(archive_path + '.index.json', 'r') as f:
+        return dict((member['key'], member) for member in json.load(f)['members'])
+
+
+def _read_archive(archive_path, codec):
+    """Names and contents of the members of an archive, read with tarfile."""
+    with contextlib.ExitStack() as stack:
+        if codec == 'zst':
+            import zstandard
+            f = stack.enter_context(open(archive_path, 'rb'))
+            stream = stack.enter_context(zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True))
+            tfile = stack.enter_context(tarfile.open(fileobj=stream, mode='r|'))
+        else:
+            tfile = stack.enter_context(tarfile.open(archive_path, f'r:{codec}'))
+        return [(member.name, tfile.extractfile(member).read()) for member in tfile]
+
+
+def _expected_members(area_path):
+    """The members of the archive as written by the original exporter: the whole frame of each edge as CSV."""
+    input_file = os.path.basename(area_path).split('.')[0]
+    with pd.HDFStore(area_path, mode='r') as store:
+        return [(f"{input_file}/{key.lstrip('/')}.csv", store.select(key).to_csv().encode('utf-8'))
+                for key in store.keys()]
+
+
+class TestIncrementalExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        self.area_path = os.path.join(self.tmpdir.name, 'tms_between_provinces_input_old.h5')
+        _write_area_file(self.area_path, num_times=30)
+        self.archive_path = export.export_area_data_as_csv(self.area_path, workers=2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _export_member(self, path, key, cached_member):
+        with pd.HDFStore(path, mode='r') as store:
+            return export._export_member(store, key, 'bz2', self.tmpdir.name, cached_member)
+
+    def _fresh_export(self, path):
+        """Exports a copy of the area file without an earlier archive."""
+        fresh_dir = os.path.join(self.tmpdir.name, 'fresh')
+        os.makedirs(fresh_dir, exist_ok=True)
+        fresh_path = os.path.join(fresh_dir, os.path.basename(path))
+        shutil.copyfile(path, fresh_path)
+        return export.export_area_data_as_csv(fresh_path, workers=2)
+
+    def test_unchanged_member_is_reused(self):
+        index = _read_index(self.archive_path)
+        member = self._export_member(self.area_path, '/' + _edges[0], index['/' + _edges[0]])
+        self.assertIsNone(member['path'])
+        with open(self.archive_path, 'rb') as f:
+            archive = f.read()
+        export.export_area_data_as_csv(self.area_path, workers=2)
+        with open(self.archive_path, 'rb') as f:
+            self.assertEqual(f.read(), archive)
+
+    def test_extended_edge_is_appended(self):
+        index = _read_index(self.archive_path)
+        new_path = os.path.join(self.tmpdir.name, 'tms_between_provinces_input_new.h5')
+        shutil.copyfile(self.area_path, new_path)
+        _extend_area_file(new_path, num_times=30, extra_times=5)
+
+        member = self._export_member(new_path, '/' + _edges[0], index['/' + _edges[0]])
+        self.assertTrue(member['appended'])
+        self.assertEqual(member['nrows'], 35 * 7)
+        # Only the new rows are formatted
+        self.assertEqual(member['size'], len(_edge_frame(35, seed=0).iloc[30 * 7:].to_csv(header=False)))
+        os.remove(member['path'])
+
+        new_archive = export.export_area_data_as_csv(new_path, workers=2, reuse_from=self.archive_path)
+        # The compressed data of the earlier archive is copied
+        with open(self.archive_path, 'rb') as f:
+            old_archive = f.read()
+        with open(new_archive, 'rb') as f:
+            new_archive_bytes = f.read()
+        old_member = index['/' + _edges[0]]
+        new_member = _read_index(new_archive)['/' + _edges[0]]
+        self.assertEqual(new_archive_bytes[new_member['offset']:new_member['offset'] + old_member['length']],
+                         old_archive[old_member['offset']:old_member['offset'] + old_member['length']])
+        self.assertEqual(_read_members(new_archive), _read_members(self._fresh_export(new_path)))
+
+    def test_changed_rows_are_exported_again(self):
+        index = _read_index(self.archive_path)
+        new_path = os.path.join(self.tmpdir.name, 'tms_between_provinces_input_new.h5')
+        shutil.copyfile(self.area_path, new_path)
+        _extend_area_file(new_path, num_times=30, extra_times=5)
+        with pd.HDFStore(new_path, mode='a') as store:
+            # The last bucket of the earlier export computed again with other counts
+            df = store.select(_edges[0])
+            df.loc[df.index[30 * 7 - 3], 'counts'] += 1
+            store.put(_edges[0], df, format='table')
+        set_edge_generations(new_path, {_edges[0]: f'generation-{_edges[0]}'})
+
+        member = self._export_member(new_path, '/' + _edges[0], index['/' + _edges[0]])
+        self.assertFalse(member['appended'])
+        os.remove(member['path'])
+
+    def test_new_generation_is_exported_again(self):
+        index = _read_index(self.archive_path)
+        new_path = os.path.join(self.tmpdir.name, 'tms_between_provinces_input_new.h5')
+        _write_area_file(new_path, num_times=35, generations=dict((key, f'new-{key}') for key in _edges))
+
+        member = self._export_member(new_path, '/' + _edges[0], index['/' + _edges[0]])
+        self.assertFalse(member['appended'])
+        self.assertEqual(member['size'], len(_edge_frame(35, seed=0).to_csv()))
+        os.remove(member['path'])
+
+        new_archive = export.export_area_data_as_csv(new_path, workers=2, reuse_from=self.archive_path)
+        self.assertEqual(_read_members(new_archive), _read_members(self._fresh_export(new_path)))
+
+    def test_round_trip_is_byte_identical(self):
+        new_path = os.path.join(self.tmpdir.name, 'tms_between_provinces_input_new.h5')
+        shutil.copyfile(self.area_path, new_path)
+        _extend_area_file(new_path, num_times=30, extra_times=5)
+        new_archive = export.export_area_data_as_csv(new_path, workers=2, reuse_from=self.archive_path)
+
+        # The tar stream of the appended archive is that of a fresh export
+        with open(new_archive, 'rb') as f:
+            appended = bz2.decompress(f.read())
+        with open(self._fresh_export(new_path), 'rb') as f:
+            fresh = bz2.decompress(f.read())
+        self.assertEqual(appended, fresh)
+        members = _read_members(new_archive)
+        for i, key in enumerate(_edges):
+            with self.subTest(key=key):
+                self.assertEqual(members[f'tms_between_provinces_input_new/{key}.csv'],
+                                 _edge_frame(35, seed=i).to_csv().encode('utf-8'))
+
+
+class TestCodecs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_archives_are_readable_with_tarfile(self):
+        for codec in export._codecs:
+            with self.subTest(codec=codec):
+                try:
+                    export._get_compressor(codec)
+                except RuntimeError:
+                    self.skipTest(f"The codec '{codec}' is not available")
+                codec_dir = os.path.join(self.tmpdir.name, codec)
+                os.makedirs(codec_dir)
+                old_path = os.path.join(codec_dir, 'tms_between_provinces_old.h5')
+                _write_area_file(old_path, num_times=30)
+                old_archive = export.export_area_data_as_csv(old_path, codec=codec, workers=2)
+                self.assertTrue(old_archive.endswith(f'.tar.{codec}'))
+                self.assertEqual(_read_archive(old_archive, codec), _expected_members(old_path))
+
+                # With rows appended to the members as another compressed stream
+                new_path = os.path.join(codec_dir, 'tms_between_provinces_new.h5')
+                shutil.copyfile(old_path, new_path)
+                _extend_area_file(new_path, num_times=30, extra_times=5)
+                new_archive = export.export_area_data_as_csv(new_path, codec=codec, workers=1,
+                                                             reuse_from=old_archive)
+                self.assertTrue(all(member['nrows'] == 35 * 7 for member in _read_index(new_archive).values()))
+                self.assertEqual(_read_archive(new_archive, codec), _expected_members(new_path))
+
+    def test_unknown_codec(self):
+        path = os.path.join(self.tmpdir.name, 'tms_between_provinces.h5')
+        _write_area_file(path, num_times=2)
+        with self.assertRaises(ValueError):
+            export.export_area_data_as_csv(path, codec='lz4')
+
+
+def _edge_frame_with_statistics(num_times, seed):
+    """Rows of an edge of an area aggregated file with the statistics of the vehicles."""
+    df = _edge_frame(num_times, seed)
+    rng = np.random.default_rng(seed)
+    for column in _statistics_columns:
+        if column in ['speed_sum', 'speed_sum_sq']:
+            df[column] = rng.uniform(0.0, 1e4, df.shape[0])
+        else:
+            df[column] = rng.integers(0, 100, df.shape[0]).astype(np.int64)
+    return df
+
+
+class TestColumnarExport(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow is not available')
+        self.pa = pyarrow
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        self.area_path = os.path.join(self.tmpdir.name, 'tms_between_provinces.h5')
+        for i, key in enumerate(_edges):
+            _edge_frame_with_statistics(30, seed=i).to_hdf(self.area_path, key=key, complevel=9, format='table')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _read_table(self, output_format):
+        path = export.export_area_data_as_columnar(self.area_path, output_format)
+        self.assertTrue(path.endswith(export._columnar_formats[output_format]))
+        self.assertFalse(os.path.exists(path + '.partial'))
+        if output_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(path)
+        with self.pa.ipc.open_file(path) as reader:
+            return reader.read_all()
+
+    def test_schema_and_rows(self):
+        pa = self.pa
+        for output_format in export._columnar_formats:
+            with self.subTest(format=output_format):
+                table = self._read_table(output_format)
+                schema = table.schema
+                for column in ['source', 'destination']:
+                    field_type = schema.field(column).type
+                    self.assertTrue(pa.types.is_dictionary(field_type))
+                    self.assertEqual(field_type.value_type, pa.string())
+                    # Parquet reads the dictionary indices back as int32
+                    if output_format == 'arrow':
+                        self.assertEqual(field_type.index_type, pa.int16())
+                # Parquet has no timestamps in seconds, they are stored in milliseconds
+                self.assertEqual(schema.field('time').type, pa.timestamp('s' if output_format == 'arrow' else 'ms'))
+                self.assertEqual(schema.field('vehicle category').type, pa.int8())
+                self.assertEqual(schema.field('counts').type, pa.int32())
+                for column in _statistics_columns:
+                    self.assertEqual(schema.field(column).type,
+                                     pa.float64() if column in ['speed_sum', 'speed_sum_sq'] else pa.int32())
+
+                df = table.to_pandas()
+                for i, key in enumerate(_edges):
+                    source, destination = key.split(':')
+                    rows = df.loc[(df['source'] == source) & (df['destination'] == destination)]
+                    expected = _edge_frame_with_statistics(30, seed=i)
+                    np.testing.assert_array_equal(rows['time'].to_numpy().astype('datetime64[ns]'),
+                                                  expected['time'].to_numpy())
+                    for column in expected.columns.drop('time'):
+                        np.testing.assert_array_equal(rows[column].to_numpy(), expected[column].to_numpy())
+
+
+if __name__ == '__main__':
+    unittest.main()
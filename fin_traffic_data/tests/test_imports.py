@@ -0,0 +1,20 @@
+import unittest
+
+from fin_traffic_data.benchmarks import get_script_modules, measure_import_time
+
+# Seconds a console script may take to import, generous for slow machines
+_import_time_budget = 3.0
+
+
+class TestScriptImports(unittest.TestCase):
+
+    def test_scripts_import_heavy_dependencies_lazily(self):
+        for module in get_script_modules():
+            with self.subTest(module=module):
+                result = measure_import_time(module)
+                self.assertEqual(result['lazy_dependencies'], [])
+                self.assertLess(result['seconds'], _import_time_budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import time
+import types
+import datetime
+import unittest
+from unittest import mock
+
+import numpy as np
+import requests
+
+from fin_traffic_data import mock_server
+from fin_traffic_data.intraday import IntradayAggregate, RawDataTail, poll_intraday_data
+from fin_traffic_data.mock_server import MockServerConfig, start_mock_server
+from fin_traffic_data.raw_data import parse_tms_raw_data
+
+_date = datetime.date(2020, 3, 2)
+_delta_t = datetime.timedelta(minutes=15)
+_tms_nums = [101, 102]
+
+
+class _Session:
+
+    """HTTP session whose next response can be cut short or requested without the Range header."""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.status_codes = []
+        self.truncate = None
+        self.ignore_range = False
+
+    def get(self, url, headers):
+        if self.ignore_range:
+            headers = dict((name, value) for name, value in headers.items()
+                           if name not in ('Range', 'If-None-Match'))
+        resp = self.session.get(url, headers=headers)
+        self.status_codes.append(resp.status_code)
+        if self.truncate is not None and resp.content:
+            # As if the server sent a row still being written
+            resp._content = resp.content[:-self.truncate]
+        return resp
+
+
+class TestRawDataTail(unittest.TestCase):
+
+    def setUp(self):
+        # The datafiles grow with the time of the server, which the test advances
+        self.clock = float(int(time.time()))
+        clock = types.SimpleNamespace(time=lambda: self.clock, sleep=time.sleep, monotonic=time.monotonic)
+        self.time_patch = mock.patch.object(mock_server, 'time', clock)
+        self.time_patch.start()
+        self.server = start_mock_server(MockServerConfig(rows_per_second=2.0))
+        self.session = _Session()
+        self.tails = [RawDataTail(1, tms_num, _date, base_url=self.server.raw_data_url) for tms_num in _tms_nums]
+        self.aggregate = IntradayAggregate(_date, _delta_t)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.session.session.close()
+        self.time_patch.stop()
+
+    def _poll(self, seconds):
+        self.clock += seconds
+        del self.session.status_codes[:]
+        return poll_intraday_data(self.tails, self.aggregate, self.session)
+
+    def _assert_counts_equal_the_full_datafiles(self):
+        for tail in self.tails:
+            with self.subTest(tms=tail.tms_id):
+                expected = IntradayAggregate(_date, _delta_t)
+                expected.add(tail.tms_id, parse_tms_raw_data(requests.get(tail.url).content.decode('latin-1')))
+                np.testing.assert_array_equal(self.aggregate.counts[tail.tms_id], expected.counts[tail.tms_id])
+
+    def test_polls_equal_the_full_datafiles(self):
+        # Empty datafiles
+        self.assertEqual(self._poll(0.0), {})
+        self.assertEqual(self._poll(10.0), {101: 20, 102: 20})
+        self.assertEqual(self.session.status_codes, [200, 200])
+        # Unchanged
+        self.assertEqual(self._poll(0.1), {})
+        self.assertEqual(self.session.status_codes, [304, 304])
+
+        # The last row of the responses is incomplete, and completed by the next poll
+        self.session.truncate = 10
+        self.assertEqual(self._poll(5.0), {101: 9, 102: 9})
+        self.session.truncate = None
+        self.assertEqual(self._poll(5.0), {101: 11, 102: 11})
+        self.assertEqual(self.session.status_codes, [206, 206])
+        self._assert_counts_equal_the_full_datafiles()
+
+        # A server ignoring the Range header
+        self.session.ignore_range = True
+        self.assertEqual(self._poll(2.5), {101: 5, 102: 5})
+        self.assertEqual(self.session.status_codes, [200, 200])
+        self.session.ignore_range = False
+        self._assert_counts_equal_the_full_datafiles()
+
+        # The datafiles replaced by shorter ones are read again from the beginning
+        self.server.started = self.clock - 4.2
+        self.assertEqual(self._poll(0.0), {101: 8, 102: 8})
+        self.assertEqual(self.session.status_codes, [416, 200, 416, 200])
+        self.assertTrue(all(tail.restarted for tail in self.tails))
+        self.assertEqual(self._poll(3.0), {101: 6, 102: 6})
+        self._assert_counts_equal_the_full_datafiles()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import datetime
+import unittest
+
+from fin_traffic_data.loadtest import run_load_test
+from fin_traffic_data.mock_server import MockServerConfig
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_server_errors_are_retried(self):
+        config = MockServerConfig(vehicles_per_day=100, num_stations=4, error_rate=0.2, seed=1)
+        result = run_load_test(config, datetime.date(2020, 3, 2), datetime.date(2020, 3, 4), retry_delay=0.0)
+        injected_errors = result['server']['injected']['errors']
+        self.assertGreater(injected_errors, 0)
+        # Every server error is retried until the day is fetched
+        self.assertEqual(result['retries'], injected_errors)
+        self.assertEqual(result['http_status_codes'].get('500', 0) + result['http_status_codes'].get('503', 0),
+                         injected_errors)
+        self.assertEqual(result['station_days'], 4 * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
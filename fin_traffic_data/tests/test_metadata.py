@@ -0,0 +1,112 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from fin_traffic_data import metadata
+
+
+def _fixture_tms_stations(tms_nums=(101, 102, 103)):
+    """Station metadata as returned by get_tms_stations."""
+    tms_nums = list(tms_nums)
+    return pd.DataFrame({
+            'id': [20000 + num for num in tms_nums],
+            'num': tms_nums,
+            'latitude': [24.9 + 0.1 * i for i in range(len(tms_nums))],
+            'longitude': [60.2 + 0.1 * i for i in range(len(tms_nums))],
+            'municipality': [91] * len(tms_nums),
+            'province': [1] * len(tms_nums),
+            'dir1': [49] * len(tms_nums),
+            'dir2': [92] * len(tms_nums),
+        },
+        index=tms_nums)
+
+
+class TestTmsStationsSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        # No server listens on the discard port, so a download fails at once
+        environ = {metadata._metadata_dir_env: self.tmpdir.name,
+                   metadata._tms_stations_url_env: 'http://127.0.0.1:9/tms-stations'}
+        self.environ = mock.patch.dict(os.environ, environ)
+        self.environ.start()
+        for name in [metadata._metadata_ttl_env, metadata._offline_env]:
+            os.environ.pop(name, None)
+        metadata.clear_tms_stations_memo()
+        self.fixture = _fixture_tms_stations()
+
+    def tearDown(self):
+        metadata.clear_tms_stations_memo()
+        self.environ.stop()
+        self.tmpdir.cleanup()
+
+    def test_snapshot_round_trip(self):
+        path = metadata.write_tms_stations_snapshot(self.fixture, fetched=123.0)
+        self.assertEqual(path, metadata.get_tms_stations_snapshot_path())
+        df, fetched = metadata.read_tms_stations_snapshot()
+        pd.testing.assert_frame_equal(df, self.fixture)
+        self.assertEqual(fetched, 123.0)
+
+    def test_fresh_snapshot_is_not_downloaded_again(self):
+        metadata.write_tms_stations_snapshot(self.fixture)
+        with mock.patch.object(metadata, '_download_tms_stations') as download:
+            pd.testing.assert_frame_equal(metadata.get_tms_stations(), self.fixture)
+        download.assert_not_called()
+
+    def test_offline_uses_an_old_snapshot(self):
+        metadata.write_tms_stations_snapshot(self.fixture, fetched=0.0)
+        with mock.patch.dict(os.environ, {metadata._offline_env: '1'}), \
+                mock.patch.object(metadata, '_download_tms_stations') as download:
+            pd.testing.assert_frame_equal(metadata.get_tms_stations(), self.fixture)
+        download.assert_not_called()
+
+    def test_offline_without_a_snapshot_fails(self):
+        with mock.patch.dict(os.environ, {metadata._offline_env: '1'}):
+            with self.assertRaises(RuntimeError):
+                metadata.get_tms_stations()
+
+    def test_old_snapshot_is_used_when_the_download_fails(self):
+        metadata.write_tms_stations_snapshot(self.fixture, fetched=0.0)
+        pd.testing.assert_frame_equal(metadata.get_tms_stations(), self.fixture)
+
+    def test_old_snapshot_is_replaced_by_a_download(self):
+        metadata.write_tms_stations_snapshot(self.fixture, fetched=0.0)
+        downloaded = _fixture_tms_stations([101, 102, 103, 104])
+        with mock.patch.object(metadata, '_download_tms_stations', return_value=downloaded):
+            pd.testing.assert_frame_equal(metadata.get_tms_stations(), downloaded)
+        df, fetched = metadata.read_tms_stations_snapshot()
+        pd.testing.assert_frame_equal(df, downloaded)
+        self.assertGreater(fetched, time.time() - 60)
+
+    def test_snapshot_of_another_source_is_ignored(self):
+        metadata.write_tms_stations_snapshot(self.fixture)
+        with mock.patch.dict(os.environ, {metadata._tms_stations_url_env: 'http://127.0.0.1:9/other'}):
+            self.assertIsNone(metadata.read_tms_stations_snapshot())
+
+    def test_memo_is_used_until_cleared(self):
+        metadata.write_tms_stations_snapshot(self.fixture)
+        metadata.get_tms_stations()
+        with mock.patch.object(metadata, 'read_tms_stations_snapshot') as read:
+            pd.testing.assert_frame_equal(metadata.get_tms_stations(), self.fixture)
+            read.assert_not_called()
+            metadata.clear_tms_stations_memo()
+            read.return_value = None
+            with mock.patch.object(metadata, '_download_tms_stations', return_value=self.fixture) as download:
+                metadata.get_tms_stations()
+            read.assert_called_once()
+            download.assert_called_once()
+
+    def test_pinned_stations(self):
+        pinned = _fixture_tms_stations([201])
+        with mock.patch.object(metadata, '_download_tms_stations') as download:
+            with metadata.pinned_tms_stations(pinned):
+                pd.testing.assert_frame_equal(metadata.get_tms_stations(), pinned)
+        download.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+import threading
+import subprocess
+
+from fin_traffic_data import metrics as metrics_module
+from fin_traffic_data.metrics import Metrics
+
+
+def _record_run():
+    """Metrics of a run of two stages, the stations timed over two date intervals."""
+    metrics = Metrics()
+    metrics.count('rows_parsed', 5)
+    with metrics.stage('fetch'):
+        for latency, status_code in [(0.01, 200), (0.3, 200), (3.0, 404), (60.0, 200)]:
+            metrics.observe_http_request(latency, status_code, nbytes=100)
+        metrics.count('http_retries')
+        for _ in range(2):
+            metrics.observe_station(101, 1.5)
+            metrics.observe_station(102, 0.5)
+        with metrics.stage('aggregate'):
+            metrics.count('rows_parsed', 1000)
+            metrics.count('rows_dropped', 3)
+            metrics.observe_station(101, 2.0, step='aggregate')
+        metrics.count('bytes_written', 4096)
+    return metrics
+
+
+def _parse_prometheus(text):
+    """Samples of the Prometheus text format as a dict from the series to the value."""
+    samples = {}
+    types = []
+    for line in text.splitlines():
+        if line.startswith('# TYPE'):
+            types.append(line.split()[2])
+        elif not line.startswith('#'):
+            series, value = line.rsplit(' ', 1)
+            if series in samples:
+                raise AssertionError(f'Duplicate series {series}')
+            samples[series] = float(value)
+    if len(set(types)) != len(types):
+        raise AssertionError('Duplicate metric')
+    return samples
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_counters_of_the_stages(self):
+        metrics = _record_run()
+        self.assertEqual([s.name for s in metrics.stages], ['other', 'fetch', 'aggregate'])
+        other, fetch, aggregate = metrics.stages
+        self.assertEqual(other.counters['rows_parsed'], 5)
+        # The counters go to the innermost active stage
+        self.assertEqual(fetch.counters, {'bytes_downloaded': 400, 'http_requests': 4, 'http_retries': 1,
+                                          'rows_parsed': 0, 'rows_dropped': 0, 'bytes_written': 4096})
+        self.assertEqual(aggregate.counters['rows_parsed'], 1000)
+        self.assertEqual(aggregate.counters['rows_dropped'], 3)
+        self.assertEqual(fetch.http_status_codes, {200: 3, 404: 1})
+        self.assertEqual(fetch.latency_bucket_counts, [1, 0, 0, 1, 0, 0, 1, 0, 0, 1])
+        self.assertAlmostEqual(fetch.latency_sum, 63.31)
+        self.assertEqual(aggregate.station_timings, [(101, 'aggregate', 2.0)])
+        for stage in [fetch, aggregate]:
+            self.assertGreaterEqual(stage.wall_time, 0.0)
+            self.assertGreater(stage.peak_rss, 0)
+        self.assertGreaterEqual(fetch.wall_time, aggregate.wall_time)
+
+        # Counted after the stages
+        metrics.count('http_retries')
+        self.assertEqual([s.name for s in metrics.stages], ['other', 'fetch', 'aggregate', 'other'])
+
+    @unittest.skipIf(metrics_module.resource is None, 'No resource module')
+    def test_children_peak_rss_over_the_lifetime(self):
+        metrics = Metrics()
+        with metrics.stage('aggregate') as aggregate:
+            subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        with metrics.stage('export') as export:
+            pass
+        self.assertGreater(aggregate.children_peak_rss, 0)
+        # Not reset for the stages without worker processes
+        self.assertEqual(export.children_peak_rss, aggregate.children_peak_rss)
+
+    def test_concurrent_counts(self):
+        metrics = Metrics()
+
+        def fetch():
+            for _ in range(1000):
+                metrics.count('http_requests')
+
+        with metrics.stage('fetch') as stage:
+            threads = [threading.Thread(target=fetch) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(stage.counters['http_requests'], 4000)
+
+    def test_prometheus_series_are_unique(self):
+        path = os.path.join(self.tmpdir.name, 'metrics.prom')
+        _record_run().write_prometheus(path)
+        with open(path, 'r') as f:
+            samples = _parse_prometheus(f.read())
+        self.assertFalse(os.path.exists(path + '.partial'))
+
+        # The timings of a station over the date intervals are summed
+        self.assertEqual(samples['fin_traffic_station_seconds{stage="fetch",step="fetch",tms="101"}'], 3.0)
+        self.assertEqual(samples['fin_traffic_station_seconds{stage="fetch",step="fetch",tms="102"}'], 1.0)
+        self.assertEqual(samples['fin_traffic_station_seconds{stage="aggregate",step="aggregate",tms="101"}'], 2.0)
+        self.assertEqual(samples['fin_traffic_stage_rows_parsed{stage="aggregate"}'], 1000)
+        self.assertEqual(samples['fin_traffic_stage_http_responses{stage="fetch",code="404"}'], 1)
+        # A single series over the lifetime of the process
+        self.assertIn('fin_traffic_children_peak_rss_bytes{}', samples)
+
+        # The histogram buckets are cumulative
+        buckets = [samples[f'fin_traffic_http_request_duration_seconds_bucket{{stage="fetch",le="{le}"}}']
+                   for le in ['0.05', '0.1', '0.25', '0.5', '1.0', '2.5', '5.0', '10.0', '30.0', '+Inf']]
+        self.assertEqual(buckets, [1, 1, 1, 2, 2, 2, 3, 3, 3, 4])
+        self.assertEqual(samples['fin_traffic_http_request_duration_seconds_count{stage="fetch"}'], 4)
+
+    def test_json_lines(self):
+        path = os.path.join(self.tmpdir.name, 'metrics.jsonl')
+        _record_run().write_json_lines(path)
+        _record_run().write_json_lines(path)
+        with open(path, 'r') as f:
+            records = [json.loads(line) for line in f]
+        # Three stages and five station timings of each run
+        self.assertEqual(len(records), 16)
+        self.assertEqual(len(set(record['run'] for record in records)), 2)
+        stages = [record for record in records[:8] if record['type'] == 'stage']
+        self.assertEqual([record['stage'] for record in stages], ['other', 'fetch', 'aggregate'])
+        self.assertEqual(stages[1]['counters']['bytes_downloaded'], 400)
+        self.assertEqual(stages[1]['http_status_codes'], {'200': 3, '404': 1})
+        self.assertEqual(stages[1]['http_latency']['counts'], [1, 0, 0, 1, 0, 0, 1, 0, 0, 1])
+        stations = [(record['stage'], record['step'], record['tms'], record['seconds'])
+                    for record in records[:8] if record['type'] == 'station']
+        self.assertEqual(stations, [('fetch', 'fetch', 101, 1.5), ('fetch', 'fetch', 102, 0.5),
+                                    ('fetch', 'fetch', 101, 1.5), ('fetch', 'fetch', 102, 0.5),
+                                    ('aggregate', 'aggregate', 101, 2.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import os
+import glob
+import logging
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+from fin_traffic_data import coverage, metadata, pipeline
+from fin_traffic_data.mock_server import MockServerConfig, start_mock_server
+from fin_traffic_data.raw_data import _raw_data_url_env
+from fin_traffic_data.scripts import schedule_complete_pipeline
+from fin_traffic_data.scripts.complete_pipeline import fetch_tms_data_aggregate
+from fin_traffic_data.tests.helpers import assert_datafiles_equal
+
+
+class TestPipelined(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        cls.server = start_mock_server(MockServerConfig(vehicles_per_day=100))
+        cls.environ = mock.patch.dict(os.environ, {_raw_data_url_env: cls.server.raw_data_url,
+                                                   metadata._tms_stations_url_env: cls.server.stations_url,
+                                                   metadata._metadata_dir_env: cls.tmpdir.name})
+        cls.environ.start()
+        metadata.clear_tms_stations_memo()
+
+    @classmethod
+    def tearDownClass(cls):
+        metadata.clear_tms_stations_memo()
+        cls.environ.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.tmpdir.cleanup()
+
+    def _run(self, name, pipelined, end_date=datetime.date(2020, 3, 4)):
+        workdir = os.path.join(self.tmpdir.name, name)
+        os.makedirs(workdir, exist_ok=True)
+        fetch_tms_data_aggregate(logger=logging.getLogger(__name__),
+                                 begin_date=datetime.date(2020, 3, 2),
+                                 end_date=end_date,
+                                 progressbar_bool=False,
+                                 results_dir_fetch=os.path.join(workdir, 'raw_data'),
+                                 time_resolution=datetime.timedelta(hours=7),
+                                 results_dir_aggregate=os.path.join(workdir, 'aggregated_data_time'),
+                                 aggregation_level='province',
+                                 visualize_bool=False,
+                                 results_dir_traffic=os.path.join(workdir, 'aggregated_data_area'),
+                                 catalog_path=os.path.join(workdir, 'fin_traffic_catalog.sqlite'),
+                                 pipelined=pipelined)
+        return workdir
+
+    def _datafile(self, workdir, pattern):
+        paths = glob.glob(os.path.join(workdir, pattern))
+        self.assertEqual(len(paths), 1, paths)
+        return paths[0]
+
+    def test_pipelined_equals_sequential(self):
+        sequential = self._run('sequential', pipelined=False)
+        pipelined = self._run('pipelined', pipelined=True)
+        for pattern in ['aggregated_data_time/*.h5', 'aggregated_data_area/*.h5']:
+            with self.subTest(pattern=pattern):
+                assert_datafiles_equal(self, self._datafile(pipelined, pattern),
+                                       self._datafile(sequential, pattern))
+
+    def test_pipelined_extends_the_earlier_run(self):
+        end_date = datetime.date(2020, 3, 6)
+        sequential = self._run('sequential_extended', pipelined=False, end_date=end_date)
+        self._run('pipelined_extended', pipelined=True)
+        with self.assertLogs(__name__, level='INFO') as logs:
+            pipelined = self._run('pipelined_extended', pipelined=True, end_date=end_date)
+        self.assertTrue(any('Extending the time aggregated datafile' in line for line in logs.output))
+        for pattern in ['aggregated_data_time/*2020-03-06*.h5', 'aggregated_data_area/*2020-03-06*.h5']:
+            with self.subTest(pattern=pattern):
+                assert_datafiles_equal(self, self._datafile(pipelined, pattern),
+                                       self._datafile(sequential, pattern))
+
+    def test_interrupted_run_leaves_no_datafiles(self):
+        compute_edge_traffic = pipeline.compute_edge_traffic
+        calls = []
+
+        def interrupted(*args):
+            calls.append(args)
+            if len(calls) > 3:
+                raise KeyboardInterrupt()
+            return compute_edge_traffic(*args)
+
+        with mock.patch.object(pipeline, 'compute_edge_traffic', side_effect=interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self._run('interrupted', pipelined=True)
+        # Only the partial files of the edges computed before the interruption
+        workdir = os.path.join(self.tmpdir.name, 'interrupted')
+        for pattern in ['aggregated_data_time/*.h5', 'aggregated_data_area/*.h5']:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(glob.glob(os.path.join(workdir, pattern)), [])
+        self.assertEqual(len(glob.glob(os.path.join(workdir, 'aggregated_data_area/*.h5.partial'))), 1)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_runs_fetch_only_the_new_days(self):
+        end_dates = [datetime.date(2020, 3, day) for day in [4, 5, 5, 6, 6]]
+        sleeps = []
+        runs = []
+
+        def sleep_until(logger, wake_time):
+            sleeps.append(wake_time)
+            if len(sleeps) == 4:
+                raise KeyboardInterrupt()
+
+        def run(**kwargs):
+            # The first attempt of the third day fails
+            runs.append(kwargs['end_date'])
+            if runs.count(datetime.date(2020, 3, 6)) == 1:
+                raise RuntimeError('Server unavailable')
+
+        with tempfile.TemporaryDirectory(prefix='fin_traffic_test_') as tmpdir, \
+                mock.patch.object(schedule_complete_pipeline, '_latest_available_date', side_effect=end_dates), \
+                mock.patch.object(schedule_complete_pipeline, '_sleep_until', side_effect=sleep_until), \
+                mock.patch.object(schedule_complete_pipeline, '_retry_delay', return_value=0), \
+                mock.patch.object(schedule_complete_pipeline, 'get_tms_stations') as get_tms_stations, \
+                mock.patch.object(schedule_complete_pipeline, 'pinned_tms_stations'), \
+                mock.patch.object(schedule_complete_pipeline, 'fetch_tms_data_aggregate',
+                                  side_effect=run) as fetch:
+            with self.assertRaises(KeyboardInterrupt):
+                schedule_complete_pipeline.run_daemon(logger=logging.getLogger(__name__),
+                                                      begin_date=datetime.date(2020, 3, 2),
+                                                      results_dir_fetch=tmpdir,
+                                                      time_resolution=datetime.timedelta(hours=1),
+                                                      results_dir_aggregate=tmpdir,
+                                                      aggregation_level='province',
+                                                      results_dir_traffic=tmpdir,
+                                                      catalog_path=os.path.join(tmpdir, 'catalog.sqlite'))
+            catalog = fetch.call_args_list[0][1]['catalog']
+        # The first run checks the whole date range, the later ones the
+        # days from the completed date on, and the last week for late files
+        grace = datetime.timedelta(days=coverage._absent_grace_days)
+        self.assertEqual([(kwargs['end_date'], kwargs['fetch_from']) for _, kwargs in fetch.call_args_list],
+                         [(datetime.date(2020, 3, 4), None),
+                          (datetime.date(2020, 3, 5), datetime.date(2020, 3, 4) - grace),
+                          (datetime.date(2020, 3, 6), datetime.date(2020, 3, 5) - grace),
+                          (datetime.date(2020, 3, 6), datetime.date(2020, 3, 5) - grace)])
+        self.assertTrue(all(kwargs['catalog'] is catalog for _, kwargs in fetch.call_args_list))
+        # The station metadata is downloaded again only after the failure
+        self.assertEqual(get_tms_stations.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import datetime
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.aggregation import aggregate_datafiles
+from fin_traffic_data.prefix_sums import build_prefix_sum_index
+from fin_traffic_data.tests.helpers import get_test_tms_nums, write_test_raw_data
+
+
+class TestPrefixSumIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        cls.raw_data_files = write_test_raw_data(os.path.join(cls.tmpdir.name, 'raw_data'),
+                                                 datetime.date(2020, 3, 2), datetime.date(2020, 3, 6),
+                                                 days_per_file=2)
+        cls.tms_nums = get_test_tms_nums()
+        cls.time0 = datetime.datetime(2020, 3, 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def _aggregate(self, raw_data_files, delta_t, name):
+        results_dir = os.path.join(self.tmpdir.name, name)
+        os.makedirs(results_dir, exist_ok=True)
+        return aggregate_datafiles(raw_data_files, self.tms_nums, delta_t, results_dir)
+
+    def test_totals_equal_the_counts(self):
+        delta_t = datetime.timedelta(hours=1)
+        path = self._aggregate(self.raw_data_files, delta_t, 'totals')
+        index = build_prefix_sum_index(path, self.time0, datetime.datetime(2020, 3, 6), delta_t)
+        t0, t1 = datetime.datetime(2020, 3, 3, 5), datetime.datetime(2020, 3, 4, 17)
+        for tms_num in self.tms_nums:
+            with self.subTest(tms_num=tms_num):
+                df = pd.read_hdf(path, f'tms_{tms_num}')
+                df = df.loc[(df['time'] >= t0) & (df['time'] < t1) & (df['direction'] == 1)]
+                self.assertEqual(index.total(tms_num, t0, t1, direction=1), df['counts'].sum())
+
+    def test_extension_equals_fresh_build(self):
+        # The earlier datafile ends within a time bucket
+        for delta_t in [datetime.timedelta(hours=1), datetime.timedelta(hours=7)]:
+            with self.subTest(delta_t=delta_t):
+                earlier = self._aggregate(self.raw_data_files[:1], delta_t, f'earlier_{delta_t.seconds}')
+                build_prefix_sum_index(earlier, self.time0, datetime.datetime(2020, 3, 4), delta_t)
+                path = self._aggregate(self.raw_data_files, delta_t, f'extended_{delta_t.seconds}')
+                extended = build_prefix_sum_index(path, self.time0, datetime.datetime(2020, 3, 6), delta_t,
+                                                  extend_from=earlier)
+                fresh_path = self._aggregate(self.raw_data_files, delta_t, f'fresh_{delta_t.seconds}')
+                fresh = build_prefix_sum_index(fresh_path, self.time0, datetime.datetime(2020, 3, 6), delta_t)
+                self.assertEqual(extended.tms_nums, fresh.tms_nums)
+                np.testing.assert_array_equal(np.asarray(extended.cumsum), np.asarray(fresh.cumsum))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import io
+import os
+import glob
+import pstats
+import tempfile
+import unittest
+import contextlib
+import multiprocessing
+
+from fin_traffic_data.profiling import init_worker_profiling, profiled
+
+
+def _work(n):
+    return sum(i * i for i in range(n))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_cpu_profiles_of_the_parent_and_the_workers(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with profiled('cpu', self.tmpdir.name, 'test'):
+                with multiprocessing.Pool(2, initializer=init_worker_profiling) as pool:
+                    self.assertEqual(pool.map(_work, [100000] * 4), [_work(100000)] * 4)
+                    # The profiles of the workers are written when they exit
+                    pool.close()
+                    pool.join()
+        self.assertNotIn('FIN_TRAFFIC_PROFILE', os.environ)
+
+        basepath = os.path.join(self.tmpdir.name, f'test-{os.getpid()}')
+        worker_paths = sorted(glob.glob(os.path.join(self.tmpdir.name, 'test-worker-*.pstats')))
+        self.assertTrue(os.path.isfile(basepath + '.pstats'))
+        self.assertTrue(os.path.isfile(basepath + '.collapsed'))
+        self.assertGreaterEqual(len(worker_paths), 1)
+        for path in worker_paths:
+            with self.subTest(path=path):
+                self.assertTrue(os.path.isfile(path[:-len('.pstats')] + '.collapsed'))
+                self.assertIn('_work', [func[2] for func in pstats.Stats(path).stats])
+                with open(path[:-len('.pstats')] + '.collapsed', 'r') as f:
+                    stacks = f.read().splitlines()
+                # 'caller;callee microseconds' lines ending in the work function
+                self.assertTrue(any(';test_profiling.py:_work:' in line for line in stacks))
+                self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+
+if __name__ == '__main__':
+    unittest.main()
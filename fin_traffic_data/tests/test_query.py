@@ -0,0 +1,210 @@
+import os
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data import query
+from fin_traffic_data.query import ChunkCache, query_edges, query_stations
+
+_resolution = datetime.timedelta(hours=1)
+_begin = datetime.datetime(2020, 3, 2)
+_tms_nums = [101, 102]
+_edges = ['Uusimaa:Pirkanmaa', 'Pirkanmaa:Uusimaa']
+
+# Rows per chunk in the tests. Not a multiple of the 14 rows of a time of a
+# station, so the rows of a time are split over two chunks.
+_chunk_rows = 50
+
+
+def _write_time_aggregated_file(path, days, offset=0.0):
+    """Time aggregated datafile of the test stations over days from 2020-03-02."""
+    times = pd.date_range(_begin, _begin + datetime.timedelta(days=days), freq=_resolution, inclusive='left')
+    for num in _tms_nums:
+        pd.DataFrame({
+            'time': np.repeat(times.to_numpy(), 14),
+            'direction': np.tile(np.repeat([1, 2], 7), times.size),
+            'vehicle category': np.tile(np.arange(1, 8), 2 * times.size),
+            'counts': np.arange(14 * times.size, dtype=np.float64) + num + offset,
+        }).to_hdf(path, key=f'tms_{num}', format='table', data_columns=['time'])
+    return path
+
+
+def _write_area_aggregated_file(path, days):
+    """Area aggregated datafile of the test edges over days from 2020-03-02."""
+    times = pd.date_range(_begin, _begin + datetime.timedelta(days=days), freq=_resolution, inclusive='left')
+    for i, key in enumerate(_edges):
+        pd.DataFrame({
+            'time': np.repeat(times.to_numpy(), 7),
+            'vehicle category': np.tile(np.arange(1, 8), times.size),
+            'counts': np.arange(7 * times.size, dtype=np.float64) * (i + 1),
+        }).to_hdf(path, key=key, complevel=9, format='table')
+    return path
+
+
+def _time_mask(df, t0, t1):
+    mask = np.ones(len(df), dtype=bool)
+    if t0 is not None:
+        mask &= df['time'] >= t0
+    if t1 is not None:
+        mask &= df['time'] < t1
+    return mask
+
+
+def _expected_stations(path, t0, t1, directions=None, vehicle_categories=None):
+    """The rows of the stations read with pandas.read_hdf and filtered."""
+    frames = []
+    for num in _tms_nums:
+        df = pd.read_hdf(path, key=f'tms_{num}')
+        mask = _time_mask(df, t0, t1)
+        if directions is not None:
+            mask &= df['direction'].isin(directions)
+        if vehicle_categories is not None:
+            mask &= df['vehicle category'].isin(vehicle_categories)
+        df = df.loc[mask, ['time', 'direction', 'vehicle category', 'counts']]
+        df.insert(0, 'tms', num)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _expected_edges(path, t0, t1):
+    """The rows of the edges read with pandas.read_hdf and filtered."""
+    frames = []
+    for key in _edges:
+        df = pd.read_hdf(path, key=key)
+        df = df.loc[_time_mask(df, t0, t1), ['time', 'vehicle category', 'counts']]
+        df.insert(0, 'edge', key)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _cached_chunks(cache):
+    """Indices of the chunks in the cache."""
+    return sorted(key[3] for key in cache._entries if key[0] == 'chunk')
+
+
+class TestChunkCache(unittest.TestCase):
+
+    def test_least_recently_used_are_evicted(self):
+        cache = ChunkCache(max_bytes=300)
+        cache.put('a', 1, 100)
+        cache.put('b', 2, 100)
+        cache.put('c', 3, 100)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('d', 4, 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(key) for key in 'acd'], [1, 3, 4])
+        self.assertEqual(cache.nbytes, 300)
+
+        # Replacing a value accounts for the bytes of the new one
+        cache.put('a', 5, 200)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.get('c'), cache.get('a')), (None, 5))
+        self.assertEqual(cache.nbytes, 300)
+
+        # A value over the budget is not cached, and drops the earlier value of the key
+        cache.put('a', 6, 301)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.nbytes, 100)
+        self.assertEqual(cache.statistics(), {'entries': 1, 'bytes': 100, 'max_bytes': 300, 'hits': 5,
+                                              'misses': 3})
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        self.path = _write_time_aggregated_file(os.path.join(self.tmpdir.name, 'time.h5'), days=3)
+        self.area_path = _write_area_aggregated_file(os.path.join(self.tmpdir.name, 'area.h5'), days=3)
+        self.chunk_rows = mock.patch.object(query, '_chunk_rows', _chunk_rows)
+        self.chunk_rows.start()
+        # Times of the first rows of the chunks of a station
+        times = pd.read_hdf(self.path, key=f'tms_{_tms_nums[0]}')['time']
+        self.chunk_times = list(times.iloc[::_chunk_rows])
+
+    def tearDown(self):
+        self.chunk_rows.stop()
+        self.tmpdir.cleanup()
+
+    def _assert_stations_equal(self, cache, t0, t1, **kwargs):
+        pd.testing.assert_frame_equal(query_stations(self.path, _tms_nums, t0, t1, cache=cache, **kwargs),
+                                      _expected_stations(self.path, t0, t1, **kwargs))
+
+    def test_ranges_on_the_chunk_boundaries(self):
+        cache = ChunkCache()
+        resolution = pd.Timedelta(_resolution)
+        for i, boundary in enumerate(self.chunk_times[1:-1]):
+            ranges = [(boundary, boundary + 5 * resolution), (boundary - 5 * resolution, boundary),
+                      (boundary, self.chunk_times[i + 2]), (boundary - resolution, boundary + resolution),
+                      (boundary + resolution, boundary + 2 * resolution)]
+            for t0, t1 in ranges:
+                with self.subTest(t0=t0, t1=t1):
+                    self._assert_stations_equal(cache, t0, t1)
+                    pd.testing.assert_frame_equal(query_edges(self.area_path, _edges, t0, t1, cache=cache),
+                                                  _expected_edges(self.area_path, t0, t1))
+        # Also with the data read from the cache, and with the filters
+        t0, t1 = self.chunk_times[3], self.chunk_times[7]
+        self._assert_stations_equal(cache, t0, t1)
+        self._assert_stations_equal(cache, t0, t1, directions=[2], vehicle_categories=[1, 5])
+
+    def test_only_the_overlapping_chunks_are_read(self):
+        cache = ChunkCache()
+        t0, t1 = self.chunk_times[5], self.chunk_times[6] + pd.Timedelta(_resolution)
+        self._assert_stations_equal(cache, t0, t1)
+        # The chunk before the range may end with rows of the time t0
+        self.assertEqual(_cached_chunks(cache), sorted([4, 5, 6] * len(_tms_nums)))
+
+        cache = ChunkCache()
+        self._assert_stations_equal(cache, _begin, self.chunk_times[1])
+        self.assertEqual(_cached_chunks(cache), sorted([0] * len(_tms_nums)))
+        self._assert_stations_equal(cache, self.chunk_times[-1], _begin + datetime.timedelta(days=3))
+        num_chunks = len(self.chunk_times)
+        self.assertEqual(_cached_chunks(cache), sorted([0, num_chunks - 2, num_chunks - 1] * len(_tms_nums)))
+
+    def test_cache_smaller_than_a_chunk(self):
+        # The chunks are read but not cached
+        cache = ChunkCache(max_bytes=_chunk_rows * 8)
+        t0, t1 = self.chunk_times[2], self.chunk_times[9]
+        for _ in range(2):
+            self._assert_stations_equal(cache, t0, t1)
+            pd.testing.assert_frame_equal(query_edges(self.area_path, _edges, t0, t1, cache=cache),
+                                          _expected_edges(self.area_path, t0, t1))
+            self.assertEqual(_cached_chunks(cache), [])
+            self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+    def test_byte_budget_is_kept(self):
+        chunk_bytes = _chunk_rows * 4 * 8
+        cache = ChunkCache(max_bytes=3 * chunk_bytes + 20 * query._small_entry_bytes)
+        for i in range(len(self.chunk_times) - 1):
+            self._assert_stations_equal(cache, self.chunk_times[i], self.chunk_times[i + 1])
+            self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        # The least recently read chunks are evicted
+        self.assertNotIn(0, _cached_chunks(cache))
+        self.assertIn(len(self.chunk_times) - 2, _cached_chunks(cache))
+
+    def test_replaced_file_is_read_again(self):
+        cache = ChunkCache()
+        t0, t1 = self.chunk_times[1], self.chunk_times[4]
+        self._assert_stations_equal(cache, t0, t1)
+        mtime_ns = os.stat(self.path).st_mtime_ns
+
+        # Same size and times, other counts
+        partial_path = self.path + '.partial'
+        _write_time_aggregated_file(partial_path, days=3, offset=1000.0)
+        os.replace(partial_path, self.path)
+        os.utime(self.path, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+        self._assert_stations_equal(cache, t0, t1)
+
+        # A longer file
+        _write_time_aggregated_file(partial_path, days=4)
+        os.replace(partial_path, self.path)
+        t1 = _begin + datetime.timedelta(days=4)
+        self._assert_stations_equal(cache, t0, t1)
+        self._assert_stations_equal(cache, None, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data import regions
+from fin_traffic_data.aggregation import aggregate_datafiles
+from fin_traffic_data.borders import build_border_tables
+from fin_traffic_data.metadata import get_municipality_info
+from fin_traffic_data.regions import RegionFlowOperator, get_region_flow_operator
+from fin_traffic_data.registry import get_station_registry
+from fin_traffic_data.scripts.get_aggregated_traffic_between_areas import (
+    _read_tms_counts, compute_edge_traffic, parse_border_tms
+)
+from fin_traffic_data.synthetic import write_raw_data_file
+
+# Stations between municipalities chosen at random, the last one without raw data
+_tms_nums = list(range(101, 131))
+
+
+def _fixture_tms_stations(seed=2020):
+    """Station metadata as returned by get_tms_stations."""
+    rng = np.random.default_rng(seed)
+    municipalities = get_municipality_info().index.to_numpy()
+    return pd.DataFrame({
+            'id': [20000 + num for num in _tms_nums],
+            'num': _tms_nums,
+            'latitude': [24.9] * len(_tms_nums),
+            'longitude': [60.2] * len(_tms_nums),
+            'municipality': [91] * len(_tms_nums),
+            'province': [1] * len(_tms_nums),
+            'dir1': rng.choice(municipalities, len(_tms_nums)),
+            'dir2': rng.choice(municipalities, len(_tms_nums)),
+        },
+        index=_tms_nums)
+
+
+def _hcd_mapping(tms_stations):
+    """Municipality-to-region mapping with the hospital care districts as the regions."""
+    codes = get_municipality_info().index.to_numpy()
+    hcds = get_station_registry(tms_stations).municipality_hcd(codes)
+    return dict((int(code), hcd) for code, hcd in zip(codes, hcds) if hcd is not None)
+
+
+class TestRegionFlowOperator(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        cls.tms_stations = _fixture_tms_stations()
+        raw_data_path = write_raw_data_file(os.path.join(cls.tmpdir.name, 'raw_data'), _tms_nums[:-1],
+                                            datetime.date(2020, 3, 2), datetime.date(2020, 3, 4), 300)
+        results_dir = os.path.join(cls.tmpdir.name, 'aggregated')
+        os.makedirs(results_dir)
+        cls.inputfile = aggregate_datafiles([(raw_data_path, datetime.date(2020, 3, 2), datetime.date(2020, 3, 4))],
+                                            _tms_nums, datetime.timedelta(hours=7), results_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_hcd_regions_equal_the_hcd_edges(self):
+        operator = RegionFlowOperator.compile(_hcd_mapping(self.tms_stations), self.tms_stations)
+        frames = operator.apply_to_file(self.inputfile)
+        border_table = build_border_tables(self.tms_stations)['hcd']
+        self.assertEqual(sorted(frames.keys()),
+                         sorted(f"{row['source']}:{row['destination']}" for _, row in border_table.iterrows()))
+        with pd.HDFStore(self.inputfile, mode='r') as store:
+            for _, row in border_table.iterrows():
+                key = f"{row['source']}:{row['destination']}"
+                with self.subTest(edge=key):
+                    expected = compute_edge_traffic(parse_border_tms(row['tms']),
+                                                    lambda tms_num: _read_tms_counts(store, tms_num))
+                    pd.testing.assert_frame_equal(frames[key], expected.reset_index(drop=True), check_dtype=False)
+
+    def test_save_and_load(self):
+        operator = RegionFlowOperator.compile(_hcd_mapping(self.tms_stations), self.tms_stations)
+        path = os.path.join(self.tmpdir.name, 'operators', 'operator.npz')
+        operator.save(path)
+        loaded = RegionFlowOperator.load(path)
+        self.assertEqual(loaded.key, operator.key)
+        self.assertEqual(loaded.edges, operator.edges)
+        for name in ['tms_nums', 'directions', 'edge_index']:
+            np.testing.assert_array_equal(getattr(loaded, name), getattr(operator, name))
+        self.assertEqual((loaded.matrix != operator.matrix).nnz, 0)
+        self.assertIsNone(RegionFlowOperator.load(os.path.join(self.tmpdir.name, 'operators', 'missing.npz')))
+        with mock.patch.object(regions, '_operator_version', regions._operator_version + 1):
+            self.assertIsNone(RegionFlowOperator.load(path))
+
+    def test_compiled_once_per_mapping_and_metadata(self):
+        operator_dir = os.path.join(self.tmpdir.name, 'cached_operators')
+        mapping = {91: 'Helsinki', 49: 'Espoo', 92: 'Vantaa', 837: 'Tampere'}
+        other_stations = self.tms_stations.copy()
+        other_stations.loc[101, 'dir1'] = 91 if other_stations.loc[101, 'dir1'] != 91 else 49
+        with mock.patch.object(RegionFlowOperator, 'compile', wraps=RegionFlowOperator.compile) as compile:
+            operator = get_region_flow_operator(mapping, self.tms_stations, operator_dir)
+            # Municipalities by name
+            cached = get_region_flow_operator({'Helsinki': 'Helsinki', 'Espoo': 'Espoo', 'Vantaa': 'Vantaa',
+                                               'Tampere': 'Tampere'}, self.tms_stations, operator_dir)
+            self.assertEqual(compile.call_count, 1)
+            get_region_flow_operator({**mapping, 837: 'Helsinki'}, self.tms_stations, operator_dir)
+            self.assertEqual(compile.call_count, 2)
+            get_region_flow_operator(mapping, other_stations, operator_dir)
+            self.assertEqual(compile.call_count, 3)
+        self.assertEqual(cached.key, operator.key)
+        self.assertEqual(cached.edges, operator.edges)
+        self.assertEqual(len(os.listdir(operator_dir)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data.metadata import (get_municipality_info, get_neighbouring_municipalities_map,
+                                       get_tms_over_hcd_borders)
+from fin_traffic_data.registry import UNKNOWN, get_station_registry
+
+# Hospital care districts of municipalities whose district is not the one of
+# their region, and of some whose district is
+_known_hcds = {
+    'Helsinki': 'Helsinki-and-Uusimaa-Hospital-District',
+    'Kemi': 'Länsi-Pohja-Hospital-District',
+    'Pello': 'Länsi-Pohja-Hospital-District',
+    'Rovaniemi': 'Lappi-Hospital-District',
+    'Reisjärvi': 'Central-Ostrobothnia-Hospital-District',
+    'Kokkola': 'Central-Ostrobothnia-Hospital-District',
+    'Oulu': 'North-Ostrobothnia-Hospital-District',
+    'Savonlinna': 'Itä-Savo-Hospital-District',
+    'Mikkeli': 'South-Savo-Hospital-District',
+    'Vaasa': 'Vaasa-Hospital-District',
+    'Seinäjoki': 'South-Ostrobothnia-Hospital-District',
+    'Jyväskylä': 'Central-Finland-Hospital-District',
+    'Kajaani': 'Kainuu-Hospital-District',
+    'Maarianhamina': 'Åland',
+}
+
+
+def _tms_stations():
+    """Station metadata of two stations in Helsinki and Pello."""
+    return pd.DataFrame({'num': [101, 102], 'municipality': [91, 854], 'province': [1, 19]})
+
+
+class TestStationRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = get_station_registry(_tms_stations())
+        municipality_info = get_municipality_info()
+        self.municipality_codes = dict(zip(municipality_info['municipality'], municipality_info.index))
+
+    def test_hcds_of_known_municipalities(self):
+        names = list(_known_hcds)
+        hcds = self.registry.municipality_hcd([self.municipality_codes[name] for name in names])
+        self.assertEqual(dict(zip(names, hcds)), _known_hcds)
+        self.assertEqual(self.registry.station_hcd.tolist(),
+                         ['Helsinki-and-Uusimaa-Hospital-District', 'Länsi-Pohja-Hospital-District'])
+
+    def test_hcd_borders_of_the_border_table(self):
+        # Every pair of districts with stations over their border in
+        # tms_over_hcd_borders.csv has neighbouring municipalities in them
+        borders = set()
+        for municipality, neighbours in get_neighbouring_municipalities_map().items():
+            if municipality not in self.municipality_codes:
+                continue
+            codes = [self.municipality_codes[name] for name in neighbours if name in self.municipality_codes]
+            hcd = self.registry.municipality_hcd([self.municipality_codes[municipality]])[0]
+            borders.update((hcd, neighbour_hcd) for neighbour_hcd in self.registry.municipality_hcd(codes)
+                           if neighbour_hcd != hcd)
+        border_table = get_tms_over_hcd_borders()
+        for source, destination in set(zip(border_table['source'], border_table['destination'])):
+            with self.subTest(source=source, destination=destination):
+                self.assertIn((source, destination), borders)
+
+    def test_ely_ids(self):
+        np.testing.assert_array_equal(self.registry.ely_ids([102, 101, 999]), [14, 1, UNKNOWN])
+        self.assertEqual(self.registry.station_ely_ids(), {101: 1, 102: 14})
+
+
+if __name__ == '__main__':
+    unittest.main()
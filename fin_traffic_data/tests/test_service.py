@@ -0,0 +1,132 @@
+import io
+import os
+import asyncio
+import logging
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from fin_traffic_data import service as service_module
+from fin_traffic_data.aggregation import get_aggregated_file_path
+from fin_traffic_data.catalog import DatasetCatalog
+from fin_traffic_data.query import ChunkCache
+from fin_traffic_data.service import QueryError, QueryService, resolve_datasets
+
+_resolution = datetime.timedelta(hours=1)
+_begin = datetime.datetime(2020, 3, 2)
+
+
+def _write_time_aggregated_file(results_dir, days, tms_nums=(101, 102)):
+    """Time aggregated datafile of the stations over days from 2020-03-02."""
+    end = _begin + datetime.timedelta(days=days)
+    path = get_aggregated_file_path(results_dir, _begin, end, _resolution)
+    times = pd.date_range(_begin, end, freq=_resolution, inclusive='left')
+    for num in tms_nums:
+        pd.DataFrame({
+            'time': np.repeat(times.to_numpy(), 14),
+            'direction': np.tile(np.repeat([1, 2], 7), times.size),
+            'vehicle category': np.tile(np.arange(1, 8), 2 * times.size),
+            'counts': np.arange(14 * times.size, dtype=np.float64) + num,
+        }).to_hdf(path, key=f'tms_{num}', format='table', data_columns=['time'])
+    return path, end.date()
+
+
+class TestQueryService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fin_traffic_test_')
+        self.catalog_path = os.path.join(self.tmpdir.name, 'catalog.sqlite')
+        self.catalog = DatasetCatalog(self.catalog_path)
+        self.path = self._publish(days=2)
+        self.service = QueryService(logging.getLogger(__name__), self.catalog_path, _resolution,
+                                    cache=ChunkCache(2**24), threads=2)
+
+    def tearDown(self):
+        self.service._executor.shutdown(wait=True)
+        self.catalog.close()
+        self.tmpdir.cleanup()
+
+    def _publish(self, days):
+        path, end_date = _write_time_aggregated_file(self.tmpdir.name, days)
+        self.catalog.register('time', path, _begin.date(), end_date, resolution=_resolution)
+        return os.path.abspath(path)
+
+    def _run(self, coroutine):
+        async def run():
+            await self.service.reload(force=True)
+            return await coroutine()
+        return asyncio.run(run())
+
+    def _query(self, tms='101'):
+        return self.service.query('/stations', {'tms': [tms], 'begin': ['2020-03-02T05:00'],
+                                                'end': ['2020-03-03'], 'format': ['csv']})
+
+    def test_identical_queries_are_coalesced(self):
+        with mock.patch.object(service_module, 'query_stations',
+                               wraps=service_module.query_stations) as query_stations:
+            results = self._run(lambda: asyncio.gather(self._query(), self._query(), self._query('102')))
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[0], results[2])
+        self.assertEqual(query_stations.call_count, 2)
+        self.assertEqual(self.service.counters['queries'], 2)
+        self.assertEqual(self.service.counters['coalesced'], 1)
+
+    def test_repeated_query_is_answered_from_the_cache(self):
+        async def query_twice():
+            first = await self._query()
+            misses = self.service.cache.misses
+            with mock.patch.object(pd, 'HDFStore') as hdf_store:
+                second = await self._query()
+            hdf_store.assert_not_called()
+            self.assertEqual(self.service.cache.misses, misses)
+            return first, second
+
+        (body, content_type), (cached_body, _) = self._run(query_twice)
+        self.assertEqual(content_type, 'text/csv')
+        self.assertEqual(cached_body, body)
+        df = pd.read_csv(io.StringIO(body.decode('utf-8')), parse_dates=['time'])
+        expected = pd.read_hdf(self.path, 'tms_101')
+        expected = expected[(expected['time'] >= '2020-03-02 05:00') & (expected['time'] < '2020-03-03')]
+        np.testing.assert_array_equal(df['counts'].to_numpy(), expected['counts'].to_numpy())
+        self.assertGreater(self.service.cache.hits, 0)
+
+    def test_reload_on_catalog_change(self):
+        async def reload():
+            self.assertFalse(await self.service.reload())
+            newer = self._publish(days=3)
+            self.assertTrue(await self.service.reload())
+            return newer
+
+        newer = self._run(reload)
+        self.assertEqual(self.service.datasets['time'][0], newer)
+        self.assertEqual(self.service.counters['reloads'], 2)
+
+    def test_removed_datafile_is_answered_with_503(self):
+        async def query_removed():
+            os.remove(self.path)
+            with self.assertRaises(QueryError) as cm:
+                await self.service._respond('GET', '/stations?tms=101')
+            return cm.exception
+
+        self.assertEqual(self._run(query_removed).status, 503)
+        # The read-only lookups of the service leave the record in the catalog
+        self.assertIsNone(resolve_datasets(self.catalog_path, _resolution)['time'])
+        self.assertEqual(self.catalog.connection.execute("SELECT COUNT(*) FROM datasets").fetchone()[0], 1)
+
+    def test_lookups_do_not_wait_for_the_writer(self):
+        os.remove(self._publish(days=3))
+        # The pipeline holding the write lock of the catalog
+        self.catalog.connection.execute("BEGIN IMMEDIATE")
+        try:
+            datasets = resolve_datasets(self.catalog_path, _resolution)
+        finally:
+            self.catalog.connection.rollback()
+        self.assertEqual(datasets['time'][0], self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import datetime
+import unittest
+
+import pandas as pd
+
+from fin_traffic_data.raw_data import parse_tms_raw_data
+from fin_traffic_data.synthetic import generate_lamraw_text, generate_raw_data_frame
+from fin_traffic_data.utils import daterange
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def setUp(self):
+        self.tms_num = 101
+        self.begin_date = datetime.date(2020, 3, 1)
+        self.end_date = datetime.date(2020, 3, 4)
+
+    def test_lamraw_text_is_stable(self):
+        text = generate_lamraw_text(self.tms_num, self.begin_date, vehicles_per_day=500, seed=1)
+        self.assertEqual(generate_lamraw_text(self.tms_num, self.begin_date, vehicles_per_day=500, seed=1), text)
+        self.assertNotEqual(generate_lamraw_text(self.tms_num, self.begin_date, vehicles_per_day=500, seed=2), text)
+        self.assertNotEqual(generate_lamraw_text(self.tms_num + 1, self.begin_date, vehicles_per_day=500, seed=1),
+                            text)
+        self.assertNotEqual(generate_lamraw_text(self.tms_num, self.end_date, vehicles_per_day=500, seed=1), text)
+
+    def test_parsed_lamraw_texts_are_the_raw_data_frame(self):
+        frames = [parse_tms_raw_data(generate_lamraw_text(self.tms_num, date, vehicles_per_day=500, seed=1))
+                  for date in daterange(self.begin_date, self.end_date)]
+        parsed = pd.concat(frames, ignore_index=True)
+        df = generate_raw_data_frame(self.tms_num, self.begin_date, self.end_date, vehicles_per_day=500, seed=1)
+        self.assertIsNotNone(df)
+        pd.testing.assert_frame_equal(parsed, df)
+
+
+if __name__ == '__main__':
+    unittest.main()
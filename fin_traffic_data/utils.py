@@ -1,5 +1,6 @@
+import re
 import datetime
-from typing import Iterator, Tuple
+from typing import Iterator, Text, Tuple
 
 
 def daterange(start_date: datetime.date,
@@ -27,3 +28,32 @@ def compute_daterange_overlap(dr1_begin, dr1_end, dr2_begin, dr2_end):
     rng1 = set(daterange(dr1_begin, dr1_end))
     rng2 = set(daterange(dr2_begin, dr2_end))
     return list(rng1.intersection(rng2))
+
+
+def parse_time_resolution(x: Text) -> datetime.timedelta:
+    """Parse human-readable input of time resolution, e.g. '1h' or '1d12h'"""
+    m = re.findall(r"(?P<num>\d+)(?P<qualif>w|d|h|m|s)", x)
+    dt = datetime.timedelta()
+    for obj in m:
+        if obj[1] == 'w':
+            dt += datetime.timedelta(days=int(obj[0])*7)
+        elif obj[1] == 'd':
+            dt += datetime.timedelta(days=int(obj[0]))
+        elif obj[1] == 'h':
+            dt += datetime.timedelta(hours=int(obj[0]))
+        elif obj[1] == 'm':
+            dt += datetime.timedelta(minutes=int(obj[0]))
+        elif obj[1] == 's':
+            dt += datetime.timedelta(seconds=int(obj[0]))
+        else:
+            raise ValueError(f"Unknown literal '{obj[1]}'")
+    return dt
+
+
+def parse_memory_size(x: Text) -> int:
+    """Parse human-readable input of a memory size in bytes, e.g. '512M' or '4G'"""
+    m = re.match(r"^(?P<num>\d+(\.\d*)?)(?P<qualif>[kKmMgGtT]?)[bB]?$", x.strip())
+    if not m:
+        raise ValueError(f"Invalid memory size '{x}'")
+    exponent = ' kmgt'.index(m.group('qualif').lower() or ' ')
+    return int(float(m.group('num')) * 1024**exponent)
@@ -52,9 +52,17 @@ setup(
             'fin-traffic-fetch-raw-data = fin_traffic_data.scripts.fetch_raw_data:main',
             'fin-traffic-aggregate-raw-data = fin_traffic_data.scripts.aggregate_raw_data:main',
             'fin-traffic-compute-traffic-between-areas = fin_traffic_data.scripts.get_aggregated_traffic_between_areas:main',
+            'fin-traffic-compute-traffic-between-regions = fin_traffic_data.scripts.get_aggregated_traffic_between_regions:main',
             'fin-traffic-export-traffic-between-areas-to-csv = fin_traffic_data.scripts.export_area_data_as_csv:main',
             'fin-traffic-complete_pipeline = fin_traffic_data.scripts.complete_pipeline:main',
-            'fin-traffic-schedule-complete_pipeline = fin_traffic_data.scripts.schedule_complete_pipeline:main'
+            'fin-traffic-schedule-complete_pipeline = fin_traffic_data.scripts.schedule_complete_pipeline:main',
+            'fin-traffic-tail-raw-data = fin_traffic_data.scripts.tail_raw_data:main',
+            'fin-traffic-build-border-tables = fin_traffic_data.scripts.build_border_tables:main',
+            'fin-traffic-serve-queries = fin_traffic_data.scripts.serve_queries:main',
+            'fin-traffic-benchmark = fin_traffic_data.scripts.run_benchmarks:main',
+            'fin-traffic-mock-server = fin_traffic_data.scripts.mock_server:main',
+            'fin-traffic-load-test = fin_traffic_data.scripts.load_test:main',
+            'fin-traffic-compact-raw-data = fin_traffic_data.scripts.compact_raw_data:main'
         ]
     },
     install_requires=get_requirements(),